@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+# Key/value cache memory benchmark
+#
+# This tool measures the memory held by the key/value cache of `generate` with the default cache and with the
+# quantized caches, along with the generation throughput, and prints a report in github format:
+#
+#     ./kv-cache-memory-benchmark.py --model gpt2 --batch-size 8 --prompt-length 512 --max-new-tokens 128
+#
+# The cache size is the largest size of `past_key_values` recorded by `GenerationProfiler` along the generation, i.e.
+# what the cache holds between two decoding steps. The quantized caches also allocate the dequantized states of one
+# layer at a time during the forward passes, which is not part of it.
+#
+# Variations are selected with --variations, e.g. `--variations default int8` (by default, all of them are run).
+
+import argparse
+import time
+
+import torch
+
+from transformers import AutoModelForCausalLM, GenerationProfiler
+
+
+VARIATIONS = {
+    "default": {},
+    "int8": {"cache_implementation": "quantized", "cache_nbits": 8},
+    "int4": {"cache_implementation": "quantized", "cache_nbits": 4},
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="gpt2", type=str, help="The model to benchmark")
+    parser.add_argument("--batch-size", default=8, type=int)
+    parser.add_argument("--prompt-length", default=512, type=int)
+    parser.add_argument("--max-new-tokens", default=128, type=int)
+    parser.add_argument("--residual-length", default=32, type=int, help="Tokens kept in full precision")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+    parser.add_argument("--variations", nargs="+", default=list(VARIATIONS), choices=list(VARIATIONS))
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=getattr(torch, args.dtype)).to(args.device)
+    model.eval()
+    model.generation_config.pad_token_id = model.generation_config.eos_token_id
+    torch.manual_seed(0)
+    input_ids = torch.randint(
+        0, model.config.vocab_size, (args.batch_size, args.prompt_length), device=args.device, dtype=torch.long
+    )
+
+    results = []
+    for name in args.variations:
+        profiler = GenerationProfiler()
+        start = time.perf_counter()
+        model.generate(
+            input_ids,
+            do_sample=False,
+            max_new_tokens=args.max_new_tokens,
+            min_new_tokens=args.max_new_tokens,
+            cache_residual_length=args.residual_length,
+            profiler=profiler,
+            **VARIATIONS[name],
+        )
+        duration = time.perf_counter() - start
+        summary = profiler.summary()
+        results.append((name, summary["max_past_key_values_bytes"], summary["tokens_per_second"], duration))
+
+    default_bytes = {name: num_bytes for name, num_bytes, _, _ in results}.get("default")
+    print(
+        f"*** {args.model}, {args.dtype}, batch size {args.batch_size}, prompt length {args.prompt_length}, "
+        f"{args.max_new_tokens} new tokens\n"
+    )
+    print("| cache | KV cache (MiB) | vs default | tokens/s per sequence | total time (s) |")
+    print("|:------|---------------:|-----------:|----------------------:|---------------:|")
+    for name, num_bytes, tokens_per_second, duration in results:
+        ratio = f"{num_bytes / default_bytes:.2f}" if default_bytes else "-"
+        print(f"| {name} | {num_bytes / 2**20:.1f} | {ratio} | {tokens_per_second:.1f} | {duration:.2f} |")
+
+
+if __name__ == "__main__":
+    main()
@@ -96,7 +96,7 @@ _import_structure = {
     "feature_extraction_sequence_utils": ["SequenceFeatureExtractor"],
     "feature_extraction_utils": ["BatchFeature", "FeatureExtractionMixin"],
     "file_utils": [],
-    "generation": ["GenerationConfig", "TextIteratorStreamer", "TextStreamer"],
+    "generation": ["AsyncTextIteratorStreamer", "GenerationConfig", "TextIteratorStreamer", "TextStreamer"],
     "hf_argparser": ["HfArgumentParser"],
     "hyperparameter_search": [],
     "image_transforms": [],
@@ -975,6 +975,7 @@ else:
     _import_structure["activations"] = []
     _import_structure["benchmark.benchmark"] = ["PyTorchBenchmark"]
     _import_structure["benchmark.benchmark_args"] = ["PyTorchBenchmarkArguments"]
+    _import_structure["cache_utils"] = ["Cache", "PagedCache", "QuantizedCache", "SinkCache", "StaticCache"]
     _import_structure["data.datasets"] = [
         "GlueDataset",
         "GlueDataTrainingArguments",
@@ -994,15 +995,19 @@ else:
             "ConstrainedBeamSearchScorer",
             "Constraint",
             "ConstraintListState",
+            "ContinuousBatchingEngine",
             "DisjunctiveConstraint",
             "ForcedBOSTokenLogitsProcessor",
             "ForcedEOSTokenLogitsProcessor",
             "GenerationMixin",
+            "GenerationProfiler",
+            "GenerationResultCache",
             "HammingDiversityLogitsProcessor",
             "InfNanRemoveLogitsProcessor",
             "LogitsProcessor",
             "LogitsProcessorList",
             "LogitsWarper",
+            "LRUGenerationResultCache",
             "MaxLengthCriteria",
             "MaxTimeCriteria",
             "MinLengthLogitsProcessor",
@@ -1010,9 +1015,12 @@ else:
             "NoBadWordsLogitsProcessor",
             "NoRepeatNGramLogitsProcessor",
             "PhrasalConstraint",
+            "PrefixCache",
             "PrefixConstrainedLogitsProcessor",
+            "RegexLogitsProcessor",
             "RepetitionPenaltyLogitsProcessor",
             "SequenceBiasLogitsProcessor",
+            "SQLiteGenerationResultCache",
             "StoppingCriteria",
             "StoppingCriteriaList",
             "TemperatureLogitsWarper",
@@ -4098,7 +4106,7 @@ if TYPE_CHECKING:
     from .feature_extraction_utils import BatchFeature, FeatureExtractionMixin
 
     # Generation
-    from .generation import GenerationConfig, TextIteratorStreamer, TextStreamer
+    from .generation import AsyncTextIteratorStreamer, GenerationConfig, TextIteratorStreamer, TextStreamer
     from .hf_argparser import HfArgumentParser
 
     # Integrations
@@ -4900,6 +4908,7 @@ if TYPE_CHECKING:
         # Benchmarks
         from .benchmark.benchmark import PyTorchBenchmark
         from .benchmark.benchmark_args import PyTorchBenchmarkArguments
+        from .cache_utils import Cache, PagedCache, QuantizedCache, SinkCache, StaticCache
         from .data.datasets import (
             GlueDataset,
             GlueDataTrainingArguments,
@@ -4917,15 +4926,19 @@ if TYPE_CHECKING:
             ConstrainedBeamSearchScorer,
             Constraint,
             ConstraintListState,
+            ContinuousBatchingEngine,
             DisjunctiveConstraint,
             ForcedBOSTokenLogitsProcessor,
             ForcedEOSTokenLogitsProcessor,
             GenerationMixin,
+            GenerationProfiler,
+            GenerationResultCache,
             HammingDiversityLogitsProcessor,
             InfNanRemoveLogitsProcessor,
             LogitsProcessor,
             LogitsProcessorList,
             LogitsWarper,
+            LRUGenerationResultCache,
             MaxLengthCriteria,
             MaxTimeCriteria,
             MinLengthLogitsProcessor,
@@ -4933,9 +4946,12 @@ if TYPE_CHECKING:
             NoBadWordsLogitsProcessor,
             NoRepeatNGramLogitsProcessor,
             PhrasalConstraint,
+            PrefixCache,
             PrefixConstrainedLogitsProcessor,
+            RegexLogitsProcessor,
             RepetitionPenaltyLogitsProcessor,
             SequenceBiasLogitsProcessor,
+            SQLiteGenerationResultCache,
             StoppingCriteria,
             StoppingCriteriaList,
             TemperatureLogitsWarper,
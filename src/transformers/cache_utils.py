@@ -0,0 +1,748 @@
+# coding=utf-8
+# Copyright 2023 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Key/value cache objects that can be passed as `past_key_values` to the models that support them, as an alternative to
+the legacy tuple-of-tuples format.
+"""
+import math
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+
+class Cache:
+    """
+    Base, abstract class for all key/value caches. A cache holds the key and value states of every decoder layer and
+    is updated in place by the attention layers, instead of being rebuilt and returned at every forward pass.
+
+    A cache is falsy while it holds no tokens, so that the `if past_key_values:` checks used in
+    `prepare_inputs_for_generation` behave the same way for empty caches and for `None`.
+    """
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Updates the cache with the new `key_states` and `value_states` for the layer `layer_idx`.
+
+        Parameters:
+            key_states (`torch.Tensor`):
+                The new key states to cache, of shape `(batch_size, num_heads, seq_len, head_dim)`.
+            value_states (`torch.Tensor`):
+                The new value states to cache, of shape `(batch_size, num_heads, seq_len, head_dim)`.
+            layer_idx (`int`):
+                The index of the layer to cache the states for.
+            cache_kwargs (`Dict[str, Any]`, *optional*):
+                Additional arguments for the cache subclass.
+
+        Return:
+            A tuple containing the key and value states of all the tokens cached so far for the layer, including the
+            new ones.
+        """
+        raise NotImplementedError("Make sure to implement `update` in a subclass.")
+
+    def get_seq_length(self, layer_idx: int = 0) -> int:
+        """Returns the number of tokens cached for the layer `layer_idx`."""
+        raise NotImplementedError("Make sure to implement `get_seq_length` in a subclass.")
+
+    def get_max_length(self) -> Optional[int]:
+        """Returns the maximum number of tokens the cache can hold, or `None` if it is unbounded."""
+        raise NotImplementedError("Make sure to implement `get_max_length` in a subclass.")
+
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        """
+        Reorders the batch dimension of the cache in place, following `beam_idx` (used by beam search). `beam_idx` may
+        select a different number of rows than the cache holds (used by the draft branches of assisted generation).
+        """
+        raise NotImplementedError("Make sure to implement `reorder_cache` in a subclass.")
+
+    def crop(self, max_length: int):
+        """Discards all cached tokens beyond `max_length` (used by assisted generation)."""
+        raise NotImplementedError("Make sure to implement `crop` in a subclass.")
+
+    def expand_batch(self, expand_size: int):
+        """
+        Repeats each row of the batch `expand_size` times, like `repeat_interleave` (used when expanding the inputs
+        for beam search or `num_return_sequences`).
+        """
+        raise NotImplementedError("Make sure to implement `expand_batch` in a subclass.")
+
+    def to_legacy_cache(self) -> Tuple[Tuple[torch.Tensor, torch.Tensor]]:
+        """Returns the cache contents in the legacy tuple-of-tuples format."""
+        raise NotImplementedError("Make sure to implement `to_legacy_cache` in a subclass.")
+
+    def __bool__(self) -> bool:
+        return self.get_seq_length() > 0
+
+
+class StaticCache(Cache):
+    """
+    Key/value cache whose per-layer buffers are allocated once, up to `max_cache_len` tokens, and then filled in place
+    by index. Compared to the legacy format, where every decoding step concatenates the new states to the past ones,
+    this avoids a fresh allocation and a full copy of the cache per layer and per generated token.
+
+    The buffers are allocated lazily, on the first `update` of each layer, so that the cache does not need to know the
+    batch size, number of heads or head dimension of the model in advance. `update` returns views over the filled
+    part of the buffers, so the attention layers see exactly the same shapes as with the legacy format.
+
+    Args:
+        max_cache_len (`int`):
+            The maximum number of tokens that can be cached, typically the `max_length` of the generation.
+
+    Example:
+
+    ```python
+    >>> from transformers import AutoTokenizer, AutoModelForCausalLM, StaticCache
+
+    >>> tokenizer = AutoTokenizer.from_pretrained("gpt2")
+    >>> model = AutoModelForCausalLM.from_pretrained("gpt2")
+    >>> inputs = tokenizer(["The quick brown fox"], return_tensors="pt")
+
+    >>> # `generate` can build the cache itself with `cache_implementation="static"`, or use the one it is given
+    >>> past_key_values = StaticCache(max_cache_len=inputs.input_ids.shape[1] + 10)
+    >>> outputs = model.generate(**inputs, max_new_tokens=10, past_key_values=past_key_values)
+    ```
+    """
+
+    def __init__(self, max_cache_len: int):
+        self.max_cache_len = max_cache_len
+        self.key_cache: List[Optional[torch.Tensor]] = []
+        self.value_cache: List[Optional[torch.Tensor]] = []
+        self._seq_lengths: List[int] = []
+
+    def _allocate_layer(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int):
+        while len(self.key_cache) <= layer_idx:
+            self.key_cache.append(None)
+            self.value_cache.append(None)
+            self._seq_lengths.append(0)
+
+        batch_size, num_heads, _, key_dim = key_states.shape
+        value_dim = value_states.shape[-1]
+        self.key_cache[layer_idx] = key_states.new_zeros((batch_size, num_heads, self.max_cache_len, key_dim))
+        self.value_cache[layer_idx] = value_states.new_zeros((batch_size, num_heads, self.max_cache_len, value_dim))
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if len(self.key_cache) <= layer_idx or self.key_cache[layer_idx] is None:
+            self._allocate_layer(key_states, value_states, layer_idx)
+
+        key_cache = self.key_cache[layer_idx]
+        value_cache = self.value_cache[layer_idx]
+        if key_states.shape[0] != key_cache.shape[0]:
+            raise ValueError(
+                f"The cache was allocated for a batch size of {key_cache.shape[0]}, but got key states with a batch "
+                f"size of {key_states.shape[0]}."
+            )
+
+        start = self._seq_lengths[layer_idx]
+        end = start + key_states.shape[-2]
+        if end > self.max_cache_len:
+            raise ValueError(
+                f"Cannot cache {end} tokens in a `StaticCache` with `max_cache_len={self.max_cache_len}`. Increase "
+                "`max_cache_len` so that it covers the prompt and all the generated tokens."
+            )
+
+        key_cache[:, :, start:end] = key_states
+        value_cache[:, :, start:end] = value_states
+        self._seq_lengths[layer_idx] = end
+        return key_cache[:, :, :end], value_cache[:, :, :end]
+
+    def get_seq_length(self, layer_idx: int = 0) -> int:
+        if len(self._seq_lengths) <= layer_idx:
+            return 0
+        return self._seq_lengths[layer_idx]
+
+    def get_max_length(self) -> Optional[int]:
+        return self.max_cache_len
+
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        for layer_idx in range(len(self.key_cache)):
+            if self.key_cache[layer_idx] is None:
+                continue
+            length = self._seq_lengths[layer_idx]
+            device = self.key_cache[layer_idx].device
+            layer_beam_idx = beam_idx.to(device)
+            if layer_beam_idx.shape[0] != self.key_cache[layer_idx].shape[0]:
+                # the batch size changes (e.g. with the branches of assisted decoding): the buffers are reallocated
+                self.key_cache[layer_idx] = self.key_cache[layer_idx].index_select(0, layer_beam_idx)
+                self.value_cache[layer_idx] = self.value_cache[layer_idx].index_select(0, layer_beam_idx)
+                continue
+            self.key_cache[layer_idx][:, :, :length] = self.key_cache[layer_idx][:, :, :length].index_select(
+                0, layer_beam_idx
+            )
+            self.value_cache[layer_idx][:, :, :length] = self.value_cache[layer_idx][:, :, :length].index_select(
+                0, layer_beam_idx
+            )
+
+    def crop(self, max_length: int):
+        # the stale entries beyond `max_length` are simply overwritten by the next updates
+        self._seq_lengths = [min(length, max_length) for length in self._seq_lengths]
+
+    def expand_batch(self, expand_size: int):
+        # empty layers are allocated lazily, with the expanded batch size
+        for layer_idx in range(len(self.key_cache)):
+            if self.key_cache[layer_idx] is not None:
+                self.key_cache[layer_idx] = self.key_cache[layer_idx].repeat_interleave(expand_size, dim=0)
+                self.value_cache[layer_idx] = self.value_cache[layer_idx].repeat_interleave(expand_size, dim=0)
+
+    def reset(self):
+        """Marks the cache as empty, keeping the allocated buffers so that it can be reused by another generation."""
+        self._seq_lengths = [0 for _ in self._seq_lengths]
+
+    def to_legacy_cache(self) -> Tuple[Tuple[torch.Tensor, torch.Tensor]]:
+        legacy_cache = ()
+        for layer_idx in range(len(self.key_cache)):
+            length = self._seq_lengths[layer_idx]
+            legacy_cache += ((self.key_cache[layer_idx][:, :, :length], self.value_cache[layer_idx][:, :, :length]),)
+        return legacy_cache
+
+
+class PagedCache(Cache):
+    """
+    Key/value cache whose tokens are stored in fixed-size blocks drawn from a pool shared by all the sequences of the
+    batch, each sequence holding a block table (the list of its blocks). Blocks are reference counted, so that
+    sequences can share them:
+
+        - reordering the batch (beam search) or expanding it (`num_return_sequences`, beams) only rewrites the block
+          tables, instead of copying the whole cache;
+        - a shared block is copied the first time one of its sequences writes into it (copy-on-write), which only
+          happens for the last, partially filled, block of a sequence.
+
+    When the cache is expanded before it holds any token, the prompts of a group of expanded rows are stored once and
+    their blocks shared by the whole group.
+
+    The pool is allocated lazily, on the first `update` of each layer, and grows when it runs out of free blocks.
+    `update` gathers the blocks of each sequence, so the attention layers see the same tensors as with the legacy
+    format.
+
+    Args:
+        block_size (`int`, *optional*, defaults to 16):
+            The number of tokens held by each block.
+        num_blocks (`int`, *optional*):
+            The initial number of blocks of the pool. Defaults to what the first update requires, plus one spare block
+            per sequence.
+    """
+
+    def __init__(self, block_size: int = 16, num_blocks: Optional[int] = None):
+        self.block_size = block_size
+        self.num_blocks = num_blocks
+        self.key_pool: List[torch.Tensor] = []
+        self.value_pool: List[torch.Tensor] = []
+        self.block_tables: List[List[int]] = []
+        self._ref_counts: List[int] = []
+        self._free_blocks: List[int] = []
+        self._seq_lengths: List[int] = []
+        # number of consecutive rows holding the same prompt, set when expanding the empty cache
+        self._num_shared_rows = 1
+        # block ids and offsets of the tokens written at the current step, and block table tensor, shared by all layers
+        self._slot_mapping: Optional[Tuple[int, torch.LongTensor, torch.LongTensor]] = None
+        self._block_table_tensor: Optional[torch.LongTensor] = None
+
+    @property
+    def num_used_blocks(self) -> int:
+        """The number of blocks referenced by at least one sequence."""
+        return sum(1 for ref_count in self._ref_counts if ref_count > 0)
+
+    def _allocate_layer(self, key_states: torch.Tensor, value_states: torch.Tensor):
+        _, num_heads, _, key_dim = key_states.shape
+        value_dim = value_states.shape[-1]
+        self.key_pool.append(key_states.new_zeros((self.num_blocks, num_heads, self.block_size, key_dim)))
+        self.value_pool.append(value_states.new_zeros((self.num_blocks, num_heads, self.block_size, value_dim)))
+        self._seq_lengths.append(0)
+
+    def _grow_pool(self):
+        num_new_blocks = self.num_blocks
+        for layer_idx in range(len(self.key_pool)):
+            self.key_pool[layer_idx] = torch.cat(
+                [self.key_pool[layer_idx], torch.zeros_like(self.key_pool[layer_idx][:num_new_blocks])]
+            )
+            self.value_pool[layer_idx] = torch.cat(
+                [self.value_pool[layer_idx], torch.zeros_like(self.value_pool[layer_idx][:num_new_blocks])]
+            )
+        self._ref_counts.extend([0] * num_new_blocks)
+        self._free_blocks.extend(range(self.num_blocks + num_new_blocks - 1, self.num_blocks - 1, -1))
+        self.num_blocks += num_new_blocks
+
+    def _allocate_block(self) -> int:
+        if len(self._free_blocks) == 0:
+            self._grow_pool()
+        block_id = self._free_blocks.pop()
+        self._ref_counts[block_id] = 1
+        return block_id
+
+    def _release_block(self, block_id: int):
+        self._ref_counts[block_id] -= 1
+        if self._ref_counts[block_id] == 0:
+            self._free_blocks.append(block_id)
+
+    def _copy_on_write(self, block_id: int) -> int:
+        new_block_id = self._allocate_block()
+        for layer_idx in range(len(self.key_pool)):
+            self.key_pool[layer_idx][new_block_id] = self.key_pool[layer_idx][block_id]
+            self.value_pool[layer_idx][new_block_id] = self.value_pool[layer_idx][block_id]
+        self._release_block(block_id)
+        return new_block_id
+
+    def _reserve_slots(self, batch_size: int, start: int, end: int, device: torch.device):
+        """Makes sure each sequence owns the blocks covering the positions `[start, end)`, and maps them to slots."""
+        if len(self.block_tables) == 0:
+            self.block_tables = [[] for _ in range(batch_size)]
+        if len(self.block_tables) != batch_size:
+            raise ValueError(
+                f"The cache holds {len(self.block_tables)} sequences, but got key states with a batch size of "
+                f"{batch_size}."
+            )
+
+        first_block, last_block = start // self.block_size, (end - 1) // self.block_size
+        for row, block_table in enumerate(self.block_tables):
+            if row % self._num_shared_rows != 0:
+                continue
+            for block_idx in range(first_block, last_block + 1):
+                if block_idx == len(block_table):
+                    block_table.append(self._allocate_block())
+                elif self._ref_counts[block_table[block_idx]] > 1:
+                    block_table[block_idx] = self._copy_on_write(block_table[block_idx])
+
+        if self._num_shared_rows > 1:
+            # the prompt of each group of expanded rows is stored once, in the blocks of the first row of the group
+            for row in range(batch_size):
+                leader = row - row % self._num_shared_rows
+                if leader != row:
+                    self.block_tables[row] = list(self.block_tables[leader])
+                    for block_id in self.block_tables[row]:
+                        self._ref_counts[block_id] += 1
+            self._num_shared_rows = 1
+
+        positions = torch.arange(start, end, device=device)
+        block_table_tensor = torch.tensor(self.block_tables, dtype=torch.long, device=device)
+        block_ids = block_table_tensor[:, positions // self.block_size]
+        self._slot_mapping = (start, block_ids, (positions % self.block_size).expand_as(block_ids))
+        self._block_table_tensor = block_table_tensor
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        batch_size, _, new_length, _ = key_states.shape
+        if len(self._ref_counts) == 0:
+            if self.num_blocks is None:
+                self.num_blocks = batch_size * (math.ceil(new_length / self.block_size) + 1)
+            self._ref_counts = [0] * self.num_blocks
+            self._free_blocks = list(range(self.num_blocks - 1, -1, -1))
+        if len(self.key_pool) <= layer_idx:
+            self._allocate_layer(key_states, value_states)
+
+        start = self._seq_lengths[layer_idx]
+        end = start + new_length
+        if self._slot_mapping is None or self._slot_mapping[0] != start or layer_idx == 0:
+            self._reserve_slots(batch_size, start, end, key_states.device)
+        _, block_ids, offsets = self._slot_mapping
+
+        # (batch_size, new_length, num_heads, head_dim) values are written to their (block, offset) slots
+        self.key_pool[layer_idx][block_ids, :, offsets] = key_states.transpose(1, 2)
+        self.value_pool[layer_idx][block_ids, :, offsets] = value_states.transpose(1, 2)
+        self._seq_lengths[layer_idx] = end
+
+        return self._gather(layer_idx, end)
+
+    def _gather(self, layer_idx: int, length: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        num_blocks = math.ceil(length / self.block_size)
+        block_table = self._block_table_tensor[:, :num_blocks]
+        batch_size = block_table.shape[0]
+        gathered = ()
+        for pool in (self.key_pool[layer_idx], self.value_pool[layer_idx]):
+            # (batch_size, num_blocks, num_heads, block_size, head_dim) -> (batch_size, num_heads, length, head_dim)
+            states = pool[block_table].transpose(1, 2)
+            states = states.reshape(batch_size, pool.shape[1], num_blocks * self.block_size, pool.shape[-1])
+            gathered += (states[:, :, :length],)
+        return gathered
+
+    def get_seq_length(self, layer_idx: int = 0) -> int:
+        if len(self._seq_lengths) <= layer_idx:
+            return 0
+        return self._seq_lengths[layer_idx]
+
+    def get_max_length(self) -> Optional[int]:
+        return None
+
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        new_block_tables = [list(self.block_tables[row]) for row in beam_idx.tolist()]
+        for block_table in new_block_tables:
+            for block_id in block_table:
+                self._ref_counts[block_id] += 1
+        for block_table in self.block_tables:
+            for block_id in block_table:
+                self._release_block(block_id)
+        self.block_tables = new_block_tables
+        self._slot_mapping = None
+
+    def crop(self, max_length: int):
+        self._seq_lengths = [min(length, max_length) for length in self._seq_lengths]
+        num_blocks = math.ceil(max(self._seq_lengths, default=0) / self.block_size)
+        for block_table in self.block_tables:
+            while len(block_table) > num_blocks:
+                self._release_block(block_table.pop())
+        self._slot_mapping = None
+
+    def expand_batch(self, expand_size: int):
+        if len(self.block_tables) == 0:
+            self._num_shared_rows *= expand_size
+            return
+        self.reorder_cache(torch.arange(len(self.block_tables)).repeat_interleave(expand_size))
+
+    def to_legacy_cache(self) -> Tuple[Tuple[torch.Tensor, torch.Tensor]]:
+        device = self.key_pool[0].device if len(self.key_pool) > 0 else None
+        self._block_table_tensor = torch.tensor(self.block_tables, dtype=torch.long, device=device)
+        return tuple(self._gather(layer_idx, self._seq_lengths[layer_idx]) for layer_idx in range(len(self.key_pool)))
+
+
+class SinkCache(Cache):
+    """
+    Key/value cache that keeps a bounded number of tokens, as in [Efficient Streaming Language Models with Attention
+    Sinks](https://arxiv.org/abs/2309.17453): the first `num_sink_tokens` tokens, which collect a large share of the
+    attention, and the most recent ones, up to `window_length` tokens overall. Older tokens are evicted as new ones
+    come in, so that memory and per-token latency stay constant however long the generation.
+
+    Positions are those of the tokens within the cache rather than within the whole sequence, so they stay below
+    `window_length` too. For this, the keys are cached *before* the rotary embedding is applied, and the models that
+    support the cache (`_supports_sink_cache = True`) rotate all the cached keys at their current position at each
+    forward pass. Tokens keep the positions they would have with any other cache until the first eviction, so the
+    outputs only differ once the sequence outgrows the window. The tokens being added attend to all the cached ones
+    before the eviction, so a prompt longer than the window is encoded as usual.
+
+    The attention mask that `generate` grows along the whole sequence is mapped to the cached tokens with
+    `select_attention_mask`. Evicted tokens can't be restored, so the cache can't be cropped (assisted generation),
+    and `to_legacy_cache` isn't supported since the legacy format holds rotated keys.
+
+    Args:
+        window_length (`int`):
+            The maximum number of tokens held by the cache, sink tokens included.
+        num_sink_tokens (`int`, *optional*, defaults to 4):
+            The number of initial tokens that are never evicted.
+
+    Example:
+
+    ```python
+    >>> from transformers import AutoTokenizer, AutoModelForCausalLM
+
+    >>> tokenizer = AutoTokenizer.from_pretrained("meta-llama/Llama-2-7b-hf")
+    >>> model = AutoModelForCausalLM.from_pretrained("meta-llama/Llama-2-7b-hf")
+    >>> inputs = tokenizer(["The quick brown fox"], return_tensors="pt")
+
+    >>> # only the 4 first tokens and the 1020 last ones are kept, however many tokens are generated
+    >>> outputs = model.generate(
+    ...     **inputs, max_new_tokens=4096, cache_implementation="sink", cache_window_length=1024, num_sink_tokens=4
+    ... )
+    ```
+    """
+
+    def __init__(self, window_length: int, num_sink_tokens: int = 4):
+        if num_sink_tokens >= window_length:
+            raise ValueError(
+                f"`num_sink_tokens` ({num_sink_tokens}) has to be smaller than `window_length` ({window_length})."
+            )
+        self.window_length = window_length
+        self.num_sink_tokens = num_sink_tokens
+        self.key_cache: List[torch.Tensor] = []
+        self.value_cache: List[torch.Tensor] = []
+        # number of tokens added to the cache so far, evicted ones included
+        self.seen_tokens = 0
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if layer_idx == 0:
+            self.seen_tokens += key_states.shape[-2]
+
+        if len(self.key_cache) <= layer_idx:
+            self.key_cache.append(key_states)
+            self.value_cache.append(value_states)
+        else:
+            key_states = torch.cat([self.key_cache[layer_idx], key_states], dim=-2)
+            value_states = torch.cat([self.value_cache[layer_idx], value_states], dim=-2)
+            self.key_cache[layer_idx] = key_states
+            self.value_cache[layer_idx] = value_states
+
+        # the new tokens attend to all the cached ones, the eviction only applies to the next forward passes
+        if key_states.shape[-2] > self.window_length:
+            num_recent_tokens = self.window_length - self.num_sink_tokens
+            self.key_cache[layer_idx] = torch.cat(
+                [key_states[:, :, : self.num_sink_tokens], key_states[:, :, -num_recent_tokens:]], dim=-2
+            )
+            self.value_cache[layer_idx] = torch.cat(
+                [value_states[:, :, : self.num_sink_tokens], value_states[:, :, -num_recent_tokens:]], dim=-2
+            )
+        return key_states, value_states
+
+    def get_seq_length(self, layer_idx: int = 0) -> int:
+        if len(self.key_cache) <= layer_idx:
+            return 0
+        return self.key_cache[layer_idx].shape[-2]
+
+    def get_max_length(self) -> Optional[int]:
+        return self.window_length
+
+    def select_attention_mask(self, attention_mask: torch.Tensor, num_new_tokens: int) -> torch.Tensor:
+        """
+        Maps an attention mask over the whole sequence, of shape `(batch_size, seen_tokens + num_new_tokens)`, to the
+        cached tokens followed by the new ones. Masks that already cover only the cached and new tokens are returned
+        unchanged.
+        """
+        seq_length = self.get_seq_length()
+        if attention_mask.shape[-1] == seq_length + num_new_tokens or seq_length == self.seen_tokens:
+            return attention_mask
+        num_recent_tokens = seq_length - self.num_sink_tokens
+        return torch.cat(
+            [
+                attention_mask[:, : self.num_sink_tokens],
+                attention_mask[:, self.seen_tokens - num_recent_tokens : self.seen_tokens],
+                attention_mask[:, self.seen_tokens :],
+            ],
+            dim=-1,
+        )
+
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        for layer_idx in range(len(self.key_cache)):
+            device = self.key_cache[layer_idx].device
+            self.key_cache[layer_idx] = self.key_cache[layer_idx].index_select(0, beam_idx.to(device))
+            self.value_cache[layer_idx] = self.value_cache[layer_idx].index_select(0, beam_idx.to(device))
+
+    def crop(self, max_length: int):
+        raise ValueError("A `SinkCache` can't be cropped, as the tokens it evicted can't be restored.")
+
+    def expand_batch(self, expand_size: int):
+        for layer_idx in range(len(self.key_cache)):
+            self.key_cache[layer_idx] = self.key_cache[layer_idx].repeat_interleave(expand_size, dim=0)
+            self.value_cache[layer_idx] = self.value_cache[layer_idx].repeat_interleave(expand_size, dim=0)
+
+    def to_legacy_cache(self) -> Tuple[Tuple[torch.Tensor, torch.Tensor]]:
+        raise ValueError(
+            "A `SinkCache` holds the keys before the rotary embedding, which the legacy cache format does not support."
+        )
+
+
+def _quantize(states: torch.Tensor, nbits: int, dim: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Asymmetric min-max quantization of `states` to `nbits` unsigned integers, with one scale and zero point per slice
+    along `dim`. 4-bit values are packed by pairs along the last dimension.
+    """
+    min_states = states.amin(dim=dim, keepdim=True)
+    max_states = states.amax(dim=dim, keepdim=True)
+    max_int = 2**nbits - 1
+    scale = ((max_states - min_states) / max_int).clamp(min=torch.finfo(states.dtype).tiny)
+    quantized = ((states - min_states) / scale).round_().clamp_(0, max_int).to(torch.uint8)
+    if nbits == 4:
+        quantized = quantized[..., ::2] | (quantized[..., 1::2] << 4)
+    return quantized, scale, min_states
+
+
+def _dequantize(quantized: torch.Tensor, scale: torch.Tensor, zero_point: torch.Tensor, nbits: int) -> torch.Tensor:
+    if nbits == 4:
+        quantized = torch.stack([quantized & 15, quantized >> 4], dim=-1).flatten(-2)
+    return quantized.to(scale.dtype) * scale + zero_point
+
+
+class QuantizedCache(Cache):
+    """
+    Key/value cache that stores the past states as 8-bit or 4-bit integers, dividing the memory held by the cache by
+    about 2 or 4 (fp16 states) or 4 or 8 (fp32 states), which allows proportionally more concurrent sequences. Keys
+    are quantized per channel, since their outliers concentrate in a few channels, and values per token, both with a
+    scale and zero point per head.
+
+    The most recent tokens are kept in full precision, in a residual buffer of up to `residual_length` tokens. Once the
+    buffer is full, its tokens are quantized as a block (keys sharing the scales of their block), so that the
+    per-channel scales of the keys are computed over `residual_length` tokens. `update` dequantizes the cache of the
+    layer on the fly, so the attention layers see the same shapes and dtypes as with the legacy format, and only one
+    layer is held in full precision at a time.
+
+    Args:
+        nbits (`int`, *optional*, defaults to 8):
+            The number of bits of the quantized states, 8 or 4.
+        residual_length (`int`, *optional*, defaults to 32):
+            The number of recent tokens kept in full precision, which is also the size of the quantized blocks.
+
+    Example:
+
+    ```python
+    >>> from transformers import AutoTokenizer, AutoModelForCausalLM
+
+    >>> tokenizer = AutoTokenizer.from_pretrained("gpt2")
+    >>> model = AutoModelForCausalLM.from_pretrained("gpt2")
+    >>> inputs = tokenizer(["The quick brown fox"], return_tensors="pt")
+
+    >>> outputs = model.generate(**inputs, max_new_tokens=10, cache_implementation="quantized", cache_nbits=4)
+    ```
+    """
+
+    def __init__(self, nbits: int = 8, residual_length: int = 32):
+        if nbits not in (4, 8):
+            raise ValueError(f"`nbits` has to be 4 or 8, but is {nbits}.")
+        if residual_length < 1:
+            raise ValueError(f"`residual_length` has to be a strictly positive integer, but is {residual_length}.")
+        self.nbits = nbits
+        self.residual_length = residual_length
+        # quantized blocks of shape [batch_size, num_heads, num_blocks, residual_length, head_dim (/ 2 for 4 bits)],
+        # with scales and zero points of shape [batch_size, num_heads, num_blocks, 1, head_dim] for the keys and
+        # [batch_size, num_heads, num_blocks, residual_length, 1] for the values
+        self.quantized_key_cache: List[Optional[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]] = []
+        self.quantized_value_cache: List[Optional[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]] = []
+        # full precision states of the most recent tokens
+        self.key_cache: List[torch.Tensor] = []
+        self.value_cache: List[torch.Tensor] = []
+
+    def _quantize_blocks(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int):
+        batch_size, num_heads, seq_len, head_dim = key_states.shape
+        if self.nbits == 4 and (head_dim % 2 != 0 or value_states.shape[-1] % 2 != 0):
+            raise ValueError("4-bit quantization packs the states by pairs, and requires an even head dimension.")
+        num_blocks = seq_len // self.residual_length
+        key_blocks = key_states.reshape(batch_size, num_heads, num_blocks, self.residual_length, -1)
+        value_blocks = value_states.reshape(batch_size, num_heads, num_blocks, self.residual_length, -1)
+        new_keys = _quantize(key_blocks, self.nbits, dim=-2)
+        new_values = _quantize(value_blocks, self.nbits, dim=-1)
+        if self.quantized_key_cache[layer_idx] is not None:
+            new_keys = tuple(torch.cat(pair, dim=2) for pair in zip(self.quantized_key_cache[layer_idx], new_keys))
+            new_values = tuple(
+                torch.cat(pair, dim=2) for pair in zip(self.quantized_value_cache[layer_idx], new_values)
+            )
+        self.quantized_key_cache[layer_idx] = new_keys
+        self.quantized_value_cache[layer_idx] = new_values
+
+    def _dequantize_layer(self, layer_idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        key_states = _dequantize(*self.quantized_key_cache[layer_idx], nbits=self.nbits)
+        value_states = _dequantize(*self.quantized_value_cache[layer_idx], nbits=self.nbits)
+        batch_size, num_heads = key_states.shape[:2]
+        return (
+            key_states.reshape(batch_size, num_heads, -1, key_states.shape[-1]),
+            value_states.reshape(batch_size, num_heads, -1, value_states.shape[-1]),
+        )
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if len(self.key_cache) <= layer_idx:
+            self.quantized_key_cache.append(None)
+            self.quantized_value_cache.append(None)
+            self.key_cache.append(key_states)
+            self.value_cache.append(value_states)
+        else:
+            self.key_cache[layer_idx] = torch.cat([self.key_cache[layer_idx], key_states], dim=-2)
+            self.value_cache[layer_idx] = torch.cat([self.value_cache[layer_idx], value_states], dim=-2)
+
+        if self.quantized_key_cache[layer_idx] is not None:
+            past_key_states, past_value_states = self._dequantize_layer(layer_idx)
+            key_states = torch.cat([past_key_states.to(key_states.dtype), self.key_cache[layer_idx]], dim=-2)
+            value_states = torch.cat([past_value_states.to(value_states.dtype), self.value_cache[layer_idx]], dim=-2)
+        else:
+            key_states, value_states = self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+        # the full blocks of the residual buffer are quantized once the attention has used them in full precision
+        num_quantized_tokens = self.key_cache[layer_idx].shape[-2] // self.residual_length * self.residual_length
+        if num_quantized_tokens > 0:
+            self._quantize_blocks(
+                self.key_cache[layer_idx][:, :, :num_quantized_tokens],
+                self.value_cache[layer_idx][:, :, :num_quantized_tokens],
+                layer_idx,
+            )
+            # copies the remaining tokens, so that the buffer does not keep the quantized ones alive
+            self.key_cache[layer_idx] = self.key_cache[layer_idx][:, :, num_quantized_tokens:].clone()
+            self.value_cache[layer_idx] = self.value_cache[layer_idx][:, :, num_quantized_tokens:].clone()
+        return key_states, value_states
+
+    def get_seq_length(self, layer_idx: int = 0) -> int:
+        if len(self.key_cache) <= layer_idx:
+            return 0
+        seq_length = self.key_cache[layer_idx].shape[-2]
+        if self.quantized_key_cache[layer_idx] is not None:
+            seq_length += self.quantized_key_cache[layer_idx][0].shape[2] * self.residual_length
+        return seq_length
+
+    def get_max_length(self) -> Optional[int]:
+        return None
+
+    def _map_states(self, function):
+        for layer_idx in range(len(self.key_cache)):
+            self.key_cache[layer_idx] = function(self.key_cache[layer_idx])
+            self.value_cache[layer_idx] = function(self.value_cache[layer_idx])
+            if self.quantized_key_cache[layer_idx] is not None:
+                self.quantized_key_cache[layer_idx] = tuple(map(function, self.quantized_key_cache[layer_idx]))
+                self.quantized_value_cache[layer_idx] = tuple(map(function, self.quantized_value_cache[layer_idx]))
+
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        self._map_states(lambda states: states.index_select(0, beam_idx.to(states.device)))
+
+    def crop(self, max_length: int):
+        for layer_idx in range(len(self.key_cache)):
+            if self.get_seq_length(layer_idx) <= max_length:
+                continue
+            if self.quantized_key_cache[layer_idx] is None:
+                num_blocks = 0
+            else:
+                num_blocks = self.quantized_key_cache[layer_idx][0].shape[2]
+            if max_length >= num_blocks * self.residual_length:
+                num_residual_tokens = max_length - num_blocks * self.residual_length
+                self.key_cache[layer_idx] = self.key_cache[layer_idx][:, :, :num_residual_tokens]
+                self.value_cache[layer_idx] = self.value_cache[layer_idx][:, :, :num_residual_tokens]
+                continue
+            # the tokens of the last kept block go back to the residual buffer, dequantized
+            key_states, value_states = self._dequantize_layer(layer_idx)
+            num_blocks = max_length // self.residual_length
+            start = num_blocks * self.residual_length
+            dtype = self.key_cache[layer_idx].dtype
+            self.key_cache[layer_idx] = key_states[:, :, start:max_length].to(dtype).clone()
+            self.value_cache[layer_idx] = value_states[:, :, start:max_length].to(dtype).clone()
+            if num_blocks == 0:
+                self.quantized_key_cache[layer_idx] = None
+                self.quantized_value_cache[layer_idx] = None
+            else:
+                self.quantized_key_cache[layer_idx] = tuple(
+                    states[:, :, :num_blocks] for states in self.quantized_key_cache[layer_idx]
+                )
+                self.quantized_value_cache[layer_idx] = tuple(
+                    states[:, :, :num_blocks] for states in self.quantized_value_cache[layer_idx]
+                )
+
+    def expand_batch(self, expand_size: int):
+        self._map_states(lambda states: states.repeat_interleave(expand_size, dim=0))
+
+    def to_legacy_cache(self) -> Tuple[Tuple[torch.Tensor, torch.Tensor]]:
+        legacy_cache = ()
+        for layer_idx in range(len(self.key_cache)):
+            key_states, value_states = self.key_cache[layer_idx], self.value_cache[layer_idx]
+            if self.quantized_key_cache[layer_idx] is not None:
+                past_key_states, past_value_states = self._dequantize_layer(layer_idx)
+                key_states = torch.cat([past_key_states.to(key_states.dtype), key_states], dim=-2)
+                value_states = torch.cat([past_value_states.to(value_states.dtype), value_states], dim=-2)
+            legacy_cache += ((key_states, value_states),)
+        return legacy_cache
@@ -19,7 +19,7 @@ from ..utils import OptionalDependencyNotAvailable, _LazyModule, is_flax_availab
 
 _import_structure = {
     "configuration_utils": ["GenerationConfig"],
-    "streamers": ["TextIteratorStreamer", "TextStreamer"],
+    "streamers": ["AsyncTextIteratorStreamer", "TextIteratorStreamer", "TextStreamer"],
 }
 
 try:
@@ -40,6 +40,7 @@ else:
         "BeamSearchScorer",
         "ConstrainedBeamSearchScorer",
     ]
+    _import_structure["continuous_batching"] = ["ContinuousBatchingEngine"]
     _import_structure["logits_process"] = [
         "EpsilonLogitsWarper",
         "EtaLogitsWarper",
@@ -55,6 +56,7 @@ else:
         "NoBadWordsLogitsProcessor",
         "NoRepeatNGramLogitsProcessor",
         "PrefixConstrainedLogitsProcessor",
+        "RegexLogitsProcessor",
         "RepetitionPenaltyLogitsProcessor",
         "SequenceBiasLogitsProcessor",
         "EncoderRepetitionPenaltyLogitsProcessor",
@@ -66,6 +68,13 @@ else:
         "ExponentialDecayLengthPenalty",
         "LogitNormalization",
     ]
+    _import_structure["prefix_cache"] = ["PrefixCache"]
+    _import_structure["profiler"] = ["GenerationProfiler"]
+    _import_structure["result_cache"] = [
+        "GenerationResultCache",
+        "LRUGenerationResultCache",
+        "SQLiteGenerationResultCache",
+    ]
     _import_structure["stopping_criteria"] = [
         "MaxNewTokensCriteria",
         "MaxLengthCriteria",
@@ -153,7 +162,7 @@ else:
 
 if TYPE_CHECKING:
     from .configuration_utils import GenerationConfig
-    from .streamers import TextIteratorStreamer, TextStreamer
+    from .streamers import AsyncTextIteratorStreamer, TextIteratorStreamer, TextStreamer
 
     try:
         if not is_torch_available():
@@ -163,6 +172,7 @@ if TYPE_CHECKING:
     else:
         from .beam_constraints import Constraint, ConstraintListState, DisjunctiveConstraint, PhrasalConstraint
         from .beam_search import BeamHypotheses, BeamScorer, BeamSearchScorer, ConstrainedBeamSearchScorer
+        from .continuous_batching import ContinuousBatchingEngine
         from .logits_process import (
             EncoderNoRepeatNGramLogitsProcessor,
             EncoderRepetitionPenaltyLogitsProcessor,
@@ -182,6 +192,7 @@ if TYPE_CHECKING:
             NoBadWordsLogitsProcessor,
             NoRepeatNGramLogitsProcessor,
             PrefixConstrainedLogitsProcessor,
+            RegexLogitsProcessor,
             RepetitionPenaltyLogitsProcessor,
             SequenceBiasLogitsProcessor,
             TemperatureLogitsWarper,
@@ -189,6 +200,9 @@ if TYPE_CHECKING:
             TopPLogitsWarper,
             TypicalLogitsWarper,
         )
+        from .prefix_cache import PrefixCache
+        from .profiler import GenerationProfiler
+        from .result_cache import GenerationResultCache, LRUGenerationResultCache, SQLiteGenerationResultCache
         from .stopping_criteria import (
             MaxLengthCriteria,
             MaxNewTokensCriteria,
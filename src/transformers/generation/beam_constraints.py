@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
+
+import torch
 
 
 class Constraint(ABC):
@@ -518,3 +520,212 @@ class ConstraintListState:
             new_state.pending_constraints = [constraint.copy() for constraint in self.pending_constraints]
 
         return new_state
+
+
+class ConstraintAutomaton:
+    r"""
+    The progress of a [`ConstraintListState`] through its constraints, compiled into a deterministic automaton, so that
+    beam scorers can track the constraints of all their beams with batched tensor operations instead of one
+    [`ConstraintListState`] per beam.
+
+    A state of the automaton is made of the set of fulfilled constraints and, optionally, of the constraint in
+    progress with the tokens of it generated so far. Every constraint is compiled into a trie of the tokens that
+    advance it, and the tokens that appear in none of the tries all share the same transitions. States are numbered
+    as they are discovered, and their transitions are only computed once a sequence reaches them, so that the tables
+    only grow with the states that are actually visited. Sequences start in the state `0`.
+
+    The transitions are those of `ConstraintListState.add`: a token that does not advance the constraint in progress
+    resets it, and when several pending constraints can be advanced by a token, the first one in `constraints` is
+    stepped.
+
+    Args:
+        constraints (`List[Constraint]`):
+            A list of [`Constraint`] objects that must be fulfilled by the beam scorer.
+        device (`torch.device`, *optional*):
+            The device on which the transition tables are allocated.
+    """
+
+    def __init__(self, constraints: List[Constraint], device: Optional[torch.device] = None):
+        self.constraints = constraints
+        self.device = device if device is not None else torch.device("cpu")
+
+        # max # of steps required to fulfill a given constraint
+        self.max_seqlen = max([c.seqlen for c in constraints])
+        self._all_fulfilled = (1 << len(constraints)) - 1
+
+        # per constraint, the children, remaining steps and completion of each trie node (the root being node 0)
+        self._tries = [self._compile_constraint(constraint) for constraint in constraints]
+        alphabet = sorted({token for children, _, _ in self._tries for node in children for token in node})
+        self.alphabet = torch.tensor(alphabet, dtype=torch.long, device=self.device)
+        self._symbols = {token: symbol for symbol, token in enumerate(alphabet)}
+        self.num_symbols = len(alphabet)
+
+        # a state is `(fulfilled constraints bitmask, constraint in progress or -1, trie node of that constraint)`
+        self._states: List[Tuple[int, int, int]] = []
+        self._state_ids: Dict[Tuple[int, int, int], int] = {}
+        self._banks: List[int] = []
+        self._transitions: List[Optional[List[int]]] = []
+        self._advances: List[Optional[List[bool]]] = []
+        self._tables: Optional[Dict[str, torch.Tensor]] = None
+        self._get_state_id((0, -1, 0))
+
+    @staticmethod
+    def _compile_constraint(constraint: Constraint) -> Tuple[List[Dict[int, int]], List[int], List[bool]]:
+        """
+        Enumerates the progress of `constraint` as a trie, by replaying the tokens of each node on a fresh copy of the
+        constraint and following the tokens returned by its `advance()`.
+        """
+        children, remaining, completed = [{}], [], []
+        paths = [[]]
+        node = 0
+        while node < len(paths):
+            state = constraint.copy()
+            is_completed = False
+            for token in paths[node]:
+                _, is_completed, _ = state.update(token)
+            remaining.append(state.remaining())
+            completed.append(is_completed)
+            if not is_completed:
+                advance = state.advance()
+                advance = [advance] if isinstance(advance, int) else advance
+                for token in advance or []:
+                    if token not in children[node]:
+                        children[node][token] = len(paths)
+                        paths.append(paths[node] + [token])
+                        children.append({})
+            node += 1
+        return children, remaining, completed
+
+    @property
+    def num_states(self) -> int:
+        return len(self._states)
+
+    def _get_state_id(self, state: Tuple[int, int, int]) -> int:
+        state_id = self._state_ids.get(state)
+        if state_id is None:
+            state_id = len(self._states)
+            self._states.append(state)
+            self._state_ids[state] = state_id
+            fulfilled, constraint_idx, node = state
+            bank = bin(fulfilled).count("1") * self.max_seqlen
+            if constraint_idx >= 0:
+                # extra points for having a constraint mid-fulfilled
+                bank += self.max_seqlen - self._tries[constraint_idx][1][node]
+            self._banks.append(bank)
+            self._transitions.append(None)
+            self._advances.append(None)
+            self._tables = None
+        return state_id
+
+    def _enter(self, fulfilled: int, constraint_idx: int, node: int) -> int:
+        if self._tries[constraint_idx][2][node]:
+            return self._get_state_id((fulfilled | (1 << constraint_idx), -1, 0))
+        return self._get_state_id((fulfilled, constraint_idx, node))
+
+    def _next_state_id(self, state_id: int, token: Optional[int]) -> int:
+        """The state reached from `state_id` with `token`, `None` standing for the tokens outside of the tries."""
+        fulfilled, constraint_idx, node = self._states[state_id]
+        if fulfilled == self._all_fulfilled:
+            return state_id
+        if constraint_idx >= 0:
+            child = self._tries[constraint_idx][0][node].get(token)
+            if child is None:
+                # the constraint in progress restarts, and `token` is not checked against the pending constraints
+                return self._get_state_id((fulfilled, -1, 0))
+            return self._enter(fulfilled, constraint_idx, child)
+        for pending_idx, (children, _, _) in enumerate(self._tries):
+            if not fulfilled & (1 << pending_idx) and token in children[0]:
+                return self._enter(fulfilled, pending_idx, children[0][token])
+        return state_id
+
+    def _expand(self, state_id: int) -> List[int]:
+        """Computes the transitions of a state, over the alphabet and then for any other token."""
+        if self._transitions[state_id] is None:
+            fulfilled, constraint_idx, node = self._states[state_id]
+            tokens = self.alphabet.tolist()
+            if fulfilled == self._all_fulfilled:
+                advance = set()
+            elif constraint_idx >= 0:
+                advance = set(self._tries[constraint_idx][0][node])
+            else:
+                advance = {
+                    token
+                    for pending_idx, (children, _, _) in enumerate(self._tries)
+                    if not fulfilled & (1 << pending_idx)
+                    for token in children[0]
+                }
+            self._transitions[state_id] = [self._next_state_id(state_id, token) for token in tokens + [None]]
+            self._advances[state_id] = [token in advance for token in tokens]
+            self._tables = None
+        return self._transitions[state_id]
+
+    def _get_tables(self) -> Dict[str, torch.Tensor]:
+        if self._tables is None:
+            unexpanded_transitions = [-1] * (self.num_symbols + 1)
+            unexpanded_advances = [False] * self.num_symbols
+            transitions = [row if row is not None else unexpanded_transitions for row in self._transitions]
+            advances = [row if row is not None else unexpanded_advances for row in self._advances]
+            completed = [fulfilled == self._all_fulfilled for fulfilled, _, _ in self._states]
+            self._tables = {
+                "transitions": torch.tensor(transitions, dtype=torch.long, device=self.device),
+                "advances": torch.tensor(advances, dtype=torch.bool, device=self.device),
+                "banks": torch.tensor(self._banks, dtype=torch.long, device=self.device),
+                "completed": torch.tensor(completed, dtype=torch.bool, device=self.device),
+            }
+        return self._tables
+
+    def expand(self, states: torch.LongTensor):
+        """Computes the transitions of all the `states`, which is needed before looking them up."""
+        for state_id in states.unique().tolist():
+            self._expand(state_id)
+
+    def symbols(self, token_ids: torch.LongTensor) -> torch.LongTensor:
+        """
+        Maps token ids, on the device of the automaton, to their column in the transition tables (`num_symbols` for
+        the tokens outside of the tries).
+        """
+        symbols = torch.searchsorted(self.alphabet, token_ids).clamp(max=self.num_symbols - 1)
+        return torch.where(self.alphabet[symbols] == token_ids, symbols, self.num_symbols)
+
+    def run(self, token_ids: torch.LongTensor) -> torch.LongTensor:
+        """
+        Computes the states reached by sequences of tokens, given as a tensor of shape `(num_sequences, length)`. This
+        is the only sequential operation of the automaton, done once per distinct sequence.
+        """
+        final_states = {}
+        states = []
+        for sequence in token_ids.tolist():
+            sequence = tuple(sequence)
+            if sequence not in final_states:
+                state_id = 0
+                for token in sequence:
+                    state_id = self._expand(state_id)[self._symbols.get(token, self.num_symbols)]
+                final_states[sequence] = state_id
+            states.append(final_states[sequence])
+        return torch.tensor(states, dtype=torch.long, device=self.device)
+
+    def step(self, states: torch.LongTensor, token_ids: torch.LongTensor) -> torch.LongTensor:
+        """The states reached from `states` with `token_ids`, of the same shape."""
+        self.expand(states)
+        symbols = self.symbols(token_ids.to(self.device))
+        return self._get_tables()["transitions"][states.to(self.device), symbols].to(states.device)
+
+    def advance(self, states: torch.LongTensor) -> Tuple[torch.BoolTensor, torch.LongTensor]:
+        """
+        Returns, for each of the `states` and token of `alphabet`, whether the token makes progress through the
+        constraints (like `ConstraintListState.advance`) and the state it leads to. Both tensors have the shape of
+        `states` with an extra `num_symbols` dimension.
+        """
+        self.expand(states)
+        tables = self._get_tables()
+        advances = tables["advances"][states.to(self.device)]
+        transitions = tables["transitions"][states.to(self.device), : self.num_symbols]
+        return advances.to(states.device), transitions.to(states.device)
+
+    def bank(self, states: torch.LongTensor) -> torch.LongTensor:
+        """The banks of `states`, as in `ConstraintListState.get_bank`."""
+        return self._get_tables()["banks"][states.to(self.device)].to(states.device)
+
+    def is_completed(self, states: torch.LongTensor) -> torch.BoolTensor:
+        """Whether all the constraints are fulfilled in `states`."""
+        return self._get_tables()["completed"][states.to(self.device)].to(states.device)
@@ -17,11 +17,11 @@ from abc import ABC, abstractmethod
 from collections import UserDict
 from typing import Dict, List, Optional, Tuple, Union
 
-import numpy as np
 import torch
+from torch import nn
 
 from ..utils import add_start_docstrings
-from .beam_constraints import Constraint, ConstraintListState
+from .beam_constraints import Constraint, ConstraintAutomaton, ConstraintListState
 
 
 PROCESS_INPUTS_DOCSTRING = r"""
@@ -130,6 +130,11 @@ class BeamSearchScorer(BeamScorer):
     Reference for the diverse beam search algorithm and implementation [Ashwin Kalyan's DBS
     implementation](https://github.com/ashwinkalyan/dbs/blob/master/dbs/beam_utils.lua)
 
+    The finished hypotheses of all the batch items are kept in preallocated tensors, and the candidate selection,
+    end-of-sequence handling and length-penalty scoring are done with batched tensor operations. The results are the
+    same as with one [`BeamHypotheses`] per batch item (and group of beams), which can still be inspected through
+    `_beam_hyps`.
+
     Args:
         batch_size (`int`):
             Batch Size of `input_ids` for which standard beam search decoding is run in parallel.
@@ -177,24 +182,33 @@ class BeamSearchScorer(BeamScorer):
         self.num_beam_hyps_to_keep = num_beam_hyps_to_keep
         self.num_beam_groups = num_beam_groups
         self.group_size = self.num_beams // self.num_beam_groups
+        self.max_length = max_length
+        self.batch_size = batch_size
 
         self._is_init = False
-        # self._beam_hyps[i*self.num_beam_groups+j] is the beam_hyps of the j-th group in the i-th mini-batch.
-        # If group_beam_search is not used, the list consists of `batch_size` beam_hyps.
-        self._beam_hyps = [
-            BeamHypotheses(
-                num_beams=self.group_size,
-                length_penalty=self.length_penalty,
-                early_stopping=self.do_early_stopping,
-                max_length=max_length,
+        if not isinstance(self.do_early_stopping, bool) and self.max_length is None:
+            raise ValueError(
+                "When `do_early_stopping` is set to a string, `max_length` must be defined. Ensure it is passed to the"
+                " BeamScorer class instance at initialization time."
             )
-            for _ in range(batch_size * self.num_beam_groups)
-        ]
+
+        # The finished hypotheses are stored per (batch item, group of beams): row `i*self.num_beam_groups+j` holds the
+        # `self.group_size` best hypotheses of the j-th group in the i-th mini-batch. Scores are kept in double
+        # precision, like the python floats of `BeamHypotheses` (MPS does not support float64).
+        num_rows = batch_size * self.num_beam_groups
+        self._score_dtype = torch.float32 if torch.device(device).type == "mps" else torch.float64
+        self._hyp_scores = torch.full(
+            (num_rows, self.group_size), float("-inf"), dtype=self._score_dtype, device=self.device
+        )
+        self._hyp_is_set = torch.zeros((num_rows, self.group_size), dtype=torch.bool, device=self.device)
+        self._hyp_lengths = torch.zeros((num_rows, self.group_size), dtype=torch.long, device=self.device)
+        # allocated on the first finished hypothesis, up to `max_length` tokens when it is known
+        self._hyp_tokens: Optional[torch.LongTensor] = None
+        self._hyp_beam_indices: Optional[torch.LongTensor] = None
+        self._hyp_beam_indices_lengths = torch.zeros((num_rows, self.group_size), dtype=torch.long, device=self.device)
         # self._done[i*self.num_beam_groups+j] indicates whether the generation of the beam_hyps of the j-th group
         # in the i-th mini-batch is complete.
-        self._done = torch.tensor(
-            [False for _ in range(batch_size * self.num_beam_groups)], dtype=torch.bool, device=self.device
-        )
+        self._done = torch.tensor([False for _ in range(num_rows)], dtype=torch.bool, device=self.device)
 
         if not isinstance(num_beams, int) or num_beams <= 1:
             raise ValueError(
@@ -212,6 +226,135 @@ class BeamSearchScorer(BeamScorer):
     def is_done(self) -> bool:
         return self._done.all()
 
+    @property
+    def _beam_hyps(self) -> List["BeamHypotheses"]:
+        """
+        The finished hypotheses as one [`BeamHypotheses`] per batch item and group of beams, built from the tensors of
+        the scorer. Kept for backward compatibility: modifying them does not affect the scorer.
+        """
+        beam_hyps = []
+        for row in range(self._hyp_scores.shape[0]):
+            beam_hyp = BeamHypotheses(
+                num_beams=self.group_size,
+                length_penalty=self.length_penalty,
+                early_stopping=self.do_early_stopping,
+                max_length=self.max_length,
+            )
+            for slot in self._hyp_is_set[row].nonzero().view(-1).tolist():
+                hyp = self._hyp_tokens[row, slot, : self._hyp_lengths[row, slot]]
+                beam_index = None
+                if self._hyp_beam_indices is not None:
+                    beam_index = self._hyp_beam_indices[row, slot, : self._hyp_beam_indices_lengths[row, slot]]
+                    beam_index = tuple(beam_index.tolist())
+                beam_hyp.beams.append((self._hyp_scores[row, slot].item(), hyp, beam_index))
+            if len(beam_hyp) > 0:
+                beam_hyp.worst_score = min(score for score, _, _ in beam_hyp.beams)
+            beam_hyps.append(beam_hyp)
+        return beam_hyps
+
+    def _ensure_hyp_capacity(self, length: int, beam_indices_length: Optional[int]):
+        """Allocates, or grows, the tensors holding the tokens and beam indices of the finished hypotheses."""
+        num_rows = self._hyp_scores.shape[0]
+        if self._hyp_tokens is None:
+            capacity = max(length, self.max_length or 0)
+            self._hyp_tokens = torch.zeros((num_rows, self.group_size, capacity), dtype=torch.long, device=self.device)
+        elif self._hyp_tokens.shape[-1] < length:
+            self._hyp_tokens = nn.functional.pad(self._hyp_tokens, (0, length - self._hyp_tokens.shape[-1]))
+
+        if beam_indices_length is None:
+            return
+        if self._hyp_beam_indices is None:
+            capacity = max(beam_indices_length, self.max_length or 0)
+            self._hyp_beam_indices = torch.full(
+                (num_rows, self.group_size, capacity), -1, dtype=torch.long, device=self.device
+            )
+        elif self._hyp_beam_indices.shape[-1] < beam_indices_length:
+            self._hyp_beam_indices = nn.functional.pad(
+                self._hyp_beam_indices, (0, beam_indices_length - self._hyp_beam_indices.shape[-1]), value=-1
+            )
+
+    def _add_hypotheses(
+        self,
+        rows: torch.LongTensor,
+        scores: torch.Tensor,
+        is_added: torch.BoolTensor,
+        tokens: torch.LongTensor,
+        beam_indices: Optional[torch.LongTensor] = None,
+    ):
+        """
+        Adds the candidates `is_added` (of shape `(len(rows), num_candidates)`) to the finished hypotheses of `rows`,
+        keeping the `self.group_size` best ones of each row, exactly like successive calls to `BeamHypotheses.add`.
+        `scores` are the length-normalized scores, `tokens` the candidate sequences (all of the same length) and
+        `beam_indices` their beam indices, padded with -1.
+        """
+        # only the rows with new hypotheses are updated
+        has_new_hyps = is_added.any(-1)
+        rows, scores, is_added = rows[has_new_hyps], scores[has_new_hyps], is_added[has_new_hyps]
+        tokens = tokens[has_new_hyps]
+        num_candidates = scores.shape[-1]
+        length = tokens.shape[-1]
+        beam_indices_length = beam_indices.shape[-1] if beam_indices is not None else None
+        self._ensure_hyp_capacity(length, beam_indices_length)
+
+        # The `self.group_size` best of the current and new hypotheses are kept. Sorting is stable, and current
+        # hypotheses come first, so that a new hypothesis only replaces a strictly worse one.
+        union_is_set = torch.cat([self._hyp_is_set[rows], is_added], dim=-1)
+        union_scores = torch.cat([self._hyp_scores[rows], scores.to(self._score_dtype)], dim=-1)
+        union_scores = union_scores.masked_fill(~union_is_set, float("-inf"))
+        kept = torch.sort(union_scores, dim=-1, descending=True, stable=True).indices[:, : self.group_size]
+
+        self._hyp_scores[rows] = union_scores.gather(-1, kept)
+        self._hyp_is_set[rows] = union_is_set.gather(-1, kept)
+        new_lengths = torch.full_like(is_added, length, dtype=torch.long)
+        self._hyp_lengths[rows] = torch.cat([self._hyp_lengths[rows], new_lengths], dim=-1).gather(-1, kept)
+
+        capacity = self._hyp_tokens.shape[-1]
+        new_tokens = nn.functional.pad(tokens, (0, capacity - length))
+        union_tokens = torch.cat([self._hyp_tokens[rows], new_tokens], dim=1)
+        self._hyp_tokens[rows] = union_tokens.gather(1, kept.unsqueeze(-1).expand(-1, -1, capacity))
+
+        if beam_indices is not None:
+            beam_indices = beam_indices[has_new_hyps]
+            capacity = self._hyp_beam_indices.shape[-1]
+            new_beam_indices = nn.functional.pad(beam_indices, (0, capacity - beam_indices_length), value=-1)
+            union_beam_indices = torch.cat([self._hyp_beam_indices[rows], new_beam_indices], dim=1)
+            self._hyp_beam_indices[rows] = union_beam_indices.gather(1, kept.unsqueeze(-1).expand(-1, -1, capacity))
+            new_lengths = torch.full((len(rows), num_candidates), beam_indices_length, device=self.device)
+            union_lengths = torch.cat([self._hyp_beam_indices_lengths[rows], new_lengths], dim=-1)
+            self._hyp_beam_indices_lengths[rows] = union_lengths.gather(-1, kept)
+
+    def _beam_indices_to_tensor(
+        self, beam_indices: Tuple[Tuple[int]], batch_beam_idx: torch.LongTensor, is_needed: torch.BoolTensor
+    ) -> torch.LongTensor:
+        """
+        Gathers the (tuples of) beam indices of the beams `batch_beam_idx` in a tensor padded with -1, only filling the
+        entries `is_needed`.
+        """
+        length = len(beam_indices[0]) if len(beam_indices) > 0 else 0
+        tensor = torch.full(batch_beam_idx.shape + (length,), -1, dtype=torch.long)
+        for position in is_needed.nonzero().tolist():
+            tensor[tuple(position)] = torch.tensor(
+                [int(index) for index in beam_indices[batch_beam_idx[tuple(position)]]], dtype=torch.long
+            )
+        return tensor.to(self.device)
+
+    def _update_done(self, rows: torch.LongTensor, best_sum_logprobs: torch.Tensor, cur_len: int):
+        """Vectorized `BeamHypotheses.is_done`, for the batch items and groups of beams `rows`."""
+        is_full = self._hyp_is_set[rows].all(-1)
+        if self.do_early_stopping is True:
+            is_done = is_full
+        else:
+            # `False`: heuristic, computing the best possible score from `cur_len`. `"never"`: the best possible score,
+            # depending on the signal of `length_penalty` (see `BeamHypotheses.is_done`)
+            if self.do_early_stopping is not False and self.length_penalty > 0.0:
+                length = self.max_length
+            else:
+                length = cur_len
+            highest_attainable_score = best_sum_logprobs.to(self._score_dtype) / length**self.length_penalty
+            worst_score = self._hyp_scores[rows].min(-1).values
+            is_done = is_full & (worst_score >= highest_attainable_score)
+        self._done[rows] = self._done[rows] | is_done
+
     def process(
         self,
         input_ids: torch.LongTensor,
@@ -224,7 +367,7 @@ class BeamSearchScorer(BeamScorer):
         group_index: Optional[int] = 0,
     ) -> Dict[str, torch.Tensor]:
         cur_len = input_ids.shape[-1] + 1  # add up to the length which the next_scores is calculated on
-        batch_size = len(self._beam_hyps) // self.num_beam_groups
+        batch_size = self.batch_size
 
         if not (batch_size == (input_ids.shape[0] // self.group_size)):
             if self.num_beam_groups > 1:
@@ -239,71 +382,64 @@ class BeamSearchScorer(BeamScorer):
                 )
 
         device = input_ids.device
-        next_beam_scores = torch.zeros((batch_size, self.group_size), dtype=next_scores.dtype, device=device)
-        next_beam_tokens = torch.zeros((batch_size, self.group_size), dtype=next_tokens.dtype, device=device)
-        next_beam_indices = torch.zeros((batch_size, self.group_size), dtype=next_indices.dtype, device=device)
-
         if isinstance(eos_token_id, int):
             eos_token_id = [eos_token_id]
 
-        for batch_idx in range(batch_size):
-            batch_group_idx = batch_idx * self.num_beam_groups + group_index
-            if self._done[batch_group_idx]:
-                if self.num_beams < len(self._beam_hyps[batch_group_idx]):
-                    raise ValueError(f"Batch can only be done if at least {self.num_beams} beams have been generated")
-                if eos_token_id is None or pad_token_id is None:
-                    raise ValueError("Generated beams >= num_beams -> eos_token_id and pad_token have to be defined")
-                # pad the batch
-                next_beam_scores[batch_idx, :] = 0
-                next_beam_tokens[batch_idx, :] = pad_token_id
-                next_beam_indices[batch_idx, :] = 0
-                continue
-
-            # next tokens for this sentence
-            beam_idx = 0
-            for beam_token_rank, (next_token, next_score, next_index) in enumerate(
-                zip(next_tokens[batch_idx], next_scores[batch_idx], next_indices[batch_idx])
-            ):
-                batch_beam_idx = batch_idx * self.group_size + next_index
-                # add to generated hypotheses if end of sentence
-                if (eos_token_id is not None) and (next_token.item() in eos_token_id):
-                    # if beam_token does not belong to top num_beams tokens, it should not be added
-                    is_beam_token_worse_than_top_num_beams = beam_token_rank >= self.group_size
-                    if is_beam_token_worse_than_top_num_beams:
-                        continue
-                    if beam_indices is not None:
-                        beam_index = beam_indices[batch_beam_idx]
-                        beam_index = beam_index + (batch_beam_idx,)
-                    else:
-                        beam_index = None
-
-                    self._beam_hyps[batch_group_idx].add(
-                        input_ids[batch_beam_idx].clone(),
-                        next_score.item(),
-                        beam_indices=beam_index,
-                    )
-                else:
-                    # add next predicted token since it is not eos_token
-                    next_beam_scores[batch_idx, beam_idx] = next_score
-                    next_beam_tokens[batch_idx, beam_idx] = next_token
-                    next_beam_indices[batch_idx, beam_idx] = batch_beam_idx
-                    beam_idx += 1
+        rows = torch.arange(batch_size, device=self.device) * self.num_beam_groups + group_index
+        is_done = self._done[rows].to(device)
+        if (eos_token_id is None or pad_token_id is None) and is_done.any():
+            raise ValueError("Generated beams >= num_beams -> eos_token_id and pad_token have to be defined")
 
-                # once the beam for next step is full, don't add more tokens to it.
-                if beam_idx == self.group_size:
-                    break
+        num_candidates = next_tokens.shape[-1]
+        if eos_token_id is not None:
+            eos_token_id_tensor = torch.tensor(eos_token_id, device=device)
+            is_eos = next_tokens.unsqueeze(-1).eq(eos_token_id_tensor).any(-1)
+        else:
+            is_eos = torch.zeros_like(next_tokens, dtype=torch.bool)
 
-            if beam_idx < self.group_size:
-                raise ValueError(
-                    f"At most {self.group_size} tokens in {next_tokens[batch_idx]} can be equal to `eos_token_id:"
-                    f" {eos_token_id}`. Make sure {next_tokens[batch_idx]} are corrected."
-                )
+        is_short_of_beams = (num_candidates - is_eos.sum(-1) < self.group_size) & ~is_done
+        if is_short_of_beams.any():
+            batch_idx = is_short_of_beams.nonzero()[0].item()
+            raise ValueError(
+                f"At most {self.group_size} tokens in {next_tokens[batch_idx]} can be equal to `eos_token_id:"
+                f" {eos_token_id}`. Make sure {next_tokens[batch_idx]} are corrected."
+            )
 
-            # Check if we are done so that we can save a pad step if all(done)
-            self._done[batch_group_idx] = self._done[batch_group_idx] or self._beam_hyps[batch_group_idx].is_done(
-                next_scores[batch_idx].max().item(), cur_len
+        # the best `self.group_size` candidates that are not an end of sentence are the beams of the next step
+        candidate_rank = torch.arange(num_candidates, device=device)
+        next_beams = torch.argsort(is_eos.long() * num_candidates + candidate_rank, dim=-1)[:, : self.group_size]
+        batch_offset = torch.arange(batch_size, device=device).unsqueeze(-1) * self.group_size
+        next_beam_scores = next_scores.gather(-1, next_beams)
+        next_beam_tokens = next_tokens.gather(-1, next_beams)
+        next_beam_indices = next_indices.gather(-1, next_beams) + batch_offset
+
+        if is_done.any():
+            # pad the batch
+            next_beam_scores = next_beam_scores.masked_fill(is_done.unsqueeze(-1), 0)
+            next_beam_tokens = next_beam_tokens.masked_fill(is_done.unsqueeze(-1), pad_token_id)
+            next_beam_indices = next_beam_indices.masked_fill(is_done.unsqueeze(-1), 0)
+
+        # the ends of sentence among the best `self.group_size` candidates are added to the generated hypotheses
+        is_finished = is_eos[:, : self.group_size] & ~is_done.unsqueeze(-1)
+        if is_finished.any():
+            batch_beam_idx = next_indices[:, : self.group_size] + batch_offset
+            hyp_length = input_ids.shape[-1]
+            hyp_scores = next_scores[:, : self.group_size].to(self._score_dtype) / (hyp_length**self.length_penalty)
+            hyp_beam_indices = None
+            if beam_indices is not None:
+                hyp_beam_indices = self._beam_indices_to_tensor(beam_indices, batch_beam_idx.cpu(), is_finished.cpu())
+                hyp_beam_indices = torch.cat([hyp_beam_indices, batch_beam_idx.unsqueeze(-1).to(self.device)], dim=-1)
+            self._add_hypotheses(
+                rows,
+                hyp_scores.to(self.device),
+                is_finished.to(self.device),
+                input_ids[batch_beam_idx].to(self.device),
+                beam_indices=hyp_beam_indices,
             )
 
+        # Check if we are done so that we can save a pad step if all(done)
+        self._update_done(rows, next_scores.max(-1).values.to(self.device), cur_len)
+
         return UserDict(
             {
                 "next_beam_scores": next_beam_scores.view(-1),
@@ -323,80 +459,67 @@ class BeamSearchScorer(BeamScorer):
         eos_token_id: Optional[Union[int, List[int]]] = None,
         beam_indices: Optional[torch.LongTensor] = None,
     ) -> Tuple[torch.LongTensor]:
-        batch_size = len(self._beam_hyps) // self.num_beam_groups
+        batch_size = self.batch_size
+        num_rows, hyp_length = self._hyp_scores.shape[0], input_ids.shape[-1]
 
         if isinstance(eos_token_id, int):
             eos_token_id = [eos_token_id]
 
         # finalize all open beam hypotheses and add to generated hypotheses
-        for batch_group_idx, beam_hyp in enumerate(self._beam_hyps):
-            if self._done[batch_group_idx]:
-                continue
-
-            # all open beam hypotheses are added to the beam hypothesis
-            # beam hypothesis class automatically keeps the best beams
-            for index_per_group in range(self.group_size):
-                batch_beam_idx = batch_group_idx * self.group_size + index_per_group
-                final_score = final_beam_scores[batch_beam_idx].item()
-                final_tokens = input_ids[batch_beam_idx]
-                beam_index = beam_indices[batch_beam_idx] if beam_indices is not None else None
-                beam_hyp.add(final_tokens, final_score, beam_indices=beam_index)
-
-        # select the best hypotheses
-        sent_lengths = input_ids.new(batch_size * self.num_beam_hyps_to_keep)
-        best = []
-        best_indices = []
-        best_scores = torch.zeros(batch_size * self.num_beam_hyps_to_keep, device=self.device, dtype=torch.float32)
-
-        # retrieve best hypotheses
-        for i in range(batch_size):
-            beam_hyps_in_batch = self._beam_hyps[i * self.num_beam_groups : (i + 1) * self.num_beam_groups]
-            candidate_beams = [beam for beam_hyp in beam_hyps_in_batch for beam in beam_hyp.beams]
-            sorted_hyps = sorted(candidate_beams, key=lambda x: x[0])
-            for j in range(self.num_beam_hyps_to_keep):
-                best_hyp_tuple = sorted_hyps.pop()
-                best_score = best_hyp_tuple[0]
-                best_hyp = best_hyp_tuple[1]
-                best_index = best_hyp_tuple[2]
-                sent_lengths[self.num_beam_hyps_to_keep * i + j] = len(best_hyp)
+        is_open = ~self._done.unsqueeze(-1).expand(-1, self.group_size)
+        if is_open.any():
+            rows = torch.arange(num_rows, device=self.device)
+            batch_beam_idx = torch.arange(num_rows * self.group_size).view(num_rows, self.group_size)
+            final_scores = final_beam_scores.view(num_rows, self.group_size).to(self._score_dtype)
+            final_beam_indices = None
+            if beam_indices is not None:
+                final_beam_indices = self._beam_indices_to_tensor(beam_indices, batch_beam_idx, is_open.cpu())
+            self._add_hypotheses(
+                rows,
+                final_scores.to(self.device) / (hyp_length**self.length_penalty),
+                is_open,
+                input_ids.view(num_rows, self.group_size, hyp_length).to(self.device),
+                beam_indices=final_beam_indices,
+            )
 
-                # append hyp to lists
-                best.append(best_hyp)
+        # select the best hypotheses, across the groups of beams of each batch item. As the hypotheses used to be
+        # sorted in ascending order and popped from the end, the last one wins ties.
+        scores = self._hyp_scores.view(batch_size, -1)
+        scores = scores.masked_fill(~self._hyp_is_set.view(batch_size, -1), float("-inf"))
+        best = torch.sort(scores, dim=-1, stable=True).indices.flip(-1)[:, : self.num_beam_hyps_to_keep]
+        best = (best + torch.arange(batch_size, device=self.device).unsqueeze(-1) * scores.shape[-1]).view(-1)
 
-                # append indices to list
-                best_indices.append(best_index)
-
-                best_scores[i * self.num_beam_hyps_to_keep + j] = best_score
+        best_scores = self._hyp_scores.view(-1)[best].to(torch.float32)
+        sent_lengths = self._hyp_lengths.view(-1)[best].to(input_ids.device)
+        best_hyps = self._hyp_tokens.view(-1, self._hyp_tokens.shape[-1])[best].to(input_ids.device)
 
         # prepare for adding eos
         sent_lengths_max = sent_lengths.max().item() + 1
         sent_max_len = min(sent_lengths_max, max_length) if max_length is not None else sent_lengths_max
         decoded: torch.LongTensor = input_ids.new(batch_size * self.num_beam_hyps_to_keep, sent_max_len)
 
-        if len(best_indices) > 0 and best_indices[0] is not None:
-            indices: torch.LongTensor = input_ids.new(batch_size * self.num_beam_hyps_to_keep, sent_max_len)
-        else:
-            indices = None
-
         # shorter batches are padded if needed
         if sent_lengths.min().item() != sent_lengths.max().item():
             if pad_token_id is None:
                 raise ValueError("`pad_token_id` has to be defined")
             decoded.fill_(pad_token_id)
 
-        if indices is not None:
-            indices.fill_(-1)
-
         # fill with hypotheses and eos_token_id if the latter fits in
-        for i, (hypo, best_idx) in enumerate(zip(best, best_indices)):
-            decoded[i, : sent_lengths[i]] = hypo
-
-            if indices is not None:
-                indices[i, : len(best_idx)] = torch.tensor(best_idx)
-
-            if sent_lengths[i] < sent_max_len:
-                # inserting only the first eos_token_id
-                decoded[i, sent_lengths[i]] = eos_token_id[0]
+        positions = torch.arange(sent_max_len, device=input_ids.device)
+        copy_width = min(sent_max_len, best_hyps.shape[-1])
+        is_hyp_token = positions[:copy_width] < sent_lengths.unsqueeze(-1)
+        decoded[:, :copy_width] = torch.where(is_hyp_token, best_hyps[:, :copy_width], decoded[:, :copy_width])
+        is_eos_position = positions == sent_lengths.unsqueeze(-1)
+        if eos_token_id is not None:
+            # inserting only the first eos_token_id
+            decoded.masked_fill_(is_eos_position, eos_token_id[0])
+
+        indices = None
+        if self._hyp_beam_indices is not None:
+            indices = input_ids.new_full((batch_size * self.num_beam_hyps_to_keep, sent_max_len), -1)
+            best_beam_indices = self._hyp_beam_indices.view(-1, self._hyp_beam_indices.shape[-1])[best]
+            copy_width = min(sent_max_len, best_beam_indices.shape[-1])
+            indices[:, :copy_width] = best_beam_indices[:, :copy_width].to(input_ids.device)
 
         return UserDict(
             {
@@ -411,6 +534,10 @@ class ConstrainedBeamSearchScorer(BeamScorer):
     r"""
     [`BeamScorer`] implementing constrained beam search decoding.
 
+    The constraints are compiled into a `ConstraintAutomaton`, and the scorer keeps the automaton state of each beam
+    from one step to the next. Advancing the beams, proposing the tokens that make progress through the constraints,
+    sorting the candidates into banks and pruning them are therefore batched tensor operations over all the beams of
+    the batch, instead of replaying every sequence through a [`ConstraintListState`].
 
     Args:
         batch_size (`int`):
@@ -464,6 +591,9 @@ class ConstrainedBeamSearchScorer(BeamScorer):
         self.num_beam_groups = num_beam_groups
         self.group_size = self.num_beams // self.num_beam_groups
         self.constraints = constraints
+        self.constraint_automaton = ConstraintAutomaton(constraints, device=device)
+        # `(length, last tokens, automaton states, sequence classes)` of the beams returned by the last `process` call
+        self._tracked_beams: Optional[Tuple[int, torch.LongTensor, torch.LongTensor, torch.LongTensor]] = None
 
         self._is_init = False
         self._beam_hyps = [
@@ -497,9 +627,25 @@ class ConstrainedBeamSearchScorer(BeamScorer):
         return [ConstraintListState([constraint.copy() for constraint in self.constraints]) for _ in range(n)]
 
     def check_completes_constraints(self, sequence):
-        new_state = self.make_constraint_states(1)[0]
-        new_state.reset(sequence)
-        return new_state.completed
+        states = self.constraint_automaton.run(torch.tensor([sequence], dtype=torch.long))
+        return self.constraint_automaton.is_completed(states)[0].item()
+
+    def _get_beam_states(self, input_ids: torch.LongTensor) -> Tuple[torch.LongTensor, torch.LongTensor]:
+        """
+        Returns the automaton state of each sequence of `input_ids`, and a class id per sequence such that two
+        sequences have the same class if and only if they are equal. They are carried over from the last `process` call
+        when `input_ids` are the beams it returned, and computed from the tokens otherwise.
+        """
+        if self._tracked_beams is not None:
+            length, last_tokens, states, classes = self._tracked_beams
+            if (
+                input_ids.shape == (last_tokens.shape[0], length)
+                and (input_ids[:, -1].to(self.device) == last_tokens).all()
+            ):
+                return states, classes
+        states = self.constraint_automaton.run(input_ids)
+        classes = torch.unique(input_ids, dim=0, return_inverse=True)[1].to(self.device)
+        return states, classes
 
     def process(
         self,
@@ -573,6 +719,10 @@ class ConstrainedBeamSearchScorer(BeamScorer):
         if isinstance(eos_token_id, int):
             eos_token_id = [eos_token_id]
 
+        beam_states, beam_classes = self._get_beam_states(input_ids)
+        completes_constraints = self.constraint_automaton.is_completed(beam_states).tolist()
+        is_active = ~self._done.to(device)
+
         for batch_idx, beam_hyp in enumerate(self._beam_hyps):
             if self._done[batch_idx]:
                 if self.num_beams < len(beam_hyp):
@@ -598,8 +748,7 @@ class ConstrainedBeamSearchScorer(BeamScorer):
                     if is_beam_token_worse_than_top_num_beams:
                         continue
 
-                    completes_constraint = self.check_completes_constraints(input_ids[batch_beam_idx].cpu().tolist())
-                    if completes_constraint:
+                    if completes_constraints[batch_beam_idx]:
                         if beam_indices is not None:
                             beam_index = beam_indices[batch_beam_idx]
                             beam_index = beam_index + (batch_beam_idx,)
@@ -622,19 +771,6 @@ class ConstrainedBeamSearchScorer(BeamScorer):
                 if beam_idx == self.group_size:
                     break
 
-            new_scores, new_tokens, new_indices = self.step_sentence_constraint(
-                batch_idx,
-                input_ids,
-                scores_for_all_vocab,
-                next_beam_scores[batch_idx],
-                next_beam_tokens[batch_idx],
-                next_beam_indices[batch_idx],
-            )
-
-            next_beam_scores[batch_idx] = new_scores
-            next_beam_tokens[batch_idx] = new_tokens
-            next_beam_indices[batch_idx] = new_indices
-
             if beam_idx < self.group_size:
                 raise ValueError(
                     f"At most {self.group_size} tokens in {next_tokens[batch_idx]} can be equal to `eos_token_id:"
@@ -646,6 +782,25 @@ class ConstrainedBeamSearchScorer(BeamScorer):
                 next_scores[batch_idx].max().item(), cur_len
             )
 
+        # the candidates of all the batch items that were not done are completed and pruned at once
+        new_scores, new_tokens, new_indices, new_states, new_keys = self._step_constraints(
+            beam_states,
+            beam_classes,
+            scores_for_all_vocab,
+            next_beam_scores,
+            next_beam_tokens,
+            next_beam_indices,
+            torch.arange(batch_size, device=device),
+        )
+        is_active = is_active.unsqueeze(-1)
+        next_beam_scores = torch.where(is_active, new_scores, next_beam_scores)
+        next_beam_tokens = torch.where(is_active, new_tokens, next_beam_tokens)
+        next_beam_indices = torch.where(is_active, new_indices, next_beam_indices)
+
+        # equal sequences extend equal sequences with the same token
+        new_classes = torch.unique(new_keys.view(-1), return_inverse=True)[1]
+        self._tracked_beams = (cur_len, next_beam_tokens.view(-1).to(self.device), new_states.view(-1), new_classes)
+
         return UserDict(
             {
                 "next_beam_scores": next_beam_scores.view(-1),
@@ -664,136 +819,141 @@ class ConstrainedBeamSearchScorer(BeamScorer):
         sent_beam_indices: torch.LongTensor,
         push_progress: bool = False,
     ):
-        # sent_beam_tokens are the next {num_beams} number of tokens that are under consideration for this beam
-        # (candidate next tokens)
+        beam_states, beam_classes = self._get_beam_states(input_ids)
+        new_scores, new_tokens, new_indices, _, _ = self._step_constraints(
+            beam_states,
+            beam_classes,
+            vocab_scores,
+            sent_beam_scores.unsqueeze(0),
+            sent_beam_tokens.unsqueeze(0),
+            sent_beam_indices.unsqueeze(0),
+            torch.tensor([batch_idx], device=sent_beam_indices.device),
+            push_progress=push_progress,
+        )
+        return new_scores[0], new_tokens[0], new_indices[0]
+
+    def _step_constraints(
+        self,
+        beam_states: torch.LongTensor,
+        beam_classes: torch.LongTensor,
+        vocab_scores: torch.FloatTensor,
+        sent_beam_scores: torch.FloatTensor,
+        sent_beam_tokens: torch.LongTensor,
+        sent_beam_indices: torch.LongTensor,
+        batch_indices: torch.LongTensor,
+        push_progress: bool = False,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        # sent_beam_tokens are the next {num_beams} number of tokens that are under consideration for each of the batch
+        # items `batch_indices` (candidate next tokens). They come from the beams `sent_beam_indices`, across all the
+        # batches, whose automaton states and sequence classes are `beam_states` and `beam_classes`.
 
         # 1. Adding "advance_tokens"
-        #     using ConstraintStateList.advance(), we propose new tokens to be added into this "candidate list" that will
-        #     advance us in fulfilling the constraints.
+        #     using the automaton, we propose new tokens to be added into this "candidate list" that will advance us in
+        #     fulfilling the constraints.
 
         # 2. Selecting best candidates such that we end up with highest probable candidates
         #     that fulfill our constraints.
 
-        orig_len = sent_beam_indices.size(0)
-        device = sent_beam_indices.device
-
-        # initialize states
-        topk_contraint_states = self.make_constraint_states(orig_len)
-        advance_constraint_states = self.make_constraint_states(orig_len)
-
-        sidx, eidx = batch_idx * orig_len, (batch_idx + 1) * orig_len
-        this_batch_input_ids = input_ids[sidx:eidx]
-        this_batch_token_scores = vocab_scores[sidx:eidx]
-        full_hypotheses = torch.cat((input_ids[sent_beam_indices], sent_beam_tokens.unsqueeze(-1)), dim=-1)
-
-        # need to make new hypothesis that advance the constraints
-        track_new = {
-            "new_seqs": full_hypotheses.tolist(),
-            "new_states": [],
-            "new_indices": [],
-            "new_tokens": [],
-            "new_scores": [],
-        }
-        for seq_idx, pre_seq in enumerate(this_batch_input_ids):
-            # pre_seq = ith sequence generated before this step.
-
-            # input_ids -> (topk) generic beam search best model next tokens
-            #           -> (advance) constraints forcing the next token
-            # either way, we need to sort them into "banks" later, so store a "ConstraintListState" for all types of
-            # hypotheses.
-
-            topk_state = topk_contraint_states[seq_idx]
-            topk_state.reset(full_hypotheses[seq_idx].cpu().tolist())
-
-            advance_state = advance_constraint_states[seq_idx]
-            advance_state.reset(pre_seq.cpu().tolist())
-
-            if not advance_state.completed:
-                advance_tokens = torch.LongTensor(advance_state.advance()).to(device)
-                for advance_token in advance_tokens:
-                    # since adding each `advance_token` leads to a different hypothesis, create new state instance.
-                    new_state = advance_state.copy(stateful=True)
-                    new_state.add(advance_token.cpu().tolist())
-
-                    advance_seq = torch.cat((pre_seq, advance_token.unsqueeze(0)), -1).cpu().tolist()
-                    if advance_seq not in track_new["new_seqs"]:
-                        # prevent duplicates, which are basically bound to happen in this process.
-                        track_new["new_seqs"].append(advance_seq)
-                        track_new["new_indices"].append(sidx + seq_idx)  # idx -> global idx across all the batches
-                        track_new["new_tokens"].append(advance_token)
-                        track_new["new_scores"].append(this_batch_token_scores[seq_idx].take(advance_token))
-                        track_new["new_states"].append(new_state)
-            elif push_progress:
-                # Basically, `sent_beam_indices` often chooses very little among `input_ids` the generated sequences that
-                # actually fulfill our constraints. For example, let constraints == ["loves pies"] and
-
-                #     pre_seq_1 = "The child loves pies and" pre_seq_2 = "The child plays in the playground and"
-
-                # Without this step, if `sent_beam_indices` is something like [1,1], then
-                #     1. `pre_seq_1` won't be added to the list of (topk) hypothesis since it's not in the indices and
-                #     2.  it won't be added to the list of (advance) hypothesis since it's completed already. (this is
-                #         the else part of `if constraints_completed[seq_idx]`)
-                #     3. it ends up simply getting removed from consideration.
-
-                # #3 might be fine and actually desired, since it's likely that it's a low-probability output anyways,
-                # especially if it's not in the list of `sent_beam_indices`. But this often leads to lengthened beam
-                # search times, since completed sequences keep getting removed after all this effort for constrained
-                # generation.
-
-                # Here, we basically take `pre_seq_1` and to "push" it into the considered list of hypotheses, by simply
-                # appending the next likely token in the vocabulary and adding it to the list of hypotheses.
-
-                new_score, new_token = torch.max(this_batch_token_scores[seq_idx], 0)  # some next probable token
-                advance_seq = torch.cat((pre_seq, new_token.unsqueeze(0)), -1)
-
-                advance_state = advance_constraint_states[seq_idx]
-
-                advance_seq = advance_seq.cpu().tolist()
-
-                advance_state.reset(advance_seq)
-                if advance_seq not in track_new["new_seqs"]:
-                    # but still don't want to have duplicates
-                    track_new["new_seqs"].append(advance_seq)
-                    track_new["new_indices"].append(seq_idx)
-                    track_new["new_tokens"].append(new_token)
-                    track_new["new_scores"].append(new_score)
-                    track_new["new_states"].append(advance_state)
-
-        if len(track_new["new_indices"]) > 0:
-            new_indices = torch.tensor(track_new["new_indices"]).to(device)
-            new_tokens = torch.stack(track_new["new_tokens"]).to(device)
-            new_scores = torch.stack(track_new["new_scores"]).to(device)
-
-            all_states = topk_contraint_states + track_new["new_states"]
-            all_tokens = torch.cat((sent_beam_tokens, new_tokens), -1)
-            all_scores = torch.cat((sent_beam_scores, new_scores), -1)
-            all_banks = torch.tensor([one.get_bank() for one in all_states]).to(device)
-
-            zipped = all_banks * 100 + all_scores
-            indices = zipped.sort(descending=True).indices
-            sorted_banks = all_banks[indices]
-
-            # Then we end up with {sorted among bank C}, {sorted among bank C-1}, ..., {sorted among bank 0}
-
-            counter = -1
-            cur_bank = sorted_banks[0]
-            increments = []
-            for bank in sorted_banks:
-                if bank == cur_bank:
-                    counter += 1
-                else:
-                    counter = 0
-                    cur_bank = bank
-                increments.append(counter)
-            rearrangers = torch.tensor(np.argsort(increments, kind="mergesort"))
-
-            indices = indices[rearrangers][:orig_len]
+        # Besides the scores, tokens and beam indices of the selected candidates, their automaton states and keys are
+        # returned, two candidates being the same sequence if and only if they have the same key.
 
-            sent_beam_scores = all_scores[indices]
-            sent_beam_tokens = all_tokens[indices]
-            sent_beam_indices = torch.cat((sent_beam_indices, new_indices))[indices]
-
-        return sent_beam_scores, sent_beam_tokens, sent_beam_indices
+        automaton = self.constraint_automaton
+        num_rows, orig_len = sent_beam_indices.shape
+        device = sent_beam_indices.device
+        vocab_size = vocab_scores.shape[-1]
+        beam_states, beam_classes = beam_states.to(device), beam_classes.to(device)
+
+        # input_ids -> (topk) generic beam search best model next tokens
+        #           -> (advance) constraints forcing the next token
+        # either way, we need to sort them into "banks" later, so compute the automaton state of all the hypotheses.
+        topk_states = automaton.step(beam_states[sent_beam_indices], sent_beam_tokens)
+
+        # the `orig_len` beams of each batch item, and their advance tokens among the tokens of the constraints
+        batch_beam_idx = batch_indices.unsqueeze(-1) * orig_len + torch.arange(orig_len, device=device)
+        pre_states = beam_states[batch_beam_idx]
+        alphabet = automaton.alphabet.to(device)
+        is_advance, advance_states = automaton.advance(pre_states)
+        advance_tokens = alphabet.expand(num_rows, orig_len, -1)
+        advance_indices = batch_beam_idx.unsqueeze(-1).expand_as(advance_tokens)
+        advance_scores = vocab_scores[batch_beam_idx.unsqueeze(-1), alphabet]
+
+        all_scores = [sent_beam_scores, advance_scores.reshape(num_rows, -1)]
+        all_tokens = [sent_beam_tokens, advance_tokens.reshape(num_rows, -1)]
+        all_indices = [sent_beam_indices, advance_indices.reshape(num_rows, -1)]
+        all_states = [topk_states, advance_states.view(num_rows, -1)]
+        is_candidate = [torch.ones_like(sent_beam_tokens, dtype=torch.bool), is_advance.view(num_rows, -1)]
+
+        if push_progress:
+            # Basically, `sent_beam_indices` often chooses very little among `input_ids` the generated sequences that
+            # actually fulfill our constraints. For example, let constraints == ["loves pies"] and
+
+            #     pre_seq_1 = "The child loves pies and" pre_seq_2 = "The child plays in the playground and"
+
+            # Without this step, if `sent_beam_indices` is something like [1,1], then
+            #     1. `pre_seq_1` won't be added to the list of (topk) hypothesis since it's not in the indices and
+            #     2.  it won't be added to the list of (advance) hypothesis since it's completed already.
+            #     3. it ends up simply getting removed from consideration.
+
+            # #3 might be fine and actually desired, since it's likely that it's a low-probability output anyways,
+            # especially if it's not in the list of `sent_beam_indices`. But this often leads to lengthened beam
+            # search times, since completed sequences keep getting removed after all this effort for constrained
+            # generation.
+
+            # Here, we basically take `pre_seq_1` and to "push" it into the considered list of hypotheses, by simply
+            # appending the next likely token in the vocabulary and adding it to the list of hypotheses.
+            push_scores, push_tokens = vocab_scores[batch_beam_idx].max(-1)  # some next probable token
+            all_scores.append(push_scores)
+            all_tokens.append(push_tokens)
+            all_indices.append(batch_beam_idx)
+            all_states.append(automaton.step(pre_states, push_tokens))
+            is_candidate.append(automaton.is_completed(pre_states))
+
+        all_scores = torch.cat(all_scores, dim=-1)
+        all_tokens = torch.cat(all_tokens, dim=-1)
+        all_indices = torch.cat(all_indices, dim=-1)
+        all_states = torch.cat(all_states, dim=-1)
+        is_candidate = torch.cat(is_candidate, dim=-1)
+        all_keys = beam_classes[all_indices] * vocab_size + all_tokens
+        num_candidates = all_keys.shape[-1]
+
+        # prevent duplicates, which are basically bound to happen in this process: a new hypothesis is only kept if
+        # it is the first occurrence of its sequence (the topk hypotheses come first, and are all kept)
+        positions = torch.arange(num_candidates, device=device)
+        all_keys = torch.where(is_candidate, all_keys, -1 - positions)
+        sorted_keys, key_order = torch.sort(all_keys, dim=-1, stable=True)
+        is_first = torch.ones_like(is_candidate)
+        is_first[:, 1:] = sorted_keys[:, 1:] != sorted_keys[:, :-1]
+        is_first = torch.empty_like(is_first).scatter_(-1, key_order, is_first)
+        is_new = positions >= orig_len
+        is_kept = is_candidate & (is_first | ~is_new)
+
+        all_banks = automaton.bank(all_states)
+        zipped = (all_banks * 100 + all_scores).masked_fill(~is_kept, float("-inf"))
+        indices = zipped.sort(dim=-1, descending=True, stable=True).indices
+        # the candidates that are not kept go last, even behind kept ones scored `-inf`
+        indices = indices.gather(-1, torch.sort((~is_kept).gather(-1, indices).long(), dim=-1, stable=True).indices)
+        sorted_banks = all_banks.gather(-1, indices)
+
+        # Then we end up with {sorted among bank C}, {sorted among bank C-1}, ..., {sorted among bank 0}, and the
+        # candidates are taken in turns from each of these runs of banks
+        is_run_start = torch.ones_like(is_kept)
+        is_run_start[:, 1:] = sorted_banks[:, 1:] != sorted_banks[:, :-1]
+        run_starts = torch.where(is_run_start, positions, 0).cummax(dim=-1).values
+        increments = (positions - run_starts).masked_fill(~is_kept.gather(-1, indices), num_candidates)
+        rearrangers = torch.sort(increments, dim=-1, stable=True).indices
+        indices = indices.gather(-1, rearrangers)[:, :orig_len]
+
+        # the topk hypotheses are left untouched when there is no new hypothesis
+        has_new = (is_kept & is_new).any(-1, keepdim=True)
+        indices = torch.where(has_new, indices, positions[:orig_len])
+
+        return (
+            all_scores.gather(-1, indices),
+            all_tokens.gather(-1, indices),
+            all_indices.gather(-1, indices),
+            all_states.gather(-1, indices),
+            all_keys.gather(-1, indices),
+        )
 
     def finalize(
         self,
@@ -811,6 +971,8 @@ class ConstrainedBeamSearchScorer(BeamScorer):
         if isinstance(eos_token_id, int):
             eos_token_id = [eos_token_id]
 
+        completes_constraints = self.constraint_automaton.is_completed(self._get_beam_states(input_ids)[0]).tolist()
+
         # finalize all open beam hypotheses and add to generated hypotheses
         for batch_idx, beam_hyp in enumerate(self._beam_hyps):
             if self._done[batch_idx]:
@@ -825,8 +987,7 @@ class ConstrainedBeamSearchScorer(BeamScorer):
                 final_score = final_beam_scores[batch_beam_idx].item()
                 final_tokens = input_ids[batch_beam_idx]
 
-                completes_constraint = self.check_completes_constraints(final_tokens.cpu().tolist())
-                if completes_constraint:
+                if completes_constraints[batch_beam_idx]:
                     beam_index = beam_indices[batch_beam_idx] if beam_indices is not None else None
                     beam_hyp.add(final_tokens, final_score, beam_indices=beam_index)
                     ids_collect.append(beam_id)
@@ -0,0 +1,401 @@
+# coding=utf-8
+# Copyright 2023 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+import torch
+from torch import nn
+
+from ..cache_utils import Cache
+
+
+if TYPE_CHECKING:
+    from ..modeling_utils import PreTrainedModel
+    from .logits_process import LogitsProcessorList
+
+
+class CandidateGenerator:
+    """Abstract base class for all the candidate generators that can be used in assisted decoding."""
+
+    def get_candidates(
+        self, input_ids: torch.LongTensor, attention_mask: Optional[torch.LongTensor] = None, num_branches: int = 1
+    ) -> Tuple[torch.LongTensor, Optional[torch.FloatTensor]]:
+        """
+        Fetches the candidate continuations of the current sequences.
+
+        Args:
+            input_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
+                The sequences generated so far.
+            attention_mask (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
+                The attention mask of `input_ids`, for decoder-only models.
+            num_branches (`int`, *optional*, defaults to 1):
+                The number of candidate continuations of each sequence, which share no first token when possible.
+
+        Return:
+            `Tuple[torch.LongTensor, Optional[torch.FloatTensor]]`: The candidate sequences, of shape `(batch_size *
+            num_branches, sequence_length + num_candidate_tokens)`, where the branches of the `i`-th sequence are the
+            rows `i * num_branches` to `(i + 1) * num_branches - 1`. A generator that has fewer branches to offer may
+            return a single one per sequence, and `num_candidate_tokens` may be 0. Then, the probabilities the
+            candidate tokens were sampled from, of shape `(batch_size * num_branches, num_candidate_tokens,
+            vocab_size)`, or `None` if the candidates were picked deterministically.
+        """
+        raise NotImplementedError(
+            f"{self.__class__} is an abstract class. Only classes inheriting this class can call `get_candidates`."
+        )
+
+    def update_candidate_strategy(
+        self, input_ids: torch.LongTensor, selected_rows: Optional[torch.LongTensor], num_matches: int
+    ):
+        """
+        Updates the candidate generator once the candidates have been verified.
+
+        Args:
+            input_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
+                The sequences, including the tokens that were just accepted.
+            selected_rows (`torch.LongTensor` of shape `(batch_size,)`, *optional*):
+                For each sequence, the row of its selected branch in the candidates returned by `get_candidates`.
+                `None` when a single branch was drafted.
+            num_matches (`int`):
+                The number of candidate tokens accepted for every sequence.
+        """
+        raise NotImplementedError(
+            f"{self.__class__} is an abstract class. Only classes inheriting this class can call "
+            "`update_candidate_strategy`."
+        )
+
+
+class AssistedCandidateGenerator(CandidateGenerator):
+    """
+    Drafts the candidates with an assistant model, which has to share the tokenizer of the main model. The assistant
+    picks its tokens like the main model would: greedily, or by sampling from its processed and warped distribution.
+
+    Args:
+        assistant_model (`PreTrainedModel`):
+            The model used to draft the candidates. The number of candidate tokens is stored in its
+            `max_assistant_tokens` attribute, and updated after each verification: it grows by 2 when all the
+            candidates were accepted, and shrinks by 1 otherwise.
+        model_kwargs (`Dict`):
+            The keyword arguments of the main model. They hold the encoder outputs of the assistant (as
+            `assistant_encoder_outputs`) and the encoder attention mask, for encoder-decoder assistants.
+        logits_processor (`LogitsProcessorList`):
+            The processors applied to the logits of the main model.
+        logits_warper (`LogitsProcessorList`, *optional*):
+            The warpers applied to the logits of the main model, when sampling.
+        do_sample (`bool`, *optional*, defaults to `False`):
+            Whether the candidates are sampled or picked greedily.
+        eos_token_id (`List[int]`, *optional*):
+            The end-of-sequence tokens: drafting stops once every candidate sequence contains one of them.
+        max_length (`int`, *optional*):
+            The maximum length of the generated sequences, beyond which no candidate is drafted.
+    """
+
+    def __init__(
+        self,
+        assistant_model: "PreTrainedModel",
+        model_kwargs: Dict[str, Any],
+        logits_processor: "LogitsProcessorList",
+        logits_warper: Optional["LogitsProcessorList"] = None,
+        do_sample: bool = False,
+        eos_token_id: Optional[List[int]] = None,
+        max_length: Optional[int] = None,
+    ):
+        if not hasattr(assistant_model, "max_assistant_tokens"):
+            assistant_model.max_assistant_tokens = 5  # this value, which will be updated, persists across calls
+        self.assistant_model = assistant_model
+        self.logits_processor = logits_processor
+        self.logits_warper = logits_warper
+        self.do_sample = do_sample
+        self.eos_token_id = eos_token_id
+        self.max_length = max_length
+
+        self.past_key_values = None
+        if assistant_model.config.is_encoder_decoder:
+            self.encoder_outputs = model_kwargs["assistant_encoder_outputs"]
+            self.encoder_attention_mask = model_kwargs.get("attention_mask")
+        # bloom is special: its key states have the sequence length in their last dimension
+        self.kv_indexing = (
+            1
+            if "bloom" in assistant_model.__class__.__name__.lower()
+            or (
+                assistant_model.config.architectures is not None
+                and "bloom" in assistant_model.config.architectures[0].lower()
+            )
+            else 0
+        )
+
+    def _forward(self, input_ids: torch.LongTensor, attention_mask: torch.LongTensor, num_new_tokens: int):
+        # TODO (joao): make it compatible with models that use unconventional fwd pass logic, like blip2
+        if self.assistant_model.config.is_encoder_decoder:
+            return self.assistant_model(
+                decoder_input_ids=input_ids[:, -num_new_tokens:],
+                attention_mask=self.encoder_attention_mask,
+                encoder_outputs=self.encoder_outputs,
+                past_key_values=self.past_key_values,
+            )
+        model_inputs = _prepare_decoder_only_inputs(self.assistant_model, input_ids, attention_mask, num_new_tokens)
+        return self.assistant_model(**model_inputs, past_key_values=self.past_key_values)
+
+    def get_candidates(
+        self, input_ids: torch.LongTensor, attention_mask: Optional[torch.LongTensor] = None, num_branches: int = 1
+    ) -> Tuple[torch.LongTensor, Optional[torch.FloatTensor]]:
+        batch_size, cur_len = input_ids.shape
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        num_candidate_tokens = int(self.assistant_model.max_assistant_tokens)
+        if self.max_length is not None:
+            # candidates beyond `max_length` are discarded anyway
+            num_candidate_tokens = min(num_candidate_tokens, max(1, self.max_length - cur_len - 1))
+        eos_token_id_tensor = (
+            torch.tensor(self.eos_token_id, device=input_ids.device) if self.eos_token_id is not None else None
+        )
+
+        candidate_input_ids = input_ids
+        candidate_probs = []
+        has_eos = None
+        for step in range(num_candidate_tokens):
+            # 1. run the assistant on the tokens it hasn't seen yet: the whole sequence on the first call, then the
+            # last candidate, or the tokens picked by the main model since the previous call
+            if self.past_key_values is None:
+                num_new_tokens = candidate_input_ids.shape[1]
+            else:
+                num_new_tokens = candidate_input_ids.shape[1] - self.past_key_values[0][self.kv_indexing].shape[-2]
+            assistant_outputs = self._forward(candidate_input_ids, attention_mask, num_new_tokens)
+            self.past_key_values = assistant_outputs.past_key_values
+
+            # 2. pick the next candidate tokens, processing the logits like the main model does
+            next_token_logits = self.logits_processor(candidate_input_ids, assistant_outputs.logits[:, -1, :])
+            if self.do_sample:
+                next_token_logits = self.logits_warper(candidate_input_ids, next_token_logits)
+                probs = nn.functional.softmax(next_token_logits, dim=-1)
+
+            if step == 0 and num_branches > 1:
+                # the candidates form a tree that branches on its first token: each branch then becomes a row of its
+                # own, and is extended independently from the others
+                if self.do_sample:
+                    next_tokens = torch.multinomial(probs, num_samples=num_branches, replacement=True).view(-1)
+                    probs = probs.repeat_interleave(num_branches, dim=0)
+                else:
+                    next_tokens = next_token_logits.topk(num_branches, dim=-1).indices.view(-1)
+                branch_idx = torch.arange(batch_size, device=input_ids.device).repeat_interleave(num_branches)
+                candidate_input_ids = candidate_input_ids[branch_idx]
+                attention_mask = attention_mask[branch_idx]
+                self.past_key_values = self.assistant_model._reorder_past_key_values(self.past_key_values, branch_idx)
+            elif self.do_sample:
+                next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+            else:
+                next_tokens = next_token_logits.argmax(dim=-1)
+
+            candidate_input_ids = torch.cat((candidate_input_ids, next_tokens[:, None]), dim=-1)
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim=-1)
+            if self.do_sample:
+                candidate_probs.append(probs)
+
+            # 3. stop drafting once every candidate sequence contains an EOS token
+            if eos_token_id_tensor is not None:
+                is_eos = next_tokens[:, None].eq(eos_token_id_tensor).any(dim=-1)
+                has_eos = is_eos if has_eos is None else has_eos | is_eos
+                if has_eos.all():
+                    break
+
+        candidate_probs = torch.stack(candidate_probs, dim=1) if self.do_sample else None
+        return candidate_input_ids, candidate_probs
+
+    def update_candidate_strategy(
+        self, input_ids: torch.LongTensor, selected_rows: Optional[torch.LongTensor], num_matches: int
+    ):
+        if selected_rows is not None:
+            self.past_key_values = self.assistant_model._reorder_past_key_values(self.past_key_values, selected_rows)
+        # discards the states of the rejected candidates. The assistant hasn't seen the last token picked by the main
+        # model yet, hence the -1
+        self.past_key_values = _crop_past_key_values(
+            self.assistant_model, self.past_key_values, input_ids.shape[-1] - 1
+        )
+
+        # the number of candidate tokens grows when they are all accepted, and shrinks otherwise. This is a simple
+        # heuristic, that balances the benefits of getting candidates right with the cost of drafting wrong ones.
+        if num_matches == int(self.assistant_model.max_assistant_tokens):
+            self.assistant_model.max_assistant_tokens += 2.0
+        else:
+            self.assistant_model.max_assistant_tokens = max(1.0, self.assistant_model.max_assistant_tokens - 1.0)
+
+
+class PromptLookupCandidateGenerator(CandidateGenerator):
+    """
+    Drafts the candidates without an assistant model, by looking up the last tokens of each sequence in its earlier
+    tokens (the prompt and the tokens generated so far): the tokens that followed the most recent earlier occurrence
+    of the longest matching n-gram are proposed as candidates. This works well when the output copies spans of the
+    input, as in summarization, code editing or retrieval-augmented question answering.
+
+    The n-grams of each sequence are indexed incrementally: every call only indexes the n-grams ending at the tokens
+    added since the previous call, so a lookup costs a few dictionary accesses regardless of the sequence length.
+
+    Args:
+        num_output_tokens (`int`, *optional*, defaults to 10):
+            The maximum number of candidate tokens proposed for each sequence.
+        max_matching_ngram_size (`int`, *optional*, defaults to 2):
+            The size of the largest n-gram looked up. Shorter n-grams, down to a single token, are looked up when it
+            has no earlier occurrence.
+        max_length (`int`, *optional*):
+            The maximum length of the generated sequences, beyond which no candidate is proposed.
+    """
+
+    def __init__(
+        self, num_output_tokens: int = 10, max_matching_ngram_size: int = 2, max_length: Optional[int] = None
+    ):
+        if num_output_tokens < 1 or max_matching_ngram_size < 1:
+            raise ValueError(
+                "`prompt_lookup_num_tokens` and `max_matching_ngram_size` have to be strictly positive integers, but "
+                f"are {num_output_tokens} and {max_matching_ngram_size}."
+            )
+        self.num_output_tokens = num_output_tokens
+        self.max_matching_ngram_size = max_matching_ngram_size
+        self.max_length = max_length
+        # for each sequence, its tokens, and the end positions of the earlier occurrences of each of its n-grams
+        self._token_ids: List[List[int]] = []
+        self._ngram_index: List[Dict[Tuple[int, ...], List[int]]] = []
+
+    def _update_index(self, input_ids: torch.LongTensor):
+        if len(self._token_ids) == 0:
+            self._token_ids = [[] for _ in range(input_ids.shape[0])]
+            self._ngram_index = [{} for _ in range(input_ids.shape[0])]
+        num_known_tokens = len(self._token_ids[0])
+        new_token_ids = input_ids[:, num_known_tokens:].tolist()
+        for token_ids, ngram_index, new_ids in zip(self._token_ids, self._ngram_index, new_token_ids):
+            token_ids.extend(new_ids)
+            # only the n-grams followed by at least one token can be matched, hence the -1
+            for end in range(max(num_known_tokens - 1, 0), len(token_ids) - 1):
+                for ngram_size in range(1, min(self.max_matching_ngram_size, end + 1) + 1):
+                    ngram = tuple(token_ids[end - ngram_size + 1 : end + 1])
+                    ngram_index.setdefault(ngram, []).append(end)
+
+    def _lookup(self, row: int, num_branches: int, num_tokens: int) -> List[List[int]]:
+        """Returns up to `num_branches` continuations of the sequence `row`, starting with different tokens."""
+        token_ids = self._token_ids[row]
+        ngram_index = self._ngram_index[row]
+        continuations = []
+        first_tokens = set()
+        for ngram_size in range(min(self.max_matching_ngram_size, len(token_ids)), 0, -1):
+            for end in reversed(ngram_index.get(tuple(token_ids[-ngram_size:]), [])):
+                continuation = token_ids[end + 1 : end + 1 + num_tokens]
+                if continuation[0] not in first_tokens:
+                    first_tokens.add(continuation[0])
+                    continuations.append(continuation)
+                    if len(continuations) == num_branches:
+                        return continuations
+        return continuations
+
+    def get_candidates(
+        self, input_ids: torch.LongTensor, attention_mask: Optional[torch.LongTensor] = None, num_branches: int = 1
+    ) -> Tuple[torch.LongTensor, Optional[torch.FloatTensor]]:
+        batch_size, cur_len = input_ids.shape
+        num_tokens = self.num_output_tokens
+        if self.max_length is not None:
+            # candidates beyond `max_length` are discarded anyway
+            num_tokens = min(num_tokens, max(1, self.max_length - cur_len - 1))
+
+        self._update_index(input_ids)
+        continuations = [self._lookup(row, num_branches, num_tokens) for row in range(batch_size)]
+        num_branches = max(1, max(len(row_continuations) for row_continuations in continuations))
+        num_candidate_tokens = max(
+            (len(continuation) for row_continuations in continuations for continuation in row_continuations),
+            default=0,
+        )
+        if num_candidate_tokens == 0:
+            return input_ids, None
+
+        # the sequences with fewer matches get filler candidates: any token is a valid candidate, as all of them are
+        # verified by the model, and repeating the last token of the sequence sometimes gets them accepted
+        candidates = []
+        for row, row_continuations in enumerate(continuations):
+            last_token = self._token_ids[row][-1]
+            row_continuations = row_continuations + row_continuations[:1] * (num_branches - len(row_continuations))
+            for continuation in row_continuations or [[]] * num_branches:
+                candidates.append(continuation + [last_token] * (num_candidate_tokens - len(continuation)))
+        candidates = torch.tensor(candidates, dtype=input_ids.dtype, device=input_ids.device)
+        candidate_input_ids = torch.cat([input_ids.repeat_interleave(num_branches, dim=0), candidates], dim=-1)
+        return candidate_input_ids, None
+
+    def update_candidate_strategy(
+        self, input_ids: torch.LongTensor, selected_rows: Optional[torch.LongTensor], num_matches: int
+    ):
+        # the index is updated with the accepted tokens on the next call to `get_candidates`
+        return
+
+
+def _prepare_decoder_only_inputs(
+    model: "PreTrainedModel", input_ids: torch.LongTensor, attention_mask: torch.LongTensor, num_new_tokens: int
+) -> Dict[str, torch.Tensor]:
+    """
+    Prepares the inputs of a forward pass of a decoder-only model over the last `num_new_tokens` tokens of
+    `input_ids`. The position ids, if the model derives them from the attention mask, are computed over the whole
+    sequence, so that left-padded batches get the same positions as in the other generation methods.
+    """
+    model_inputs = {"input_ids": input_ids[:, -num_new_tokens:], "attention_mask": attention_mask}
+    position_ids = model.prepare_inputs_for_generation(input_ids, attention_mask=attention_mask).get("position_ids")
+    if position_ids is not None:
+        model_inputs["position_ids"] = position_ids[:, -num_new_tokens:]
+    return model_inputs
+
+
+def _crop_past_key_values(model, past_key_values, maximum_length):
+    """Crops the past key values up to a certain maximum length."""
+    if isinstance(past_key_values, Cache):
+        past_key_values.crop(maximum_length)
+        return past_key_values
+
+    new_past = []
+    if model.config.is_encoder_decoder:
+        for idx in range(len(past_key_values)):
+            new_past.append(
+                (
+                    past_key_values[idx][0][:, :, :maximum_length, :],
+                    past_key_values[idx][1][:, :, :maximum_length, :],
+                    past_key_values[idx][2],
+                    past_key_values[idx][3],
+                )
+            )
+        past_key_values = tuple(new_past)
+    # bloom is special
+    elif "bloom" in model.__class__.__name__.lower() or (
+        model.config.architectures is not None and "bloom" in model.config.architectures[0].lower()
+    ):
+        for idx in range(len(past_key_values)):
+            new_past.append(
+                (
+                    past_key_values[idx][0][:, :, :maximum_length],
+                    past_key_values[idx][1][:, :maximum_length, :],
+                )
+            )
+        past_key_values = tuple(new_past)
+    # gptbigcode is too
+    elif "gptbigcode" in model.__class__.__name__.lower() or (
+        model.config.architectures is not None and "gptbigcode" in model.config.architectures[0].lower()
+    ):
+        if model.config.multi_query:
+            for idx in range(len(past_key_values)):
+                past_key_values[idx] = past_key_values[idx][:, :maximum_length, :]
+        else:
+            for idx in range(len(past_key_values)):
+                past_key_values[idx] = past_key_values[idx][:, :, :maximum_length, :]
+    else:
+        for idx in range(len(past_key_values)):
+            new_past.append(
+                (
+                    past_key_values[idx][0][:, :, :maximum_length, :],
+                    past_key_values[idx][1][:, :, :maximum_length, :],
+                )
+            )
+        past_key_values = tuple(new_past)
+    return past_key_values
@@ -35,6 +35,8 @@ from ..utils import (
 
 logger = logging.get_logger(__name__)
 
+ALL_CACHE_IMPLEMENTATIONS = ["static", "paged", "sink", "quantized"]
+
 
 class GenerationConfig(PushToHubMixin):
     r"""
@@ -56,7 +58,7 @@ class GenerationConfig(PushToHubMixin):
         - *constrained beam-search decoding* by calling [`~generation.GenerationMixin.constrained_beam_search`], if
             `constraints!=None` or `force_words_ids!=None`
         - *assisted decoding* by calling [`~generation.GenerationMixin.assisted_decoding`], if
-            `assistant_model` is passed to `.generate()`
+            `assistant_model` is passed to `.generate()` or `prompt_lookup_num_tokens` is set
 
     You do not need to call any of the above methods directly. Pass custom parameter values to '.generate()'. To learn
     more about decoding strategies refer to the [text generation strategies guide](../generation_strategies).
@@ -98,6 +100,53 @@ class GenerationConfig(PushToHubMixin):
         use_cache (`bool`, *optional*, defaults to `True`):
             Whether or not the model should use the past last key/values attentions (if applicable to the model) to
             speed up decoding.
+        cache_implementation (`str`, *optional*):
+            The [`Cache`] class `generate` should instantiate to hold the past key/values, instead of the legacy
+            tuple-of-tuples format. Only models with `_supports_cache_class = True` accept it. Can be one of:
+
+                - `"static"`: [`StaticCache`], which preallocates the cache up to `max_length` tokens and fills it in
+                  place, avoiding a reallocation of the cache at every decoding step.
+                - `"paged"`: [`PagedCache`], which stores the cache in reference-counted blocks, so that beam search
+                  and `num_return_sequences` share the blocks of the prompt instead of copying them.
+                - `"sink"`: [`SinkCache`], which only keeps the `num_sink_tokens` first tokens and the most recent
+                  ones, up to `cache_window_length` tokens, so that memory and per-token latency stay constant
+                  however many tokens are generated. Only models with `_supports_sink_cache = True` accept it.
+                - `"quantized"`: [`QuantizedCache`], which stores the past states as `cache_nbits` integers and
+                  dequantizes them on the fly, dividing the memory held by the cache by 2 to 8.
+        cache_window_length (`int`, *optional*):
+            The maximum number of tokens held by the cache when `cache_implementation="sink"`, sink tokens included.
+        num_sink_tokens (`int`, *optional*, defaults to 4):
+            The number of initial tokens that are never evicted from the cache when `cache_implementation="sink"`.
+        cache_nbits (`int`, *optional*, defaults to 8):
+            The number of bits of the states stored by the cache when `cache_implementation="quantized"`, 8 or 4.
+        cache_residual_length (`int`, *optional*, defaults to 32):
+            The number of recent tokens kept in full precision when `cache_implementation="quantized"`, which is also
+            the number of tokens quantized together.
+        num_draft_branches (`int`, *optional*, defaults to 1):
+            Number of candidate continuations drafted for each sequence in assisted decoding. With more than one
+            branch, the candidates form a tree whose branches start with different first tokens, and all of them are
+            verified in a single forward pass of the model. Only models with `_supports_cache_class = True` accept
+            it.
+        prompt_lookup_num_tokens (`int`, *optional*):
+            If set, triggers assisted decoding without an assistant model: the candidate tokens are the
+            `prompt_lookup_num_tokens` tokens that followed an earlier occurrence of the last tokens of the sequence,
+            in the prompt or in the generated tokens. Speeds up the generations that copy spans of their input.
+        max_matching_ngram_size (`int`, *optional*, defaults to 2):
+            The number of last tokens of the sequence looked up by `prompt_lookup_num_tokens`. Fewer tokens are looked
+            up when they have no earlier occurrence.
+        compact_finished_sequences (`bool`, *optional*, defaults to `False`):
+            Whether greedy search and multinomial sampling drop the sequences that reached an end-of-sequence token
+            from the batch, instead of running them through the model until all sequences are finished. This saves
+            the compute spent on finished sequences when their lengths vary widely, for the same returned sequences
+            (with sampling, the random draws of the remaining sequences differ). It can't be combined with
+            `output_scores`, `output_attentions` or `output_hidden_states`, nor with logits processors that depend on
+            the position of the sequences in the batch, such as `prefix_allowed_tokens_fn` and `guidance_scale`.
+        prefill_chunk_size (`int`, *optional*):
+            If set, the prompt of decoder-only models is fed to the model `prefill_chunk_size` tokens at a time,
+            growing the cache chunk by chunk, instead of in a single forward pass. The peak memory of long prompts is
+            then bounded by the chunk size rather than by the prompt length, for the same generated tokens. Only models
+            with `_supports_cache_class = True` accept it, and the attentions and hidden states returned for the first
+            step then only cover the last prompt token.
 
         > Parameters for manipulation of the model output logits
 
@@ -190,7 +239,15 @@ class GenerationConfig(PushToHubMixin):
             Higher guidance scale encourages the model to generate samples that are more closely linked to the input
             prompt, usually at the expense of poorer quality.
         low_memory (`bool`, *optional*):
-            Switch to sequential topk for contrastive search to reduce peak memory. Used with contrastive search.
+            Switch to sequential topk for contrastive search to reduce peak memory. Used with contrastive search. The
+            `top_k` candidates are then run one at a time on top of the cache of their sequence, which is shared
+            instead of being replicated `top_k` times.
+        regex (`str`, *optional*):
+            A regular expression the generated text has to match. Requires passing the `tokenizer` to `generate`.
+            Check [`~generation.RegexLogitsProcessor`] for further documentation and the supported syntax.
+        json_schema (`Union[str, Dict[str, Any]]`, *optional*):
+            A JSON schema the generated text has to follow, as a JSON document. Requires passing the `tokenizer` to
+            `generate`, and can't be combined with `regex`.
 
 
         > Parameters that define the output variables of `generate`
@@ -248,6 +305,16 @@ class GenerationConfig(PushToHubMixin):
         self.num_beam_groups = kwargs.pop("num_beam_groups", 1)
         self.penalty_alpha = kwargs.pop("penalty_alpha", None)
         self.use_cache = kwargs.pop("use_cache", True)
+        self.cache_implementation = kwargs.pop("cache_implementation", None)
+        self.cache_window_length = kwargs.pop("cache_window_length", None)
+        self.num_sink_tokens = kwargs.pop("num_sink_tokens", 4)
+        self.cache_nbits = kwargs.pop("cache_nbits", 8)
+        self.cache_residual_length = kwargs.pop("cache_residual_length", 32)
+        self.num_draft_branches = kwargs.pop("num_draft_branches", 1)
+        self.prompt_lookup_num_tokens = kwargs.pop("prompt_lookup_num_tokens", None)
+        self.max_matching_ngram_size = kwargs.pop("max_matching_ngram_size", 2)
+        self.prefill_chunk_size = kwargs.pop("prefill_chunk_size", None)
+        self.compact_finished_sequences = kwargs.pop("compact_finished_sequences", False)
 
         # Parameters for manipulation of the model output logits
         self.temperature = kwargs.pop("temperature", 1.0)
@@ -275,6 +342,8 @@ class GenerationConfig(PushToHubMixin):
         self.sequence_bias = kwargs.pop("sequence_bias", None)
         self.guidance_scale = kwargs.pop("guidance_scale", None)
         self.low_memory = kwargs.pop("low_memory", None)
+        self.regex = kwargs.pop("regex", None)
+        self.json_schema = kwargs.pop("json_schema", None)
 
         # Parameters that define the output variables of `generate`
         self.num_return_sequences = kwargs.pop("num_return_sequences", 1)
@@ -337,6 +406,32 @@ class GenerationConfig(PushToHubMixin):
         """
         if self.early_stopping not in {True, False, "never"}:
             raise ValueError(f"`early_stopping` must be a boolean or 'never', but is {self.early_stopping}.")
+        if self.cache_implementation is not None and self.cache_implementation not in ALL_CACHE_IMPLEMENTATIONS:
+            raise ValueError(
+                f"`cache_implementation` must be one of {ALL_CACHE_IMPLEMENTATIONS}, but is "
+                f"{self.cache_implementation}."
+            )
+        if self.cache_implementation == "sink" and (
+            self.cache_window_length is None or self.num_sink_tokens >= self.cache_window_length
+        ):
+            raise ValueError(
+                "`cache_implementation='sink'` requires a `cache_window_length` larger than `num_sink_tokens`, but "
+                f"got `cache_window_length={self.cache_window_length}` and `num_sink_tokens={self.num_sink_tokens}`."
+            )
+        if self.cache_implementation == "quantized" and self.cache_nbits not in (4, 8):
+            raise ValueError(f"`cache_nbits` has to be 4 or 8, but is {self.cache_nbits}.")
+        if not isinstance(self.num_draft_branches, int) or self.num_draft_branches < 1:
+            raise ValueError(
+                f"`num_draft_branches` has to be a strictly positive integer, but is {self.num_draft_branches}."
+            )
+        if self.prefill_chunk_size is not None and (
+            not isinstance(self.prefill_chunk_size, int) or self.prefill_chunk_size < 1
+        ):
+            raise ValueError(
+                f"`prefill_chunk_size` has to be a strictly positive integer, but is {self.prefill_chunk_size}."
+            )
+        if self.regex is not None and self.json_schema is not None:
+            raise ValueError("Only one of `regex` and `json_schema` can be set.")
 
     def save_pretrained(
         self,
@@ -0,0 +1,373 @@
+# coding=utf-8
+# Copyright 2023 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+from collections import deque
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
+
+import torch
+from torch import nn
+
+from .configuration_utils import GenerationConfig
+from .logits_process import LogitsProcessorList
+from .stopping_criteria import StoppingCriteriaList
+
+
+if TYPE_CHECKING:
+    from ..modeling_utils import PreTrainedModel
+    from .streamers import BaseStreamer
+
+
+@dataclass
+class _RequestState:
+    """Book-keeping of a single request handled by [`ContinuousBatchingEngine`]."""
+
+    request_id: int
+    input_ids: torch.LongTensor
+    logits_processor: LogitsProcessorList
+    logits_warper: Optional[LogitsProcessorList]
+    stopping_criteria: StoppingCriteriaList
+    eos_token_id_tensor: Optional[torch.Tensor]
+    streamer: Optional["BaseStreamer"] = None
+
+
+def _select_past_rows(past_key_values, indices: torch.LongTensor):
+    """Keeps the rows `indices` of the batch dimension of each cached tensor."""
+    return tuple(
+        tuple(past_state.index_select(0, indices.to(past_state.device)) for past_state in layer_past)
+        for layer_past in past_key_values
+    )
+
+
+def _left_pad_past(past_key_values, pad_length: int):
+    """Left-pads the sequence dimension (`-2`) of each cached tensor with `pad_length` zeros."""
+    if pad_length == 0:
+        return past_key_values
+    return tuple(
+        tuple(nn.functional.pad(past_state, (0, 0, pad_length, 0)) for past_state in layer_past)
+        for layer_past in past_key_values
+    )
+
+
+class ContinuousBatchingEngine:
+    r"""
+    Scheduler-driven generation engine for decoder-only models. Contrary to [`~generation.GenerationMixin.generate`],
+    which decodes a fixed batch until its longest sequence is done, the engine evicts each sequence as soon as it
+    finishes and admits new requests into the freed slots at the next step, so that the batch stays full with
+    mixed-length traffic.
+
+    Each request keeps its own [`LogitsProcessorList`], [`StoppingCriteriaList`] and optional streamer, built from its
+    [`GenerationConfig`] exactly as `generate` would build them, and is decoded with greedy search or multinomial
+    sampling. Running sequences are left-padded to a common length: the attention mask hides the padding, and the
+    position ids are derived from the attention mask by the model's `prepare_inputs_for_generation`.
+
+    <Tip warning={true}>
+
+    The engine relies on the legacy cache format, with the sequence length in the second-to-last dimension of every
+    cached tensor (e.g. `(batch_size, num_heads, sequence_length, embed_size_per_head)`), and on models deriving their
+    position ids from the attention mask. Beam search, contrastive search and constrained generation are not
+    supported.
+
+    </Tip>
+
+    Args:
+        model ([`PreTrainedModel`]):
+            The decoder-only model used to generate.
+        max_batch_size (`int`, *optional*, defaults to 8):
+            The maximum number of sequences decoded together at each step.
+        generation_config ([`~generation.GenerationConfig`], *optional*):
+            The default generation configuration of the requests. Defaults to `model.generation_config`.
+
+    Examples:
+
+    ```python
+    >>> from transformers import AutoModelForCausalLM, AutoTokenizer, ContinuousBatchingEngine
+
+    >>> tokenizer = AutoTokenizer.from_pretrained("gpt2")
+    >>> model = AutoModelForCausalLM.from_pretrained("gpt2")
+    >>> engine = ContinuousBatchingEngine(model, max_batch_size=2)
+
+    >>> prompts = ["Hello, my dog is", "The capital of France", "Once upon a time"]
+    >>> request_ids = [engine.add_request(tokenizer(prompt).input_ids, max_new_tokens=5) for prompt in prompts]
+    >>> outputs = engine.run()
+    >>> texts = [tokenizer.decode(outputs[request_id][0]) for request_id in request_ids]
+    ```
+    """
+
+    def __init__(
+        self,
+        model: "PreTrainedModel",
+        max_batch_size: int = 8,
+        generation_config: Optional[GenerationConfig] = None,
+    ):
+        if model.config.is_encoder_decoder:
+            raise ValueError("`ContinuousBatchingEngine` only supports decoder-only models.")
+        if max_batch_size < 1:
+            raise ValueError(f"`max_batch_size` has to be a strictly positive integer, but is {max_batch_size}.")
+
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.generation_config = generation_config if generation_config is not None else model.generation_config
+
+        self._next_request_id = 0
+        self._waiting: deque = deque()
+        self._running: List[_RequestState] = []
+        self._outputs: Dict[int, torch.LongTensor] = {}
+        # batched state of the running sequences, whose rows follow `self._running`
+        self._past_key_values = None
+        self._attention_mask: Optional[torch.LongTensor] = None
+
+    def add_request(
+        self,
+        input_ids: Union[List[int], torch.LongTensor],
+        generation_config: Optional[GenerationConfig] = None,
+        logits_processor: Optional[LogitsProcessorList] = None,
+        stopping_criteria: Optional[StoppingCriteriaList] = None,
+        streamer: Optional["BaseStreamer"] = None,
+        **kwargs,
+    ) -> int:
+        r"""
+        Queues a new prompt. It will be admitted into the running batch as soon as a slot is free.
+
+        Args:
+            input_ids (`List[int]` or `torch.LongTensor` of shape `(sequence_length,)` or `(1, sequence_length)`):
+                The unpadded prompt.
+            generation_config ([`~generation.GenerationConfig`], *optional*):
+                The generation configuration of this request. Defaults to the engine's `generation_config`.
+            logits_processor (`LogitsProcessorList`, *optional*):
+                Custom logits processors that complement the ones built from the generation config.
+            stopping_criteria (`StoppingCriteriaList`, *optional*):
+                Custom stopping criteria that complement the ones built from the generation config.
+            streamer (`BaseStreamer`, *optional*):
+                Streamer receiving the prompt when the request is admitted, then each of its new tokens.
+            kwargs (`Dict[str, Any]`, *optional*):
+                Ad hoc parametrization of `generation_config`, e.g. `max_new_tokens=20`.
+
+        Return:
+            `int`: The id of the request, used to retrieve its output.
+        """
+        if generation_config is None:
+            generation_config = self.generation_config
+        generation_config = copy.deepcopy(generation_config)
+        unused_kwargs = generation_config.update(**kwargs)
+        if len(unused_kwargs) > 0:
+            raise ValueError(f"The following arguments are not generation parameters: {list(unused_kwargs)}")
+        generation_config.validate()
+        if generation_config.num_beams != 1 or generation_config.num_beam_groups != 1:
+            raise ValueError("`ContinuousBatchingEngine` only supports greedy search and sampling (`num_beams=1`).")
+        if generation_config.penalty_alpha is not None or generation_config.constraints is not None:
+            raise ValueError("`ContinuousBatchingEngine` does not support contrastive search nor constraints.")
+
+        if not isinstance(input_ids, torch.Tensor):
+            input_ids = torch.tensor(input_ids, dtype=torch.long)
+        input_ids = input_ids.view(1, -1).to(self.model.device)
+        input_ids_seq_length = input_ids.shape[-1]
+        if generation_config.max_new_tokens is not None:
+            generation_config.max_length = generation_config.max_new_tokens + input_ids_seq_length
+        if generation_config.pad_token_id is None and generation_config.eos_token_id is not None:
+            eos_token_id = generation_config.eos_token_id
+            generation_config.pad_token_id = eos_token_id[0] if isinstance(eos_token_id, list) else eos_token_id
+
+        eos_token_id = generation_config.eos_token_id
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        eos_token_id_tensor = torch.tensor(eos_token_id).to(self.model.device) if eos_token_id is not None else None
+
+        request = _RequestState(
+            request_id=self._next_request_id,
+            input_ids=input_ids,
+            logits_processor=self.model._get_logits_processor(
+                generation_config=generation_config,
+                input_ids_seq_length=input_ids_seq_length,
+                encoder_input_ids=input_ids,
+                prefix_allowed_tokens_fn=None,
+                logits_processor=logits_processor if logits_processor is not None else LogitsProcessorList(),
+            ),
+            logits_warper=self.model._get_logits_warper(generation_config) if generation_config.do_sample else None,
+            stopping_criteria=self.model._get_stopping_criteria(
+                generation_config=generation_config,
+                stopping_criteria=stopping_criteria if stopping_criteria is not None else StoppingCriteriaList(),
+            ),
+            eos_token_id_tensor=eos_token_id_tensor,
+            streamer=streamer,
+        )
+        self._waiting.append(request)
+        self._next_request_id += 1
+        return request.request_id
+
+    def has_unfinished_requests(self) -> bool:
+        """Returns whether some requests are still waiting or running."""
+        return len(self._waiting) > 0 or len(self._running) > 0
+
+    def get_output(self, request_id: int) -> Optional[torch.LongTensor]:
+        """
+        Pops the output of a finished request, of shape `(1, sequence_length)` and containing the prompt, or returns
+        `None` if the request is not finished yet.
+        """
+        return self._outputs.pop(request_id, None)
+
+    @torch.no_grad()
+    def step(self) -> List[int]:
+        """
+        Runs one decoding step: every running sequence receives a new token, finished sequences are evicted, and
+        waiting requests are admitted into the free slots (their prefill yields their first token).
+
+        Return:
+            `List[int]`: The ids of the requests that finished during this step.
+        """
+        finished_request_ids = []
+        if len(self._running) > 0:
+            finished_request_ids += self._decode_running()
+        if len(self._waiting) > 0 and len(self._running) < self.max_batch_size:
+            finished_request_ids += self._admit_waiting()
+        return finished_request_ids
+
+    def run(self) -> Dict[int, torch.LongTensor]:
+        """
+        Steps until all the queued requests are finished.
+
+        Return:
+            `Dict[int, torch.LongTensor]`: The outputs of all the finished requests, indexed by request id.
+        """
+        while self.has_unfinished_requests():
+            self.step()
+        outputs = self._outputs
+        self._outputs = {}
+        return outputs
+
+    def _forward(self, input_ids: torch.LongTensor, attention_mask: torch.LongTensor, past_key_values=None):
+        model_inputs = self.model.prepare_inputs_for_generation(
+            input_ids, past_key_values=past_key_values, attention_mask=attention_mask, use_cache=True
+        )
+        outputs = self.model(**model_inputs, return_dict=True)
+        return outputs.logits[:, -1, :], self.model._extract_past_from_model_output(outputs)
+
+    def _decode_running(self) -> List[int]:
+        last_tokens = torch.cat([request.input_ids[:, -1:] for request in self._running], dim=0)
+        attention_mask = torch.cat(
+            [self._attention_mask, self._attention_mask.new_ones((self._attention_mask.shape[0], 1))], dim=-1
+        )
+        next_token_logits, self._past_key_values = self._forward(last_tokens, attention_mask, self._past_key_values)
+        self._attention_mask = attention_mask
+
+        keep_indices, finished_request_ids = self._process_next_tokens(self._running, next_token_logits)
+        if len(finished_request_ids) > 0:
+            self._running = [self._running[idx] for idx in keep_indices]
+            if len(keep_indices) == 0:
+                self._past_key_values = None
+                self._attention_mask = None
+            else:
+                keep_indices = torch.tensor(keep_indices, device=self._attention_mask.device)
+                self._past_key_values = _select_past_rows(self._past_key_values, keep_indices)
+                self._attention_mask = self._attention_mask.index_select(0, keep_indices)
+                self._remove_leading_padding()
+        return finished_request_ids
+
+    def _admit_waiting(self) -> List[int]:
+        num_admitted = min(len(self._waiting), self.max_batch_size - len(self._running))
+        requests = [self._waiting.popleft() for _ in range(num_admitted)]
+        for request in requests:
+            if request.streamer is not None:
+                request.streamer.put(request.input_ids.cpu())
+
+        # prefill the new prompts together, left-padded to a common length
+        prompt_lengths = [request.input_ids.shape[-1] for request in requests]
+        max_prompt_length = max(prompt_lengths)
+        pad_token_id = self.generation_config.pad_token_id if self.generation_config.pad_token_id is not None else 0
+        input_ids = requests[0].input_ids.new_full((num_admitted, max_prompt_length), pad_token_id)
+        attention_mask = requests[0].input_ids.new_zeros((num_admitted, max_prompt_length))
+        for row, (request, prompt_length) in enumerate(zip(requests, prompt_lengths)):
+            input_ids[row, max_prompt_length - prompt_length :] = request.input_ids[0]
+            attention_mask[row, max_prompt_length - prompt_length :] = 1
+        next_token_logits, past_key_values = self._forward(input_ids, attention_mask)
+
+        keep_indices, finished_request_ids = self._process_next_tokens(requests, next_token_logits)
+        if len(keep_indices) == 0:
+            return finished_request_ids
+        if len(keep_indices) < num_admitted:
+            requests = [requests[idx] for idx in keep_indices]
+            keep_indices = torch.tensor(keep_indices, device=attention_mask.device)
+            past_key_values = _select_past_rows(past_key_values, keep_indices)
+            attention_mask = attention_mask.index_select(0, keep_indices)
+
+        # merge the new sequences into the running batch
+        if len(self._running) == 0:
+            self._past_key_values = past_key_values
+            self._attention_mask = attention_mask
+        else:
+            running_length = self._attention_mask.shape[-1]
+            new_length = attention_mask.shape[-1]
+            max_length = max(running_length, new_length)
+            running_past = _left_pad_past(self._past_key_values, max_length - running_length)
+            past_key_values = _left_pad_past(past_key_values, max_length - new_length)
+            self._past_key_values = tuple(
+                tuple(torch.cat([running_state, new_state], dim=0) for running_state, new_state in zip(*layer_pasts))
+                for layer_pasts in zip(running_past, past_key_values)
+            )
+            self._attention_mask = torch.cat(
+                [
+                    nn.functional.pad(self._attention_mask, (max_length - running_length, 0)),
+                    nn.functional.pad(attention_mask, (max_length - new_length, 0)),
+                ],
+                dim=0,
+            )
+        self._running.extend(requests)
+        return finished_request_ids
+
+    def _process_next_tokens(
+        self, requests: List[_RequestState], next_token_logits: torch.FloatTensor
+    ) -> Tuple[List[int], List[int]]:
+        """
+        Picks the next token of each request with its own processors, streams it and checks whether the request is
+        finished. Returns the indices of the unfinished requests and the ids of the finished ones.
+        """
+        keep_indices = []
+        finished_request_ids = []
+        for idx, request in enumerate(requests):
+            next_tokens_scores = request.logits_processor(request.input_ids, next_token_logits[idx : idx + 1])
+            if request.logits_warper is not None:
+                next_tokens_scores = request.logits_warper(request.input_ids, next_tokens_scores)
+                probs = nn.functional.softmax(next_tokens_scores, dim=-1)
+                next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+            else:
+                next_tokens = torch.argmax(next_tokens_scores, dim=-1)
+
+            request.input_ids = torch.cat([request.input_ids, next_tokens[:, None]], dim=-1)
+            if request.streamer is not None:
+                request.streamer.put(next_tokens.cpu())
+
+            is_done = request.stopping_criteria(request.input_ids, next_tokens_scores)
+            if request.eos_token_id_tensor is not None:
+                is_done = is_done or bool((next_tokens == request.eos_token_id_tensor).any())
+
+            if is_done:
+                if request.streamer is not None:
+                    request.streamer.end()
+                self._outputs[request.request_id] = request.input_ids
+                finished_request_ids.append(request.request_id)
+            else:
+                keep_indices.append(idx)
+        return keep_indices, finished_request_ids
+
+    def _remove_leading_padding(self):
+        """Drops the leading positions that are padding for all the running sequences."""
+        num_padding = int((self._attention_mask.sum(dim=0) == 0).int().cumprod(dim=0).sum())
+        if num_padding > 0:
+            self._attention_mask = self._attention_mask[:, num_padding:]
+            self._past_key_values = tuple(
+                tuple(past_state[..., num_padding:, :] for past_state in layer_past)
+                for layer_past in self._past_key_values
+            )
@@ -14,14 +14,20 @@
 # limitations under the License.
 
 import inspect
+import itertools
 import math
-from typing import Callable, Dict, Iterable, List, Tuple, Union
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
 
 from ..utils import add_start_docstrings
 from ..utils.logging import get_logger
+from .token_automaton import TokenAutomaton, json_schema_to_regex
+
+
+if TYPE_CHECKING:
+    from ..tokenization_utils_base import PreTrainedTokenizerBase
 
 
 logger = get_logger(__name__)
@@ -66,6 +72,14 @@ class LogitsProcessorList(list):
     This class can be used to create a list of [`LogitsProcessor`] or [`LogitsWarper`] to subsequently process a
     `scores` input tensor. This class inherits from list and adds a specific *__call__* method to apply each
     [`LogitsProcessor`] or [`LogitsWarper`] to the inputs.
+
+    The way the processors are applied is planned on the first call, and planned again only when the content of the
+    list changes. Consecutive sampling warpers of this library ([`TemperatureLogitsWarper`], [`TopKLogitsWarper`],
+    [`TopPLogitsWarper`], [`TypicalLogitsWarper`], [`EpsilonLogitsWarper`] and [`EtaLogitsWarper`]) that filter with
+    `-float("Inf")` are applied together on a single sorted copy of the scores when at least one of them has to sort
+    the vocabulary anyway, which avoids sorting and allocating a tensor of the size of the vocabulary for each of them.
+    All the other processors, including the subclasses of the ones above, are applied one after the other. Like some of
+    the processors, the fused warpers update `scores` in place.
     """
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.FloatTensor:
@@ -84,12 +98,11 @@ class LogitsProcessorList(list):
                 The processed prediction scores.
 
         """
-        for processor in self:
-            function_args = inspect.signature(processor.__call__).parameters
+        for processor, function_args in self._get_execution_plan():
             if len(function_args) > 2:
-                if not all(arg in kwargs for arg in list(function_args.keys())[2:]):
+                if not all(arg in kwargs for arg in function_args[2:]):
                     raise ValueError(
-                        f"Make sure that all the required parameters: {list(function_args.keys())} for "
+                        f"Make sure that all the required parameters: {function_args} for "
                         f"{processor.__class__} are passed to the logits processor."
                     )
                 scores = processor(input_ids, scores, **kwargs)
@@ -97,6 +110,26 @@ class LogitsProcessorList(list):
                 scores = processor(input_ids, scores)
         return scores
 
+    def _get_execution_plan(self) -> List[Tuple[Callable, List[str]]]:
+        """
+        Returns the callables to apply in order, with the names of their arguments. The plan is cached until the
+        content of the list changes: it holds references to the processors, so that their ids can't be reused.
+        """
+        processor_ids = tuple(id(processor) for processor in self)
+        if self.__dict__.get("_execution_plan_ids") != processor_ids:
+            execution_plan = []
+            for fusable, processors in itertools.groupby(self, key=_is_fusable_warper):
+                processors = list(processors)
+                if fusable and _FusedLogitsWarpers.should_fuse(processors):
+                    execution_plan.append((_FusedLogitsWarpers(processors), ["input_ids", "scores"]))
+                    continue
+                for processor in processors:
+                    function_args = list(inspect.signature(processor.__call__).parameters.keys())
+                    execution_plan.append((processor, function_args))
+            self._execution_plan = execution_plan
+            self._execution_plan_ids = processor_ids
+        return self._execution_plan
+
 
 class MinLengthLogitsProcessor(LogitsProcessor):
     r"""
@@ -525,39 +558,125 @@ class EtaLogitsWarper(LogitsWarper):
         return scores
 
 
-def _get_ngrams(ngram_size: int, prev_input_ids: torch.Tensor, num_hypos: int):
-    generated_ngrams = [{} for _ in range(num_hypos)]
-    for idx in range(num_hypos):
-        gen_tokens = prev_input_ids[idx].tolist()
-        generated_ngram = generated_ngrams[idx]
-        for ngram in zip(*[gen_tokens[i:] for i in range(ngram_size)]):
-            prev_ngram_tuple = tuple(ngram[:-1])
-            generated_ngram[prev_ngram_tuple] = generated_ngram.get(prev_ngram_tuple, []) + [ngram[-1]]
-    return generated_ngrams
+def _is_fusable_warper(processor) -> bool:
+    if type(processor) is TemperatureLogitsWarper:
+        return True
+    return type(processor) in _FusedLogitsWarpers.filtering_warpers and processor.filter_value == -float("Inf")
 
 
-def _get_generated_ngrams(banned_ngrams, prev_input_ids, ngram_size, cur_len):
-    # Before decoding the next token, prevent decoding of ngrams that have already appeared
-    start_idx = cur_len + 1 - ngram_size
-    ngram_idx = tuple(prev_input_ids[start_idx:cur_len].tolist())
-    return banned_ngrams.get(ngram_idx, [])
+class _FusedLogitsWarpers:
+    """
+    Applies consecutive [`TemperatureLogitsWarper`], [`TopKLogitsWarper`], [`TopPLogitsWarper`],
+    [`TypicalLogitsWarper`], [`EpsilonLogitsWarper`] and [`EtaLogitsWarper`] on a single copy of the scores, sorted in
+    ascending order. Temperature scaling preserves that order, and top-k, top-p, epsilon and eta sampling only filter
+    the lowest scores, so that the scores stay sorted and each warper finds its cutoff in the sorted copy. Typical
+    sampling ranks the tokens by their distance to the entropy instead, so it still sorts that distance, after which
+    the filtered tokens are moved back to the front in linear time. The scores are scattered back to the vocabulary
+    order at the end, in place.
+    """
 
+    filtering_warpers = (
+        TopKLogitsWarper,
+        TopPLogitsWarper,
+        TypicalLogitsWarper,
+        EpsilonLogitsWarper,
+        EtaLogitsWarper,
+    )
 
-def _calc_banned_ngram_tokens(
-    ngram_size: int, prev_input_ids: torch.Tensor, num_hypos: int, cur_len: int
-) -> List[Iterable[int]]:
-    """Copied from fairseq for no_repeat_ngram in beam_search"""
-    if cur_len + 1 < ngram_size:
-        # return no banned tokens if we haven't generated no_repeat_ngram_size tokens yet
-        return [[] for _ in range(num_hypos)]
+    def __init__(self, warpers: List[LogitsWarper]):
+        self.warpers = warpers
 
-    generated_ngrams = _get_ngrams(ngram_size, prev_input_ids, num_hypos)
+    @classmethod
+    def should_fuse(cls, warpers: List[LogitsWarper]) -> bool:
+        """Fusing pays off when the vocabulary is sorted anyway and at least two warpers filter the scores."""
+        num_filtering_warpers = sum(isinstance(warper, cls.filtering_warpers) for warper in warpers)
+        sorts_vocabulary = any(isinstance(warper, (TopPLogitsWarper, TypicalLogitsWarper)) for warper in warpers)
+        return sorts_vocabulary and num_filtering_warpers >= 2
 
-    banned_tokens = [
-        _get_generated_ngrams(generated_ngrams[hypo_idx], prev_input_ids[hypo_idx], ngram_size, cur_len)
-        for hypo_idx in range(num_hypos)
-    ]
-    return banned_tokens
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        sorted_scores, sorted_indices = torch.sort(scores, descending=False, stable=True)
+        vocab_size = sorted_scores.size(-1)
+
+        for warper_idx, warper in enumerate(self.warpers):
+            if isinstance(warper, TemperatureLogitsWarper):
+                sorted_scores.div_(warper.temperature)
+                continue
+
+            if isinstance(warper, TopKLogitsWarper):
+                top_k = min(warper.top_k, vocab_size)
+                sorted_indices_to_remove = sorted_scores < sorted_scores[..., -top_k, None]
+            elif isinstance(warper, TopPLogitsWarper):
+                cumulative_probs = sorted_scores.softmax(dim=-1).cumsum(dim=-1)
+                sorted_indices_to_remove = cumulative_probs <= (1 - warper.top_p)
+                sorted_indices_to_remove[..., -warper.min_tokens_to_keep :] = 0
+            elif isinstance(warper, (EpsilonLogitsWarper, EtaLogitsWarper)):
+                probabilities = sorted_scores.softmax(dim=-1)
+                if isinstance(warper, EtaLogitsWarper):
+                    entropy = torch.distributions.Categorical(logits=sorted_scores).entropy()
+                    cutoff = torch.min(warper.epsilon, torch.sqrt(warper.epsilon) * torch.exp(-entropy))[..., None]
+                else:
+                    cutoff = warper.epsilon
+                top_k = min(warper.min_tokens_to_keep, vocab_size)
+                sorted_indices_to_remove = probabilities < cutoff
+                sorted_indices_to_remove &= sorted_scores < sorted_scores[..., -top_k, None]
+            else:
+                sorted_indices_to_remove = self._typical_indices_to_remove(warper, sorted_scores)
+
+            sorted_scores.masked_fill_(sorted_indices_to_remove, warper.filter_value)
+            if isinstance(warper, TypicalLogitsWarper) and warper_idx < len(self.warpers) - 1:
+                sorted_scores, sorted_indices = self._move_filtered_to_front(sorted_scores, sorted_indices)
+
+        scores.scatter_(1, sorted_indices, sorted_scores)
+        return scores
+
+    @staticmethod
+    def _typical_indices_to_remove(warper: TypicalLogitsWarper, sorted_scores: torch.FloatTensor) -> torch.BoolTensor:
+        # same as `TypicalLogitsWarper.__call__`, in the order of `sorted_scores`
+        normalized = torch.nn.functional.log_softmax(sorted_scores, dim=-1)
+        p = torch.exp(normalized)
+        ent = -(normalized * p).nansum(-1, keepdim=True)
+
+        shifted_scores = torch.abs((-normalized) - ent)
+        typical_scores, typical_indices = torch.sort(shifted_scores, descending=False)
+        typical_logits = sorted_scores.gather(-1, typical_indices)
+        cumulative_probs = typical_logits.softmax(dim=-1).cumsum(dim=-1)
+
+        last_ind = (cumulative_probs < warper.mass).sum(dim=1)
+        last_ind[last_ind < 0] = 0
+        typical_indices_to_remove = typical_scores > typical_scores.gather(1, last_ind.view(-1, 1))
+        typical_indices_to_remove[..., : warper.min_tokens_to_keep] = 0
+        return typical_indices_to_remove.scatter(1, typical_indices, typical_indices_to_remove)
+
+    @staticmethod
+    def _move_filtered_to_front(
+        sorted_scores: torch.FloatTensor, sorted_indices: torch.LongTensor
+    ) -> Tuple[torch.FloatTensor, torch.LongTensor]:
+        # a stable partition, which sorts the scores again since the kept ones are still in ascending order
+        filtered = sorted_scores == -float("Inf")
+        kept = ~filtered
+        num_filtered = filtered.sum(dim=-1, keepdim=True)
+        new_positions = torch.where(kept, num_filtered + kept.cumsum(dim=-1) - 1, filtered.cumsum(dim=-1) - 1)
+        sorted_scores = torch.empty_like(sorted_scores).scatter_(1, new_positions, sorted_scores)
+        sorted_indices = torch.empty_like(sorted_indices).scatter_(1, new_positions, sorted_indices)
+        return sorted_scores, sorted_indices
+
+
+def _get_banned_ngram_tokens_mask(
+    ngrams: torch.LongTensor, input_ids: torch.LongTensor, vocab_size: int
+) -> torch.BoolTensor:
+    """
+    Returns the mask, of shape `(num_hypos, vocab_size)`, of the tokens that would complete one of the `ngrams` of each
+    hypothesis (of shape `(num_hypos, num_ngrams, ngram_size)`) after its last `ngram_size - 1` tokens.
+    """
+    ngram_size = ngrams.shape[-1]
+    prefixes = input_ids[:, input_ids.shape[-1] - ngram_size + 1 :]
+    matches = (ngrams[..., :-1] == prefixes[:, None, :]).all(dim=-1)
+
+    # the tokens following the n-grams that don't match are sent to an extra column, which is then dropped
+    banned_tokens = ngrams[..., -1].masked_fill(~matches, vocab_size)
+    banned_tokens_mask = torch.zeros((input_ids.shape[0], vocab_size + 1), dtype=torch.bool, device=input_ids.device)
+    banned_tokens_mask.scatter_(1, banned_tokens, True)
+    return banned_tokens_mask[:, :-1]
 
 
 class NoRepeatNGramLogitsProcessor(LogitsProcessor):
@@ -577,13 +696,14 @@ class NoRepeatNGramLogitsProcessor(LogitsProcessor):
 
     @add_start_docstrings(LOGITS_PROCESSOR_INPUTS_DOCSTRING)
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-        num_batch_hypotheses = scores.shape[0]
-        cur_len = input_ids.shape[-1]
-        banned_batch_tokens = _calc_banned_ngram_tokens(self.ngram_size, input_ids, num_batch_hypotheses, cur_len)
-
-        for i, banned_tokens in enumerate(banned_batch_tokens):
-            scores[i, banned_tokens] = -float("inf")
+        if input_ids.shape[-1] < self.ngram_size:
+            # no n-gram was generated yet
+            return scores
 
+        # all the n-grams of all the hypotheses are compared at once, without leaving the device
+        ngrams = input_ids.unfold(1, self.ngram_size, 1)
+        banned_tokens_mask = _get_banned_ngram_tokens_mask(ngrams, input_ids, scores.shape[-1])
+        scores.masked_fill_(banned_tokens_mask, -float("inf"))
         return scores
 
 
@@ -608,24 +728,28 @@ class EncoderNoRepeatNGramLogitsProcessor(LogitsProcessor):
         if len(encoder_input_ids.shape) == 1:
             encoder_input_ids = encoder_input_ids.unsqueeze(0)
         self.batch_size = encoder_input_ids.shape[0]
-        self.generated_ngrams = _get_ngrams(encoder_ngram_size, encoder_input_ids, self.batch_size)
+        if encoder_input_ids.shape[-1] >= encoder_ngram_size:
+            self.encoder_ngrams = encoder_input_ids.unfold(1, encoder_ngram_size, 1)
+        else:
+            self.encoder_ngrams = encoder_input_ids.new_zeros((self.batch_size, 0, encoder_ngram_size))
+
+        # The encoder n-grams of each hypothesis, populated on the first call (when the number of beams is known)
+        self.hypotheses_ngrams = None
 
     @add_start_docstrings(LOGITS_PROCESSOR_INPUTS_DOCSTRING)
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if input_ids.shape[-1] < self.ngram_size - 1:
+            return scores
+
         # B x num_beams
         num_hypos = scores.shape[0]
-        num_beams = num_hypos // self.batch_size
-        cur_len = input_ids.shape[-1]
-        banned_batch_tokens = [
-            _get_generated_ngrams(
-                self.generated_ngrams[hypo_idx // num_beams], input_ids[hypo_idx], self.ngram_size, cur_len
-            )
-            for hypo_idx in range(num_hypos)
-        ]
-
-        for i, banned_tokens in enumerate(banned_batch_tokens):
-            scores[i, banned_tokens] = -float("inf")
+        if self.hypotheses_ngrams is None or self.hypotheses_ngrams.shape[0] != num_hypos:
+            num_beams = num_hypos // self.batch_size
+            self.hypotheses_ngrams = self.encoder_ngrams.repeat_interleave(num_beams, dim=0)
+        self.hypotheses_ngrams = self.hypotheses_ngrams.to(input_ids.device)
 
+        banned_tokens_mask = _get_banned_ngram_tokens_mask(self.hypotheses_ngrams, input_ids, scores.shape[-1])
+        scores.masked_fill_(banned_tokens_mask, -float("inf"))
         return scores
 
 
@@ -698,6 +822,11 @@ class SequenceBiasLogitsProcessor(LogitsProcessor):
         # Bias variables that will be populated on the first call (for retrocompatibility purposes, the vocabulary size
         # is infered in the first usage, which inhibits initializing here)
         self.length_1_bias = None
+        self.prefixes = None
+        self.prefixes_mask = None
+        self.sequence_lengths = None
+        self.last_tokens = None
+        self.multi_token_bias = None
         self.prepared_bias_variables = False
 
     @add_start_docstrings(LOGITS_PROCESSOR_INPUTS_DOCSTRING)
@@ -712,23 +841,20 @@ class SequenceBiasLogitsProcessor(LogitsProcessor):
         # 3 - include the bias from length = 1
         bias += self.length_1_bias
 
-        # 4 - include the bias from length > 1, after determining which biased sequences may be completed.
-        for sequence_ids, sequence_bias in self.sequence_bias.items():
-            if len(sequence_ids) == 1:  # the sequence is of length 1, already applied
-                continue
-            if len(sequence_ids) > input_ids.shape[1]:  # the sequence is longer than the context, ignore
-                continue
-            prefix_length = len(sequence_ids) - 1
-            last_token = sequence_ids[-1]
-            matching_rows = torch.eq(
-                input_ids[:, -prefix_length:],
-                torch.tensor(sequence_ids[:-1], dtype=input_ids.dtype, device=input_ids.device),
-            ).prod(dim=1)
-            bias[:, last_token] += torch.where(
-                matching_rows.bool(),
-                torch.tensor(sequence_bias, device=input_ids.device),
-                torch.tensor(0.0, device=input_ids.device),
-            )
+        # 4 - include the bias from length > 1, after determining which biased sequences may be completed. All the
+        # sequences are matched at once against the end of the context, their prefixes being right-aligned and padded.
+        if self.prefixes is not None:
+            cur_len = input_ids.shape[1]
+            max_prefix_length = self.prefixes.shape[1]
+            if cur_len >= max_prefix_length:
+                context = input_ids[:, -max_prefix_length:]
+            else:
+                context = torch.nn.functional.pad(input_ids, (max_prefix_length - cur_len, 0), value=-1)
+            matching_rows = ((context[:, None, :] == self.prefixes) | ~self.prefixes_mask).all(dim=-1)
+            # sequences longer than the context are ignored
+            matching_rows &= self.sequence_lengths <= cur_len
+            sequence_bias = torch.where(matching_rows, self.multi_token_bias, torch.zeros_like(self.multi_token_bias))
+            bias.index_add_(1, self.last_tokens, sequence_bias.to(bias.dtype))
 
         # 5 - apply the bias to the scores
         scores = scores + bias
@@ -756,6 +882,24 @@ class SequenceBiasLogitsProcessor(LogitsProcessor):
             if len(sequence_ids) == 1:
                 self.length_1_bias[sequence_ids[-1]] = bias
 
+        # Longer sequences are stored as tensors of right-aligned prefixes, so that they can all be matched at once.
+        multi_token_sequences = [sequence_ids for sequence_ids in self.sequence_bias if len(sequence_ids) > 1]
+        if len(multi_token_sequences) > 0:
+            max_prefix_length = max(len(sequence_ids) for sequence_ids in multi_token_sequences) - 1
+            prefixes = torch.zeros((len(multi_token_sequences), max_prefix_length), dtype=torch.long)
+            prefixes_mask = torch.zeros((len(multi_token_sequences), max_prefix_length), dtype=torch.bool)
+            for sequence_idx, sequence_ids in enumerate(multi_token_sequences):
+                prefix_length = len(sequence_ids) - 1
+                prefixes[sequence_idx, max_prefix_length - prefix_length :] = torch.tensor(sequence_ids[:-1])
+                prefixes_mask[sequence_idx, max_prefix_length - prefix_length :] = True
+            self.prefixes = prefixes.to(scores.device)
+            self.prefixes_mask = prefixes_mask.to(scores.device)
+            self.sequence_lengths = torch.tensor([len(ids) for ids in multi_token_sequences], device=scores.device)
+            self.last_tokens = torch.tensor([ids[-1] for ids in multi_token_sequences], device=scores.device)
+            self.multi_token_bias = torch.tensor(
+                [self.sequence_bias[ids] for ids in multi_token_sequences], dtype=torch.float, device=scores.device
+            )
+
         self.prepared_bias_variables = True
 
     def _validate_arguments(self):
@@ -901,6 +1045,120 @@ class PrefixConstrainedLogitsProcessor(LogitsProcessor):
         return scores + mask
 
 
+class RegexLogitsProcessor(LogitsProcessor):
+    r"""
+    [`LogitsProcessor`] that constrains the generated text to match a regular expression, or to be a JSON document
+    following a JSON schema. The pattern is compiled once against the vocabulary of the tokenizer into an automaton
+    over token ids, which is cached on disk per tokenizer and pattern, so that each step only looks up the precomputed
+    allowed tokens of the state of each sequence. Unlike [`PrefixConstrainedLogitsProcessor`], no Python function is
+    called per sequence and per step.
+
+    The end-of-sequence tokens are only allowed once the generated text matches the whole pattern, and are the only
+    tokens allowed after that. The supported regular expressions are the ones that can be compiled to a finite
+    automaton: groups, alternations, character classes, quantifiers and escapes, but no anchors, lookarounds or
+    backreferences.
+
+    Args:
+        tokenizer (`PreTrainedTokenizerBase`):
+            The tokenizer of the model, whose vocabulary the pattern is compiled against.
+        regex (`str`, *optional*):
+            The regular expression the generated text has to match.
+        json_schema (`Union[str, Dict[str, Any]]`, *optional*):
+            The JSON schema (or its serialization) the generated text has to follow. Exactly one of `regex` and
+            `json_schema` has to be set.
+        eos_token_id (`Union[int, List[int]]`, *optional*):
+            The id of the *end-of-sequence* token. Optionally, use a list to set multiple *end-of-sequence* tokens.
+            Defaults to `tokenizer.eos_token_id`.
+        prompt_length (`int`, *optional*):
+            The length of the prompt, which is not constrained. Defaults to the length of the `input_ids` of the first
+            call.
+        cache_dir (`Union[str, os.PathLike]`, *optional*):
+            The directory where compiled automata are cached. Defaults to `TRANSFORMERS_TOKEN_AUTOMATA_CACHE`.
+        use_cache (`bool`, *optional*, defaults to `True`):
+            Whether to load and save the compiled automaton from and to `cache_dir`.
+
+    Examples:
+
+    ```python
+    >>> from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    >>> tokenizer = AutoTokenizer.from_pretrained("gpt2")
+    >>> model = AutoModelForCausalLM.from_pretrained("gpt2")
+    >>> inputs = tokenizer("My phone number is", return_tensors="pt")
+
+    >>> outputs = model.generate(**inputs, regex=r" [0-9]{3}-[0-9]{4}", tokenizer=tokenizer, max_new_tokens=10)
+    >>> text = tokenizer.batch_decode(outputs[:, inputs.input_ids.shape[-1] :], skip_special_tokens=True)[0]
+    >>> len(text)
+    9
+    ```
+    """
+
+    def __init__(
+        self,
+        tokenizer: "PreTrainedTokenizerBase",
+        regex: Optional[str] = None,
+        json_schema: Optional[Union[str, Dict[str, Any]]] = None,
+        eos_token_id: Optional[Union[int, List[int]]] = None,
+        prompt_length: Optional[int] = None,
+        cache_dir: Optional[str] = None,
+        use_cache: bool = True,
+    ):
+        if (regex is None) == (json_schema is None):
+            raise ValueError("Exactly one of `regex` and `json_schema` has to be set.")
+        if eos_token_id is None:
+            eos_token_id = tokenizer.eos_token_id
+        if eos_token_id is None:
+            raise ValueError("`eos_token_id` has to be set when the tokenizer has no end-of-sequence token.")
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+
+        if json_schema is not None:
+            regex = json_schema_to_regex(json_schema)
+        self.regex = regex
+        self.automaton = TokenAutomaton.from_regex(regex, tokenizer, cache_dir=cache_dir, use_cache=use_cache)
+        self.eos_token_id = eos_token_id
+        self.prompt_length = prompt_length
+        self._generated_ids = None
+        self._states = None
+
+    def _get_states(self, input_ids: torch.LongTensor) -> torch.LongTensor:
+        """The automaton states of the sequences of `input_ids`, tracked across calls to avoid replaying them."""
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[-1]
+        generated_ids = input_ids[:, self.prompt_length :]
+        num_sequences, length = generated_ids.shape
+
+        states = None
+        if length == 0:
+            states = torch.zeros(num_sequences, dtype=torch.long, device=input_ids.device)
+        elif self._generated_ids is not None and self._generated_ids.shape[-1] == length - 1:
+            previous_ids = self._generated_ids.to(input_ids.device)
+            if previous_ids.shape[0] == num_sequences and torch.equal(previous_ids, generated_ids[:, :-1]):
+                parents = torch.arange(num_sequences, device=input_ids.device)
+            else:
+                # beam search reorders (and duplicates) the sequences between steps
+                is_parent = (generated_ids[:, None, :-1] == previous_ids[None]).all(-1)
+                parents = is_parent.int().argmax(-1) if is_parent.any(-1).all() else None
+            if parents is not None:
+                previous_states = self._states.to(input_ids.device)[parents]
+                states = self.automaton.step(previous_states, generated_ids[:, -1])
+
+        if states is None:
+            states = torch.zeros(num_sequences, dtype=torch.long, device=input_ids.device)
+            for column in generated_ids.unbind(-1):
+                states = self.automaton.step(states, column)
+
+        self._generated_ids = generated_ids
+        self._states = states
+        return states
+
+    @add_start_docstrings(LOGITS_PROCESSOR_INPUTS_DOCSTRING)
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        states = self._get_states(input_ids)
+        allowed = self.automaton.allowed_tokens_mask(states, scores.shape[-1], self.eos_token_id)
+        return scores.masked_fill(~allowed, -math.inf)
+
+
 class HammingDiversityLogitsProcessor(LogitsProcessor):
     r"""
     [`LogitsProcessor`] that enforces diverse beam search. Note that this logits processor is only effective for
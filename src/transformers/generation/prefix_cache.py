@@ -0,0 +1,248 @@
+# coding=utf-8
+# Copyright 2023 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import torch
+
+
+@dataclass
+class _PrefixCacheEntry:
+    """A prompt stored by [`PrefixCache`], with the key/value states of its tokens."""
+
+    token_ids: Tuple[int, ...]
+    past_key_values: Tuple[Tuple[torch.Tensor]]
+    block_hashes: List[int]
+    num_bytes: int
+
+
+def _past_num_bytes(past_key_values) -> int:
+    return sum(past_state.numel() * past_state.element_size() for layer in past_key_values for past_state in layer)
+
+
+class PrefixCache:
+    r"""
+    Stores the key/value states computed for the prompts of previous [`~generation.GenerationMixin.generate`] calls, so
+    that later calls whose `input_ids` start with the same tokens (a shared system prompt, few-shot examples, the
+    previous turns of a chat, ...) only have to encode the tokens that follow the cached prefix.
+
+    Prompts are split in blocks of `block_size` tokens, and each block is indexed by a hash of all the tokens up to its
+    end, so that the longest cached prefix of a new prompt is found in a number of dictionary lookups proportional to
+    its number of blocks. The match is then extended token by token within the stored prompt. When the cached states
+    exceed `max_memory_bytes`, the least recently used prompts are evicted.
+
+    A cache must only be used with the model that filled it. It is used by passing it to `generate` as
+    `prefix_cache`, and works with decoder-only models that support [`~cache_utils.Cache`] instances (and therefore
+    return their legacy cache in the `(batch_size, num_heads, sequence_length, embed_size_per_head)` format), for
+    unpadded inputs.
+
+    <Tip>
+
+    The cached prefix is only skipped by the forward pass over the prompt: the scores and outputs returned by
+    `generate` are unchanged, but the attentions and hidden states returned for the first generation step only cover
+    the last prompt token.
+
+    </Tip>
+
+    Args:
+        block_size (`int`, *optional*, defaults to 16):
+            The number of tokens per indexed block. Smaller blocks find shorter shared prefixes, at the price of more
+            lookups.
+        max_memory_bytes (`int`, *optional*):
+            The maximum size, in bytes, of the cached key/value states. Unbounded if unset.
+
+    Examples:
+
+    ```python
+    >>> from transformers import AutoModelForCausalLM, AutoTokenizer, PrefixCache
+
+    >>> tokenizer = AutoTokenizer.from_pretrained("gpt2")
+    >>> model = AutoModelForCausalLM.from_pretrained("gpt2")
+    >>> prefix_cache = PrefixCache(max_memory_bytes=2**30)
+
+    >>> system_prompt = "You are a helpful assistant that answers in a single sentence.\n"
+    >>> for question in ["What is the capital of France?", "What is the capital of Italy?"]:
+    ...     inputs = tokenizer(system_prompt + question, return_tensors="pt")
+    ...     outputs = model.generate(**inputs, max_new_tokens=10, prefix_cache=prefix_cache)
+    >>> prefix_cache.num_hits
+    1
+    ```
+    """
+
+    def __init__(self, block_size: int = 16, max_memory_bytes: Optional[int] = None):
+        if block_size < 1:
+            raise ValueError(f"`block_size` has to be a strictly positive integer, but is {block_size}")
+        self.block_size = block_size
+        self.max_memory_bytes = max_memory_bytes
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_reused_tokens = 0
+        self._entries: "OrderedDict[int, _PrefixCacheEntry]" = OrderedDict()
+        # maps the hash of each block to all the entries containing it, as several prompts can share a prefix
+        self._block_index: Dict[int, Set[int]] = {}
+        self._prompt_index: Dict[Tuple[int, ...], int] = {}
+        self._next_entry_id = 0
+        self._num_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def num_bytes(self) -> int:
+        """The size, in bytes, of the cached key/value states."""
+        return self._num_bytes
+
+    def _block_hashes(self, token_ids: Sequence[int]) -> List[int]:
+        block_hashes = []
+        block_hash = None
+        for start in range(0, len(token_ids) - self.block_size + 1, self.block_size):
+            block_hash = hash((block_hash, tuple(token_ids[start : start + self.block_size])))
+            block_hashes.append(block_hash)
+        return block_hashes
+
+    def _match(self, token_ids: Sequence[int]) -> Tuple[Optional[int], int]:
+        """Returns the id of the entry sharing the longest prefix with `token_ids`, and the length of that prefix."""
+        entry_ids = None
+        for block_hash in self._block_hashes(token_ids):
+            if block_hash not in self._block_index:
+                break
+            entry_ids = self._block_index[block_hash]
+        if entry_ids is None:
+            return None, 0
+
+        # extends the match beyond the last matching block, which also guards against hash collisions
+        best_entry_id, best_length = None, 0
+        for entry_id in entry_ids:
+            length = 0
+            for cached_token, token in zip(self._entries[entry_id].token_ids, token_ids):
+                if cached_token != token:
+                    break
+                length += 1
+            if best_entry_id is None or length > best_length:
+                best_entry_id, best_length = entry_id, length
+        return best_entry_id, best_length
+
+    def lookup(
+        self, token_ids: Sequence[int], max_length: Optional[int] = None, record_stats: bool = True
+    ) -> Tuple[int, Optional[Tuple]]:
+        """
+        Finds the longest cached prefix of `token_ids`.
+
+        Args:
+            token_ids (`Sequence[int]`):
+                The token ids of a single prompt.
+            max_length (`int`, *optional*):
+                The maximum length of the returned prefix.
+            record_stats (`bool`, *optional*, defaults to `True`):
+                Whether to count the lookup in `num_hits`, `num_misses` and `num_reused_tokens`. Callers that may reuse
+                less than the returned prefix disable it and call `record_lookup` instead.
+
+        Return:
+            `Tuple[int, Optional[Tuple]]`: The length of the cached prefix and its key/value states, in the legacy
+            cache format with a batch size of 1, or `(0, None)` if no prefix of at least one block is cached.
+        """
+        entry_id, length = self._match(token_ids)
+        if max_length is not None:
+            length = min(length, max_length)
+        if record_stats:
+            self.record_lookup(1, length)
+        if length == 0:
+            return 0, None
+
+        self._entries.move_to_end(entry_id)
+        past_key_values = self._entries[entry_id].past_key_values
+        past_key_values = tuple(tuple(past_state[:, :, :length] for past_state in layer) for layer in past_key_values)
+        return length, past_key_values
+
+    def record_lookup(self, batch_size: int, reused_length: int):
+        """
+        Counts a lookup in `num_hits`, `num_misses` and `num_reused_tokens`.
+
+        Args:
+            batch_size (`int`):
+                The number of prompts looked up.
+            reused_length (`int`):
+                The length of the cached prefix reused for each of these prompts, `0` for a miss.
+        """
+        if reused_length > 0:
+            self.num_hits += batch_size
+            self.num_reused_tokens += reused_length * batch_size
+        else:
+            self.num_misses += batch_size
+
+    def store(self, token_ids: Sequence[int], past_key_values: Tuple[Tuple[torch.Tensor]]):
+        """
+        Caches the key/value states of a prompt.
+
+        Args:
+            token_ids (`Sequence[int]`):
+                The token ids of a single prompt.
+            past_key_values (`Tuple[Tuple[torch.Tensor]]`):
+                The key/value states of `token_ids`, in the legacy cache format with a batch size of 1. The tensors are
+                kept as they are, and must therefore not be modified in place afterwards.
+        """
+        token_ids = tuple(token_ids)
+        if token_ids in self._prompt_index:
+            self._entries.move_to_end(self._prompt_index[token_ids])
+            return
+        entry_id, length = self._match(token_ids)
+        if entry_id is not None and length == len(token_ids):
+            # the prompt is already cached, as the prefix of a longer one
+            self._entries.move_to_end(entry_id)
+            return
+        if entry_id is not None and length == len(self._entries[entry_id].token_ids):
+            # the new prompt extends a cached one, which becomes redundant
+            self._remove(entry_id)
+
+        num_bytes = _past_num_bytes(past_key_values)
+        if self.max_memory_bytes is not None and num_bytes > self.max_memory_bytes:
+            return
+
+        entry_id = self._next_entry_id
+        self._next_entry_id += 1
+        entry = _PrefixCacheEntry(
+            token_ids=token_ids,
+            past_key_values=past_key_values,
+            block_hashes=self._block_hashes(token_ids),
+            num_bytes=num_bytes,
+        )
+        self._entries[entry_id] = entry
+        self._prompt_index[token_ids] = entry_id
+        for block_hash in entry.block_hashes:
+            self._block_index.setdefault(block_hash, set()).add(entry_id)
+        self._num_bytes += num_bytes
+
+        if self.max_memory_bytes is not None:
+            while self._num_bytes > self.max_memory_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        del self._prompt_index[entry.token_ids]
+        for block_hash in entry.block_hashes:
+            entry_ids = self._block_index[block_hash]
+            entry_ids.discard(entry_id)
+            if not entry_ids:
+                del self._block_index[block_hash]
+        self._num_bytes -= entry.num_bytes
+
+    def clear(self):
+        """Removes all the cached prompts."""
+        self._entries.clear()
+        self._block_index.clear()
+        self._prompt_index.clear()
+        self._num_bytes = 0
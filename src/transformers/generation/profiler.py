@@ -0,0 +1,254 @@
+# coding=utf-8
+# Copyright 2023 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import torch
+
+from ..cache_utils import Cache
+
+
+GENERATION_PHASES = (
+    "candidate_generation",
+    "forward",
+    "logits_processor",
+    "logits_warper",
+    "sampling",
+    "cache_update",
+    "streamer",
+    "stopping_criteria",
+)
+
+
+@dataclass
+class GenerationStepProfile:
+    """
+    The timings of a decoding step recorded by [`GenerationProfiler`].
+
+    Args:
+        step (`int`):
+            The index of the step, starting at 0.
+        duration (`float`):
+            The duration of the step, in seconds.
+        num_new_tokens (`int`):
+            The number of tokens added to each sequence by the step (more than one for assisted generation).
+        phase_durations (`Dict[str, float]`):
+            The time spent in each phase of the step, in seconds. The phases are the ones of `GENERATION_PHASES` that
+            the decoding method goes through.
+        past_key_values_bytes (`int`, *optional*):
+            The size, in bytes, of the key/value cache at the end of the step.
+    """
+
+    step: int
+    duration: float
+    num_new_tokens: int
+    phase_durations: Dict[str, float] = field(default_factory=dict)
+    past_key_values_bytes: Optional[int] = None
+
+
+def _get_num_bytes(past_key_values: Any, seen_data_ptrs: Set[int]) -> int:
+    """The size of the tensors held by `past_key_values`, counting tensors that share their storage only once."""
+    if isinstance(past_key_values, torch.Tensor):
+        if past_key_values.data_ptr() in seen_data_ptrs:
+            return 0
+        seen_data_ptrs.add(past_key_values.data_ptr())
+        return past_key_values.numel() * past_key_values.element_size()
+    if isinstance(past_key_values, Cache):
+        past_key_values = vars(past_key_values)
+    if isinstance(past_key_values, dict):
+        past_key_values = list(past_key_values.values())
+    if isinstance(past_key_values, (list, tuple)):
+        return sum(_get_num_bytes(item, seen_data_ptrs) for item in past_key_values)
+    return 0
+
+
+class GenerationProfiler:
+    r"""
+    Records where the time of [`~generation.GenerationMixin.generate`] goes, step by step, to find out why generation
+    is slow without wrapping its internals in `torch.profiler`. It is used by passing it to `generate` as `profiler`.
+
+    Each decoding step is split in phases, listed in `GENERATION_PHASES`: the drafting of candidate tokens in assisted
+    generation, the model forward pass, the logits processors and warpers, the selection of the next tokens
+    (`"sampling"`, which also covers greedy and beam selection), the update of the model inputs and of the cache
+    (`"cache_update"`, which includes the reordering of the cache in beam methods), the streamer callbacks and the
+    stopping criteria. The size of the key/value cache is also recorded at the end of each step. The time spent before
+    the first step, e.g. encoding the inputs of an encoder-decoder model, is reported as `setup_time`.
+
+    Phases are timed with wall-clock timestamps taken between them, so that profiling adds no more than a function call
+    per phase. On GPUs, where the work of a phase may still be running when the next one starts, `synchronize=True`
+    waits for the device at each timestamp, which gives accurate phase timings at the expense of some overlap.
+
+    Args:
+        on_step (`Callable[[GenerationStepProfile], None]`, *optional*):
+            A function called with the [`~generation.profiler.GenerationStepProfile`] of each step, as soon as the step
+            ends.
+        on_end (`Callable[[Dict[str, Any]], None]`, *optional*):
+            A function called with the `summary()` of the generation once it ends.
+        synchronize (`bool`, *optional*, defaults to `True`):
+            Whether to synchronize the CUDA devices before each timestamp.
+
+    Examples:
+
+    ```python
+    >>> from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationProfiler
+
+    >>> tokenizer = AutoTokenizer.from_pretrained("gpt2")
+    >>> model = AutoModelForCausalLM.from_pretrained("gpt2")
+    >>> inputs = tokenizer(["An increasing sequence: one,"], return_tensors="pt")
+
+    >>> profiler = GenerationProfiler()
+    >>> _ = model.generate(**inputs, max_new_tokens=10, profiler=profiler)
+    >>> summary = profiler.summary()
+    >>> summary["num_steps"], sorted(summary["phase_times"])
+    (10, ['cache_update', 'forward', 'logits_processor', 'sampling', 'stopping_criteria', 'streamer'])
+    ```
+    """
+
+    def __init__(
+        self,
+        on_step: Optional[Callable[[GenerationStepProfile], None]] = None,
+        on_end: Optional[Callable[[Dict[str, Any]], None]] = None,
+        synchronize: bool = True,
+    ):
+        self.on_step = on_step
+        self.on_end = on_end
+        self.synchronize = synchronize
+        self.start()
+
+    def _now(self) -> float:
+        if self.synchronize and torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def start(self):
+        """Discards the previous records and starts timing a new generation. Called by `generate`."""
+        self.steps: List[GenerationStepProfile] = []
+        self.setup_time: Optional[float] = None
+        self._start_time = self._now()
+        self._step_start_time = None
+        self._last_time = None
+        self._phase_durations: Dict[str, float] = {}
+        self._sequence_length = None
+
+    def mark(self, phase: str):
+        """Books the time elapsed since the previous timestamp of the current step to `phase`."""
+        now = self._now()
+        if self._last_time is not None:
+            self._phase_durations[phase] = self._phase_durations.get(phase, 0.0) + now - self._last_time
+        self._last_time = now
+
+    def step(self, input_ids: torch.LongTensor, past_key_values: Any = None):
+        """
+        Ends the current step, if any, and starts a new one. Called at the start of each iteration of the decoding
+        loops: the time elapsed since the last timestamp of the step that ends is booked to the stopping criteria,
+        which close every iteration.
+
+        Args:
+            input_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
+                The sequences generated so far.
+            past_key_values (*optional*):
+                The key/value cache of the model, whose size is recorded.
+        """
+        now = self._end_step(input_ids, past_key_values)
+        self._step_start_time = now
+        self._last_time = now
+
+    def end(self, input_ids: Optional[torch.LongTensor] = None, past_key_values: Any = None):
+        """Ends the current step, if any, and the generation. Called once the decoding loops end."""
+        self._end_step(input_ids, past_key_values)
+        self._step_start_time = None
+        self._last_time = None
+        if self.on_end is not None:
+            self.on_end(self.summary())
+
+    def _end_step(self, input_ids: Optional[torch.LongTensor], past_key_values: Any) -> float:
+        now = self._now()
+        if self._step_start_time is None:
+            if self.setup_time is None:
+                self.setup_time = now - self._start_time
+        else:
+            self.mark("stopping_criteria")
+            num_new_tokens = 0
+            if input_ids is not None and self._sequence_length is not None:
+                num_new_tokens = input_ids.shape[-1] - self._sequence_length
+            step_profile = GenerationStepProfile(
+                step=len(self.steps),
+                duration=now - self._step_start_time,
+                num_new_tokens=num_new_tokens,
+                phase_durations=self._phase_durations,
+                past_key_values_bytes=(
+                    _get_num_bytes(past_key_values, set()) if past_key_values is not None else None
+                ),
+            )
+            self.steps.append(step_profile)
+            if self.on_step is not None:
+                self.on_step(step_profile)
+        self._phase_durations = {}
+        if input_ids is not None:
+            self._sequence_length = input_ids.shape[-1]
+        return now
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Summarizes the recorded steps.
+
+        Return:
+            `Dict[str, Any]`: A dictionary with
+            - `"num_steps"` and `"num_new_tokens"`, the number of decoding steps and of tokens added to each sequence,
+            - `"setup_time"`, the time spent before the first step, in seconds,
+            - `"time_to_first_token"`, the time until the end of the first step, in seconds,
+            - `"inter_token_latency"`, the mean time per token after the first step, in seconds, and
+              `"inter_token_latency_p50"`, `"inter_token_latency_p90"` and `"inter_token_latency_max"`, its
+              percentiles over the steps,
+            - `"total_time"`, in seconds, and `"tokens_per_second"`,
+            - `"phase_times"`, the total time spent in each phase, in seconds,
+            - `"max_past_key_values_bytes"`, the largest recorded size of the key/value cache.
+        """
+        setup_time = self.setup_time or 0.0
+        summary = {
+            "num_steps": len(self.steps),
+            "num_new_tokens": sum(step.num_new_tokens for step in self.steps),
+            "setup_time": setup_time,
+            "time_to_first_token": setup_time + self.steps[0].duration if self.steps else None,
+            "total_time": setup_time + sum(step.duration for step in self.steps),
+        }
+
+        later_steps = [step for step in self.steps[1:] if step.num_new_tokens > 0]
+        latencies = sorted(step.duration / step.num_new_tokens for step in later_steps)
+        num_later_tokens = sum(step.num_new_tokens for step in later_steps)
+        summary["inter_token_latency"] = (
+            sum(step.duration for step in later_steps) / num_later_tokens if num_later_tokens > 0 else None
+        )
+        for name, quantile in (("p50", 0.5), ("p90", 0.9), ("max", 1.0)):
+            summary[f"inter_token_latency_{name}"] = (
+                latencies[min(int(quantile * len(latencies)), len(latencies) - 1)] if latencies else None
+            )
+        summary["tokens_per_second"] = (
+            summary["num_new_tokens"] / summary["total_time"] if summary["total_time"] > 0 else None
+        )
+
+        phase_times = {}
+        for step in self.steps:
+            for phase, duration in step.phase_durations.items():
+                phase_times[phase] = phase_times.get(phase, 0.0) + duration
+        summary["phase_times"] = phase_times
+
+        past_key_values_bytes = [
+            step.past_key_values_bytes for step in self.steps if step.past_key_values_bytes is not None
+        ]
+        summary["max_past_key_values_bytes"] = max(past_key_values_bytes) if past_key_values_bytes else None
+        return summary
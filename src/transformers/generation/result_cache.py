@@ -0,0 +1,343 @@
+# coding=utf-8
+# Copyright 2023 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+import torch
+from safetensors import SafetensorError
+from safetensors.torch import load, save
+
+from ..utils import logging
+from .configuration_utils import GenerationConfig
+
+
+if TYPE_CHECKING:
+    from ..modeling_utils import PreTrainedModel
+
+
+logger = logging.get_logger(__name__)
+
+
+def _sequences_num_bytes(sequences: torch.Tensor) -> int:
+    return sequences.numel() * sequences.element_size()
+
+
+class GenerationResultCache:
+    r"""
+    Base class of the caches storing the sequences returned by [`~generation.GenerationMixin.generate`], so that calls
+    repeating a previous one return its result without running the model. A cache is used by passing it to `generate`
+    (or to the `"text-generation"` pipeline) as `result_cache`.
+
+    Calls are looked up by a SHA-256 hash of the identity of the model (see `get_model_id`), of the model inputs and of
+    `generation_config.to_diff_dict()`. Only calls whose result is a deterministic function of these are cached:
+    greedy decoding, beam search, contrastive search, and sampling with `sequence_seeds`. The other calls, as well as
+    calls that return a [`~utils.ModelOutput`] or use a streamer, custom logits processors or stopping criteria, or
+    model kwargs that can't be hashed (e.g. `past_key_values`) run as usual and are counted as `bypasses`.
+
+    Subclasses store the sequences by implementing `_get`, `_set`, `clear`, `__len__` and `num_bytes`, and set
+    `is_persistent` if the stored sequences can outlive the process.
+    """
+
+    is_persistent = False
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.reset_metrics()
+
+    def get_model_id(self, model: "PreTrainedModel") -> Optional[str]:
+        """
+        Returns the identity of `model` in the cache keys: its class, checkpoint, revision and dtype, or `None` if its
+        results can't be cached. Models that were not loaded from a checkpoint are identified by their `id` instead, so
+        that their results are only reused while the model lives, and are therefore not cached by persistent caches, in
+        which a later model could get the same `id`. Override this method to tell apart models whose weights change
+        under the same name.
+        """
+        name_or_path = getattr(model.config, "_name_or_path", "")
+        if not name_or_path:
+            if self.is_persistent:
+                return None
+            name_or_path = f"id={id(model)}"
+        commit_hash = getattr(model.config, "_commit_hash", None)
+        return f"{model.__class__.__name__}|{name_or_path}|{commit_hash}|{model.dtype}"
+
+    def get_key(
+        self,
+        model: "PreTrainedModel",
+        inputs: Optional[torch.Tensor],
+        generation_config: GenerationConfig,
+        model_kwargs: Dict[str, Any],
+        sequence_seeds: Optional[Any] = None,
+    ) -> Optional[str]:
+        """
+        Returns the key of a `generate` call, or `None` if its result can't be cached.
+
+        Args:
+            model (`PreTrainedModel`):
+                The model `generate` is called on.
+            inputs (`torch.Tensor`, *optional*):
+                The `inputs` passed to `generate`.
+            generation_config (`GenerationConfig`):
+                The generation config of the call, updated with its kwargs.
+            model_kwargs (`Dict[str, Any]`):
+                The model kwargs of the call (e.g. `input_ids` and `attention_mask`).
+            sequence_seeds (*optional*):
+                The `sequence_seeds` passed to `generate`.
+        """
+        if generation_config.return_dict_in_generate:
+            return None
+        if generation_config.do_sample and sequence_seeds is None:
+            return None
+
+        model_id = self.get_model_id(model)
+        if model_id is None:
+            return None
+
+        config_dict = generation_config.to_diff_dict()
+        config_dict.pop("_from_model_config", None)
+        hasher = hashlib.sha256()
+        hasher.update(model_id.encode())
+        hasher.update(json.dumps(config_dict, sort_keys=True, default=str).encode())
+        for name, value in sorted({"inputs": inputs, "sequence_seeds": sequence_seeds, **model_kwargs}.items()):
+            hasher.update(name.encode())
+            if isinstance(value, torch.Tensor):
+                value = value.detach().cpu().contiguous()
+                hasher.update(f"{value.dtype}{tuple(value.shape)}".encode())
+                if value.dtype == torch.bfloat16:
+                    # numpy has no bfloat16: hash the same bytes as int16
+                    value = value.view(torch.int16)
+                hasher.update(value.numpy().tobytes())
+            elif value is None or isinstance(value, (bool, int, float, str)):
+                hasher.update(repr(value).encode())
+            elif isinstance(value, (list, tuple)) and all(isinstance(item, (bool, int, float, str)) for item in value):
+                hasher.update(repr(list(value)).encode())
+            else:
+                return None
+        return hasher.hexdigest()
+
+    def get(self, key: str) -> Optional[torch.LongTensor]:
+        """Returns the sequences stored under `key`, or `None`, and records the hit or the miss."""
+        with self._lock:
+            sequences = self._get(key)
+            if sequences is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return sequences
+
+    def set(self, key: str, sequences: torch.LongTensor):
+        """Stores `sequences` under `key`, evicting older entries if the cache is full."""
+        with self._lock:
+            self._set(key, sequences.detach().cpu().clone())
+
+    def record_bypass(self):
+        """Records a `generate` call whose result can't be cached."""
+        with self._lock:
+            self.bypasses += 1
+
+    def reset_metrics(self):
+        """Resets the hit, miss, bypass and eviction counts."""
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        """
+        The `hits`, `misses`, `bypasses` and `evictions` counts, the `hit_rate` among the cacheable calls, and the
+        number of `entries` and `num_bytes` currently stored.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups > 0 else None,
+                "entries": len(self),
+                "num_bytes": self.num_bytes(),
+            }
+
+    def _get(self, key: str) -> Optional[torch.LongTensor]:
+        raise NotImplementedError(f"{self.__class__.__name__} has to implement `_get`.")
+
+    def _set(self, key: str, sequences: torch.LongTensor):
+        raise NotImplementedError(f"{self.__class__.__name__} has to implement `_set`.")
+
+    def clear(self):
+        """Removes all the stored sequences."""
+        raise NotImplementedError(f"{self.__class__.__name__} has to implement `clear`.")
+
+    def num_bytes(self) -> int:
+        """The size of the stored sequences, in bytes."""
+        raise NotImplementedError(f"{self.__class__.__name__} has to implement `num_bytes`.")
+
+    def __len__(self) -> int:
+        raise NotImplementedError(f"{self.__class__.__name__} has to implement `__len__`.")
+
+
+class LRUGenerationResultCache(GenerationResultCache):
+    r"""
+    A [`GenerationResultCache`] holding the sequences in memory. When the cache holds more than `max_entries` results
+    or more than `max_num_bytes` bytes of sequences, the least recently used results are evicted.
+
+    Args:
+        max_entries (`int`, *optional*):
+            The maximum number of stored results. Unbounded if not set.
+        max_num_bytes (`int`, *optional*):
+            The maximum size of the stored sequences, in bytes. Unbounded if not set.
+
+    Examples:
+
+    ```python
+    >>> from transformers import AutoModelForCausalLM, AutoTokenizer, LRUGenerationResultCache
+
+    >>> tokenizer = AutoTokenizer.from_pretrained("gpt2")
+    >>> model = AutoModelForCausalLM.from_pretrained("gpt2")
+    >>> inputs = tokenizer(["An increasing sequence: one,"], return_tensors="pt")
+
+    >>> result_cache = LRUGenerationResultCache(max_entries=1000)
+    >>> outputs = model.generate(**inputs, max_new_tokens=10, result_cache=result_cache)
+    >>> outputs = model.generate(**inputs, max_new_tokens=10, result_cache=result_cache)  # doesn't run the model
+    >>> result_cache.metrics["hits"], result_cache.metrics["misses"]
+    (1, 1)
+    ```
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, max_num_bytes: Optional[int] = None):
+        if max_entries is not None and max_entries < 1:
+            raise ValueError(f"`max_entries` has to be a strictly positive integer, but is {max_entries}.")
+        self.max_entries = max_entries
+        self.max_num_bytes = max_num_bytes
+        self._entries: "OrderedDict[str, torch.LongTensor]" = OrderedDict()
+        self._num_bytes = 0
+        super().__init__()
+
+    def _get(self, key: str) -> Optional[torch.LongTensor]:
+        sequences = self._entries.get(key)
+        if sequences is not None:
+            self._entries.move_to_end(key)
+        return sequences
+
+    def _set(self, key: str, sequences: torch.LongTensor):
+        if key in self._entries:
+            self._num_bytes -= _sequences_num_bytes(self._entries.pop(key))
+        self._entries[key] = sequences
+        self._num_bytes += _sequences_num_bytes(sequences)
+        while len(self._entries) > 1 and (
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+            or (self.max_num_bytes is not None and self._num_bytes > self.max_num_bytes)
+        ):
+            _, evicted = self._entries.popitem(last=False)
+            self._num_bytes -= _sequences_num_bytes(evicted)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+
+    def num_bytes(self) -> int:
+        return self._num_bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteGenerationResultCache(GenerationResultCache):
+    r"""
+    A [`GenerationResultCache`] storing the sequences on disk, in a SQLite database, so that they can be shared by
+    several processes and outlive them. When the stored sequences exceed `max_num_bytes` bytes, the least recently used
+    results are evicted. The sequences are stored in the safetensors format, so that loading a shared database can't
+    run arbitrary code.
+
+    Args:
+        path (`str`):
+            The path to the database file, created if it doesn't exist.
+        max_num_bytes (`int`, *optional*):
+            The maximum size of the stored sequences, in bytes. Unbounded if not set.
+    """
+
+    is_persistent = True
+
+    def __init__(self, path: str, max_num_bytes: Optional[int] = None):
+        self.path = path
+        self.max_num_bytes = max_num_bytes
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS generation_results "
+            "(key TEXT PRIMARY KEY, sequences BLOB NOT NULL, num_bytes INTEGER NOT NULL, last_access INTEGER NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS generation_results_last_access ON generation_results (last_access)"
+        )
+        super().__init__()
+
+    def _get(self, key: str) -> Optional[torch.LongTensor]:
+        row = self._connection.execute("SELECT sequences FROM generation_results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            sequences = load(row[0])["sequences"]
+        except (SafetensorError, KeyError) as error:
+            # a row not written by this class: treated as a miss, and replaced by the next result
+            logger.warning(f"Dropping the unreadable generation result {key} of {self.path}: {error}")
+            self._connection.execute("DELETE FROM generation_results WHERE key = ?", (key,))
+            return None
+        self._connection.execute("UPDATE generation_results SET last_access = ? WHERE key = ?", (time.time_ns(), key))
+        return sequences
+
+    def _set(self, key: str, sequences: torch.LongTensor):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO generation_results (key, sequences, num_bytes, last_access) VALUES (?, ?, ?, ?)",
+            (key, save({"sequences": sequences.contiguous()}), _sequences_num_bytes(sequences), time.time_ns()),
+        )
+        if self.max_num_bytes is None:
+            return
+        excess = self.num_bytes() - self.max_num_bytes
+        if excess <= 0:
+            return
+        evicted_keys = []
+        rows = self._connection.execute(
+            "SELECT key, num_bytes FROM generation_results WHERE key != ? ORDER BY last_access", (key,)
+        ).fetchall()
+        for evicted_key, num_bytes in rows:
+            if excess <= 0:
+                break
+            evicted_keys.append((evicted_key,))
+            excess -= num_bytes
+        self._connection.executemany("DELETE FROM generation_results WHERE key = ?", evicted_keys)
+        self.evictions += len(evicted_keys)
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM generation_results")
+
+    def num_bytes(self) -> int:
+        return self._connection.execute("SELECT COALESCE(SUM(num_bytes), 0) FROM generation_results").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM generation_results").fetchone()[0]
+
+    def close(self):
+        """Closes the connection to the database."""
+        self._connection.close()
@@ -2,13 +2,17 @@ import time
 import warnings
 from abc import ABC
 from copy import deepcopy
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
 import torch
 
 from ..utils import add_start_docstrings, logging
 
 
+if TYPE_CHECKING:
+    from .streamers import AsyncTextIteratorStreamer
+
+
 logger = logging.get_logger(__name__)
 
 
@@ -121,6 +125,24 @@ class MaxTimeCriteria(StoppingCriteria):
         return time.time() - self.initial_timestamp > self.max_time
 
 
+class StreamerCancelledCriteria(StoppingCriteria):
+    """
+    This class can be used to stop generation once all the sequences streamed by an [`AsyncTextIteratorStreamer`] were
+    cancelled, e.g. because their consumers are gone. It is available as the streamer's `stopping_criteria`.
+
+    Args:
+        streamer (`AsyncTextIteratorStreamer`):
+            The streamer passed to `.generate()`.
+    """
+
+    def __init__(self, streamer: "AsyncTextIteratorStreamer"):
+        self.streamer = streamer
+
+    @add_start_docstrings(STOPPING_CRITERIA_INPUTS_DOCSTRING)
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        return self.streamer.all_cancelled
+
+
 class StoppingCriteriaList(list):
     @add_start_docstrings(STOPPING_CRITERIA_INPUTS_DOCSTRING)
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
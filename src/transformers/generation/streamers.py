@@ -13,12 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import threading
 from queue import Queue
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional, Union
 
 
 if TYPE_CHECKING:
     from ..models.auto import AutoTokenizer
+    from .stopping_criteria import StoppingCriteriaList
 
 
 class BaseStreamer:
@@ -225,3 +228,341 @@ class TextIteratorStreamer(TextStreamer):
             raise StopIteration()
         else:
             return value
+
+
+class _IncrementalDetokenizer:
+    """
+    Decodes the tokens of a sequence as they are generated, by only decoding a window of the last tokens: the text of
+    the tokens that were not returned yet is the difference between the decoding of the window with and without them.
+    Text ending with an incomplete character (e.g. a multi-byte character split over several tokens) is held back.
+    """
+
+    # number of already returned tokens kept in the window when starting after a prompt, as decoding a token on its own
+    # may not give the same text as decoding it after other tokens (e.g. the space before a word)
+    context_size = 5
+
+    def __init__(self, tokenizer: "AutoTokenizer", **decode_kwargs):
+        self.tokenizer = tokenizer
+        self.decode_kwargs = decode_kwargs
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def add_context(self, token_ids: List[int]):
+        """Adds tokens whose text will not be returned, such as the prompt."""
+        self.token_ids.extend(token_ids)
+        self.read_offset = len(self.token_ids)
+        self.prefix_offset = max(self.read_offset - self.context_size, 0)
+
+    def add_tokens(self, token_ids: List[int]) -> str:
+        """Adds new tokens, and returns the text that can be printed."""
+        self.token_ids.extend(token_ids)
+        prefix_text, text = self._decode_window()
+        if len(text) <= len(prefix_text) or text.endswith("\ufffd"):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        self._trim()
+        return text[len(prefix_text) :]
+
+    def flush(self) -> str:
+        """Returns the text held back so far."""
+        prefix_text, text = self._decode_window()
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        self._trim()
+        return text[len(prefix_text) :]
+
+    def peek(self, token_ids: List[int]) -> str:
+        """Returns the text held back so far followed by the text of `token_ids`, without adding them."""
+        prefix_text, text = self._decode_window(token_ids)
+        return text[len(prefix_text) :]
+
+    def _decode_window(self, token_ids: Optional[List[int]] = None):
+        prefix_ids = self.token_ids[self.prefix_offset : self.read_offset]
+        prefix_text = self.tokenizer.decode(prefix_ids, **self.decode_kwargs)
+        window_ids = self.token_ids[self.prefix_offset :] + (token_ids if token_ids is not None else [])
+        text = self.tokenizer.decode(window_ids, **self.decode_kwargs)
+        return prefix_text, text
+
+    def _trim(self):
+        # only the window is decoded from now on, so that long sequences are not kept in memory
+        del self.token_ids[: self.prefix_offset]
+        self.read_offset -= self.prefix_offset
+        self.prefix_offset = 0
+
+
+class _AsyncSequenceIterator:
+    """Asynchronous iterator over the text of one of the sequences streamed by an [`AsyncTextIteratorStreamer`]."""
+
+    def __init__(self, streamer: "AsyncTextIteratorStreamer", sequence_idx: int):
+        self.streamer = streamer
+        self.sequence_idx = sequence_idx
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        queue = self.streamer._get_queue(self.sequence_idx)
+        try:
+            value = await asyncio.wait_for(queue.get(), timeout=self.streamer.timeout)
+        except asyncio.CancelledError:
+            # the consumer is gone (e.g. the client of a web server disconnected): there is no need to generate more
+            self.streamer.cancel(self.sequence_idx)
+            raise
+        if value is self.streamer.stop_signal:
+            raise StopAsyncIteration()
+        self.streamer._release(self.sequence_idx)
+        return value
+
+
+class AsyncTextIteratorStreamer(BaseStreamer):
+    """
+    Streamer that makes the generated text available to `asyncio` code, with one asynchronous iterator per generated
+    sequence: `async for text in streamer[i]` iterates over the text of the `i`-th sequence of the batch, and `async
+    for text in streamer` over the text of the first one. `.generate()` is meant to run in another thread (e.g. with
+    `loop.run_in_executor`), while the event loop consumes the text.
+
+    Contrary to [`TextIteratorStreamer`], only the last tokens of each sequence are decoded at each step, and the text
+    is made available as soon as it is complete, instead of waiting for entire words. A sequence ends when it generates
+    `eos_token_id`.
+
+    <Tip warning={true}>
+
+    The API for the streamer classes is still under development and may change in the future.
+
+    </Tip>
+
+    Parameters:
+        tokenizer (`AutoTokenizer`):
+            The tokenized used to decode the tokens.
+        skip_prompt (`bool`, *optional*, defaults to `False`):
+            Whether to skip the prompt to `.generate()` or not. Useful e.g. for chatbots.
+        timeout (`float`, *optional*):
+            The timeout, in seconds, of the iterators and of the generation thread when it waits for the consumers. If
+            `None`, they will wait indefinitely. Useful to handle exceptions in `.generate()`.
+        max_queue_size (`int`, *optional*, defaults to 0):
+            The maximum number of pieces of text waiting to be consumed, per sequence. When one of them is reached,
+            generation blocks until the text is consumed, so that a slow consumer slows generation down instead of
+            letting text pile up in memory. With a value of 0, the queues are unbounded. When set, the text of every
+            sequence has to be consumed, or the sequence has to be cancelled.
+        eos_token_id (`Union[int, List[int]]`, *optional*):
+            The id of the *end-of-sequence* token, which ends the stream of a sequence. Optionally, use a list to set
+            multiple *end-of-sequence* tokens. Defaults to the tokenizer's.
+        loop (`asyncio.AbstractEventLoop`, *optional*):
+            The event loop of the consumers. Defaults to the running event loop.
+        decode_kwargs (`dict`, *optional*):
+            Additional keyword arguments to pass to the tokenizer's `decode` method.
+
+    Examples:
+
+        ```python
+        >>> import asyncio
+        >>> from transformers import AutoModelForCausalLM, AutoTokenizer, AsyncTextIteratorStreamer
+
+        >>> tok = AutoTokenizer.from_pretrained("gpt2")
+        >>> model = AutoModelForCausalLM.from_pretrained("gpt2")
+        >>> inputs = tok(["An increasing sequence: one,"], return_tensors="pt")
+
+
+        >>> async def stream():
+        ...     streamer = AsyncTextIteratorStreamer(tok, max_queue_size=8)
+        ...     # `streamer.stopping_criteria` stops the generation if the consumer is cancelled
+        ...     generation_kwargs = dict(
+        ...         inputs, streamer=streamer, stopping_criteria=streamer.stopping_criteria, max_new_tokens=20
+        ...     )
+        ...     loop = asyncio.get_running_loop()
+        ...     generation = loop.run_in_executor(None, lambda: model.generate(**generation_kwargs))
+        ...     generated_text = ""
+        ...     async for new_text in streamer:
+        ...         generated_text += new_text
+        ...     await generation
+        ...     return generated_text
+
+
+        >>> asyncio.run(stream())
+        'An increasing sequence: one, two, three, four, five, six, seven, eight, nine, ten, eleven,'
+        ```
+    """
+
+    def __init__(
+        self,
+        tokenizer: "AutoTokenizer",
+        skip_prompt: bool = False,
+        timeout: Optional[float] = None,
+        max_queue_size: int = 0,
+        eos_token_id: Optional[Union[int, List[int]]] = None,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+        **decode_kwargs,
+    ):
+        if max_queue_size < 0:
+            raise ValueError(f"`max_queue_size` has to be a positive integer, but is {max_queue_size}")
+        self.tokenizer = tokenizer
+        self.skip_prompt = skip_prompt
+        self.timeout = timeout
+        self.max_queue_size = max_queue_size
+        if eos_token_id is None:
+            eos_token_id = tokenizer.eos_token_id
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        self.eos_token_id = set(eos_token_id) if eos_token_id is not None else set()
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        self.decode_kwargs = decode_kwargs
+        self.stop_signal = None
+
+        # variables used in the streaming process, by the generation thread
+        self.detokenizers: List[_IncrementalDetokenizer] = []
+        self.ended = []
+        self.next_tokens_are_prompt = True
+        # variables of the event loop
+        self._queues: Dict[int, asyncio.Queue] = {}
+        self._num_sequences = None
+        # variables shared by both: the semaphores count the room left for text in each queue
+        self._semaphores: List[threading.Semaphore] = []
+        self._cancelled = set()
+        self._all_cancelled = False
+
+    def __getitem__(self, sequence_idx: int) -> _AsyncSequenceIterator:
+        if self._num_sequences is not None and not 0 <= sequence_idx < self._num_sequences:
+            raise IndexError(f"The batch only has {self._num_sequences} sequences, {sequence_idx} is out of range")
+        return _AsyncSequenceIterator(self, sequence_idx)
+
+    def __aiter__(self) -> _AsyncSequenceIterator:
+        return self[0]
+
+    @property
+    def stopping_criteria(self) -> "StoppingCriteriaList":
+        """
+        The stopping criteria to pass to `.generate()` for the generation to stop early, once all the sequences were
+        cancelled.
+        """
+        from .stopping_criteria import StoppingCriteriaList, StreamerCancelledCriteria
+
+        return StoppingCriteriaList([StreamerCancelledCriteria(self)])
+
+    @property
+    def all_cancelled(self) -> bool:
+        """Whether all the sequences of the batch were cancelled, or ended before the others were cancelled."""
+        if self._all_cancelled:
+            return True
+        if len(self._cancelled) == 0:
+            return False
+        return len(self.ended) > 0 and all(
+            ended or sequence_idx in self._cancelled for sequence_idx, ended in enumerate(self.ended)
+        )
+
+    def cancel(self, sequence_idx: Optional[int] = None):
+        """
+        Stops streaming the text of a sequence, or of all the sequences if `sequence_idx` is not set, and ends their
+        iterators. Once all the sequences are cancelled, generation stops at the next step if `stopping_criteria` was
+        passed to `.generate()`. Can be called from any thread.
+        """
+        if sequence_idx is None:
+            self._all_cancelled = True
+        else:
+            self._cancelled.add(sequence_idx)
+
+        # unblocks the generation thread if it waits for room in the queue of a cancelled sequence
+        for semaphore_idx, semaphore in enumerate(self._semaphores):
+            if sequence_idx is None or semaphore_idx == sequence_idx:
+                semaphore.release()
+        self.loop.call_soon_threadsafe(self._end_cancelled, sequence_idx)
+
+    def _is_cancelled(self, sequence_idx: int) -> bool:
+        return self._all_cancelled or sequence_idx in self._cancelled
+
+    def put(self, value):
+        """
+        Receives tokens, decodes them incrementally, and sends the new text of each sequence to its iterator.
+        """
+        token_ids = value.tolist()
+        if len(value.shape) == 1:
+            # one new token per sequence
+            token_ids = [[token_id] for token_id in token_ids]
+
+        new_texts = {}
+        if self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            num_sequences = len(token_ids)
+            self.detokenizers = [_IncrementalDetokenizer(self.tokenizer, **self.decode_kwargs) for _ in token_ids]
+            self.ended = [False] * num_sequences
+            self._semaphores = [threading.Semaphore(self.max_queue_size) for _ in range(num_sequences)]
+            self.loop.call_soon_threadsafe(self._set_num_sequences, num_sequences)
+            for sequence_idx, sequence_token_ids in enumerate(token_ids):
+                if self.skip_prompt:
+                    self.detokenizers[sequence_idx].add_context(sequence_token_ids)
+                else:
+                    new_texts[sequence_idx] = self.detokenizers[sequence_idx].add_tokens(sequence_token_ids)
+        else:
+            for sequence_idx, sequence_token_ids in enumerate(token_ids):
+                if self.ended[sequence_idx]:
+                    continue
+                # the tokens after the end of a sequence are padding
+                for num_tokens, token_id in enumerate(sequence_token_ids):
+                    if token_id in self.eos_token_id:
+                        sequence_token_ids = sequence_token_ids[: num_tokens + 1]
+                        self.ended[sequence_idx] = True
+                        break
+                new_texts[sequence_idx] = self.detokenizers[sequence_idx].add_tokens(sequence_token_ids)
+                if self.ended[sequence_idx]:
+                    new_texts[sequence_idx] += self.detokenizers[sequence_idx].flush()
+
+        ended = [sequence_idx for sequence_idx in new_texts if self.ended[sequence_idx]]
+        self._send(new_texts, ended)
+
+    def end(self):
+        """Flushes any remaining text and ends the iterators of all the sequences."""
+        new_texts = {}
+        for sequence_idx, detokenizer in enumerate(self.detokenizers):
+            if not self.ended[sequence_idx]:
+                new_texts[sequence_idx] = detokenizer.flush()
+                self.ended[sequence_idx] = True
+        self.next_tokens_are_prompt = True
+        self._send(new_texts, ended=list(new_texts.keys()))
+
+    def _send(self, new_texts: Dict[int, str], ended: List[int]):
+        """
+        Sends text from the generation thread to the event loop. With bounded queues, waits until there is room for the
+        text of each sequence, the stop signals being always accepted.
+        """
+        items = []
+        for sequence_idx, text in new_texts.items():
+            if len(text) == 0 or self._is_cancelled(sequence_idx):
+                continue
+            if self.max_queue_size > 0 and not self._semaphores[sequence_idx].acquire(timeout=self.timeout):
+                raise TimeoutError(f"The text of sequence {sequence_idx} was not consumed in {self.timeout} seconds")
+            items.append((sequence_idx, text))
+        items.extend((sequence_idx, self.stop_signal) for sequence_idx in ended)
+        if len(items) > 0:
+            self.loop.call_soon_threadsafe(self._put, items)
+
+    def _put(self, items):
+        for sequence_idx, value in items:
+            if not self._is_cancelled(sequence_idx):
+                self._get_queue(sequence_idx).put_nowait(value)
+
+    def _get_queue(self, sequence_idx: int) -> asyncio.Queue:
+        # the queues are created lazily by the event loop, as `asyncio.Queue` may be bound to the current event loop
+        if sequence_idx not in self._queues:
+            self._queues[sequence_idx] = asyncio.Queue()
+            if self._is_cancelled(sequence_idx):
+                self._queues[sequence_idx].put_nowait(self.stop_signal)
+        return self._queues[sequence_idx]
+
+    def _release(self, sequence_idx: int):
+        # called by the event loop when a piece of text is consumed
+        if self.max_queue_size > 0:
+            self._semaphores[sequence_idx].release()
+
+    def _set_num_sequences(self, num_sequences: int):
+        self._num_sequences = num_sequences
+        # ends the iterators of sequences that are not in the batch
+        for sequence_idx, queue in self._queues.items():
+            if sequence_idx >= num_sequences:
+                queue.put_nowait(self.stop_signal)
+
+    def _end_cancelled(self, sequence_idx: Optional[int]):
+        for queue_idx, queue in self._queues.items():
+            if sequence_idx is None or queue_idx == sequence_idx:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(self.stop_signal)
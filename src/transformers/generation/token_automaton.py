@@ -0,0 +1,690 @@
+# coding=utf-8
+# Copyright 2023 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Regular expressions (and JSON schemas, through regular expressions) compiled against the vocabulary of a tokenizer
+into automata over token ids, used to constrain generation.
+"""
+
+import bisect
+import hashlib
+import json
+import os
+import re
+import weakref
+from collections import deque
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
+
+import torch
+from safetensors.torch import load_file, save_file
+
+from ..utils import logging
+from ..utils.hub import hf_cache_home
+
+
+if TYPE_CHECKING:
+    from ..tokenization_utils_base import PreTrainedTokenizerBase
+
+
+logger = logging.get_logger(__name__)
+
+TOKEN_AUTOMATA_CACHE = os.getenv("TRANSFORMERS_TOKEN_AUTOMATA_CACHE", os.path.join(hf_cache_home, "token_automata"))
+
+SPIECE_UNDERLINE = "▁"
+_MAX_CODE_POINT = 0x10FFFF
+_DIGIT_RANGES = [(ord("0"), ord("9"))]
+_WORD_RANGES = [(ord("0"), ord("9")), (ord("A"), ord("Z")), (ord("_"), ord("_")), (ord("a"), ord("z"))]
+_SPACE_RANGES = [(ord("\t"), ord("\r")), (ord(" "), ord(" "))]
+_ESCAPED_CHARACTERS = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "0": "\0"}
+_QUANTIFIER = re.compile(r"\{(\d+)(,(\d*))?\}")
+
+
+class _CharClass:
+    """A set of characters, stored as sorted and disjoint ranges of code points."""
+
+    def __init__(self, ranges: List[Tuple[int, int]], negated: bool = False):
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        if negated:
+            complement, previous_end = [], -1
+            for start, end in merged:
+                if start > previous_end + 1:
+                    complement.append((previous_end + 1, start - 1))
+                previous_end = end
+            if previous_end < _MAX_CODE_POINT:
+                complement.append((previous_end + 1, _MAX_CODE_POINT))
+            merged = complement
+        self.starts = [start for start, _ in merged]
+        self.ends = [end for _, end in merged]
+
+    def __contains__(self, char: str) -> bool:
+        code_point = ord(char)
+        idx = bisect.bisect_right(self.starts, code_point) - 1
+        return idx >= 0 and code_point <= self.ends[idx]
+
+
+class _RegexParser:
+    """
+    Parses a regular expression into a syntax tree of `("char", _CharClass)`, `("concat", nodes)`, `("alt", nodes)`
+    and `("repeat", node, min, max)` nodes. Groups, alternations, character classes, the usual escapes and quantifiers
+    are supported; backreferences, lookarounds and word boundaries, which are not regular, are not.
+    """
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.pos = 0
+
+    def parse(self):
+        node = self._alternation()
+        if self.pos < len(self.pattern):
+            self._error(f"unbalanced `{self.pattern[self.pos]}`")
+        return node
+
+    def _error(self, message: str):
+        raise ValueError(f"Unsupported regular expression {self.pattern!r}: {message} at position {self.pos}.")
+
+    def _peek(self) -> Optional[str]:
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def _next(self) -> str:
+        if self.pos >= len(self.pattern):
+            self._error("unexpected end of pattern")
+        self.pos += 1
+        return self.pattern[self.pos - 1]
+
+    def _alternation(self):
+        branches = [self._concatenation()]
+        while self._peek() == "|":
+            self.pos += 1
+            branches.append(self._concatenation())
+        return ("alt", branches) if len(branches) > 1 else branches[0]
+
+    def _concatenation(self):
+        nodes = []
+        while self._peek() is not None and self._peek() not in "|)":
+            nodes.append(self._repetition())
+        return ("concat", nodes)
+
+    def _repetition(self):
+        node = self._atom()
+        while True:
+            char = self._peek()
+            if char == "*":
+                min_count, max_count = 0, None
+            elif char == "+":
+                min_count, max_count = 1, None
+            elif char == "?":
+                min_count, max_count = 0, 1
+            elif char == "{" and _QUANTIFIER.match(self.pattern, self.pos):
+                match = _QUANTIFIER.match(self.pattern, self.pos)
+                min_count = int(match.group(1))
+                if match.group(2) is None:
+                    max_count = min_count
+                else:
+                    max_count = int(match.group(3)) if match.group(3) else None
+                if max_count is not None and max_count < min_count:
+                    self._error("min repeat greater than max repeat")
+                self.pos = match.end() - 1
+            else:
+                return node
+            self.pos += 1
+            # lazy and possessive quantifiers match the same language
+            if self._peek() in ("?", "+"):
+                self.pos += 1
+            node = ("repeat", node, min_count, max_count)
+
+    def _atom(self):
+        char = self._next()
+        if char == "(":
+            if self.pattern.startswith("?:", self.pos):
+                self.pos += 2
+            elif self._peek() == "?":
+                self._error("only non-capturing groups `(?:...)` are supported among the group extensions")
+            node = self._alternation()
+            if self._next() != ")":
+                self._error("missing `)`")
+            return node
+        if char == "[":
+            return ("char", self._char_class())
+        if char == ".":
+            return ("char", _CharClass([(ord("\n"), ord("\n"))], negated=True))
+        if char == "\\":
+            return ("char", self._escape(in_class=False))
+        if char in "^$":
+            # the whole generated text is matched against the pattern, anchors are implicit
+            return ("concat", [])
+        if char in "*+?{" and not (char == "{" and not _QUANTIFIER.match(self.pattern, self.pos - 1)):
+            self._error("nothing to repeat")
+        return ("char", _CharClass([(ord(char), ord(char))]))
+
+    def _escape(self, in_class: bool):
+        char = self._next()
+        if char in "dws":
+            ranges = {"d": _DIGIT_RANGES, "w": _WORD_RANGES, "s": _SPACE_RANGES}[char]
+            return ranges if in_class else _CharClass(ranges)
+        if char in "DWS":
+            if in_class:
+                self._error(f"`\\{char}` is not supported in character classes")
+            return _CharClass({"D": _DIGIT_RANGES, "W": _WORD_RANGES, "S": _SPACE_RANGES}[char], negated=True)
+        if char in "xu":
+            num_digits = 2 if char == "x" else 4
+            digits = self.pattern[self.pos : self.pos + num_digits]
+            if len(digits) != num_digits or any(digit not in "0123456789abcdefABCDEF" for digit in digits):
+                self._error(f"invalid `\\{char}` escape")
+            self.pos += num_digits
+            code_point = int(digits, 16)
+        elif char in _ESCAPED_CHARACTERS:
+            code_point = ord(_ESCAPED_CHARACTERS[char])
+        elif char.isalnum():
+            self._error(f"unsupported escape `\\{char}`")
+        else:
+            code_point = ord(char)
+        ranges = [(code_point, code_point)]
+        return ranges if in_class else _CharClass(ranges)
+
+    def _char_class(self) -> _CharClass:
+        negated = self._peek() == "^"
+        if negated:
+            self.pos += 1
+        ranges = []
+        is_first = True
+        while True:
+            char = self._next()
+            if char == "]" and not is_first:
+                return _CharClass(ranges, negated=negated)
+            is_first = False
+            item = self._escape(in_class=True) if char == "\\" else [(ord(char), ord(char))]
+            is_single = len(item) == 1 and item[0][0] == item[0][1]
+            if is_single and self._peek() == "-" and self.pattern[self.pos + 1 : self.pos + 2] not in ("]", ""):
+                self.pos += 1
+                char = self._next()
+                end = self._escape(in_class=True) if char == "\\" else [(ord(char), ord(char))]
+                if len(end) != 1 or end[0][0] != end[0][1] or end[0][0] < item[0][0]:
+                    self._error("bad character range")
+                item = [(item[0][0], end[0][0])]
+            ranges.extend(item)
+
+
+class _LazyDFA:
+    """
+    The deterministic automaton of a regular expression over characters, built from its Thompson NFA by subset
+    construction, as its states and transitions are visited.
+    """
+
+    def __init__(self, pattern: str):
+        self._epsilons: List[List[int]] = []
+        self._edges: List[Optional[Tuple[_CharClass, int]]] = []
+        start, self._accept = self._compile(_RegexParser(pattern).parse())
+        self._subsets: List[frozenset] = []
+        self._subset_ids: Dict[frozenset, int] = {}
+        self._transitions: List[Dict[str, int]] = []
+        self.initial_state = self._get_state_id({start})
+
+    def _new_state(self) -> int:
+        self._epsilons.append([])
+        self._edges.append(None)
+        return len(self._edges) - 1
+
+    def _compile(self, node) -> Tuple[int, int]:
+        start, end = self._new_state(), self._new_state()
+        kind = node[0]
+        if kind == "char":
+            self._edges[start] = (node[1], end)
+        elif kind == "concat":
+            current = start
+            for child in node[1]:
+                child_start, child_end = self._compile(child)
+                self._epsilons[current].append(child_start)
+                current = child_end
+            self._epsilons[current].append(end)
+        elif kind == "alt":
+            for child in node[1]:
+                child_start, child_end = self._compile(child)
+                self._epsilons[start].append(child_start)
+                self._epsilons[child_end].append(end)
+        else:
+            _, child, min_count, max_count = node
+            current = start
+            for _ in range(min_count):
+                child_start, child_end = self._compile(child)
+                self._epsilons[current].append(child_start)
+                current = child_end
+            if max_count is None:
+                child_start, child_end = self._compile(child)
+                self._epsilons[current].extend([child_start, end])
+                self._epsilons[child_end].extend([child_start, end])
+            else:
+                for _ in range(max_count - min_count):
+                    child_start, child_end = self._compile(child)
+                    self._epsilons[current].extend([child_start, end])
+                    current = child_end
+                self._epsilons[current].append(end)
+        return start, end
+
+    def _get_state_id(self, nfa_states) -> int:
+        closure, stack = set(nfa_states), list(nfa_states)
+        while stack:
+            for next_state in self._epsilons[stack.pop()]:
+                if next_state not in closure:
+                    closure.add(next_state)
+                    stack.append(next_state)
+        # only the states with a character edge, and the accepting state, matter
+        subset = frozenset(state for state in closure if self._edges[state] is not None or state == self._accept)
+        state_id = self._subset_ids.get(subset)
+        if state_id is None:
+            state_id = len(self._subsets)
+            self._subsets.append(subset)
+            self._subset_ids[subset] = state_id
+            self._transitions.append({})
+        return state_id
+
+    def step(self, state: int, char: str) -> int:
+        """The state reached from `state` with `char`, or -1 if no text matching the pattern continues that way."""
+        transitions = self._transitions[state]
+        next_state = transitions.get(char)
+        if next_state is None:
+            targets = [
+                self._edges[nfa_state][1]
+                for nfa_state in self._subsets[state]
+                if self._edges[nfa_state] is not None and char in self._edges[nfa_state][0]
+            ]
+            next_state = self._get_state_id(targets) if targets else -1
+            if next_state >= 0 and len(self._subsets[next_state]) == 0:
+                next_state = -1
+            transitions[char] = next_state
+        return next_state
+
+    def is_accepting(self, state: int) -> bool:
+        return self._accept in self._subsets[state]
+
+
+def _escape_regex(text: str) -> str:
+    return "".join("\\" + char if char in "\\.^$|?*+()[]{}-" else char for char in text)
+
+
+_JSON_WHITESPACE = r"[ \t\n]*"
+_JSON_STRING_CHARACTER = r'(?:[^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})'
+_JSON_INTEGER = r"-?(?:0|[1-9][0-9]*)"
+_JSON_NUMBER = _JSON_INTEGER + r"(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?"
+_JSON_TYPES = {
+    "integer": _JSON_INTEGER,
+    "number": _JSON_NUMBER,
+    "boolean": r"(?:true|false)",
+    "null": "null",
+}
+
+
+def json_schema_to_regex(schema: Union[str, Dict[str, Any]]) -> str:
+    """
+    Converts a JSON schema into a regular expression matching the (compact or indented) JSON documents that are valid
+    instances of it.
+
+    The `type` (including lists of types), `enum`, `const`, `anyOf`, `oneOf`, single-element `allOf` and local `$ref`
+    keywords are supported, as well as `properties` and `required` for objects (the properties are generated in the
+    order of the schema), `items`, `minItems` and `maxItems` for arrays, `minLength` and `maxLength` for strings and
+    `pattern` for strings. As a regular expression can only describe a bounded nesting, recursive schemas, and
+    objects or arrays without `properties` or `items`, are not supported.
+
+    Args:
+        schema (`Union[str, Dict[str, Any]]`):
+            The JSON schema, as a dictionary or as a JSON string.
+
+    Return:
+        `str`: The regular expression.
+    """
+    if isinstance(schema, str):
+        schema = json.loads(schema)
+    return _json_schema_to_regex(schema, schema, ())
+
+
+def _json_schema_to_regex(schema: Dict[str, Any], root: Dict[str, Any], refs: Tuple[str, ...]) -> str:
+    if "$ref" in schema:
+        ref = schema["$ref"]
+        if ref in refs:
+            raise ValueError(f"Recursive JSON schemas can't be converted to a regular expression, but {ref} is.")
+        if not ref.startswith("#/"):
+            raise ValueError(f"Only local `$ref` are supported in JSON schemas, but got {ref}.")
+        target = root
+        for key in ref[2:].split("/"):
+            target = target[key]
+        return _json_schema_to_regex(target, root, refs + (ref,))
+    if "const" in schema:
+        return _escape_regex(json.dumps(schema["const"]))
+    if "enum" in schema:
+        return "(?:" + "|".join(_escape_regex(json.dumps(value)) for value in schema["enum"]) + ")"
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            return "(?:" + "|".join(_json_schema_to_regex(option, root, refs) for option in schema[key]) + ")"
+    if "allOf" in schema:
+        if len(schema["allOf"]) != 1:
+            raise ValueError("Only `allOf` with a single schema is supported in JSON schemas.")
+        return _json_schema_to_regex(schema["allOf"][0], root, refs)
+
+    schema_type = schema.get("type")
+    if isinstance(schema_type, list):
+        options = [_json_schema_to_regex({**schema, "type": option}, root, refs) for option in schema_type]
+        return "(?:" + "|".join(options) + ")"
+    if schema_type in _JSON_TYPES:
+        return _JSON_TYPES[schema_type]
+    if schema_type == "string":
+        if "pattern" in schema:
+            return '"' + schema["pattern"].lstrip("^").rstrip("$") + '"'
+        min_length, max_length = schema.get("minLength", 0), schema.get("maxLength")
+        max_length = "" if max_length is None else max_length
+        return f'"{_JSON_STRING_CHARACTER}{{{min_length},{max_length}}}"'
+    if schema_type == "array" and "items" in schema:
+        item = _json_schema_to_regex(schema["items"], root, refs)
+        separator = f"{_JSON_WHITESPACE},{_JSON_WHITESPACE}"
+        min_items, max_items = schema.get("minItems", 0), schema.get("maxItems")
+        if max_items == 0:
+            items = ""
+        else:
+            max_others = "" if max_items is None else max_items - 1
+            items = f"{item}(?:{separator}{item}){{{max(min_items - 1, 0)},{max_others}}}"
+            if min_items == 0:
+                items = f"(?:{items})?"
+        return rf"\[{_JSON_WHITESPACE}{items}{_JSON_WHITESPACE}\]"
+    if schema_type == "object" and "properties" in schema:
+        required = set(schema.get("required", []))
+        properties = []
+        for name, property_schema in schema["properties"].items():
+            value = _json_schema_to_regex(property_schema, root, refs)
+            member = f'"{_escape_regex(name)}"{_JSON_WHITESPACE}:{_JSON_WHITESPACE}{value}'
+            properties.append((member, name in required))
+        separator = f"{_JSON_WHITESPACE},{_JSON_WHITESPACE}"
+        # any property can come first, as long as all the ones before it are optional
+        options = []
+        for first_idx, (first_property, _) in enumerate(properties):
+            option = first_property
+            for next_property, is_required in properties[first_idx + 1 :]:
+                option += f"{separator}{next_property}" if is_required else f"(?:{separator}{next_property})?"
+            options.append(option)
+            if properties[first_idx][1]:
+                break
+        else:
+            options.append("")
+        members = "(?:" + "|".join(options) + ")"
+        return rf"\{{{_JSON_WHITESPACE}{members}{_JSON_WHITESPACE}\}}"
+    raise ValueError(f"The JSON schema {schema} can't be converted to a regular expression.")
+
+
+def _get_token_strings(tokenizer: "PreTrainedTokenizerBase") -> Dict[int, str]:
+    """
+    The text that each regular token adds in the middle of a sequence. Special tokens, and tokens that are not valid
+    text on their own (such as parts of multi-byte characters), are left out.
+    """
+    special_ids = set(tokenizer.all_special_ids)
+    token_strings = {}
+    for token, token_id in tokenizer.get_vocab().items():
+        if token_id in special_ids:
+            continue
+        string = tokenizer.convert_tokens_to_string([token])
+        # sentencepiece tokenizers strip the leading space of the first token of a text
+        if (token.startswith(SPIECE_UNDERLINE) or token == "<0x20>") and not string.startswith(" "):
+            string = " " + string
+        if len(string) > 0 and "\ufffd" not in string:
+            token_strings[token_id] = string
+    return token_strings
+
+
+_TOKEN_STRINGS: "weakref.WeakKeyDictionary[PreTrainedTokenizerBase, Tuple[int, Dict[int, str], str]]"
+_TOKEN_STRINGS = weakref.WeakKeyDictionary()
+
+
+def _get_tokenizer_strings_and_hash(tokenizer: "PreTrainedTokenizerBase") -> Tuple[Dict[int, str], str]:
+    """The token texts of `tokenizer` and their hash, kept as long as the tokenizer is alive and of the same size."""
+    cached = _TOKEN_STRINGS.get(tokenizer)
+    if cached is None or cached[0] != len(tokenizer):
+        token_strings = _get_token_strings(tokenizer)
+        tokenizer_hash = hashlib.sha256(json.dumps(sorted(token_strings.items())).encode("utf-8")).hexdigest()
+        cached = (len(tokenizer), token_strings, tokenizer_hash)
+        _TOKEN_STRINGS[tokenizer] = cached
+    return cached[1], cached[2]
+
+
+class TokenAutomaton:
+    r"""
+    A regular expression compiled against the vocabulary of a tokenizer: a deterministic automaton whose transitions
+    are token ids, such that the text of the tokens of any path from the initial state `0` is a prefix of a text
+    matching the pattern. Paths that can't be completed into a match are pruned, so that every state that is not
+    accepting has at least one allowed token.
+
+    The transitions are stored as a sorted tensor of `state * stride + token_id` keys and the matching tensor of next
+    states, so that looking up the transitions of a batch of states is a binary search, and the tokens allowed in each
+    state are expanded into boolean masks on the device of the scores.
+
+    Args:
+        transition_keys (`torch.LongTensor`):
+            The sorted keys `state * stride + token_id` of all the transitions.
+        next_states (`torch.LongTensor`):
+            The state reached by each transition.
+        accepting (`torch.BoolTensor`):
+            Whether the text leading to each state matches the pattern.
+        stride (`int`):
+            An integer strictly larger than all token ids.
+    """
+
+    def __init__(
+        self,
+        transition_keys: torch.LongTensor,
+        next_states: torch.LongTensor,
+        accepting: torch.BoolTensor,
+        stride: int,
+    ):
+        self.transition_keys = transition_keys
+        self.next_states = next_states
+        self.accepting = accepting
+        self.stride = stride
+        self._device_tensors: Dict[torch.device, Dict[str, torch.Tensor]] = {}
+
+    @property
+    def num_states(self) -> int:
+        return self.accepting.shape[0]
+
+    @classmethod
+    def from_regex(
+        cls,
+        pattern: str,
+        tokenizer: "PreTrainedTokenizerBase",
+        cache_dir: Optional[Union[str, os.PathLike]] = None,
+        use_cache: bool = True,
+    ) -> "TokenAutomaton":
+        """
+        Compiles `pattern` against the vocabulary of `tokenizer`. The automaton is cached on disk, under a hash of the
+        text of the tokens and of the pattern, so that it is only compiled once per tokenizer.
+
+        Args:
+            pattern (`str`):
+                The regular expression, which the whole generated text has to match.
+            tokenizer (`PreTrainedTokenizerBase`):
+                The tokenizer of the model.
+            cache_dir (`str` or `os.PathLike`, *optional*):
+                The directory of the compiled automata. Defaults to `TRANSFORMERS_TOKEN_AUTOMATA_CACHE`, or to
+                `token_automata` in the Hugging Face cache directory.
+            use_cache (`bool`, *optional*, defaults to `True`):
+                Whether to load and store the automaton in `cache_dir`.
+        """
+        token_strings, tokenizer_hash = _get_tokenizer_strings_and_hash(tokenizer)
+        cache_file = None
+        if use_cache:
+            pattern_hash = hashlib.sha256(pattern.encode("utf-8")).hexdigest()
+            cache_dir = cache_dir if cache_dir is not None else TOKEN_AUTOMATA_CACHE
+            cache_file = os.path.join(cache_dir, f"{tokenizer_hash[:32]}-{pattern_hash[:32]}.safetensors")
+            if os.path.isfile(cache_file):
+                return cls.load(cache_file)
+
+        automaton = cls._compile(pattern, token_strings, stride=max(len(tokenizer), max(token_strings) + 1))
+        if cache_file is not None:
+            try:
+                automaton.save(cache_file)
+            except OSError as error:
+                logger.warning(f"The token automaton could not be cached in {cache_file}: {error}")
+        return automaton
+
+    @classmethod
+    def _compile(cls, pattern: str, token_strings: Dict[int, str], stride: int) -> "TokenAutomaton":
+        dfa = _LazyDFA(pattern)
+
+        # the token texts are walked through the automaton along a trie, so that shared prefixes are walked once and
+        # most tokens are pruned by their first character
+        trie_children: List[Dict[str, int]] = [{}]
+        trie_tokens: List[List[int]] = [[]]
+        for token_id, string in token_strings.items():
+            node = 0
+            for char in string:
+                child = trie_children[node].get(char)
+                if child is None:
+                    child = len(trie_children)
+                    trie_children[node][char] = child
+                    trie_children.append({})
+                    trie_tokens.append([])
+                node = child
+            trie_tokens[node].append(token_id)
+
+        # token states are the character states reached at the end of tokens, numbered in order of discovery
+        state_ids = {dfa.initial_state: 0}
+        dfa_states = [dfa.initial_state]
+        transitions: List[List[Tuple[int, int]]] = []
+        queue = deque([0])
+        while queue:
+            state = queue.popleft()
+            state_transitions = []
+            stack = [(0, dfa_states[state])]
+            while stack:
+                node, dfa_state = stack.pop()
+                for char, child in trie_children[node].items():
+                    next_dfa_state = dfa.step(dfa_state, char)
+                    if next_dfa_state < 0:
+                        continue
+                    if trie_tokens[child]:
+                        next_state = state_ids.get(next_dfa_state)
+                        if next_state is None:
+                            next_state = len(dfa_states)
+                            state_ids[next_dfa_state] = next_state
+                            dfa_states.append(next_dfa_state)
+                            queue.append(next_state)
+                        state_transitions.extend((token_id, next_state) for token_id in trie_tokens[child])
+                    stack.append((child, next_dfa_state))
+            transitions.append(state_transitions)
+        accepting = [dfa.is_accepting(dfa_state) for dfa_state in dfa_states]
+
+        # prunes the states from which no accepting state can be reached
+        predecessors = [[] for _ in dfa_states]
+        for state, state_transitions in enumerate(transitions):
+            for _, next_state in state_transitions:
+                predecessors[next_state].append(state)
+        is_live = list(accepting)
+        queue = deque(state for state, is_accepting in enumerate(accepting) if is_accepting)
+        while queue:
+            for state in predecessors[queue.popleft()]:
+                if not is_live[state]:
+                    is_live[state] = True
+                    queue.append(state)
+        if not is_live[0]:
+            raise ValueError(f"No sequence of tokens of the tokenizer can generate a text matching {pattern!r}.")
+        new_ids = {}
+        for state, state_is_live in enumerate(is_live):
+            if state_is_live:
+                new_ids[state] = len(new_ids)
+
+        keys, next_states = [], []
+        for state, new_state in new_ids.items():
+            for token_id, next_state in transitions[state]:
+                if next_state in new_ids:
+                    keys.append(new_state * stride + token_id)
+                    next_states.append(new_ids[next_state])
+        keys = torch.tensor(keys, dtype=torch.long)
+        next_states = torch.tensor(next_states, dtype=torch.long)
+        order = torch.argsort(keys)
+        accepting = torch.tensor([accepting[state] for state in new_ids], dtype=torch.bool)
+        return cls(keys[order], next_states[order], accepting, stride)
+
+    def save(self, path: Union[str, os.PathLike]):
+        """Saves the automaton in a safetensors file."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tensors = {
+            "transition_keys": self.transition_keys.contiguous(),
+            "next_states": self.next_states.contiguous(),
+            "accepting": self.accepting.to(torch.uint8),
+        }
+        # written next to its destination then renamed, so that concurrent processes never read a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        save_file(tensors, tmp_path, metadata={"stride": str(self.stride)})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Union[str, os.PathLike]) -> "TokenAutomaton":
+        """Loads an automaton saved with `save`."""
+        from safetensors import safe_open
+
+        with safe_open(path, framework="pt") as f:
+            stride = int(f.metadata()["stride"])
+        tensors = load_file(path)
+        return cls(tensors["transition_keys"], tensors["next_states"], tensors["accepting"].bool(), stride)
+
+    def _get_device_tensors(self, device: torch.device) -> Dict[str, torch.Tensor]:
+        if device not in self._device_tensors:
+            self._device_tensors[device] = {
+                "transition_keys": self.transition_keys.to(device),
+                "next_states": self.next_states.to(device),
+                # the last state stands for the sequences that left the automaton
+                "accepting": torch.cat([self.accepting.to(device), torch.ones(1, dtype=torch.bool, device=device)]),
+            }
+        return self._device_tensors[device]
+
+    def _get_allowed_tokens(self, device: torch.device, vocab_size: int) -> torch.BoolTensor:
+        tensors = self._get_device_tensors(device)
+        key = f"allowed_{vocab_size}"
+        if key not in tensors:
+            transition_keys = tensors["transition_keys"]
+            allowed = torch.zeros((self.num_states + 1, vocab_size), dtype=torch.bool, device=device)
+            tokens = transition_keys % self.stride
+            in_vocab = tokens < vocab_size
+            allowed[transition_keys[in_vocab] // self.stride, tokens[in_vocab]] = True
+            tensors[key] = allowed
+        return tensors[key]
+
+    def step(self, states: torch.LongTensor, token_ids: torch.LongTensor) -> torch.LongTensor:
+        """
+        The states reached from `states` with `token_ids`, with -1 for the sequences that left the automaton (or had
+        already left it).
+        """
+        tensors = self._get_device_tensors(states.device)
+        transition_keys = tensors["transition_keys"]
+        if transition_keys.numel() == 0:
+            return torch.full_like(states, -1)
+        queries = states * self.stride + token_ids
+        idx = torch.searchsorted(transition_keys, queries).clamp(max=transition_keys.numel() - 1)
+        is_found = (transition_keys[idx] == queries) & (states >= 0) & (token_ids >= 0) & (token_ids < self.stride)
+        return torch.where(is_found, tensors["next_states"][idx], -1)
+
+    def allowed_tokens_mask(
+        self, states: torch.LongTensor, vocab_size: int, eos_token_id: Optional[List[int]] = None
+    ) -> torch.BoolTensor:
+        """
+        The tokens allowed in each of `states`, as a mask of shape `(len(states), vocab_size)`. The end-of-sequence
+        tokens are allowed in the accepting states, and are the only tokens allowed to the sequences that left the
+        automaton.
+        """
+        rows = torch.where(states >= 0, states, self.num_states)
+        allowed = self._get_allowed_tokens(states.device, vocab_size)[rows]
+        if eos_token_id is not None:
+            eos_token_id = torch.tensor(eos_token_id, device=states.device)
+            is_accepting = self._get_device_tensors(states.device)["accepting"][rows]
+            allowed[:, eos_token_id] |= is_accepting.unsqueeze(-1)
+        return allowed
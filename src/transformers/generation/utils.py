@@ -24,6 +24,7 @@ import torch
 import torch.distributed as dist
 from torch import nn
 
+from ..cache_utils import Cache, PagedCache, QuantizedCache, SinkCache, StaticCache
 from ..deepspeed import is_deepspeed_zero3_enabled
 from ..modeling_outputs import CausalLMOutputWithPast, Seq2SeqLMOutput
 from ..models.auto import (
@@ -36,6 +37,13 @@ from ..models.auto import (
 from ..utils import ModelOutput, logging
 from .beam_constraints import DisjunctiveConstraint, PhrasalConstraint
 from .beam_search import BeamScorer, BeamSearchScorer, ConstrainedBeamSearchScorer
+from .candidate_generator import (
+    AssistedCandidateGenerator,
+    CandidateGenerator,
+    PromptLookupCandidateGenerator,
+    _crop_past_key_values,
+    _prepare_decoder_only_inputs,
+)
 from .configuration_utils import GenerationConfig
 from .logits_process import (
     ClassifierFreeGuidanceLogitsProcessor,
@@ -56,6 +64,7 @@ from .logits_process import (
     NoBadWordsLogitsProcessor,
     NoRepeatNGramLogitsProcessor,
     PrefixConstrainedLogitsProcessor,
+    RegexLogitsProcessor,
     RepetitionPenaltyLogitsProcessor,
     SequenceBiasLogitsProcessor,
     SuppressTokensAtBeginLogitsProcessor,
@@ -76,6 +85,10 @@ from .stopping_criteria import (
 
 if TYPE_CHECKING:
     from ..modeling_utils import PreTrainedModel
+    from ..tokenization_utils_base import PreTrainedTokenizerBase
+    from .prefix_cache import PrefixCache
+    from .profiler import GenerationProfiler
+    from .result_cache import GenerationResultCache
     from .streamers import BaseStreamer
 
 logger = logging.get_logger(__name__)
@@ -719,6 +732,14 @@ class GenerationMixin:
             for key in dict_to_expand:
                 if dict_to_expand[key] is not None and isinstance(dict_to_expand[key], torch.Tensor):
                     dict_to_expand[key] = dict_to_expand[key].repeat_interleave(expand_size, dim=0)
+                elif isinstance(dict_to_expand[key], Cache):
+                    dict_to_expand[key].expand_batch(expand_size)
+                elif key == "past_key_values" and isinstance(dict_to_expand[key], tuple):
+                    # legacy cache of the prompt prefix (see `PrefixCache`), in the standard format
+                    dict_to_expand[key] = tuple(
+                        tuple(past_state.repeat_interleave(expand_size, dim=0) for past_state in layer_past)
+                        for layer_past in dict_to_expand[key]
+                    )
             return dict_to_expand
 
         if input_ids is not None:
@@ -791,6 +812,224 @@ class GenerationMixin:
             f" enable beam search for {self.__class__}"
         )
 
+    def _reorder_past_key_values(self, past_key_values, beam_idx):
+        """
+        Reorders `past_key_values` following `beam_idx`: [`Cache`] instances are reordered in place, while the legacy
+        format is delegated to the model-specific `_reorder_cache`.
+        """
+        if isinstance(past_key_values, Cache):
+            past_key_values.reorder_cache(beam_idx)
+            return past_key_values
+        return self._reorder_cache(past_key_values, beam_idx)
+
+    def _get_cache(self, generation_config: GenerationConfig) -> Cache:
+        """
+        Instantiates the [`Cache`] requested by `generation_config.cache_implementation`. Must be called once
+        `generation_config.max_length` holds its final value.
+        """
+        if not self._supports_cache_class:
+            raise ValueError(
+                f"{self.__class__.__name__} does not support `cache_implementation` (its `_supports_cache_class` is "
+                "`False`). Please unset `cache_implementation` to use the default cache format."
+            )
+        if generation_config.cache_implementation == "static":
+            return StaticCache(max_cache_len=generation_config.max_length)
+        if generation_config.cache_implementation == "paged":
+            return PagedCache()
+        if generation_config.cache_implementation == "sink":
+            if not self._supports_sink_cache:
+                raise ValueError(
+                    f"{self.__class__.__name__} does not support `cache_implementation='sink'`, which requires models "
+                    "with rotary position embeddings (`_supports_sink_cache = True`)."
+                )
+            return SinkCache(
+                window_length=generation_config.cache_window_length, num_sink_tokens=generation_config.num_sink_tokens
+            )
+        if generation_config.cache_implementation == "quantized":
+            return QuantizedCache(
+                nbits=generation_config.cache_nbits, residual_length=generation_config.cache_residual_length
+            )
+        raise ValueError(f"Unknown `cache_implementation`: {generation_config.cache_implementation}.")
+
+    def _generate_with_result_cache(
+        self,
+        result_cache: "GenerationResultCache",
+        inputs: Optional[torch.Tensor],
+        generation_config: GenerationConfig,
+        model_kwargs: Dict[str, Any],
+        **generate_kwargs,
+    ) -> Union[GenerateOutput, torch.LongTensor]:
+        """
+        Returns the result of a `generate` call from `result_cache` if it is stored there, and otherwise runs
+        `generate` and stores its result when it is cacheable.
+        """
+        cache_key = None
+        uses_custom_components = (
+            generate_kwargs["logits_processor"]
+            or generate_kwargs["stopping_criteria"]
+            or generate_kwargs["prefix_allowed_tokens_fn"] is not None
+            or generate_kwargs["streamer"] is not None
+        )
+        if not uses_custom_components:
+            cache_key = result_cache.get_key(
+                self, inputs, generation_config, model_kwargs, sequence_seeds=generate_kwargs["sequence_seeds"]
+            )
+        if cache_key is None:
+            result_cache.record_bypass()
+        else:
+            sequences = result_cache.get(cache_key)
+            if sequences is not None:
+                return sequences.to(self.device)
+
+        outputs = self.generate(inputs, generation_config=generation_config, **generate_kwargs, **model_kwargs)
+        if cache_key is not None:
+            result_cache.set(cache_key, outputs)
+        return outputs
+
+    def _prefill_in_chunks(
+        self,
+        input_ids: torch.LongTensor,
+        model_kwargs: Dict[str, Any],
+        past_key_values: Optional[Union[Cache, Tuple[Tuple[torch.Tensor]]]] = None,
+        past_length: int = 0,
+        chunk_size: Optional[int] = None,
+    ):
+        """
+        Encodes the prompt tokens from `past_length` up to the last one, excluded, on top of `past_key_values`, and
+        returns the grown `past_key_values`. The tokens are fed `chunk_size` at a time, so that the attention weights
+        and masks of the prompt scale with `chunk_size * prompt_length` instead of `prompt_length ** 2`. The last token
+        is left to the first decoding step, so that the decoding loops start from a regular `past_key_values`.
+        """
+        prompt_length = input_ids.shape[-1]
+        attention_mask = model_kwargs.get("attention_mask")
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        # same positions as the ones `prepare_inputs_for_generation` derives from the attention mask
+        position_ids = None
+        if "position_ids" in set(inspect.signature(self.base_model.forward).parameters.keys()):
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+        token_type_ids = model_kwargs.get("token_type_ids")
+
+        chunk_size = chunk_size or prompt_length
+        for start in range(past_length, prompt_length - 1, chunk_size):
+            end = min(start + chunk_size, prompt_length - 1)
+            chunk_inputs = {"input_ids": input_ids[:, start:end], "attention_mask": attention_mask[:, :end]}
+            if position_ids is not None:
+                chunk_inputs["position_ids"] = position_ids[:, start:end]
+            if token_type_ids is not None:
+                chunk_inputs["token_type_ids"] = token_type_ids[:, start:end]
+            outputs = self.base_model(
+                **chunk_inputs, past_key_values=past_key_values, use_cache=True, return_dict=True
+            )
+            past_key_values = outputs.past_key_values
+        return past_key_values
+
+    def _prefill_with_prefix_cache(
+        self,
+        input_ids: torch.LongTensor,
+        model_kwargs: Dict[str, Any],
+        prefix_cache: "PrefixCache",
+        chunk_size: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """
+        Encodes all the prompt tokens but the last one, reusing the longest prefix cached in `prefix_cache`, and stores
+        the resulting key/value states back into `prefix_cache`. The last token is left to the first decoding step, so
+        that the decoding loops start from a regular `past_key_values`. The uncached tokens are encoded `chunk_size` at
+        a time, see `_prefill_in_chunks`.
+        """
+        attention_mask = model_kwargs.get("attention_mask")
+        if attention_mask is not None and not bool(attention_mask.all()):
+            logger.warning_once("`prefix_cache` is ignored for padded inputs.")
+            return model_kwargs
+        batch_size, prompt_length = input_ids.shape
+        if prompt_length < 2:
+            return model_kwargs
+
+        prefix_ids = input_ids[:, :-1].tolist()
+        lookups = [prefix_cache.lookup(row_ids, record_stats=False) for row_ids in prefix_ids]
+        # the rows of the batch share the same past length, the shortest of their cached prefixes
+        past_length = min(length for length, _ in lookups)
+        # only the shared past is reused, so a single uncached row makes the whole batch a miss
+        prefix_cache.record_lookup(batch_size, past_length)
+        past_key_values = None
+        if past_length > 0:
+            past_key_values = tuple(
+                tuple(
+                    torch.cat([past[layer_idx][state_idx][:, :, :past_length] for _, past in lookups], dim=0)
+                    for state_idx in range(len(lookups[0][1][layer_idx]))
+                )
+                for layer_idx in range(len(lookups[0][1]))
+            )
+
+        if past_length < prompt_length - 1:
+            past_key_values = self._prefill_in_chunks(
+                input_ids,
+                model_kwargs,
+                past_key_values=past_key_values,
+                past_length=past_length,
+                chunk_size=chunk_size,
+            )
+            for row_idx, row_ids in enumerate(prefix_ids):
+                row_past = past_key_values
+                if batch_size > 1:
+                    # copies the row, so that the cache does not keep the whole batch alive
+                    row_past = tuple(
+                        tuple(past_state[row_idx : row_idx + 1].clone() for past_state in layer)
+                        for layer in past_key_values
+                    )
+                prefix_cache.store(row_ids, row_past)
+
+        model_kwargs["past_key_values"] = past_key_values
+        return model_kwargs
+
+    def _drop_finished_sequences(
+        self,
+        input_ids: torch.LongTensor,
+        unfinished_sequences: torch.LongTensor,
+        row_idx: torch.LongTensor,
+        finished_sequences: List[Tuple[torch.LongTensor, torch.LongTensor]],
+        model_kwargs: Dict[str, Any],
+    ) -> Tuple[torch.LongTensor, torch.LongTensor, torch.LongTensor, Dict[str, Any]]:
+        """
+        Drops the finished rows from the batch: from `input_ids`, `unfinished_sequences`, the cache and the other
+        batched model kwargs. The dropped rows are appended to `finished_sequences` along with their index in the
+        original batch, and `row_idx` keeps the index of the remaining ones.
+        """
+        is_finished = unfinished_sequences == 0
+        finished_sequences.append((row_idx[is_finished], input_ids[is_finished]))
+        keep_idx = (~is_finished).nonzero().squeeze(-1)
+
+        def _select_rows(value):
+            if isinstance(value, torch.Tensor):
+                return value.index_select(0, keep_idx)
+            return value
+
+        for key, value in model_kwargs.items():
+            if key == "past_key_values" and value is not None:
+                model_kwargs[key] = self._reorder_past_key_values(value, keep_idx)
+            elif key == "encoder_outputs" and value is not None:
+                for output_key, output_value in value.items():
+                    value[output_key] = _select_rows(output_value)
+            else:
+                model_kwargs[key] = _select_rows(value)
+        return input_ids[keep_idx], unfinished_sequences[keep_idx], row_idx[keep_idx], model_kwargs
+
+    @staticmethod
+    def _restore_finished_sequences(
+        input_ids: torch.LongTensor,
+        row_idx: torch.LongTensor,
+        finished_sequences: List[Tuple[torch.LongTensor, torch.LongTensor]],
+        pad_token_id: int,
+    ) -> torch.LongTensor:
+        """Puts the rows dropped by `_drop_finished_sequences` back in place, padded to the length of the batch."""
+        batch_size = row_idx.shape[0] + sum(rows.shape[0] for rows, _ in finished_sequences)
+        sequences = input_ids.new_full((batch_size, input_ids.shape[-1]), pad_token_id)
+        sequences[row_idx] = input_ids
+        for rows, finished_ids in finished_sequences:
+            sequences[rows, : finished_ids.shape[-1]] = finished_ids
+        return sequences
+
     def _get_logits_warper(
         self,
         generation_config: GenerationConfig,
@@ -836,6 +1075,7 @@ class GenerationMixin:
         encoder_input_ids: torch.LongTensor,
         prefix_allowed_tokens_fn: Callable[[int, torch.Tensor], List[int]],
         logits_processor: Optional[LogitsProcessorList],
+        tokenizer: Optional["PreTrainedTokenizerBase"] = None,
     ) -> LogitsProcessorList:
         """
         This class returns a [`LogitsProcessorList`] list object that contains all relevant [`LogitsProcessor`]
@@ -908,6 +1148,21 @@ class GenerationMixin:
                     prefix_allowed_tokens_fn, generation_config.num_beams // generation_config.num_beam_groups
                 )
             )
+        if generation_config.regex is not None or generation_config.json_schema is not None:
+            if tokenizer is None:
+                raise ValueError(
+                    "Constraining the output with `regex` or `json_schema` requires passing the `tokenizer` to "
+                    "`generate`."
+                )
+            processors.append(
+                RegexLogitsProcessor(
+                    tokenizer,
+                    regex=generation_config.regex,
+                    json_schema=generation_config.json_schema,
+                    eos_token_id=generation_config.eos_token_id,
+                    prompt_length=input_ids_seq_length,
+                )
+            )
         if generation_config.forced_bos_token_id is not None:
             processors.append(ForcedBOSTokenLogitsProcessor(generation_config.forced_bos_token_id))
         if generation_config.forced_eos_token_id is not None:
@@ -1194,6 +1449,11 @@ class GenerationMixin:
         synced_gpus: Optional[bool] = None,
         assistant_model: Optional["PreTrainedModel"] = None,
         streamer: Optional["BaseStreamer"] = None,
+        prefix_cache: Optional["PrefixCache"] = None,
+        tokenizer: Optional["PreTrainedTokenizerBase"] = None,
+        profiler: Optional["GenerationProfiler"] = None,
+        sequence_seeds: Optional[Union[int, List[int], torch.LongTensor]] = None,
+        result_cache: Optional["GenerationResultCache"] = None,
         **kwargs,
     ) -> Union[GenerateOutput, torch.LongTensor]:
         r"""
@@ -1251,6 +1511,28 @@ class GenerationMixin:
             streamer (`BaseStreamer`, *optional*):
                 Streamer object that will be used to stream the generated sequences. Generated tokens are passed
                 through `streamer.put(token_ids)` and the streamer is responsible for any further processing.
+            prefix_cache (`PrefixCache`, *optional*):
+                A [`~generation.PrefixCache`] holding the key/value states of previous prompts. The longest cached
+                prefix of `input_ids` is not encoded again, and the encoded prompt is added to the cache. Only
+                supported by decoder-only models with `_supports_cache_class = True`, for unpadded inputs.
+            tokenizer (`PreTrainedTokenizerBase`, *optional*):
+                The tokenizer of the model. Required to constrain the output with the `regex` or `json_schema` options
+                of the generation config, which are compiled against its vocabulary.
+            profiler (`GenerationProfiler`, *optional*):
+                A [`~generation.GenerationProfiler`] recording, step by step, the time spent in each phase of the
+                generation and the size of the cache. Its summary reports the time to first token and the inter-token
+                latency.
+            sequence_seeds (`int`, `List[int]` or `torch.LongTensor` of shape `(batch_size,)`, *optional*):
+                The seed of the random draws of each sequence of the batch, for multinomial sampling and beam-search
+                multinomial sampling. When set, the tokens of each sequence are drawn from a counter-based random
+                stream that only depends on its seed and on the decoding step, instead of the global random number
+                generator: a sampled sequence is then the same whichever sequences share its batch, which makes it
+                reproducible and cacheable. A single `int` seeds all the sequences, and the `num_return_sequences`
+                sequences of a prompt get distinct streams derived from its seed.
+            result_cache (`GenerationResultCache`, *optional*):
+                A [`~generation.GenerationResultCache`] storing the sequences returned by previous calls. If the
+                result of this call is found in it, it is returned without running the model. Only the calls whose
+                result is deterministic are cached (see [`~generation.GenerationResultCache`]).
             kwargs (`Dict[str, Any]`, *optional*):
                 Ad hoc parametrization of `generate_config` and/or additional model-specific kwargs that will be
                 forwarded to the `forward` function of the model. If the model is an encoder-decoder model, encoder
@@ -1282,6 +1564,8 @@ class GenerationMixin:
                 synced_gpus = True
             else:
                 synced_gpus = False
+        if profiler is not None:
+            profiler.start()
 
         # 1. Handle `generation_config` and kwargs that might update it, and validate the `.generate()` call
         self._validate_model_class()
@@ -1307,6 +1591,24 @@ class GenerationMixin:
         generation_config.validate()
         self._validate_model_kwargs(model_kwargs.copy())
 
+        if result_cache is not None:
+            return self._generate_with_result_cache(
+                result_cache,
+                inputs,
+                generation_config,
+                model_kwargs,
+                logits_processor=logits_processor,
+                stopping_criteria=stopping_criteria,
+                prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
+                synced_gpus=synced_gpus,
+                assistant_model=assistant_model,
+                streamer=streamer,
+                prefix_cache=prefix_cache,
+                tokenizer=tokenizer,
+                profiler=profiler,
+                sequence_seeds=sequence_seeds,
+            )
+
         # 2. Set generation parameters if not already defined
         logits_processor = logits_processor if logits_processor is not None else LogitsProcessorList()
         stopping_criteria = stopping_criteria if stopping_criteria is not None else StoppingCriteriaList()
@@ -1470,11 +1772,16 @@ class GenerationMixin:
             and not is_contrastive_search_gen_mode
         )
         is_assisted_gen_mode = False
-        if assistant_model is not None:
+        if assistant_model is not None or generation_config.prompt_lookup_num_tokens is not None:
             if not (is_greedy_gen_mode or is_sample_gen_mode):
                 raise ValueError(
-                    "You've set `assistant_model`, which triggers assisted generate. Currently, assisted generate "
-                    "is only supported with Greedy Search and Sample."
+                    "You've set `assistant_model` or `prompt_lookup_num_tokens`, which triggers assisted generate. "
+                    "Currently, assisted generate is only supported with Greedy Search and Sample."
+                )
+            if assistant_model is not None and generation_config.prompt_lookup_num_tokens is not None:
+                raise ValueError(
+                    "`assistant_model` and `prompt_lookup_num_tokens` are two ways of drafting the candidates of "
+                    "assisted generate: only one of them can be set."
                 )
             is_assisted_gen_mode = True
 
@@ -1490,6 +1797,79 @@ class GenerationMixin:
                 "`streamer` cannot be used with beam search (yet!). Make sure that `num_beams` is set to 1."
             )
 
+        if generation_config.cache_implementation is not None and model_kwargs.get("past_key_values") is None:
+            if model_kwargs["use_cache"]:
+                model_kwargs["past_key_values"] = self._get_cache(generation_config)
+        if isinstance(model_kwargs.get("past_key_values"), Cache) and is_contrastive_search_gen_mode:
+            raise ValueError(
+                "Contrastive search does not support `Cache` instances as `past_key_values` (yet!). Please unset "
+                "`cache_implementation` or pass the legacy cache format."
+            )
+        if isinstance(model_kwargs.get("past_key_values"), SinkCache) and is_assisted_gen_mode:
+            raise ValueError(
+                "Assisted generation discards the rejected candidate tokens from the cache, which a `SinkCache` can't "
+                "do once it has evicted tokens. Please use another `cache_implementation`."
+            )
+        if sequence_seeds is not None:
+            if not (is_sample_gen_mode or is_beam_sample_gen_mode) or is_assisted_gen_mode:
+                raise ValueError(
+                    "`sequence_seeds` is only supported by multinomial sampling and beam-search multinomial sampling."
+                )
+            sequence_seeds = _get_sequence_seeds(
+                sequence_seeds, batch_size, generation_config.num_return_sequences, inputs_tensor.device
+            )
+        if generation_config.compact_finished_sequences and (
+            prefix_allowed_tokens_fn is not None
+            or (generation_config.guidance_scale is not None and generation_config.guidance_scale > 1)
+            or generation_config.encoder_repetition_penalty not in (None, 1.0)
+            or (generation_config.encoder_no_repeat_ngram_size or 0) > 0
+        ):
+            raise ValueError(
+                "`compact_finished_sequences` changes the position of the sequences in the batch, which "
+                "`prefix_allowed_tokens_fn`, `guidance_scale`, `encoder_repetition_penalty` and "
+                "`encoder_no_repeat_ngram_size` rely on. Please unset them or `compact_finished_sequences`."
+            )
+
+        if prefix_cache is not None:
+            if self.config.is_encoder_decoder or not self._supports_cache_class:
+                raise ValueError(
+                    f"{self.__class__.__name__} does not support `prefix_cache`, which requires a decoder-only model "
+                    "with `_supports_cache_class = True`."
+                )
+            if is_contrastive_search_gen_mode or is_assisted_gen_mode:
+                raise ValueError("`prefix_cache` is not supported by contrastive search and assisted generation.")
+            if model_kwargs.get("past_key_values") is not None or not model_kwargs["use_cache"]:
+                raise ValueError(
+                    "`prefix_cache` builds the legacy `past_key_values` itself: it requires `use_cache=True`, and "
+                    "can't be combined with `past_key_values` or `cache_implementation`."
+                )
+            if model_input_name == "input_ids":
+                model_kwargs = self._prefill_with_prefix_cache(
+                    input_ids, model_kwargs, prefix_cache, chunk_size=generation_config.prefill_chunk_size
+                )
+        elif generation_config.prefill_chunk_size is not None and model_input_name == "input_ids":
+            if self.config.is_encoder_decoder or not self._supports_cache_class:
+                raise ValueError(
+                    f"{self.__class__.__name__} does not support `prefill_chunk_size`, which requires a decoder-only "
+                    "model with `_supports_cache_class = True`."
+                )
+            if is_contrastive_search_gen_mode or is_assisted_gen_mode:
+                raise ValueError(
+                    "`prefill_chunk_size` is not supported by contrastive search and assisted generation."
+                )
+            if model_kwargs.get("past_key_values") or not model_kwargs["use_cache"]:
+                raise ValueError(
+                    "`prefill_chunk_size` encodes the prompt into the cache: it requires `use_cache=True`, and can't "
+                    "be combined with a non-empty `past_key_values`."
+                )
+            if input_ids.shape[-1] > generation_config.prefill_chunk_size + 1:
+                model_kwargs["past_key_values"] = self._prefill_in_chunks(
+                    input_ids,
+                    model_kwargs,
+                    past_key_values=model_kwargs.get("past_key_values"),
+                    chunk_size=generation_config.prefill_chunk_size,
+                )
+
         if self.device.type != input_ids.device.type:
             warnings.warn(
                 "You are calling .generate() with the `input_ids` being on a device type different"
@@ -1508,6 +1888,7 @@ class GenerationMixin:
             encoder_input_ids=inputs_tensor,
             prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
             logits_processor=logits_processor,
+            tokenizer=tokenizer,
         )
 
         # 9. prepare stopping criteria
@@ -1521,13 +1902,26 @@ class GenerationMixin:
                     "num_return_sequences has to be 1 when doing assisted generate, "
                     f"but is {generation_config.num_return_sequences}."
                 )
-            if batch_size > 1:
-                raise ValueError("assisted generate is only supported for batch_size = 1")
             if not model_kwargs["use_cache"]:
                 raise ValueError("assisted generate requires `use_cache=True`")
+            if generation_config.num_draft_branches > 1 and not (
+                self._supports_cache_class and (assistant_model is None or assistant_model._supports_cache_class)
+            ):
+                raise ValueError(
+                    "`num_draft_branches > 1` requires both the model and the assistant model to have "
+                    "`_supports_cache_class = True`, as their caches are copied for each branch."
+                )
 
-            # 11. If the assistant model is an encoder-decoder, prepare its encoder outputs
-            if assistant_model.config.is_encoder_decoder:
+            # 11. Prepare the candidate generator: prompt lookup, or the assistant model. If the assistant model is an
+            # encoder-decoder, prepare its encoder outputs
+            candidate_generator = None
+            if generation_config.prompt_lookup_num_tokens is not None:
+                candidate_generator = PromptLookupCandidateGenerator(
+                    num_output_tokens=generation_config.prompt_lookup_num_tokens,
+                    max_matching_ngram_size=generation_config.max_matching_ngram_size,
+                    max_length=generation_config.max_length,
+                )
+            elif assistant_model.config.is_encoder_decoder:
                 assistant_model_kwargs = copy.deepcopy(model_kwargs)
                 inputs_tensor, model_input_name, assistant_model_kwargs = assistant_model._prepare_model_inputs(
                     inputs_tensor, assistant_model.generation_config.bos_token_id, assistant_model_kwargs
@@ -1550,7 +1944,10 @@ class GenerationMixin:
                 output_scores=generation_config.output_scores,
                 return_dict_in_generate=generation_config.return_dict_in_generate,
                 synced_gpus=synced_gpus,
+                profiler=profiler,
                 streamer=streamer,
+                num_draft_branches=generation_config.num_draft_branches,
+                candidate_generator=candidate_generator,
                 **model_kwargs,
             )
         if is_greedy_gen_mode:
@@ -1570,7 +1967,9 @@ class GenerationMixin:
                 output_scores=generation_config.output_scores,
                 return_dict_in_generate=generation_config.return_dict_in_generate,
                 synced_gpus=synced_gpus,
+                profiler=profiler,
                 streamer=streamer,
+                compact_finished_sequences=generation_config.compact_finished_sequences,
                 **model_kwargs,
             )
 
@@ -1594,6 +1993,7 @@ class GenerationMixin:
                 output_scores=generation_config.output_scores,
                 return_dict_in_generate=generation_config.return_dict_in_generate,
                 synced_gpus=synced_gpus,
+                profiler=profiler,
                 streamer=streamer,
                 sequential=generation_config.low_memory,
                 **model_kwargs,
@@ -1622,7 +2022,10 @@ class GenerationMixin:
                 output_scores=generation_config.output_scores,
                 return_dict_in_generate=generation_config.return_dict_in_generate,
                 synced_gpus=synced_gpus,
+                profiler=profiler,
                 streamer=streamer,
+                compact_finished_sequences=generation_config.compact_finished_sequences,
+                sequence_seeds=sequence_seeds,
                 **model_kwargs,
             )
 
@@ -1661,6 +2064,7 @@ class GenerationMixin:
                 output_scores=generation_config.output_scores,
                 return_dict_in_generate=generation_config.return_dict_in_generate,
                 synced_gpus=synced_gpus,
+                profiler=profiler,
                 **model_kwargs,
             )
 
@@ -1700,6 +2104,8 @@ class GenerationMixin:
                 output_scores=generation_config.output_scores,
                 return_dict_in_generate=generation_config.return_dict_in_generate,
                 synced_gpus=synced_gpus,
+                profiler=profiler,
+                sequence_seeds=sequence_seeds,
                 **model_kwargs,
             )
 
@@ -1751,6 +2157,7 @@ class GenerationMixin:
                 output_scores=generation_config.output_scores,
                 return_dict_in_generate=generation_config.return_dict_in_generate,
                 synced_gpus=synced_gpus,
+                profiler=profiler,
                 **model_kwargs,
             )
 
@@ -1839,6 +2246,7 @@ class GenerationMixin:
                 output_scores=generation_config.output_scores,
                 return_dict_in_generate=generation_config.return_dict_in_generate,
                 synced_gpus=synced_gpus,
+                profiler=profiler,
                 **model_kwargs,
             )
 
@@ -1860,6 +2268,7 @@ class GenerationMixin:
         synced_gpus: bool = False,
         streamer: Optional["BaseStreamer"] = None,
         sequential: Optional[bool] = None,
+        profiler: Optional["GenerationProfiler"] = None,
         **model_kwargs,
     ) -> Union[ContrastiveSearchOutput, torch.LongTensor]:
         r"""
@@ -1911,7 +2320,10 @@ class GenerationMixin:
                 Streamer object that will be used to stream the generated sequences. Generated tokens are passed
                 through `streamer.put(token_ids)` and the streamer is responsible for any further processing.
             sequential (`bool`, *optional*):
-                Switches topk hidden state computation from parallel to sequential to reduce memory if True.
+                Switches topk hidden state computation from parallel to sequential to reduce memory if True. The
+                candidates then share the cache of their sequence instead of using `top_k` copies of it.
+            profiler (`GenerationProfiler`, *optional*):
+                A [`~generation.GenerationProfiler`] recording the time spent in each phase of the decoding steps.
             model_kwargs:
                 Additional model specific keyword arguments will be forwarded to the `forward` function of the model.
                 If model is an encoder-decoder model the kwargs should include `encoder_outputs`.
@@ -1998,6 +2410,9 @@ class GenerationMixin:
                 if this_peer_finished_flag.item() == 0.0:
                     break
 
+            if profiler is not None:
+                profiler.step(input_ids, model_kwargs.get("past_key_values"))
+
             # if the first step in the loop, encode all the prefix and obtain: (1) past_key_values;
             # (2) last_hidden_states; (3) logit_for_next_step; (4) update model kwargs for the next step
             if model_kwargs.get("past_key_values") is None:
@@ -2012,11 +2427,17 @@ class GenerationMixin:
                 )
 
                 # last decoder hidden states will be used to compute the degeneration penalty (cosine similarity with
-                # previous tokens)
+                # previous tokens). They are normalized once and kept in a buffer preallocated for the maximum length,
+                # which is only grown (doubled) if that length is unknown, instead of being concatenated at every step.
                 if self.config.is_encoder_decoder:
                     last_hidden_states = outputs.decoder_hidden_states[-1]
                 else:
                     last_hidden_states = outputs.hidden_states[-1]
+                context_length = last_hidden_states.shape[1]
+                context_hidden = last_hidden_states.new_empty(
+                    (batch_size, max(stopping_criteria.max_length or 0, context_length), last_hidden_states.shape[2])
+                )
+                context_hidden[:, :context_length] = last_hidden_states / last_hidden_states.norm(dim=2, keepdim=True)
 
                 # next logit for contrastive search to select top-k candidate tokens
                 logit_for_next_step = outputs.logits[:, -1, :]
@@ -2048,11 +2469,18 @@ class GenerationMixin:
                         "used for contrastive search without further modifications."
                     )
 
+            if profiler is not None:
+                profiler.mark("forward")
+
             # contrastive_search main logic start:
             # contrastive search decoding consists of two steps: (1) candidate tokens recall; (2) candidate re-rank by
             # degeneration penalty
             logit_for_next_step = logits_processor(input_ids, logit_for_next_step)
+            if profiler is not None:
+                profiler.mark("logits_processor")
             logit_for_next_step = logits_warper(input_ids, logit_for_next_step)
+            if profiler is not None:
+                profiler.mark("logits_warper")
             next_probs = nn.functional.softmax(logit_for_next_step, dim=-1)
             top_k_probs, top_k_ids = torch.topk(next_probs, dim=-1, k=top_k)
 
@@ -2074,60 +2502,71 @@ class GenerationMixin:
                         else (outputs.hidden_states,)
                     )
 
-            # Replicates the new past_key_values to match the `top_k` candidates
-            new_key_values = []
-            for layer in model_kwargs["past_key_values"]:
-                items = []
-                # item is either the key or the value matrix
-                for item in layer:
-                    if sequential:
-                        items.append(item.repeat_interleave(1, dim=0))
-                    else:
-                        items.append(item.repeat_interleave(top_k, dim=0))
-                new_key_values.append(items)
-            model_kwargs["past_key_values"] = new_key_values
-
             if sequential:
-                all_outputs = {key: [] for key in outputs}  # defined in first loop iteration
-                all_last_hstates, all_hstates, all_logits = [], [], []
+                # Runs the candidate tokens one at a time on top of the cache of their sequences, which is shared by
+                # all the candidates instead of being replicated `top_k` times. Only the key/value states of the
+                # candidate tokens are kept from each forward pass, to extend the cache with the ones of the selected
+                # tokens below, without running the model on the selected tokens again.
+                past_key_values = model_kwargs["past_key_values"]
+                candidate_past_states, all_logits, all_hidden_states = [], [], []
+                all_attentions, all_cross_attentions = [], []
                 for i in range(top_k):
                     # compute the candidate tokens by the language model and collect their hidden_states
                     next_model_inputs = self.prepare_inputs_for_generation(top_k_ids[:, i].view(-1, 1), **model_kwargs)
 
-                    outputs = self(
+                    candidate_outputs = self(
                         **next_model_inputs,
                         return_dict=True,
                         output_hidden_states=True,
                         output_attentions=output_attentions,
                     )
-                    for key in all_outputs:
-                        all_outputs[key].append(outputs[key])
-
+                    candidate_past_states.append(
+                        _get_new_past_states(
+                            past_key_values,
+                            self._extract_past_from_model_output(candidate_outputs, standardize_cache_format=True),
+                        )
+                    )
+                    all_logits.append(candidate_outputs.logits[:, -1, :])
                     if self.config.is_encoder_decoder:
-                        next_hidden = outputs.decoder_hidden_states[-1]
-                        full_hidden_states = outputs.decoder_hidden_states
-
+                        all_hidden_states.append(candidate_outputs.decoder_hidden_states)
+                        if output_attentions:
+                            all_attentions.append(candidate_outputs.decoder_attentions)
+                            all_cross_attentions.append(candidate_outputs.cross_attentions)
                     else:
-                        next_hidden = outputs.hidden_states[-1]
-                        full_hidden_states = outputs.hidden_states
-
-                    all_last_hstates.append(torch.squeeze(next_hidden, 0))
-                    all_hstates.append(full_hidden_states)
-                    all_logits.append(outputs.logits[:, -1, :])
-
-                # stack hidden states
-                next_hidden = torch.stack([all_last_hstates[i] for i in range(top_k)], dim=0)
-                final_full_hstates = [0 for i in range(len(full_hidden_states))]
-                for layer in range(len(full_hidden_states)):
-                    final_full_hstates[layer] = torch.stack(
-                        [torch.squeeze(all_hstates[i][layer], 0) for i in range(top_k)], dim=0
+                        all_hidden_states.append(candidate_outputs.hidden_states)
+                        if output_attentions:
+                            all_attentions.append(candidate_outputs.attentions)
+                    del candidate_outputs
+
+                # lays the outputs of the candidates out as the batched forward pass below does, with the `top_k`
+                # candidates of each sequence in consecutive rows
+                logits = torch.stack(all_logits, dim=1).flatten(0, 1)
+                full_hidden_states = tuple(
+                    torch.stack(layer, dim=1).flatten(0, 1) for layer in zip(*all_hidden_states)
+                )
+                next_hidden = full_hidden_states[-1]
+                candidate_attentions = tuple(torch.stack(layer, dim=1).flatten(0, 1) for layer in zip(*all_attentions))
+                if self.config.is_encoder_decoder:
+                    candidate_cross_attentions = tuple(
+                        torch.stack(layer, dim=1).flatten(0, 1) for layer in zip(*all_cross_attentions)
                     )
-                full_hidden_states = tuple(final_full_hstates)
-
-                # stack logits
-                logits = torch.cat(all_logits, dim=0)
+                    outputs = Seq2SeqLMOutput(
+                        decoder_attentions=candidate_attentions, cross_attentions=candidate_cross_attentions
+                    )
+                else:
+                    outputs = CausalLMOutputWithPast(attentions=candidate_attentions)
 
             else:
+                # Replicates the new past_key_values to match the `top_k` candidates
+                new_key_values = []
+                for layer in model_kwargs["past_key_values"]:
+                    items = []
+                    # item is either the key or the value matrix
+                    for item in layer:
+                        items.append(item.repeat_interleave(top_k, dim=0))
+                    new_key_values.append(items)
+                model_kwargs["past_key_values"] = new_key_values
+
                 # compute the candidate tokens by the language model and collect their hidden_states
                 # assembles top_k_ids into batch of size k
                 next_model_inputs = self.prepare_inputs_for_generation(top_k_ids.view(-1, 1), **model_kwargs)
@@ -2148,40 +2587,39 @@ class GenerationMixin:
 
                 logits = outputs.logits[:, -1, :]
 
-            context_hidden = last_hidden_states.repeat_interleave(top_k, dim=0)
+            if profiler is not None:
+                profiler.mark("forward")
 
             # compute the degeneration penalty and re-rank the candidates based on the degeneration penalty and the
             # model confidence. Keeping `selected_idx` on CPU enables multi-device contrastive search and doesn't
             # introduce (noticeable) slowdowns on single-device runs.
-            selected_idx = _ranking_fast(context_hidden, next_hidden, top_k_probs, penalty_alpha, top_k)
+            next_hidden = next_hidden.reshape(batch_size, top_k, -1)
+            next_hidden = next_hidden / next_hidden.norm(dim=2, keepdim=True)
+            selected_idx = _ranking_fast(context_hidden[:, :context_length], next_hidden, top_k_probs, penalty_alpha)
             selected_idx = selected_idx.to("cpu")
 
-            # prepare for the next step: (1) next token_id; (2) past_key_values; (3) last_hidden_states for computing
+            # prepare for the next step: (1) next token_id; (2) past_key_values; (3) context_hidden for computing
             # the degeneration penalty; (4) logits for selecting next top-k candidates; (5) selected tokens scores
             # (model confidence minus degeneration penalty); (6) decoder hidden_states
             next_tokens = top_k_ids[range(len(top_k_ids)), selected_idx]
-            next_hidden = torch.stack(torch.split(next_hidden.squeeze(dim=1), top_k))
-            next_hidden = next_hidden[range(batch_size), selected_idx, :]
-            last_hidden_states = torch.cat([last_hidden_states, next_hidden.unsqueeze(1)], dim=1)
+            if context_length == context_hidden.shape[1]:
+                context_hidden = torch.cat([context_hidden, torch.empty_like(context_hidden)], dim=1)
+            context_hidden[:, context_length] = next_hidden[range(batch_size), selected_idx, :]
+            context_length += 1
 
             next_decoder_hidden_states = ()
             for layer in full_hidden_states:
                 layer = torch.stack(torch.split(layer, top_k))[range(batch_size), selected_idx, :]
                 next_decoder_hidden_states += (layer,)
 
+            if profiler is not None:
+                profiler.mark("sampling")
+
             # generate past_key_values cache of only the selected token
             if sequential:
-                next_model_input = self.prepare_inputs_for_generation(
-                    top_k_ids[:, selected_idx].view(-1, 1), **model_kwargs
-                )
-
-                selected_outputs = self(
-                    **next_model_input,
-                    return_dict=True,
-                    output_hidden_states=False,
-                    output_attentions=False,
+                next_past_key_values = _append_selected_past_states(
+                    past_key_values, candidate_past_states, selected_idx
                 )
-                next_past_key_values = selected_outputs["past_key_values"]
 
             else:
                 next_past_key_values = self._extract_past_from_model_output(outputs, standardize_cache_format=True)
@@ -2227,6 +2665,8 @@ class GenerationMixin:
                     attentions=next_step_attentions or None,
                 )
             # contrastive_search main logic end
+            if profiler is not None:
+                profiler.mark("cache_update")
 
             if synced_gpus and this_peer_finished:
                 continue  # don't waste resources running the code we don't need
@@ -2241,9 +2681,13 @@ class GenerationMixin:
             input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
             if streamer is not None:
                 streamer.put(next_tokens.cpu())
+            if profiler is not None:
+                profiler.mark("streamer")
             model_kwargs = self._update_model_kwargs_for_generation(
                 outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
             )
+            if profiler is not None:
+                profiler.mark("cache_update")
 
             # if eos_token was found in one sentence, set sentence to finished
             if eos_token_id_tensor is not None:
@@ -2262,6 +2706,8 @@ class GenerationMixin:
             if this_peer_finished and not synced_gpus:
                 break
 
+        if profiler is not None:
+            profiler.end(input_ids, model_kwargs.get("past_key_values"))
         if streamer is not None:
             streamer.end()
 
@@ -2300,6 +2746,8 @@ class GenerationMixin:
         return_dict_in_generate: Optional[bool] = None,
         synced_gpus: bool = False,
         streamer: Optional["BaseStreamer"] = None,
+        profiler: Optional["GenerationProfiler"] = None,
+        compact_finished_sequences: Optional[bool] = None,
         **model_kwargs,
     ) -> Union[GreedySearchOutput, torch.LongTensor]:
         r"""
@@ -2347,6 +2795,11 @@ class GenerationMixin:
             streamer (`BaseStreamer`, *optional*):
                 Streamer object that will be used to stream the generated sequences. Generated tokens are passed
                 through `streamer.put(token_ids)` and the streamer is responsible for any further processing.
+            profiler (`GenerationProfiler`, *optional*):
+                A [`~generation.GenerationProfiler`] recording the time spent in each phase of the decoding steps.
+            compact_finished_sequences (`bool`, *optional*, defaults to `False`):
+                Whether to drop the finished sequences from the batch, instead of running them through the model until
+                all sequences are finished. The returned sequences are the same.
             model_kwargs:
                 Additional model specific keyword arguments will be forwarded to the `forward` function of the model.
                 If model is an encoder-decoder model the kwargs should include `encoder_outputs`.
@@ -2421,6 +2874,20 @@ class GenerationMixin:
             if return_dict_in_generate is not None
             else self.generation_config.return_dict_in_generate
         )
+        compact_finished_sequences = (
+            compact_finished_sequences
+            if compact_finished_sequences is not None
+            else self.generation_config.compact_finished_sequences
+        )
+        if (
+            compact_finished_sequences
+            and return_dict_in_generate
+            and (output_scores or output_attentions or output_hidden_states)
+        ):
+            raise ValueError(
+                "`compact_finished_sequences` drops the finished sequences from the batch: it can't be combined with "
+                "`output_scores`, `output_attentions` or `output_hidden_states`."
+            )
 
         # init attention / hidden states / scores tuples
         scores = () if (return_dict_in_generate and output_scores) else None
@@ -2436,7 +2903,11 @@ class GenerationMixin:
             )
 
         # keep track of which sequences are already finished
-        unfinished_sequences = torch.ones(input_ids.shape[0], dtype=torch.long, device=input_ids.device)
+        batch_size = input_ids.shape[0]
+        unfinished_sequences = torch.ones(batch_size, dtype=torch.long, device=input_ids.device)
+        # with `compact_finished_sequences`, the index of the remaining rows in the batch, and the dropped rows
+        row_idx = None
+        finished_sequences = []
 
         this_peer_finished = False  # used by synced_gpus only
         while True:
@@ -2450,6 +2921,9 @@ class GenerationMixin:
                 if this_peer_finished_flag.item() == 0.0:
                     break
 
+            if profiler is not None:
+                profiler.step(input_ids, model_kwargs.get("past_key_values"))
+
             # prepare model inputs
             model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
 
@@ -2461,6 +2935,9 @@ class GenerationMixin:
                 output_hidden_states=output_hidden_states,
             )
 
+            if profiler is not None:
+                profiler.mark("forward")
+
             if synced_gpus and this_peer_finished:
                 continue  # don't waste resources running the code we don't need
 
@@ -2468,6 +2945,8 @@ class GenerationMixin:
 
             # pre-process distribution
             next_tokens_scores = logits_processor(input_ids, next_token_logits)
+            if profiler is not None:
+                profiler.mark("logits_processor")
 
             # Store scores, attentions and hidden_states when required
             if return_dict_in_generate:
@@ -2498,11 +2977,22 @@ class GenerationMixin:
 
             # update generated ids, model inputs, and length for next step
             input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+            if profiler is not None:
+                profiler.mark("sampling")
             if streamer is not None:
-                streamer.put(next_tokens.cpu())
+                if row_idx is not None:
+                    # the dropped rows are streamed padding tokens, as they would be without compaction
+                    full_next_tokens = next_tokens.new_full((batch_size,), pad_token_id)
+                    streamer.put(full_next_tokens.index_copy(0, row_idx, next_tokens).cpu())
+                else:
+                    streamer.put(next_tokens.cpu())
+            if profiler is not None:
+                profiler.mark("streamer")
             model_kwargs = self._update_model_kwargs_for_generation(
                 outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
             )
+            if profiler is not None:
+                profiler.mark("cache_update")
 
             # if eos_token was found in one sentence, set sentence to finished
             if eos_token_id_tensor is not None:
@@ -2521,8 +3011,19 @@ class GenerationMixin:
             if this_peer_finished and not synced_gpus:
                 break
 
+            if compact_finished_sequences and not synced_gpus and unfinished_sequences.min() == 0:
+                if row_idx is None:
+                    row_idx = torch.arange(batch_size, device=input_ids.device)
+                input_ids, unfinished_sequences, row_idx, model_kwargs = self._drop_finished_sequences(
+                    input_ids, unfinished_sequences, row_idx, finished_sequences, model_kwargs
+                )
+
+        if profiler is not None:
+            profiler.end(input_ids, model_kwargs.get("past_key_values"))
         if streamer is not None:
             streamer.end()
+        if row_idx is not None:
+            input_ids = self._restore_finished_sequences(input_ids, row_idx, finished_sequences, pad_token_id)
 
         if return_dict_in_generate:
             if self.config.is_encoder_decoder:
@@ -2560,6 +3061,9 @@ class GenerationMixin:
         return_dict_in_generate: Optional[bool] = None,
         synced_gpus: bool = False,
         streamer: Optional["BaseStreamer"] = None,
+        profiler: Optional["GenerationProfiler"] = None,
+        compact_finished_sequences: Optional[bool] = None,
+        sequence_seeds: Optional[torch.LongTensor] = None,
         **model_kwargs,
     ) -> Union[SampleOutput, torch.LongTensor]:
         r"""
@@ -2609,6 +3113,15 @@ class GenerationMixin:
             streamer (`BaseStreamer`, *optional*):
                 Streamer object that will be used to stream the generated sequences. Generated tokens are passed
                 through `streamer.put(token_ids)` and the streamer is responsible for any further processing.
+            profiler (`GenerationProfiler`, *optional*):
+                A [`~generation.GenerationProfiler`] recording the time spent in each phase of the decoding steps.
+            compact_finished_sequences (`bool`, *optional*, defaults to `False`):
+                Whether to drop the finished sequences from the batch, instead of running them through the model until
+                all sequences are finished. The returned sequences are the same.
+            sequence_seeds (`torch.LongTensor` of shape `(batch_size,)`, *optional*):
+                The seed of each sequence of the batch. When set, the tokens are drawn from counter-based random
+                streams that only depend on the seed of the sequence and on the decoding step, instead of the global
+                random number generator.
             model_kwargs:
                 Additional model specific kwargs will be forwarded to the `forward` function of the model. If model is
                 an encoder-decoder model the kwargs should include `encoder_outputs`.
@@ -2700,6 +3213,20 @@ class GenerationMixin:
             if return_dict_in_generate is not None
             else self.generation_config.return_dict_in_generate
         )
+        compact_finished_sequences = (
+            compact_finished_sequences
+            if compact_finished_sequences is not None
+            else self.generation_config.compact_finished_sequences
+        )
+        if (
+            compact_finished_sequences
+            and return_dict_in_generate
+            and (output_scores or output_attentions or output_hidden_states)
+        ):
+            raise ValueError(
+                "`compact_finished_sequences` drops the finished sequences from the batch: it can't be combined with "
+                "`output_scores`, `output_attentions` or `output_hidden_states`."
+            )
 
         # init attention / hidden states / scores tuples
         scores = () if (return_dict_in_generate and output_scores) else None
@@ -2715,7 +3242,12 @@ class GenerationMixin:
             )
 
         # keep track of which sequences are already finished
-        unfinished_sequences = torch.ones(input_ids.shape[0], dtype=torch.long, device=input_ids.device)
+        batch_size = input_ids.shape[0]
+        unfinished_sequences = torch.ones(batch_size, dtype=torch.long, device=input_ids.device)
+        # with `compact_finished_sequences`, the index of the remaining rows in the batch, and the dropped rows
+        row_idx = None
+        finished_sequences = []
+        prompt_length = input_ids.shape[-1]
 
         this_peer_finished = False  # used by synced_gpus only
         # auto-regressive generation
@@ -2730,6 +3262,9 @@ class GenerationMixin:
                 if this_peer_finished_flag.item() == 0.0:
                     break
 
+            if profiler is not None:
+                profiler.step(input_ids, model_kwargs.get("past_key_values"))
+
             # prepare model inputs
             model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
 
@@ -2741,6 +3276,9 @@ class GenerationMixin:
                 output_hidden_states=output_hidden_states,
             )
 
+            if profiler is not None:
+                profiler.mark("forward")
+
             if synced_gpus and this_peer_finished:
                 continue  # don't waste resources running the code we don't need
 
@@ -2748,7 +3286,11 @@ class GenerationMixin:
 
             # pre-process distribution
             next_token_scores = logits_processor(input_ids, next_token_logits)
+            if profiler is not None:
+                profiler.mark("logits_processor")
             next_token_scores = logits_warper(input_ids, next_token_scores)
+            if profiler is not None:
+                profiler.mark("logits_warper")
 
             # Store scores, attentions and hidden_states when required
             if return_dict_in_generate:
@@ -2769,8 +3311,13 @@ class GenerationMixin:
                     )
 
             # sample
-            probs = nn.functional.softmax(next_token_scores, dim=-1)
-            next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+            if sequence_seeds is not None:
+                row_seeds = sequence_seeds if row_idx is None else sequence_seeds[row_idx]
+                step = input_ids.shape[-1] - prompt_length
+                next_tokens = _sample_with_seeds(next_token_scores, row_seeds, step).squeeze(1)
+            else:
+                probs = nn.functional.softmax(next_token_scores, dim=-1)
+                next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
 
             # finished sentences should have their next token be a padding token
             if eos_token_id is not None:
@@ -2780,11 +3327,22 @@ class GenerationMixin:
 
             # update generated ids, model inputs, and length for next step
             input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+            if profiler is not None:
+                profiler.mark("sampling")
             if streamer is not None:
-                streamer.put(next_tokens.cpu())
+                if row_idx is not None:
+                    # the dropped rows are streamed padding tokens, as they would be without compaction
+                    full_next_tokens = next_tokens.new_full((batch_size,), pad_token_id)
+                    streamer.put(full_next_tokens.index_copy(0, row_idx, next_tokens).cpu())
+                else:
+                    streamer.put(next_tokens.cpu())
+            if profiler is not None:
+                profiler.mark("streamer")
             model_kwargs = self._update_model_kwargs_for_generation(
                 outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
             )
+            if profiler is not None:
+                profiler.mark("cache_update")
 
             # if eos_token was found in one sentence, set sentence to finished
             if eos_token_id_tensor is not None:
@@ -2803,8 +3361,19 @@ class GenerationMixin:
             if this_peer_finished and not synced_gpus:
                 break
 
+            if compact_finished_sequences and not synced_gpus and unfinished_sequences.min() == 0:
+                if row_idx is None:
+                    row_idx = torch.arange(batch_size, device=input_ids.device)
+                input_ids, unfinished_sequences, row_idx, model_kwargs = self._drop_finished_sequences(
+                    input_ids, unfinished_sequences, row_idx, finished_sequences, model_kwargs
+                )
+
+        if profiler is not None:
+            profiler.end(input_ids, model_kwargs.get("past_key_values"))
         if streamer is not None:
             streamer.end()
+        if row_idx is not None:
+            input_ids = self._restore_finished_sequences(input_ids, row_idx, finished_sequences, pad_token_id)
 
         if return_dict_in_generate:
             if self.config.is_encoder_decoder:
@@ -2841,6 +3410,7 @@ class GenerationMixin:
         output_scores: Optional[bool] = None,
         return_dict_in_generate: Optional[bool] = None,
         synced_gpus: bool = False,
+        profiler: Optional["GenerationProfiler"] = None,
         **model_kwargs,
     ) -> Union[BeamSearchOutput, torch.LongTensor]:
         r"""
@@ -2886,6 +3456,8 @@ class GenerationMixin:
                 Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
             synced_gpus (`bool`, *optional*, defaults to `False`):
                 Whether to continue running the while loop until max_length (needed for ZeRO stage 3)
+            profiler (`GenerationProfiler`, *optional*):
+                A [`~generation.GenerationProfiler`] recording the time spent in each phase of the decoding steps.
             model_kwargs:
                 Additional model specific kwargs will be forwarded to the `forward` function of the model. If model is
                 an encoder-decoder model the kwargs should include `encoder_outputs`.
@@ -2978,7 +3550,7 @@ class GenerationMixin:
             else self.generation_config.return_dict_in_generate
         )
 
-        batch_size = len(beam_scorer._beam_hyps)
+        batch_size = beam_scorer.batch_size
         num_beams = beam_scorer.num_beams
 
         batch_beam_size, cur_len = input_ids.shape
@@ -3022,6 +3594,9 @@ class GenerationMixin:
                 if this_peer_finished_flag.item() == 0.0:
                     break
 
+            if profiler is not None:
+                profiler.step(input_ids, model_kwargs.get("past_key_values"))
+
             model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
 
             outputs = self(
@@ -3031,6 +3606,9 @@ class GenerationMixin:
                 output_hidden_states=output_hidden_states,
             )
 
+            if profiler is not None:
+                profiler.mark("forward")
+
             if synced_gpus and this_peer_finished:
                 cur_len = cur_len + 1
                 continue  # don't waste resources running the code we don't need
@@ -3044,6 +3622,8 @@ class GenerationMixin:
             )  # (batch_size * num_beams, vocab_size)
 
             next_token_scores_processed = logits_processor(input_ids, next_token_scores)
+            if profiler is not None:
+                profiler.mark("logits_processor")
             next_token_scores = next_token_scores_processed + beam_scores[:, None].expand_as(next_token_scores)
 
             # Store scores, attentions and hidden_states when required
@@ -3093,11 +3673,17 @@ class GenerationMixin:
 
             input_ids = torch.cat([input_ids[beam_idx, :], beam_next_tokens.unsqueeze(-1)], dim=-1)
 
+            if profiler is not None:
+                profiler.mark("sampling")
             model_kwargs = self._update_model_kwargs_for_generation(
                 outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
             )
             if model_kwargs["past_key_values"] is not None:
-                model_kwargs["past_key_values"] = self._reorder_cache(model_kwargs["past_key_values"], beam_idx)
+                model_kwargs["past_key_values"] = self._reorder_past_key_values(
+                    model_kwargs["past_key_values"], beam_idx
+                )
+            if profiler is not None:
+                profiler.mark("cache_update")
 
             if return_dict_in_generate and output_scores:
                 beam_indices = tuple((beam_indices[beam_idx[i]] + (beam_idx[i],) for i in range(len(beam_indices))))
@@ -3111,6 +3697,8 @@ class GenerationMixin:
                 else:
                     this_peer_finished = True
 
+        if profiler is not None:
+            profiler.end(input_ids, model_kwargs.get("past_key_values"))
         sequence_outputs = beam_scorer.finalize(
             input_ids,
             beam_scores,
@@ -3165,6 +3753,8 @@ class GenerationMixin:
         output_scores: Optional[bool] = None,
         return_dict_in_generate: Optional[bool] = None,
         synced_gpus: bool = False,
+        profiler: Optional["GenerationProfiler"] = None,
+        sequence_seeds: Optional[torch.LongTensor] = None,
         **model_kwargs,
     ) -> Union[BeamSampleOutput, torch.LongTensor]:
         r"""
@@ -3214,6 +3804,12 @@ class GenerationMixin:
                 Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
             synced_gpus (`bool`, *optional*, defaults to `False`):
                 Whether to continue running the while loop until max_length (needed for ZeRO stage 3)
+            profiler (`GenerationProfiler`, *optional*):
+                A [`~generation.GenerationProfiler`] recording the time spent in each phase of the decoding steps.
+            sequence_seeds (`torch.LongTensor` of shape `(batch_size,)`, *optional*):
+                The seed of each sequence of the batch. When set, the tokens are drawn from counter-based random
+                streams that only depend on the seed of the sequence and on the decoding step, instead of the global
+                random number generator.
             model_kwargs:
                 Additional model specific kwargs will be forwarded to the `forward` function of the model. If model is
                 an encoder-decoder model the kwargs should include `encoder_outputs`.
@@ -3312,7 +3908,7 @@ class GenerationMixin:
             else self.generation_config.return_dict_in_generate
         )
 
-        batch_size = len(beam_scorer._beam_hyps)
+        batch_size = beam_scorer.batch_size
         num_beams = beam_scorer.num_beams
 
         batch_beam_size, cur_len = input_ids.shape
@@ -3335,6 +3931,7 @@ class GenerationMixin:
 
         beam_scores = torch.zeros((batch_size, num_beams), dtype=torch.float, device=input_ids.device)
         beam_scores = beam_scores.view((batch_size * num_beams,))
+        prompt_length = input_ids.shape[-1]
 
         this_peer_finished = False  # used by synced_gpus only
         while True:
@@ -3348,6 +3945,9 @@ class GenerationMixin:
                 if this_peer_finished_flag.item() == 0.0:
                     break
 
+            if profiler is not None:
+                profiler.step(input_ids, model_kwargs.get("past_key_values"))
+
             model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
 
             outputs = self(
@@ -3357,6 +3957,9 @@ class GenerationMixin:
                 output_hidden_states=output_hidden_states,
             )
 
+            if profiler is not None:
+                profiler.mark("forward")
+
             if synced_gpus and this_peer_finished:
                 cur_len = cur_len + 1
                 continue  # don't waste resources running the code we don't need
@@ -3371,11 +3974,15 @@ class GenerationMixin:
             )  # (batch_size * num_beams, vocab_size)
 
             next_token_scores_processed = logits_processor(input_ids, next_token_scores)
+            if profiler is not None:
+                profiler.mark("logits_processor")
             next_token_scores = next_token_scores_processed + beam_scores[:, None].expand_as(next_token_scores)
             # Note: logits warpers are intentionally applied after adding running beam scores. On some logits warpers
             # (like top_p) this is indiferent, but on others (like temperature) it is not. For reference, see
             # https://github.com/huggingface/transformers/pull/5420#discussion_r449779867
             next_token_scores = logits_warper(input_ids, next_token_scores)
+            if profiler is not None:
+                profiler.mark("logits_warper")
 
             # Store scores, attentions and hidden_states when required
             if return_dict_in_generate:
@@ -3399,9 +4006,12 @@ class GenerationMixin:
             vocab_size = next_token_scores.shape[-1]
             next_token_scores = next_token_scores.view(batch_size, num_beams * vocab_size)
 
-            probs = nn.functional.softmax(next_token_scores, dim=-1)
-
-            next_tokens = torch.multinomial(probs, num_samples=2 * num_beams)
+            if sequence_seeds is not None:
+                step = input_ids.shape[-1] - prompt_length
+                next_tokens = _sample_with_seeds(next_token_scores, sequence_seeds, step, num_samples=2 * num_beams)
+            else:
+                probs = nn.functional.softmax(next_token_scores, dim=-1)
+                next_tokens = torch.multinomial(probs, num_samples=2 * num_beams)
             next_token_scores = torch.gather(next_token_scores, -1, next_tokens)
 
             next_token_scores, _indices = torch.sort(next_token_scores, descending=True, dim=1)
@@ -3426,11 +4036,17 @@ class GenerationMixin:
 
             input_ids = torch.cat([input_ids[beam_idx, :], beam_next_tokens.unsqueeze(-1)], dim=-1)
 
+            if profiler is not None:
+                profiler.mark("sampling")
             model_kwargs = self._update_model_kwargs_for_generation(
                 outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
             )
             if model_kwargs["past_key_values"] is not None:
-                model_kwargs["past_key_values"] = self._reorder_cache(model_kwargs["past_key_values"], beam_idx)
+                model_kwargs["past_key_values"] = self._reorder_past_key_values(
+                    model_kwargs["past_key_values"], beam_idx
+                )
+            if profiler is not None:
+                profiler.mark("cache_update")
 
             if return_dict_in_generate and output_scores:
                 beam_indices = tuple((beam_indices[beam_idx[i]] + (beam_idx[i],) for i in range(len(beam_indices))))
@@ -3444,6 +4060,8 @@ class GenerationMixin:
                 else:
                     this_peer_finished = True
 
+        if profiler is not None:
+            profiler.end(input_ids, model_kwargs.get("past_key_values"))
         sequence_outputs = beam_scorer.finalize(
             input_ids,
             beam_scores,
@@ -3497,6 +4115,7 @@ class GenerationMixin:
         output_scores: Optional[bool] = None,
         return_dict_in_generate: Optional[bool] = None,
         synced_gpus: bool = False,
+        profiler: Optional["GenerationProfiler"] = None,
         **model_kwargs,
     ):
         r"""
@@ -3542,6 +4161,8 @@ class GenerationMixin:
                 Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
             synced_gpus (`bool`, *optional*, defaults to `False`):
                 Whether to continue running the while loop until max_length (needed for ZeRO stage 3)
+            profiler (`GenerationProfiler`, *optional*):
+                A [`~generation.GenerationProfiler`] recording the time spent in each phase of the decoding steps.
 
             model_kwargs:
                 Additional model specific kwargs that will be forwarded to the `forward` function of the model. If
@@ -3641,7 +4262,7 @@ class GenerationMixin:
         num_beams = beam_scorer.num_beams
         num_beam_groups = beam_scorer.num_beam_groups
         num_sub_beams = num_beams // num_beam_groups
-        batch_size = len(beam_scorer._beam_hyps) // num_beam_groups
+        batch_size = beam_scorer.batch_size
         device = input_ids.device
 
         batch_beam_size, cur_len = input_ids.shape
@@ -3687,6 +4308,9 @@ class GenerationMixin:
                 if this_peer_finished_flag.item() == 0.0:
                     break
 
+            if profiler is not None:
+                profiler.step(input_ids, model_kwargs.get("past_key_values"))
+
             # predicted tokens in cur_len step
             current_tokens = torch.zeros(batch_size * num_beams, dtype=input_ids.dtype, device=device)
 
@@ -3702,6 +4326,9 @@ class GenerationMixin:
                 output_hidden_states=output_hidden_states,
             )
 
+            if profiler is not None:
+                profiler.mark("forward")
+
             if synced_gpus and this_peer_finished:
                 cur_len = cur_len + 1
                 continue  # don't waste resources running the code we don't need
@@ -3737,6 +4364,8 @@ class GenerationMixin:
                 next_token_scores_processed = logits_processor(
                     group_input_ids, next_token_scores, current_tokens=current_tokens, beam_group_idx=beam_group_idx
                 )
+                if profiler is not None:
+                    profiler.mark("logits_processor")
                 next_token_scores = next_token_scores_processed + beam_scores[batch_group_indices].unsqueeze(-1)
                 next_token_scores = next_token_scores.expand_as(next_token_scores_processed)
 
@@ -3786,6 +4415,8 @@ class GenerationMixin:
                     + group_start_idx
                     + (beam_idx % group_size)
                 )
+                if profiler is not None:
+                    profiler.mark("sampling")
 
             # Store scores, attentions and hidden_states when required
             if return_dict_in_generate:
@@ -3807,13 +4438,17 @@ class GenerationMixin:
 
             input_ids = torch.cat([input_ids, current_tokens.unsqueeze(-1)], dim=-1)
 
+            if profiler is not None:
+                profiler.mark("sampling")
             model_kwargs = self._update_model_kwargs_for_generation(
                 outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
             )
             if model_kwargs["past_key_values"] is not None:
-                model_kwargs["past_key_values"] = self._reorder_cache(
+                model_kwargs["past_key_values"] = self._reorder_past_key_values(
                     model_kwargs["past_key_values"], reordering_indices
                 )
+            if profiler is not None:
+                profiler.mark("cache_update")
 
             # increase cur_len
             cur_len = cur_len + 1
@@ -3824,6 +4459,8 @@ class GenerationMixin:
                 else:
                     this_peer_finished = True
 
+        if profiler is not None:
+            profiler.end(input_ids, model_kwargs.get("past_key_values"))
         final_beam_indices = sum(beam_indices, ()) if beam_indices is not None else None
         sequence_outputs = beam_scorer.finalize(
             input_ids,
@@ -3878,6 +4515,7 @@ class GenerationMixin:
         output_scores: Optional[bool] = None,
         return_dict_in_generate: Optional[bool] = None,
         synced_gpus: Optional[bool] = None,
+        profiler: Optional["GenerationProfiler"] = None,
         **model_kwargs,
     ) -> Union[BeamSearchOutput, torch.LongTensor]:
         r"""
@@ -3928,6 +4566,8 @@ class GenerationMixin:
                 Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
             synced_gpus (`bool`, *optional*, defaults to `False`):
                 Whether to continue running the while loop until max_length (needed for ZeRO stage 3)
+            profiler (`GenerationProfiler`, *optional*):
+                A [`~generation.GenerationProfiler`] recording the time spent in each phase of the decoding steps.
             model_kwargs:
                 Additional model specific kwargs will be forwarded to the `forward` function of the model. If model is
                 an encoder-decoder model the kwargs should include `encoder_outputs`.
@@ -4070,6 +4710,9 @@ class GenerationMixin:
                 if this_peer_finished_flag.item() == 0.0:
                     break
 
+            if profiler is not None:
+                profiler.step(input_ids, model_kwargs.get("past_key_values"))
+
             model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
 
             outputs = self(
@@ -4079,6 +4722,9 @@ class GenerationMixin:
                 output_hidden_states=output_hidden_states,
             )
 
+            if profiler is not None:
+                profiler.mark("forward")
+
             if synced_gpus and this_peer_finished:
                 cur_len = cur_len + 1
                 continue  # don't waste resources running the code we don't need
@@ -4092,6 +4738,8 @@ class GenerationMixin:
             )  # (batch_size * num_beams, vocab_size)
 
             next_token_scores_processed = logits_processor(input_ids, next_token_scores)
+            if profiler is not None:
+                profiler.mark("logits_processor")
 
             next_token_scores = next_token_scores_processed + beam_scores[:, None].expand_as(next_token_scores)
 
@@ -4143,11 +4791,17 @@ class GenerationMixin:
             beam_idx = beam_outputs["next_beam_indices"]
 
             input_ids = torch.cat([input_ids[beam_idx, :], beam_next_tokens.unsqueeze(-1)], dim=-1)
+            if profiler is not None:
+                profiler.mark("sampling")
             model_kwargs = self._update_model_kwargs_for_generation(
                 outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
             )
             if model_kwargs["past_key_values"] is not None:
-                model_kwargs["past_key_values"] = self._reorder_cache(model_kwargs["past_key_values"], beam_idx)
+                model_kwargs["past_key_values"] = self._reorder_past_key_values(
+                    model_kwargs["past_key_values"], beam_idx
+                )
+            if profiler is not None:
+                profiler.mark("cache_update")
 
             if return_dict_in_generate and output_scores:
                 beam_indices = tuple((beam_indices[beam_idx[i]] + (beam_idx[i],) for i in range(len(beam_indices))))
@@ -4161,6 +4815,8 @@ class GenerationMixin:
                 else:
                     this_peer_finished = True
 
+        if profiler is not None:
+            profiler.end(input_ids, model_kwargs.get("past_key_values"))
         sequence_outputs = constrained_beam_scorer.finalize(
             input_ids,
             beam_scores,
@@ -4202,7 +4858,7 @@ class GenerationMixin:
     def assisted_decoding(
         self,
         input_ids: torch.LongTensor,
-        assistant_model: "PreTrainedModel",
+        assistant_model: Optional["PreTrainedModel"] = None,
         do_sample: bool = False,
         logits_processor: Optional[LogitsProcessorList] = None,
         logits_warper: Optional[LogitsProcessorList] = None,
@@ -4215,12 +4871,19 @@ class GenerationMixin:
         return_dict_in_generate: Optional[bool] = None,
         synced_gpus: bool = False,
         streamer: Optional["BaseStreamer"] = None,
+        num_draft_branches: int = 1,
+        candidate_generator: Optional[CandidateGenerator] = None,
+        profiler: Optional["GenerationProfiler"] = None,
         **model_kwargs,
     ):
         r"""
         Generates sequences of token ids for models with a language modeling head using **greedy decoding** or
-        **sample** (depending on `do_sample`), assisted by a smaller model. Can be used for text-decoder, text-to-text,
-        speech-to-text, and vision-to-text models.
+        **sample** (depending on `do_sample`), assisted by a smaller model or by another source of candidate tokens.
+        Can be used for text-decoder, text-to-text, speech-to-text, and vision-to-text models.
+
+        The candidate tokens drafted for a whole batch are verified in a single forward pass of the
+        model. With sampling, they are accepted or rejected by speculative sampling, so that the generated tokens
+        follow the exact distribution of the model.
 
         <Tip warning={true}>
 
@@ -4269,6 +4932,15 @@ class GenerationMixin:
             streamer (`BaseStreamer`, *optional*):
                 Streamer object that will be used to stream the generated sequences. Generated tokens are passed
                 through `streamer.put(token_ids)` and the streamer is responsible for any further processing.
+            num_draft_branches (`int`, *optional*, defaults to 1):
+                The number of candidate continuations drafted by the assistant for each sequence. With more than one,
+                the candidates form a tree that branches on its first token, and all of its branches are verified in a
+                single forward pass of the model.
+            candidate_generator (`CandidateGenerator`, *optional*):
+                Drafts the candidate tokens instead of `assistant_model`, e.g. a `PromptLookupCandidateGenerator`,
+                which looks them up in the sequences themselves.
+            profiler (`GenerationProfiler`, *optional*):
+                A [`~generation.GenerationProfiler`] recording the time spent in each phase of the decoding steps.
             model_kwargs:
                 Additional model specific keyword arguments will be forwarded to the `forward` function of the model.
                 If model is an encoder-decoder model the kwargs should include `encoder_outputs`.
@@ -4315,10 +4987,6 @@ class GenerationMixin:
         >>> tokenizer.batch_decode(outputs, skip_special_tokens=True)
         ["It might be possible to get a better understanding of the nature of the problem, but it's not"]
         ```"""
-        # Assistant: initialize assistant-related variables
-        if not hasattr(assistant_model, "max_assistant_tokens"):
-            assistant_model.max_assistant_tokens = 5  # this value, which will be updated, persists across calls
-
         # init values
         logits_processor = logits_processor if logits_processor is not None else LogitsProcessorList()
         logits_warper = logits_warper if logits_warper is not None else LogitsProcessorList()
@@ -4342,6 +5010,8 @@ class GenerationMixin:
             if return_dict_in_generate is not None
             else self.generation_config.return_dict_in_generate
         )
+        if num_draft_branches > 1 and self.config.is_encoder_decoder:
+            raise ValueError("`num_draft_branches > 1` is only supported by decoder-only models.")
 
         # init attention / hidden states / scores tuples
         scores = () if (return_dict_in_generate and output_scores) else None
@@ -4357,19 +5027,25 @@ class GenerationMixin:
             )
 
         # keep track of which sequences are already finished
-        unfinished_sequences = input_ids.new(input_ids.shape[0]).fill_(1)
+        batch_size = input_ids.shape[0]
+        unfinished_sequences = input_ids.new(batch_size).fill_(1)
+        if not self.config.is_encoder_decoder and model_kwargs.get("attention_mask") is None:
+            model_kwargs["attention_mask"] = torch.ones_like(input_ids)
 
         # other auxiliary variables
         max_len = stopping_criteria[0].max_length
-        assistant_kv_indexing = (
-            1
-            if "bloom" in assistant_model.__class__.__name__.lower()
-            or (
-                assistant_model.config.architectures is not None
-                and "bloom" in assistant_model.config.architectures[0].lower()
+        if candidate_generator is None:
+            if assistant_model is None:
+                raise ValueError("assisted generate requires either an `assistant_model` or a `candidate_generator`.")
+            candidate_generator = AssistedCandidateGenerator(
+                assistant_model=assistant_model,
+                model_kwargs=model_kwargs,
+                logits_processor=logits_processor,
+                logits_warper=logits_warper,
+                do_sample=do_sample,
+                eos_token_id=eos_token_id,
+                max_length=max_len,
             )
-            else 0
-        )
 
         this_peer_finished = False  # used by synced_gpus only
         while True:
@@ -4383,162 +5059,145 @@ class GenerationMixin:
                 if this_peer_finished_flag.item() == 0.0:
                     break
 
+            if profiler is not None:
+                profiler.step(input_ids, model_kwargs.get("past_key_values"))
+
             # Assistant: main logic start
             cur_len = input_ids.shape[-1]
+            # an empty `Cache` object may already be present before the first forward pass
+            has_past = bool(model_kwargs.get("past_key_values"))
+            # the first forward pass of the model also encodes the prompt: it verifies a single branch, so that the
+            # prompt isn't encoded once per branch
+            num_branches = num_draft_branches if has_past else 1
+            attention_mask = model_kwargs.get("attention_mask") if not self.config.is_encoder_decoder else None
+
+            #  1. Fetch the candidate sequences. The candidate generator may return fewer branches than requested
+            candidate_input_ids, candidate_probs = candidate_generator.get_candidates(
+                input_ids, attention_mask=attention_mask, num_branches=num_branches
+            )
+            if profiler is not None:
+                profiler.mark("candidate_generation")
+            num_branches = candidate_input_ids.shape[0] // batch_size
+            candidate_length = candidate_input_ids.shape[1] - cur_len
 
-            #  1. Forecast next N tokens using the assistant model. This `for` block can be replaced with a
-            # `.generate()` call if we decide to add `past_key_values` as a possible output of generate, as we
-            # need access to the assistant cache to secure strong speedups.
-            candidate_input_ids = input_ids
-            for _ in range(int(assistant_model.max_assistant_tokens)):
-                # 1.1. use the assistant model to obtain the next candidate logits
-                if "assistant_past_key_values" in model_kwargs:
-                    prev_seq_len = model_kwargs["assistant_past_key_values"][0][assistant_kv_indexing].shape[-2]
-                    # `new_token_len` can be 1 or 2 (next token in assistant + last token picked by the larger model)
-                    new_token_len = candidate_input_ids.shape[1] - prev_seq_len
-                    assist_inputs = candidate_input_ids[:, -new_token_len:]
-                    assist_attn = torch.ones_like(candidate_input_ids)
-                    # TODO (joao): make it compatible with models that use unconventional fwd pass logic, like blip2
-                    if assistant_model.config.is_encoder_decoder:
-                        assistant_model_outputs = assistant_model(
-                            decoder_input_ids=assist_inputs,
-                            decoder_attention_mask=assist_attn,
-                            past_key_values=model_kwargs["assistant_past_key_values"],
-                            encoder_outputs=model_kwargs["assistant_encoder_outputs"],
-                        )
-                    else:
-                        assistant_model_outputs = assistant_model(
-                            assist_inputs,
-                            attention_mask=assist_attn,
-                            past_key_values=model_kwargs["assistant_past_key_values"],
-                        )
-                else:
-                    if assistant_model.config.is_encoder_decoder:
-                        assistant_model_outputs = assistant_model(
-                            decoder_input_ids=candidate_input_ids,
-                            encoder_outputs=model_kwargs["assistant_encoder_outputs"],
-                        )
-                    else:
-                        assistant_model_outputs = assistant_model(candidate_input_ids)
-
-                # 1.2. greedily select the next candidate token
-                model_kwargs["assistant_past_key_values"] = assistant_model_outputs.past_key_values
-                if len(logits_processor) > 0:
-                    assistant_model_outputs.logits[:, -1, :] = logits_processor(
-                        candidate_input_ids, assistant_model_outputs.logits[:, -1, :]
-                    )
-                new_token = assistant_model_outputs.logits[:, -1, :].argmax(dim=-1)
-                candidate_input_ids = torch.cat((candidate_input_ids, new_token[:, None]), dim=-1)
-
-                # 1.3. stop assistant generation on EOS
-                if eos_token_id_tensor is not None:
-                    last_assistant_token_is_eos = new_token.tile(eos_token_id_tensor.shape[0], 1)
-                    last_assistant_token_is_eos = (
-                        ~last_assistant_token_is_eos.ne(eos_token_id_tensor.unsqueeze(1)).prod(dim=0).bool()
-                    )
-                    if last_assistant_token_is_eos:
-                        break
-                else:
-                    last_assistant_token_is_eos = False
-
-            candidate_length = candidate_input_ids.shape[1] - input_ids.shape[1]
-
-            # 2. Use the original model to obtain the next token logits given the candidate sequence. We obtain
+            # 2. Use the original model to obtain the next token logits given the candidate sequences. We obtain
             # `candidate_length + 1` relevant logits from this process: in the event that all candidates are correct,
             # we use this forward pass to also pick the subsequent logits in the original model.
 
-            # 2.1. Run a forward pass on the candidate sequence
-            if "past_key_values" in model_kwargs:
-                model_attn = torch.ones_like(candidate_input_ids)
-                model_input_ids = candidate_input_ids[:, -candidate_length - 1 :]
-                if self.config.is_encoder_decoder:
-                    outputs = self(
-                        decoder_input_ids=model_input_ids,
-                        decoder_attention_mask=model_attn,
-                        past_key_values=model_kwargs["past_key_values"],
-                        encoder_outputs=model_kwargs["encoder_outputs"],
-                        output_attentions=output_attentions,
-                        output_hidden_states=output_hidden_states,
-                        use_cache=True,
-                    )
-                else:
-                    outputs = self(
-                        model_input_ids,
-                        attention_mask=model_attn,
-                        past_key_values=model_kwargs["past_key_values"],
-                        output_attentions=output_attentions,
-                        output_hidden_states=output_hidden_states,
-                        use_cache=True,
-                    )
+            # 2.1. Run a single forward pass on all the candidate sequences. Each branch of the candidate tree is a row
+            # of the batch, which holds a copy of the cache of its sequence: every candidate token only attends to its
+            # own sequence and to the previous tokens of its branch, as a tree attention mask over the flattened tree
+            # would let it.
+            past_key_values = model_kwargs.get("past_key_values")
+            if num_branches > 1:
+                branch_idx = torch.arange(batch_size, device=input_ids.device).repeat_interleave(num_branches)
+                past_key_values = self._reorder_past_key_values(past_key_values, branch_idx)
+            num_new_tokens = candidate_length + 1 if has_past else candidate_input_ids.shape[1]
+            if self.config.is_encoder_decoder:
+                outputs = self(
+                    decoder_input_ids=candidate_input_ids[:, -num_new_tokens:],
+                    attention_mask=model_kwargs.get("attention_mask"),
+                    past_key_values=past_key_values,
+                    encoder_outputs=model_kwargs["encoder_outputs"],
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                    use_cache=True,
+                )
             else:
-                if self.config.is_encoder_decoder:
-                    outputs = self(
-                        decoder_input_ids=candidate_input_ids,
-                        encoder_outputs=model_kwargs["encoder_outputs"],
-                        output_attentions=output_attentions,
-                        output_hidden_states=output_hidden_states,
-                        use_cache=True,
-                    )
-                else:
-                    outputs = self(
-                        candidate_input_ids,
-                        output_attentions=output_attentions,
-                        output_hidden_states=output_hidden_states,
-                        use_cache=True,
-                    )
+                candidate_attention_mask = torch.cat(
+                    [attention_mask, attention_mask.new_ones((batch_size, candidate_length))], dim=-1
+                ).repeat_interleave(num_branches, dim=0)
+                model_inputs = _prepare_decoder_only_inputs(
+                    self, candidate_input_ids, candidate_attention_mask, num_new_tokens
+                )
+                outputs = self(
+                    **model_inputs,
+                    past_key_values=past_key_values,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                    use_cache=True,
+                )
+
+            if profiler is not None:
+                profiler.mark("forward")
 
             # 2.2. Process the new logits
             new_logits = outputs.logits[:, -candidate_length - 1 :]  # excludes the input prompt if present
             if len(logits_processor) > 0:
-                for i in range(candidate_length):
+                for i in range(candidate_length + 1):
                     new_logits[:, i, :] = logits_processor(candidate_input_ids[:, : cur_len + i], new_logits[:, i, :])
-            if len(logits_warper) > 0:
-                for i in range(candidate_length):
+            if profiler is not None:
+                profiler.mark("logits_processor")
+            if do_sample and len(logits_warper) > 0:
+                for i in range(candidate_length + 1):
                     new_logits[:, i, :] = logits_warper(candidate_input_ids[:, : cur_len + i], new_logits[:, i, :])
 
-            # 3. Obtain the next tokens from the original model logits.
+            if profiler is not None:
+                profiler.mark("logits_warper")
+
+            # 3. Verify the candidates. For each sequence, this selects a branch, and returns the candidate tokens of
+            # that branch followed by the token picked by the original model after the last accepted candidate.
+            candidate_new_tokens = candidate_input_ids[:, cur_len:]
             if do_sample:
-                probs = new_logits[:, -candidate_length - 1 :, :].softmax(dim=-1)
-                selected_tokens = torch.multinomial(probs[0, :, :], num_samples=1).squeeze(1)[None, :]
+                selected_tokens, num_accepted, selected_branches = _speculative_sampling(
+                    candidate_new_tokens, candidate_probs, new_logits.softmax(dim=-1), num_branches
+                )
             else:
-                selected_tokens = new_logits[:, -candidate_length - 1 :, :].argmax(dim=-1)
-
-            # 4. Compare the argmax from the original model logits with the assistant forecasted tokens. We can keep
-            # the assistant forecasted tokens until the first mismatch, or until the max length is reached.
-            candidate_new_tokens = candidate_input_ids[:, -candidate_length:]
-            n_matches = ((~(candidate_new_tokens == selected_tokens[:, :-1])).cumsum(dim=-1) < 1).sum()
+                selected_tokens, num_accepted, selected_branches = _greedy_verification(
+                    candidate_new_tokens, new_logits, num_branches
+                )
 
-            # 5. Update variables according to the number of matching assistant tokens. Remember: the token generated
-            # by the model after the last candidate match is also valid, as it is generated from a correct sequence.
-            # Because of this last token, assisted generation search reduces to a normal greedy search/sample if there
-            # is no match.
+            # 4. All the sequences advance by the same number of tokens: the candidates accepted by all the unfinished
+            # sequences, then one more token. For the sequences that accepted more candidates, that token is their next
+            # accepted candidate, which is a valid continuation too. A sequence can't go past an EOS token, and the
+            # generation can't go past `max_len`.
+            if eos_token_id_tensor is not None:
+                is_eos = selected_tokens[:, :, None].eq(eos_token_id_tensor).any(dim=-1)
+                first_eos = torch.where(is_eos.any(dim=-1), is_eos.int().argmax(dim=-1), candidate_length)
+                num_accepted = torch.minimum(num_accepted, first_eos)
+            num_accepted = num_accepted.masked_fill(unfinished_sequences == 0, candidate_length)
+            n_matches = min(int(num_accepted.min()), max_len - cur_len - 1)
 
-            # 5.1. Ensure we don't generate beyond max_len or an EOS token
-            if last_assistant_token_is_eos and n_matches == candidate_length:
-                n_matches -= 1
-            n_matches = min(n_matches, max_len - cur_len - 1)
+            # 5. Update variables according to the number of matching candidate tokens.
 
-            # 5.2. Get the valid continuation, after the matching tokens
+            # 5.1. Get the valid continuation, after the matching tokens
             valid_tokens = selected_tokens[:, : n_matches + 1]
+            if eos_token_id is not None:
+                valid_tokens = valid_tokens * unfinished_sequences[:, None] + pad_token_id * (
+                    1 - unfinished_sequences[:, None]
+                )
+            if profiler is not None:
+                profiler.mark("sampling")
             input_ids = torch.cat((input_ids, valid_tokens), dim=-1)
             if streamer is not None:
                 streamer.put(valid_tokens.cpu())
+            if profiler is not None:
+                profiler.mark("streamer")
             new_cur_len = input_ids.shape[-1]
 
-            # 5.3. Discard past key values relative to unused assistant tokens
-            new_cache_size = new_cur_len - 1
-            outputs.past_key_values = _crop_past_key_values(self, outputs.past_key_values, new_cache_size)
-            model_kwargs["assistant_past_key_values"] = _crop_past_key_values(
-                assistant_model, model_kwargs["assistant_past_key_values"], new_cache_size - 1
-            )  # the assistant does not have the token after the last match, hence the -1
-
-            # 6. Adjust the max number of assistant tokens to use in the next iteration. This is a simple heuristic,
-            # probably can be improved -- we want to balance the benefits of getting assistant tokens correct with the
-            # cost of forecasting incorrect assistant tokens.
-            if n_matches == int(assistant_model.max_assistant_tokens):
-                assistant_model.max_assistant_tokens += 2.0
-            else:
-                assistant_model.max_assistant_tokens = max(1.0, assistant_model.max_assistant_tokens - 1.0)
+            # 5.2. Keep the cache of the selected branches, and discard the past key values of unused candidate tokens
+            selected_rows = None
+            new_past_key_values = outputs.past_key_values
+            if num_branches > 1:
+                selected_rows = torch.arange(batch_size, device=input_ids.device) * num_branches + selected_branches
+                new_past_key_values = self._reorder_past_key_values(new_past_key_values, selected_rows)
+                new_logits = new_logits[selected_rows]
+                if return_dict_in_generate and output_attentions:
+                    outputs.attentions = tuple(layer[selected_rows] for layer in outputs.attentions)
+                if return_dict_in_generate and output_hidden_states:
+                    outputs.hidden_states = tuple(layer[selected_rows] for layer in outputs.hidden_states)
+            model_kwargs["past_key_values"] = _crop_past_key_values(self, new_past_key_values, new_cur_len - 1)
+            if not self.config.is_encoder_decoder:
+                model_kwargs["attention_mask"] = torch.cat(
+                    [attention_mask, attention_mask.new_ones((batch_size, n_matches + 1))], dim=-1
+                )
+
+            # 6. Let the candidate generator discard its unused candidates, and adjust the number of candidate tokens
+            # for the next iteration
+            candidate_generator.update_candidate_strategy(input_ids, selected_rows, n_matches)
+
+            if profiler is not None:
+                profiler.mark("cache_update")
 
             # Assistant: main logic end
 
@@ -4551,7 +5210,7 @@ class GenerationMixin:
                 if output_scores:
                     scores += tuple(new_logits[:, i, :] for i in range(n_matches + 1))
 
-                if "past_key_values" not in model_kwargs:
+                if not has_past:
                     added_len = new_cur_len
                 else:
                     added_len = n_matches + 1
@@ -4586,10 +5245,6 @@ class GenerationMixin:
                             decoder_hidden_states, outputs.hidden_states, cur_len, added_len
                         )
 
-            model_kwargs = self._update_model_kwargs_for_generation(
-                outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
-            )
-
             # if eos_token was found in one sentence, set sentence to finished
             if eos_token_id_tensor is not None:
                 unfinished_sequences = unfinished_sequences.mul(
@@ -4610,6 +5265,8 @@ class GenerationMixin:
             if this_peer_finished and not synced_gpus:
                 break
 
+        if profiler is not None:
+            profiler.end(input_ids, model_kwargs.get("past_key_values"))
         if streamer is not None:
             streamer.end()
 
@@ -4635,52 +5292,128 @@ class GenerationMixin:
             return input_ids
 
 
-def _crop_past_key_values(model, past_key_values, maximum_length):
-    """Crops the past key values up to a certain maximum length."""
-    new_past = []
-    if model.config.is_encoder_decoder:
-        for idx in range(len(past_key_values)):
-            new_past.append(
-                (
-                    past_key_values[idx][0][:, :, :maximum_length, :],
-                    past_key_values[idx][1][:, :, :maximum_length, :],
-                    past_key_values[idx][2],
-                    past_key_values[idx][3],
-                )
-            )
-        past_key_values = tuple(new_past)
-    # bloom is special
-    elif "bloom" in model.__class__.__name__.lower() or (
-        model.config.architectures is not None and "bloom" in model.config.architectures[0].lower()
-    ):
-        for idx in range(len(past_key_values)):
-            new_past.append(
-                (
-                    past_key_values[idx][0][:, :, :maximum_length],
-                    past_key_values[idx][1][:, :maximum_length, :],
-                )
-            )
-        past_key_values = tuple(new_past)
-    # gptbigcode is too
-    elif "gptbigcode" in model.__class__.__name__.lower() or (
-        model.config.architectures is not None and "gptbigcode" in model.config.architectures[0].lower()
-    ):
-        if model.config.multi_query:
-            for idx in range(len(past_key_values)):
-                past_key_values[idx] = past_key_values[idx][:, :maximum_length, :]
-        else:
-            for idx in range(len(past_key_values)):
-                past_key_values[idx] = past_key_values[idx][:, :, :maximum_length, :]
-    else:
-        for idx in range(len(past_key_values)):
-            new_past.append(
-                (
-                    past_key_values[idx][0][:, :, :maximum_length, :],
-                    past_key_values[idx][1][:, :, :maximum_length, :],
-                )
-            )
-        past_key_values = tuple(new_past)
-    return past_key_values
+def _greedy_verification(
+    candidate_new_tokens: torch.LongTensor, new_logits: torch.FloatTensor, num_branches: int
+) -> Tuple[torch.LongTensor, torch.LongTensor, torch.LongTensor]:
+    """
+    Verifies the candidate tokens of assisted decoding against the greedy choices of the model.
+
+    Args:
+        candidate_new_tokens (`torch.LongTensor` of shape `(batch_size * num_branches, candidate_length)`):
+            The candidate tokens of each branch.
+        new_logits (`torch.FloatTensor` of shape `(batch_size * num_branches, candidate_length + 1, vocab_size)`):
+            The processed logits of the model at each candidate position, and after the last candidate.
+        num_branches (`int`):
+            The number of branches of each sequence.
+
+    Return:
+        `Tuple[torch.LongTensor, torch.LongTensor, torch.LongTensor]`: For each sequence, the tokens of its selected
+        branch, of shape `(batch_size, candidate_length + 1)`, whose first `num_accepted` tokens are the accepted
+        candidates and whose next token is picked by the model; `num_accepted`; and the index of the selected branch.
+    """
+    candidate_length = candidate_new_tokens.shape[-1]
+    selected_tokens = new_logits.argmax(dim=-1).view(-1, num_branches, candidate_length + 1)
+    candidate_new_tokens = candidate_new_tokens.view(-1, num_branches, candidate_length)
+    num_matches = ((~(candidate_new_tokens == selected_tokens[:, :, :-1])).cumsum(dim=-1) < 1).sum(dim=-1)
+    # the first tokens of the branches differ: at most one branch matches the model
+    num_accepted, selected_branches = num_matches.max(dim=-1)
+    batch_idx = torch.arange(selected_tokens.shape[0], device=selected_tokens.device)
+    return selected_tokens[batch_idx, selected_branches], num_accepted, selected_branches
+
+
+def _speculative_sampling(
+    candidate_new_tokens: torch.LongTensor,
+    candidate_probs: Optional[torch.FloatTensor],
+    new_probs: torch.FloatTensor,
+    num_branches: int,
+) -> Tuple[torch.LongTensor, torch.LongTensor, torch.LongTensor]:
+    """
+    Verifies the candidate tokens of assisted decoding with speculative sampling
+    (https://arxiv.org/abs/2211.17192): a candidate `x` drawn from `q` is accepted with probability `min(1, p(x) /
+    q(x))`, where `p` is the distribution of the model, and the first rejected candidate is replaced by a token
+    sampled from `norm(max(0, p - q))`. The first tokens of the branches of a sequence are verified one after the
+    other, each against the residual distribution left by the previous rejections (https://arxiv.org/abs/2305.09781),
+    and the candidates of the first accepted branch are then verified in turn. The tokens returned therefore follow
+    `p` exactly.
+
+    Args:
+        candidate_new_tokens (`torch.LongTensor` of shape `(batch_size * num_branches, candidate_length)`):
+            The candidate tokens of each branch.
+        candidate_probs (`torch.FloatTensor` of shape `(batch_size * num_branches, candidate_length, vocab_size)`):
+            The distributions the candidate tokens were sampled from, or `None` if they were picked deterministically.
+        new_probs (`torch.FloatTensor` of shape `(batch_size * num_branches, candidate_length + 1, vocab_size)`):
+            The distributions of the model at each candidate position, and after the last candidate.
+        num_branches (`int`):
+            The number of branches of each sequence.
+
+    Return:
+        `Tuple[torch.LongTensor, torch.LongTensor, torch.LongTensor]`: As in `_greedy_verification`.
+    """
+    candidate_length = candidate_new_tokens.shape[-1]
+    vocab_size = new_probs.shape[-1]
+    if candidate_length == 0:
+        # no candidate to verify: this is a regular sampling step
+        next_tokens = torch.multinomial(new_probs[::num_branches, 0], num_samples=1)
+        no_candidates = torch.zeros_like(next_tokens.squeeze(1))
+        return next_tokens, no_candidates, no_candidates
+    if candidate_probs is None:
+        candidate_probs = nn.functional.one_hot(candidate_new_tokens, num_classes=vocab_size).to(new_probs.dtype)
+    elif candidate_probs.shape[-1] != vocab_size:
+        # the assistant may have a different number of (unused) embeddings
+        candidate_probs = candidate_probs[..., :vocab_size]
+        candidate_probs = nn.functional.pad(candidate_probs, (0, vocab_size - candidate_probs.shape[-1]))
+
+    candidate_new_tokens = candidate_new_tokens.view(-1, num_branches, candidate_length)
+    candidate_probs = candidate_probs.view(-1, num_branches, candidate_length, vocab_size)
+    new_probs = new_probs.view(-1, num_branches, candidate_length + 1, vocab_size)
+    batch_size = candidate_new_tokens.shape[0]
+    batch_idx = torch.arange(batch_size, device=candidate_new_tokens.device)
+
+    def _residual(probs, candidate_probs):
+        residual = (probs - candidate_probs).clamp(min=0)
+        residual_mass = residual.sum(dim=-1, keepdim=True)
+        # `p <= q` everywhere only happens when `p == q`, in which case the candidate is always accepted
+        return torch.where(residual_mass > 0, residual / residual_mass.clamp(min=1e-12), probs)
+
+    # 1. the first tokens of the branches all follow the same distribution of the model
+    first_probs = new_probs[:, 0, 0]
+    is_first_accepted = torch.zeros(batch_size, dtype=torch.bool, device=batch_idx.device)
+    selected_branches = torch.zeros_like(batch_idx)
+    for branch in range(num_branches):
+        tokens = candidate_new_tokens[:, branch, 0:1]
+        token_candidate_probs = candidate_probs[:, branch, 0]
+        p = first_probs.gather(-1, tokens).squeeze(-1)
+        q = token_candidate_probs.gather(-1, tokens).squeeze(-1)
+        is_accepted = ~is_first_accepted & (torch.rand_like(q) * q < p)
+        selected_branches = selected_branches.masked_fill(is_accepted, branch)
+        is_first_accepted |= is_accepted
+        first_probs = torch.where(
+            is_first_accepted[:, None], first_probs, _residual(first_probs, token_candidate_probs)
+        )
+
+    # 2. the next candidates of the selected branch
+    tokens = candidate_new_tokens[batch_idx, selected_branches]
+    token_candidate_probs = candidate_probs[batch_idx, selected_branches]
+    token_probs = new_probs[batch_idx, selected_branches]
+    p = token_probs[:, :-1].gather(-1, tokens[:, :, None]).squeeze(-1)
+    q = token_candidate_probs.gather(-1, tokens[:, :, None]).squeeze(-1)
+    is_accepted = torch.rand_like(q) * q < p
+    is_accepted[:, 0] = is_first_accepted
+    num_accepted = ((~is_accepted).cumsum(dim=-1) < 1).sum(dim=-1)
+
+    # 3. the token after the accepted candidates is sampled from the residual distribution of the first rejected
+    # candidate, or from the distribution of the model if all the candidates were accepted
+    next_probs = token_probs[batch_idx, num_accepted]
+    rejected_candidate_probs = token_candidate_probs[batch_idx, num_accepted.clamp(max=candidate_length - 1)]
+    next_probs = torch.where(
+        (num_accepted < candidate_length)[:, None], _residual(next_probs, rejected_candidate_probs), next_probs
+    )
+    next_probs = torch.where((num_accepted == 0)[:, None], first_probs, next_probs)
+    next_tokens = torch.multinomial(next_probs, num_samples=1).squeeze(1)
+
+    selected_tokens = torch.cat([tokens, tokens.new_zeros((batch_size, 1))], dim=-1)
+    selected_tokens[batch_idx, num_accepted] = next_tokens
+    return selected_tokens, num_accepted, selected_branches
 
 
 def _split_model_outputs(outputs, new_outputs, cur_len, added_len, is_decoder_attention=False):
@@ -4745,23 +5478,131 @@ def top_k_top_p_filtering(
 
 
 def _ranking_fast(
-    context_hidden: torch.FloatTensor,
-    next_hidden: torch.FloatTensor,
+    norm_context_hidden: torch.FloatTensor,
+    norm_next_hidden: torch.FloatTensor,
     next_top_k_probs: torch.FloatTensor,
     alpha: float,
-    beam_width: int,
 ) -> torch.FloatTensor:
     """
     Reranks the top_k candidates based on a degeneration penalty (cosine similarity with previous tokens), as described
     in the paper "A Contrastive Framework for Neural Text Generation". Returns the index of the best candidate for each
-    row in the batch.
+    row in the batch. Both the `[B, S, D]` hidden states of the previous tokens and the `[B, K, D]` hidden states of
+    the candidates are expected to be normalized, and the previous tokens are shared by the `K` candidates instead of
+    being replicated for each of them.
     """
-    norm_context_hidden = context_hidden / context_hidden.norm(dim=2, keepdim=True)
-    norm_next_hidden = next_hidden / next_hidden.norm(dim=2, keepdim=True)
-    cosine_matrix = torch.matmul(norm_context_hidden, norm_next_hidden.transpose(1, 2)).squeeze(-1)  # [B*K, S]
-    degeneration_penalty, _ = torch.max(cosine_matrix, dim=-1)  # [B*K]
-    next_top_k_probs = next_top_k_probs.view(-1)  # [B*K]
-    contrastive_score = (1.0 - alpha) * next_top_k_probs - alpha * degeneration_penalty
-    contrastive_score = torch.stack(torch.split(contrastive_score, beam_width))  # [B, K]
+    cosine_matrix = torch.bmm(norm_next_hidden, norm_context_hidden.transpose(1, 2))  # [B, K, S]
+    degeneration_penalty, _ = torch.max(cosine_matrix, dim=-1)  # [B, K]
+    contrastive_score = (1.0 - alpha) * next_top_k_probs - alpha * degeneration_penalty  # [B, K]
     _, selected_idx = contrastive_score.max(dim=-1)  # [B]
     return selected_idx
+
+
+def _get_new_past_states(past_key_values, new_past_key_values):
+    """
+    Returns a copy of the key/value states that each tensor of `new_past_key_values` holds beyond the matching tensor
+    of `past_key_values`, as a `(dim, states)` pair where `dim` is the dimension the states were appended to, or `None`
+    for the tensors that didn't grow (like the cross-attention states of encoder-decoder models). The copy lets the
+    full `new_past_key_values` be freed.
+    """
+    new_states = []
+    for layer, new_layer in zip(past_key_values, new_past_key_values):
+        layer_states = []
+        for item, new_item in zip(layer, new_layer):
+            grown_dims = [dim for dim in range(item.dim()) if new_item.shape[dim] != item.shape[dim]]
+            if len(grown_dims) == 0:
+                layer_states.append(None)
+                continue
+            dim = grown_dims[0]
+            states = new_item.narrow(dim, item.shape[dim], new_item.shape[dim] - item.shape[dim])
+            layer_states.append((dim, states.clone(memory_format=torch.contiguous_format)))
+        new_states.append(layer_states)
+    return new_states
+
+
+def _append_selected_past_states(past_key_values, candidate_past_states, selected_idx):
+    """
+    Appends to `past_key_values` the key/value states of the candidate selected for each row, given the states of all
+    the candidates as returned by `_get_new_past_states`.
+    """
+    batch_size = len(selected_idx)
+    new_past_key_values = ()
+    for layer_idx, layer in enumerate(past_key_values):
+        items = ()
+        for item_idx, item in enumerate(layer):
+            if candidate_past_states[0][layer_idx][item_idx] is None:
+                items += (item,)
+                continue
+            dim = candidate_past_states[0][layer_idx][item_idx][0]
+            states = torch.stack([states[layer_idx][item_idx][1] for states in candidate_past_states], dim=1)
+            items += (torch.cat([item, states[range(batch_size), selected_idx]], dim=dim),)
+        new_past_key_values += (items,)
+    return new_past_key_values
+
+
+_UINT32_MASK = 0xFFFFFFFF
+
+
+def _mul_uint32(x: torch.LongTensor, constant: int) -> torch.LongTensor:
+    """Multiplies the uint32 values held by the int64 tensor `x` by `constant`, modulo 2**32, without overflowing."""
+    low = x * (constant & 0xFFFF)
+    high = ((x * (constant >> 16)) & 0xFFFF) << 16
+    return (low + high) & _UINT32_MASK
+
+
+def _hash_uint32(x: torch.LongTensor) -> torch.LongTensor:
+    """The `lowbias32` integer hash of the uint32 values held by the int64 tensor `x`."""
+    x = x ^ (x >> 16)
+    x = _mul_uint32(x, 0x7FEB352D)
+    x = x ^ (x >> 15)
+    x = _mul_uint32(x, 0x846CA68B)
+    return x ^ (x >> 16)
+
+
+def _get_sequence_seeds(
+    sequence_seeds: Union[int, List[int], torch.LongTensor],
+    batch_size: int,
+    num_return_sequences: int,
+    device: torch.device,
+) -> torch.LongTensor:
+    """
+    Returns the `(batch_size * num_return_sequences,)` seeds of the sequences generated for the `sequence_seeds` passed
+    to `generate`. The first sequence of each prompt keeps its seed, the other ones get seeds derived from it.
+    """
+    seeds = torch.as_tensor(sequence_seeds, dtype=torch.long).to(device)
+    if seeds.dim() == 0:
+        seeds = seeds.expand(batch_size)
+    if seeds.shape != (batch_size,):
+        raise ValueError(
+            f"`sequence_seeds` should be an int or hold one seed per sequence of the batch ({batch_size}), but has "
+            f"shape {tuple(seeds.shape)}."
+        )
+    if num_return_sequences > 1:
+        copy_idx = torch.arange(num_return_sequences, device=device).repeat(batch_size)
+        seeds = seeds.repeat_interleave(num_return_sequences) ^ ((_hash_uint32(copy_idx) & 0x7FFFFFFF) << 32)
+    return seeds
+
+
+def _counter_based_uniform(seeds: torch.LongTensor, counter: int, num_samples: int) -> torch.FloatTensor:
+    """
+    Returns `(len(seeds), num_samples)` uniform samples in (0, 1). Each sample is a hash of the seed of its row, of
+    `counter` and of its column, so a row only depends on its seed and not on the other rows of the batch.
+    """
+    row_keys = _hash_uint32(_hash_uint32(seeds & _UINT32_MASK) ^ ((seeds >> 32) & _UINT32_MASK))
+    row_keys = _hash_uint32(row_keys ^ (counter & _UINT32_MASK))
+    column_keys = _hash_uint32(torch.arange(num_samples, dtype=torch.long, device=seeds.device))
+    bits = _hash_uint32(row_keys[:, None] ^ column_keys[None, :])
+    # the 24 high bits fit the mantissa of a float32
+    return ((bits >> 8).float() + 0.5) / 2**24
+
+
+def _sample_with_seeds(
+    scores: torch.FloatTensor, seeds: torch.LongTensor, counter: int, num_samples: int = 1
+) -> torch.LongTensor:
+    """
+    Draws `num_samples` tokens without replacement from `softmax(scores)` for each row, with the Gumbel-max trick on
+    the counter-based random stream of each row (see `_counter_based_uniform`). This is a vectorized alternative to
+    `torch.multinomial` whose draws don't depend on the other rows of the batch.
+    """
+    uniform = _counter_based_uniform(seeds, counter, scores.shape[-1])
+    gumbel_noise = -torch.log(-torch.log(uniform))
+    return torch.topk(scores.float() + gumbel_noise, num_samples, dim=-1).indices
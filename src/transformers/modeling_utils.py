@@ -1076,6 +1076,11 @@ class PreTrainedModel(nn.Module, ModuleUtilsMixin, GenerationMixin, PushToHubMix
     is_parallelizable = False
     supports_gradient_checkpointing = False
 
+    # whether the model accepts a `Cache` instance (see `cache_utils.py`) as `past_key_values`
+    _supports_cache_class = False
+    # whether the model accepts a `SinkCache`, which requires rotating the cached keys at each forward pass
+    _supports_sink_cache = False
+
     @property
     def dummy_inputs(self) -> Dict[str, torch.Tensor]:
         """
@@ -25,6 +25,7 @@ from torch import nn
 from torch.cuda.amp import autocast
 
 from ...activations import ACT2FN
+from ...cache_utils import Cache
 from ...modeling_outputs import BaseModelOutputWithPastAndCrossAttentions
 from ...modeling_utils import PreTrainedModel
 from ...pytorch_utils import Conv1D, find_pruneable_heads_and_indices, prune_conv1d_layer
@@ -302,15 +303,20 @@ class DecisionTransformerGPT2Attention(nn.Module):
         key = self._split_heads(key, self.num_heads, self.head_dim)
         value = self._split_heads(value, self.num_heads, self.head_dim)
 
-        if layer_past is not None:
+        if isinstance(layer_past, Cache):
+            # the cache is updated in place and returns the states of all the tokens seen so far
+            key, value = layer_past.update(key, value, self.layer_idx)
+        elif layer_past is not None:
             past_key, past_value = layer_past
             key = torch.cat((past_key, key), dim=-2)
             value = torch.cat((past_value, value), dim=-2)
 
-        if use_cache is True:
-            present = (key, value)
-        else:
+        if use_cache is not True:
             present = None
+        elif isinstance(layer_past, Cache):
+            present = layer_past
+        else:
+            present = (key, value)
 
         if self.reorder_and_upcast_attn:
             attn_output, attn_weights = self._upcast_and_reordered_attn(query, key, value, attention_mask, head_mask)
@@ -546,9 +552,14 @@ class DecisionTransformerGPT2Model(DecisionTransformerGPT2PreTrainedModel):
         if position_ids is not None:
             position_ids = position_ids.view(-1, input_shape[-1])
 
+        cache = past_key_values if isinstance(past_key_values, Cache) else None
         if past_key_values is None:
             past_length = 0
             past_key_values = tuple([None] * len(self.h))
+        elif cache is not None:
+            past_length = cache.get_seq_length()
+            # a cache object is shared by all the blocks, each of them updating its own entry
+            past_key_values = tuple([cache] * len(self.h))
         else:
             past_length = past_key_values[0][0].size(-2)
         if position_ids is None:
@@ -621,7 +632,7 @@ class DecisionTransformerGPT2Model(DecisionTransformerGPT2PreTrainedModel):
             if self.model_parallel:
                 torch.cuda.set_device(hidden_states.device)
                 # Ensure layer_past is on same device as hidden_states (might not be correct)
-                if layer_past is not None:
+                if layer_past is not None and cache is None:
                     layer_past = tuple(past_state.to(hidden_states.device) for past_state in layer_past)
                 # Ensure that attention_mask is always on the same device as hidden_states
                 if attention_mask is not None:
@@ -683,6 +694,9 @@ class DecisionTransformerGPT2Model(DecisionTransformerGPT2PreTrainedModel):
         if output_hidden_states:
             all_hidden_states = all_hidden_states + (hidden_states,)
 
+        if use_cache is True and cache is not None:
+            presents = cache
+
         if not return_dict:
             return tuple(
                 v
@@ -23,6 +23,7 @@ from torch import nn
 from torch.nn import BCEWithLogitsLoss, CrossEntropyLoss, LayerNorm, MSELoss
 from torch.nn import functional as F
 
+from ...cache_utils import Cache, SinkCache
 from ...modeling_outputs import (
     BaseModelOutputWithPastAndCrossAttentions,
     CausalLMOutputWithCrossAttentions,
@@ -188,8 +189,9 @@ def dropout_add(x: torch.Tensor, residual: torch.Tensor, prob: float, training:
 
 
 class FalconAttention(nn.Module):
-    def __init__(self, config: FalconConfig):
+    def __init__(self, config: FalconConfig, layer_idx: Optional[int] = None):
         super().__init__()
+        self.layer_idx = layer_idx
 
         self.hidden_size = config.hidden_size
         self.num_heads = config.num_attention_heads
@@ -303,20 +305,46 @@ class FalconAttention(nn.Module):
         )
         value_layer = value_layer.transpose(1, 2).reshape(batch_size * num_kv_heads, query_length, self.head_dim)
 
-        past_kv_length = 0 if layer_past is None else layer_past[0].shape[1]
-        query_layer, key_layer = self.maybe_rotary(query_layer, key_layer, past_kv_length)
-
-        if layer_past is not None:
-            past_key, past_value = layer_past
-            # concatenate along seq_length dimension:
-            #  - key: [batch_size * self.num_heads, kv_length, head_dim]
-            #  - value: [batch_size * self.num_heads, kv_length, head_dim]
-            key_layer = torch.cat((past_key, key_layer), dim=1)
-            value_layer = torch.cat((past_value, value_layer), dim=1)
+        if isinstance(layer_past, SinkCache):
+            # the keys are cached before the rotary embedding, and all of them are rotated at their index within the
+            # cache, in the standard [batch_size, num_kv_heads, kv_length, head_dim] format
+            key_layer, value_layer = layer_past.update(
+                key_layer.view(batch_size, num_kv_heads, query_length, self.head_dim),
+                value_layer.view(batch_size, num_kv_heads, query_length, self.head_dim),
+                self.layer_idx,
+            )
+            key_layer = key_layer.reshape(batch_size * num_kv_heads, -1, self.head_dim)
+            value_layer = value_layer.reshape(batch_size * num_kv_heads, -1, self.head_dim)
+            query_layer, _ = self.maybe_rotary(query_layer, query_layer, key_layer.shape[1] - query_length)
+            key_layer, _ = self.maybe_rotary(key_layer, key_layer, 0)
+        else:
+            if isinstance(layer_past, Cache):
+                past_kv_length = layer_past.get_seq_length(self.layer_idx)
+            else:
+                past_kv_length = 0 if layer_past is None else layer_past[0].shape[1]
+            query_layer, key_layer = self.maybe_rotary(query_layer, key_layer, past_kv_length)
+
+            if isinstance(layer_past, Cache):
+                # the cache is updated in place and returns the states of all the tokens seen so far, in the standard
+                # [batch_size, num_kv_heads, kv_length, head_dim] format
+                key_layer, value_layer = layer_past.update(
+                    key_layer.view(batch_size, num_kv_heads, query_length, self.head_dim),
+                    value_layer.view(batch_size, num_kv_heads, query_length, self.head_dim),
+                    self.layer_idx,
+                )
+                key_layer = key_layer.reshape(batch_size * num_kv_heads, -1, self.head_dim)
+                value_layer = value_layer.reshape(batch_size * num_kv_heads, -1, self.head_dim)
+            elif layer_past is not None:
+                past_key, past_value = layer_past
+                # concatenate along seq_length dimension:
+                #  - key: [batch_size * self.num_heads, kv_length, head_dim]
+                #  - value: [batch_size * self.num_heads, kv_length, head_dim]
+                key_layer = torch.cat((past_key, key_layer), dim=1)
+                value_layer = torch.cat((past_value, value_layer), dim=1)
 
         _, kv_length, _ = key_layer.shape
         if use_cache:
-            present = (key_layer, value_layer)
+            present = layer_past if isinstance(layer_past, Cache) else (key_layer, value_layer)
         else:
             present = None
 
@@ -412,11 +440,11 @@ class FalconMLP(nn.Module):
 
 
 class FalconDecoderLayer(nn.Module):
-    def __init__(self, config: FalconConfig):
+    def __init__(self, config: FalconConfig, layer_idx: Optional[int] = None):
         super().__init__()
         hidden_size = config.hidden_size
         self.num_heads = config.num_attention_heads
-        self.self_attention = FalconAttention(config)
+        self.self_attention = FalconAttention(config, layer_idx=layer_idx)
         self.mlp = FalconMLP(config)
         self.hidden_dropout = config.hidden_dropout
         self.config = config
@@ -569,6 +597,8 @@ class FalconPreTrainedModel(PreTrainedModel):
     base_model_prefix = "transformer"
     supports_gradient_checkpointing = True
     _no_split_modules = ["FalconDecoderLayer"]
+    _supports_cache_class = True
+    _supports_sink_cache = True
 
     def __init__(self, *inputs, **kwargs):
         super().__init__(*inputs, **kwargs)
@@ -647,7 +677,9 @@ class FalconModel(FalconPreTrainedModel):
         self.word_embeddings = nn.Embedding(config.vocab_size, self.embed_dim)
 
         # Transformer blocks
-        self.h = nn.ModuleList([FalconDecoderLayer(config) for _ in range(config.num_hidden_layers)])
+        self.h = nn.ModuleList(
+            [FalconDecoderLayer(config, layer_idx=layer_idx) for layer_idx in range(config.num_hidden_layers)]
+        )
 
         # Final Layer Norm
         self.ln_f = LayerNorm(self.embed_dim, eps=config.layer_norm_epsilon)
@@ -728,8 +760,13 @@ class FalconModel(FalconPreTrainedModel):
         else:
             raise ValueError("You have to specify either input_ids or inputs_embeds")
 
+        cache = None
         if past_key_values is None:
             past_key_values = tuple([None] * len(self.h))
+        elif isinstance(past_key_values, Cache):
+            # a cache object is shared by all the layers, each of them updating its own entry
+            cache = past_key_values
+            past_key_values = tuple([cache] * len(self.h))
         else:
             past_key_values = self._convert_to_rw_cache(past_key_values)
 
@@ -750,12 +787,18 @@ class FalconModel(FalconPreTrainedModel):
 
         # Compute alibi tensor: check build_alibi_tensor documentation
         past_key_values_length = 0
-        if past_key_values[0] is not None:
+        if cache is not None:
+            past_key_values_length = cache.get_seq_length()
+        elif past_key_values[0] is not None:
             past_key_values_length = past_key_values[0][0].shape[1]  # 1 because RW-cache, not standard format
         if attention_mask is None:
             attention_mask = torch.ones((batch_size, seq_length + past_key_values_length), device=hidden_states.device)
         else:
             attention_mask = attention_mask.to(hidden_states.device)
+        if isinstance(cache, SinkCache):
+            if self.use_alibi:
+                raise ValueError("`SinkCache` requires rotary embeddings, and does not support models using alibi.")
+            attention_mask = cache.select_attention_mask(attention_mask, seq_length)
 
         if self.use_alibi:
             alibi = build_alibi_tensor(attention_mask, self.num_heads, dtype=hidden_states.dtype)
@@ -818,7 +861,10 @@ class FalconModel(FalconPreTrainedModel):
             all_hidden_states = all_hidden_states + (hidden_states,)
 
         if presents is not None:
-            presents = self._convert_cache_to_standard_format(presents, batch_size)
+            if cache is not None:
+                presents = cache
+            else:
+                presents = self._convert_cache_to_standard_format(presents, batch_size)
 
         if not return_dict:
             return tuple(v for v in [hidden_states, presents, all_hidden_states, all_self_attentions] if v is not None)
@@ -859,7 +905,7 @@ class FalconForCausalLM(FalconPreTrainedModel):
         attention_mask: Optional[torch.Tensor] = None,
         **kwargs,
     ) -> dict:
-        if past_key_values is not None:
+        if past_key_values:
             input_ids = input_ids[:, -1:]
 
         return {
@@ -22,6 +22,7 @@ from torch import nn
 from torch.nn import BCEWithLogitsLoss, CrossEntropyLoss, MSELoss
 
 from ...activations import ACT2FN
+from ...cache_utils import Cache, SinkCache
 from ...file_utils import (
     add_code_sample_docstrings,
     add_start_docstrings,
@@ -63,6 +64,8 @@ class GPTNeoXPreTrainedModel(PreTrainedModel):
     supports_gradient_checkpointing = True
     _no_split_modules = ["GPTNeoXLayer"]
     _skip_keys_device_placement = "past_key_values"
+    _supports_cache_class = True
+    _supports_sink_cache = True
 
     def _init_weights(self, module):
         """Initialize the weights"""
@@ -84,9 +87,10 @@ class GPTNeoXPreTrainedModel(PreTrainedModel):
 
 
 class GPTNeoXAttention(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, layer_idx=None):
         super().__init__()
         self.config = config
+        self.layer_idx = layer_idx
         self.num_attention_heads = config.num_attention_heads
         self.hidden_size = config.hidden_size
         if self.hidden_size % self.num_attention_heads != 0:
@@ -172,28 +176,55 @@ class GPTNeoXAttention(nn.Module):
         key = qkv[..., self.head_size : 2 * self.head_size].permute(0, 2, 1, 3)
         value = qkv[..., 2 * self.head_size :].permute(0, 2, 1, 3)
 
-        # Compute rotary embeddings on rotary_ndims
-        query_rot = query[..., : self.rotary_ndims]
-        query_pass = query[..., self.rotary_ndims :]
-        key_rot = key[..., : self.rotary_ndims]
-        key_pass = key[..., self.rotary_ndims :]
-
-        # Compute token offset for rotary embeddings (when decoding)
-        seq_len = key.shape[-2]
-        if has_layer_past:
-            seq_len += layer_past[0].shape[-2]
-        cos, sin = self.rotary_emb(value, seq_len=seq_len)
-        query, key = apply_rotary_pos_emb(query_rot, key_rot, cos, sin, position_ids)
-        query = torch.cat((query, query_pass), dim=-1)
-        key = torch.cat((key, key_pass), dim=-1)
-
-        # Cache QKV values
-        if has_layer_past:
-            past_key = layer_past[0]
-            past_value = layer_past[1]
-            key = torch.cat((past_key, key), dim=-2)
-            value = torch.cat((past_value, value), dim=-2)
-        present = (key, value) if use_cache else None
+        if isinstance(layer_past, SinkCache):
+            # the keys are cached before the rotary embedding: all of them are rotated at their position within the
+            # cache, and `position_ids` holds the positions of the cached tokens followed by the new ones
+            query_length = query.shape[-2]
+            key, value = layer_past.update(key, value, self.layer_idx)
+            present = layer_past if use_cache else None
+            cos, sin = self.rotary_emb(value, seq_len=key.shape[-2])
+            query_rot, _ = apply_rotary_pos_emb(
+                query[..., : self.rotary_ndims],
+                query[..., : self.rotary_ndims],
+                cos,
+                sin,
+                position_ids[:, -query_length:],
+            )
+            key_rot, _ = apply_rotary_pos_emb(
+                key[..., : self.rotary_ndims], key[..., : self.rotary_ndims], cos, sin, position_ids
+            )
+            query = torch.cat((query_rot, query[..., self.rotary_ndims :]), dim=-1)
+            key = torch.cat((key_rot, key[..., self.rotary_ndims :]), dim=-1)
+        else:
+            # Compute rotary embeddings on rotary_ndims
+            query_rot = query[..., : self.rotary_ndims]
+            query_pass = query[..., self.rotary_ndims :]
+            key_rot = key[..., : self.rotary_ndims]
+            key_pass = key[..., self.rotary_ndims :]
+
+            # Compute token offset for rotary embeddings (when decoding)
+            seq_len = key.shape[-2]
+            if isinstance(layer_past, Cache):
+                seq_len += layer_past.get_seq_length(self.layer_idx)
+            elif has_layer_past:
+                seq_len += layer_past[0].shape[-2]
+            cos, sin = self.rotary_emb(value, seq_len=seq_len)
+            query, key = apply_rotary_pos_emb(query_rot, key_rot, cos, sin, position_ids)
+            query = torch.cat((query, query_pass), dim=-1)
+            key = torch.cat((key, key_pass), dim=-1)
+
+            # Cache QKV values
+            if isinstance(layer_past, Cache):
+                # the cache is updated in place and returns the states of all the tokens seen so far
+                key, value = layer_past.update(key, value, self.layer_idx)
+                present = layer_past if use_cache else None
+            else:
+                if has_layer_past:
+                    past_key = layer_past[0]
+                    past_value = layer_past[1]
+                    key = torch.cat((past_key, key), dim=-2)
+                    value = torch.cat((past_value, value), dim=-2)
+                present = (key, value) if use_cache else None
 
         # Compute attention
         attn_output, attn_weights = self._attn(query, key, value, attention_mask, head_mask)
@@ -397,14 +428,14 @@ class GPTNeoXMLP(nn.Module):
 
 
 class GPTNeoXLayer(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, layer_idx=None):
         super().__init__()
         self.use_parallel_residual = config.use_parallel_residual
         self.input_layernorm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
         self.post_attention_layernorm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
         self.post_attention_dropout = nn.Dropout(config.hidden_dropout)
         self.post_mlp_dropout = nn.Dropout(config.hidden_dropout)
-        self.attention = GPTNeoXAttention(config)
+        self.attention = GPTNeoXAttention(config, layer_idx=layer_idx)
         self.mlp = GPTNeoXMLP(config)
 
     def forward(
@@ -517,7 +548,9 @@ class GPTNeoXModel(GPTNeoXPreTrainedModel):
 
         self.embed_in = nn.Embedding(config.vocab_size, config.hidden_size)
         self.emb_dropout = nn.Dropout(config.hidden_dropout)
-        self.layers = nn.ModuleList([GPTNeoXLayer(config) for _ in range(config.num_hidden_layers)])
+        self.layers = nn.ModuleList(
+            [GPTNeoXLayer(config, layer_idx=layer_idx) for layer_idx in range(config.num_hidden_layers)]
+        )
         self.final_layer_norm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
 
         self.gradient_checkpointing = False
@@ -579,13 +612,28 @@ class GPTNeoXModel(GPTNeoXPreTrainedModel):
 
         batch_size, seq_length = input_shape
 
+        cache = None
         if past_key_values is None:
             past_length = 0
             past_key_values = tuple([None] * self.config.num_hidden_layers)
+        elif isinstance(past_key_values, Cache):
+            past_length = past_key_values.get_seq_length()
+            # a cache object is shared by all the layers, each of them updating its own entry
+            cache = past_key_values
+            past_key_values = tuple([cache] * self.config.num_hidden_layers)
         else:
             past_length = past_key_values[0][0].size(-2)
 
-        if position_ids is None:
+        if isinstance(cache, SinkCache):
+            # the positions are the ones within the cache, for the cached tokens followed by the new ones
+            if attention_mask is None:
+                device = input_ids.device if input_ids is not None else inputs_embeds.device
+                attention_mask = torch.ones((batch_size, past_length + seq_length), dtype=torch.bool, device=device)
+            else:
+                attention_mask = cache.select_attention_mask(attention_mask.view(batch_size, -1), seq_length)
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+        elif position_ids is None:
             device = input_ids.device if input_ids is not None else inputs_embeds.device
             position_ids = torch.arange(past_length, seq_length + past_length, dtype=torch.long, device=device)
             position_ids = position_ids.unsqueeze(0).view(-1, seq_length)
@@ -674,6 +722,9 @@ class GPTNeoXModel(GPTNeoXPreTrainedModel):
         if output_hidden_states:
             all_hidden_states = all_hidden_states + (hidden_states,)
 
+        if use_cache and cache is not None:
+            presents = cache
+
         if not return_dict:
             return tuple(v for v in [hidden_states, presents, all_hidden_states, all_attentions] if v is not None)
 
@@ -807,7 +858,7 @@ class GPTNeoXForCausalLM(GPTNeoXPreTrainedModel):
         input_shape = input_ids.shape
 
         # cut decoder_input_ids if past is used
-        if past_key_values and past_key_values[0] is not None:
+        if past_key_values and (isinstance(past_key_values, Cache) or past_key_values[0] is not None):
             input_ids = input_ids[:, -1:]
 
         position_ids = kwargs.get("position_ids", None)
@@ -823,7 +874,7 @@ class GPTNeoXForCausalLM(GPTNeoXPreTrainedModel):
             attention_mask = input_ids.new_ones(input_shape)
 
         # if `inputs_embeds` are passed, we only want to use them in the 1st generation step
-        if inputs_embeds is not None and past_key_values is None:
+        if inputs_embeds is not None and not past_key_values:
             model_inputs = {"inputs_embeds": inputs_embeds}
         else:
             model_inputs = {"input_ids": input_ids}
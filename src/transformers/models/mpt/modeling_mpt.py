@@ -23,6 +23,7 @@ from torch import nn
 from torch.nn import BCEWithLogitsLoss, CrossEntropyLoss, LayerNorm, MSELoss
 from torch.nn import functional as F
 
+from ...cache_utils import Cache
 from ...file_utils import add_code_sample_docstrings, add_start_docstrings, add_start_docstrings_to_model_forward
 from ...modeling_outputs import (
     BaseModelOutputWithPastAndCrossAttentions,
@@ -115,8 +116,9 @@ class MptAttention(nn.Module):
     Using torch or triton attention implemetation enables user to also use additive bias.
     """
 
-    def __init__(self, config: MptConfig):
+    def __init__(self, config: MptConfig, layer_idx: Optional[int] = None):
         super().__init__()
+        self.layer_idx = layer_idx
         self.hidden_size = config.hidden_size
         self.n_heads = config.n_heads
         self.max_seq_length = config.max_seq_len
@@ -144,7 +146,10 @@ class MptAttention(nn.Module):
         key_states = key_states.reshape(batch_size, seq_length, self.n_heads, self.head_dim).transpose(1, 2)
         value_states = value_states.reshape(batch_size, seq_length, self.n_heads, self.head_dim).transpose(1, 2)
 
-        if past_key_value is not None:
+        if isinstance(past_key_value, Cache):
+            # the cache is updated in place and returns the states of all the tokens seen so far
+            key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx)
+        elif past_key_value is not None:
             if len(past_key_value) != 0:
                 key_states = torch.cat([past_key_value[0], key_states], dim=2)
                 value_states = torch.cat([past_key_value[1], value_states], dim=2)
@@ -156,7 +161,7 @@ class MptAttention(nn.Module):
 
         query_length = seq_length
         if past_key_value is not None:
-            query_length += past_key_value[0].shape[2]
+            query_length += key_states.shape[2]
 
         if position_bias is not None:
             if len(position_bias.shape) != 3:
@@ -206,7 +211,7 @@ class MptMLP(nn.Module):
 
 
 class MptBlock(nn.Module):
-    def __init__(self, config: MptConfig):
+    def __init__(self, config: MptConfig, layer_idx: Optional[int] = None):
         super().__init__()
         hidden_size = config.hidden_size
 
@@ -215,7 +220,7 @@ class MptBlock(nn.Module):
         self.norm_1.bias = None
 
         self.num_heads = config.n_heads
-        self.attn = MptAttention(config)
+        self.attn = MptAttention(config, layer_idx=layer_idx)
 
         self.norm_2 = LayerNorm(hidden_size, eps=config.layer_norm_epsilon)
         # backward compatibility with weights on the Hub
@@ -274,6 +279,7 @@ class MptPreTrainedModel(PreTrainedModel):
     base_model_prefix = "transformer"
     supports_gradient_checkpointing = True
     _no_split_modules = ["MptBlock"]
+    _supports_cache_class = True
     _keys_to_ignore_on_load_missing = [r"lm_head.*."]
 
     def __init__(self, *inputs, **kwargs):
@@ -400,7 +406,7 @@ class MptModel(MptPreTrainedModel):
         self.wte = nn.Embedding(config.vocab_size, self.hidden_size)
 
         # Transformer blocks
-        self.blocks = nn.ModuleList([MptBlock(config) for _ in range(config.n_layers)])
+        self.blocks = nn.ModuleList([MptBlock(config, layer_idx=layer_idx) for layer_idx in range(config.n_layers)])
 
         # Final Layer Norm
         self.norm_f = LayerNorm(self.hidden_size, eps=config.layer_norm_epsilon)
@@ -479,8 +485,13 @@ class MptModel(MptPreTrainedModel):
         else:
             raise ValueError("You have to specify either input_ids or inputs_embeds")
 
+        cache = None
         if past_key_values is None:
             past_key_values = tuple([None] * len(self.blocks))
+        elif isinstance(past_key_values, Cache):
+            # a cache object is shared by all the layers, each of them updating its own entry
+            cache = past_key_values
+            past_key_values = tuple([cache] * len(self.blocks))
 
         if inputs_embeds is None:
             inputs_embeds = self.wte(input_ids)
@@ -501,7 +512,10 @@ class MptModel(MptPreTrainedModel):
         # Compute alibi tensor: check build_alibi_tensor documentation
         seq_length_with_past = seq_length
         past_key_values_length = 0
-        if past_key_values[0] is not None:
+        if cache is not None:
+            past_key_values_length = cache.get_seq_length()
+            seq_length_with_past = seq_length_with_past + past_key_values_length
+        elif past_key_values[0] is not None:
             past_key_values_length = past_key_values[0][0].shape[2]
             seq_length_with_past = seq_length_with_past + past_key_values_length
         if attention_mask is None:
@@ -560,6 +574,9 @@ class MptModel(MptPreTrainedModel):
         if output_hidden_states:
             all_hidden_states = all_hidden_states + (hidden_states,)
 
+        if use_cache and cache is not None:
+            presents = cache
+
         if not return_dict:
             return tuple(v for v in [hidden_states, presents, all_hidden_states, all_self_attentions] if v is not None)
 
@@ -609,7 +626,7 @@ class MptForCausalLM(MptPreTrainedModel):
             input_ids = input_ids[:, -1].unsqueeze(-1)
 
         # if `inputs_embeds` are passed, we only want to use them in the 1st generation step
-        if inputs_embeds is not None and past_key_values is None:
+        if inputs_embeds is not None and not past_key_values:
             model_inputs = {"inputs_embeds": inputs_embeds}
         else:
             model_inputs = {"input_ids": input_ids}
@@ -12,11 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from collections import defaultdict
-from typing import TYPE_CHECKING, Dict, Optional, Union
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, Optional, Tuple, Union
 
 import numpy as np
 import requests
 
+from ..generation.streamers import _IncrementalDetokenizer
 from ..utils import is_torch_available, is_torchaudio_available, logging
 from .audio_utils import ffmpeg_read
 from .base import ChunkPipeline
@@ -26,6 +27,7 @@ if TYPE_CHECKING:
     from pyctcdecode import BeamSearchDecoderCTC
 
     from ..feature_extraction_sequence_utils import SequenceFeatureExtractor
+    from .dynamic_batching import DynamicBatcher
 
 logger = logging.get_logger(__name__)
 
@@ -53,35 +55,91 @@ def rescale_stride(stride, ratio):
     return new_strides
 
 
+def _process_chunk(chunk, feature_extractor, stride_left, stride_right, is_last, rescale=True, dtype=None):
+    processed = feature_extractor(chunk, sampling_rate=feature_extractor.sampling_rate, return_tensors="pt")
+    if dtype is not None:
+        processed = processed.to(dtype=dtype)
+
+    chunk_len = chunk.shape[0]
+    stride = (chunk_len, stride_left, stride_right)
+    if "input_features" in processed:
+        processed_len = processed["input_features"].shape[-1]
+    elif "input_values" in processed:
+        processed_len = processed["input_values"].shape[-1]
+    if processed_len != chunk.shape[-1] and rescale:
+        ratio = processed_len / chunk_len
+        stride = rescale_stride([stride], ratio)[0]
+    return {"is_last": is_last, "stride": stride, **processed}
+
+
 def chunk_iter(inputs, feature_extractor, chunk_len, stride_left, stride_right, rescale=True, dtype=None):
     inputs_len = inputs.shape[0]
     step = chunk_len - stride_left - stride_right
     for chunk_start_idx in range(0, inputs_len, step):
         chunk_end_idx = chunk_start_idx + chunk_len
         chunk = inputs[chunk_start_idx:chunk_end_idx]
-        processed = feature_extractor(chunk, sampling_rate=feature_extractor.sampling_rate, return_tensors="pt")
-        if dtype is not None:
-            processed = processed.to(dtype=dtype)
         _stride_left = 0 if chunk_start_idx == 0 else stride_left
         # all right strides must be full, otherwise it is the last item
         is_last = chunk_end_idx > inputs_len if stride_right > 0 else chunk_end_idx >= inputs_len
         _stride_right = 0 if is_last else stride_right
 
-        chunk_len = chunk.shape[0]
-        stride = (chunk_len, _stride_left, _stride_right)
-        if "input_features" in processed:
-            processed_len = processed["input_features"].shape[-1]
-        elif "input_values" in processed:
-            processed_len = processed["input_values"].shape[-1]
-        if processed_len != chunk.shape[-1] and rescale:
-            ratio = processed_len / chunk_len
-            stride = rescale_stride([stride], ratio)[0]
         if chunk.shape[0] > _stride_left:
-            yield {"is_last": is_last, "stride": stride, **processed}
+            yield _process_chunk(
+                chunk, feature_extractor, _stride_left, _stride_right, is_last, rescale=rescale, dtype=dtype
+            )
         if is_last:
             break
 
 
+class _AudioStreamChunker:
+    """
+    Splits an audio stream received piece by piece in the chunks that `chunk_iter` produces for the whole audio, only
+    keeping the samples of the chunk being filled.
+    """
+
+    def __init__(self, feature_extractor, chunk_len, stride_left, stride_right, rescale=True, dtype=None):
+        if chunk_len <= stride_left + stride_right:
+            raise ValueError("Chunk length must be superior to stride length")
+        self.feature_extractor = feature_extractor
+        self.chunk_len = chunk_len
+        self.stride_left = stride_left
+        self.stride_right = stride_right
+        self.rescale = rescale
+        self.dtype = dtype
+        self.buffer = np.zeros((0,), dtype=np.float32)
+        self.is_first = True
+
+    def add_audio(self, audio):
+        """Adds the next samples of the stream, and returns the chunks they complete."""
+        if not isinstance(audio, np.ndarray):
+            raise ValueError(f"We expect a numpy ndarray as input, got `{type(audio)}`")
+        if len(audio.shape) != 1:
+            raise ValueError("We expect a single channel audio input for AutomaticSpeechRecognitionPipeline")
+        self.buffer = np.concatenate([self.buffer, audio])
+        chunks = []
+        # as in `chunk_iter`, a full chunk is not the last one when the stride on its right is not empty
+        while self.buffer.shape[0] >= self.chunk_len:
+            chunks.append(self._process(self.buffer[: self.chunk_len], self.stride_right, is_last=False))
+            self.buffer = self.buffer[self.chunk_len - self.stride_left - self.stride_right :]
+            self.is_first = False
+        return chunks
+
+    def end(self):
+        """Returns the last chunk of the stream, if its samples are not all in the stride of the previous one."""
+        chunks = []
+        stride_left = 0 if self.is_first else self.stride_left
+        if self.buffer.shape[0] > stride_left:
+            chunks.append(self._process(self.buffer, 0, is_last=True))
+        self.buffer = self.buffer[:0]
+        return chunks
+
+    def _process(self, chunk, stride_right, is_last):
+        stride_left = 0 if self.is_first else self.stride_left
+        return _process_chunk(
+            chunk, self.feature_extractor, stride_left, stride_right, is_last, rescale=self.rescale, dtype=self.dtype
+        )
+
+
 def _fast_find_longest_common_sequence(sequence_left, sequence_right):
     seq_len_left = len(sequence_left)
     seq_len_right = len(sequence_right)
@@ -112,21 +170,82 @@ def _find_longest_common_sequence(sequences, tokenizer):
     sequence = [tok_id for tok_id in sequences[0][0].tolist() if tok_id not in tokenizer.all_special_ids]
     for new_seq in sequences[1:]:
         new_sequence = [tok_id for tok_id in new_seq[0].tolist() if tok_id not in tokenizer.all_special_ids]
-
-        index = 0
-        max_ = 0.0
-        for i in range(1, len(new_sequence) + 1):
-            # epsilon to favor long perfect matches
-            eps = i / 10000.0
-            matches = np.sum(np.array(sequence[-i:]) == np.array(new_sequence[:i]))
-            matching = matches / i + eps
-            if matches > 1 and matching > max_:
-                index = i
-                max_ = matching
+        index = _find_overlap(sequence, new_sequence)
         sequence.extend(new_sequence[index:])
     return np.array(sequence)
 
 
+def _find_overlap(sequence, new_sequence):
+    """
+    Returns the number of tokens at the start of `new_sequence` that best match the end of `sequence`, i.e. the index
+    of the tokens of `new_sequence` to append to `sequence`.
+    """
+    index = 0
+    max_ = 0.0
+    # a longer `new_sequence[:i]` cannot match the end of `sequence` element-wise
+    for i in range(1, min(len(sequence), len(new_sequence)) + 1):
+        # epsilon to favor long perfect matches
+        eps = i / 10000.0
+        matches = np.sum(np.array(sequence[-i:]) == np.array(new_sequence[:i]))
+        matching = matches / i + eps
+        if matches > 1 and matching > max_:
+            index = i
+            max_ = matching
+    return index
+
+
+class _StreamTranscript:
+    """
+    The transcript of an audio stream, updated with the outputs of the model for each of its chunks in turn. Only the
+    tokens needed to merge the outputs of the next chunks are kept.
+
+    For CTC models, the tokens of the strides of the chunks are dropped, as in `postprocess`, and the tokens of the
+    right stride of the last chunk make the partial text. For seq2seq models, the tokens of each chunk are appended
+    after the longest sequence they share with the end of the transcript, as in `_find_longest_common_sequence`.
+    """
+
+    def __init__(self, tokenizer, model_type):
+        self.tokenizer = tokenizer
+        self.is_ctc = model_type == "ctc"
+        self.detokenizer = _IncrementalDetokenizer(tokenizer, skip_special_tokens=not self.is_ctc)
+        self.special_ids = set(tokenizer.all_special_ids)
+        # the last token of the transcript for CTC models, the tokens that the next chunk may overlap otherwise
+        self.last_token = None
+        self.tail = []
+        self.max_chunk_tokens = 0
+
+    def update(self, outputs):
+        tokens = outputs["tokens"][0].tolist()
+        partial_text = ""
+        if self.is_ctc:
+            stride = outputs.get("stride", None)
+            total_n, left, right = stride if stride is not None else (len(tokens), 0, 0)
+            text = self.detokenizer.add_tokens(self._collapse(tokens[left : total_n - right], update=True))
+            partial_text = self.detokenizer.peek(self._collapse(tokens[total_n - right : total_n]))
+        else:
+            sequence = [token for token in tokens if token not in self.special_ids]
+            new_tokens = sequence[_find_overlap(self.tail, sequence) :]
+            self.max_chunk_tokens = max(self.max_chunk_tokens, len(sequence))
+            self.tail = (self.tail + new_tokens)[-self.max_chunk_tokens :]
+            text = self.detokenizer.add_tokens(new_tokens)
+        return {"text": text, "partial_text": partial_text, "is_last": False}
+
+    def end(self):
+        return {"text": self.detokenizer.flush(), "partial_text": "", "is_last": True}
+
+    def _collapse(self, tokens, update=False):
+        # CTC decoding merges the repeated tokens: dropping them keeps the decoded window short during silences
+        collapsed = []
+        last_token = self.last_token
+        for token in tokens:
+            if token != last_token:
+                collapsed.append(token)
+                last_token = token
+        if update:
+            self.last_token = last_token
+        return collapsed
+
+
 class AutomaticSpeechRecognitionPipeline(ChunkPipeline):
     """
     Pipeline that aims at extracting spoken text contained within some audio.
@@ -389,22 +508,7 @@ class AutomaticSpeechRecognitionPipeline(ChunkPipeline):
                     " ignore_warning=True)"
                 )
                 self._preprocess_params["ignore_warning"] = True
-            if stride_length_s is None:
-                stride_length_s = chunk_length_s / 6
-
-            if isinstance(stride_length_s, (int, float)):
-                stride_length_s = [stride_length_s, stride_length_s]
-
-            # XXX: Carefuly, this variable will not exist in `seq2seq` setting.
-            # Currently chunking is not possible at this level for `seq2seq` so
-            # it's ok.
-            align_to = getattr(self.model.config, "inputs_to_logits_ratio", 1)
-            chunk_len = int(round(chunk_length_s * self.feature_extractor.sampling_rate / align_to) * align_to)
-            stride_left = int(round(stride_length_s[0] * self.feature_extractor.sampling_rate / align_to) * align_to)
-            stride_right = int(round(stride_length_s[1] * self.feature_extractor.sampling_rate / align_to) * align_to)
-
-            if chunk_len < stride_left + stride_right:
-                raise ValueError("Chunk length must be superior to stride length")
+            chunk_len, stride_left, stride_right = self._get_chunk_lengths(chunk_length_s, stride_length_s)
 
             rescale = self.type != "seq2seq_whisper"
             # make sure that
@@ -425,6 +529,107 @@ class AutomaticSpeechRecognitionPipeline(ChunkPipeline):
                 processed["stride"] = stride
             yield {"is_last": True, **processed, **extra}
 
+    def _get_chunk_lengths(self, chunk_length_s, stride_length_s=None):
+        """Converts the lengths of the chunks and of their strides to numbers of samples."""
+        if stride_length_s is None:
+            stride_length_s = chunk_length_s / 6
+
+        if isinstance(stride_length_s, (int, float)):
+            stride_length_s = [stride_length_s, stride_length_s]
+
+        # XXX: Carefuly, this variable will not exist in `seq2seq` setting.
+        # Currently chunking is not possible at this level for `seq2seq` so
+        # it's ok.
+        align_to = getattr(self.model.config, "inputs_to_logits_ratio", 1)
+        chunk_len = int(round(chunk_length_s * self.feature_extractor.sampling_rate / align_to) * align_to)
+        stride_left = int(round(stride_length_s[0] * self.feature_extractor.sampling_rate / align_to) * align_to)
+        stride_right = int(round(stride_length_s[1] * self.feature_extractor.sampling_rate / align_to) * align_to)
+
+        if chunk_len < stride_left + stride_right:
+            raise ValueError("Chunk length must be superior to stride length")
+        return chunk_len, stride_left, stride_right
+
+    def transcribe_stream(
+        self,
+        audio_stream: Iterable[np.ndarray],
+        chunk_length_s: float,
+        stride_length_s: Optional[Union[float, Tuple[float, float]]] = None,
+        batcher: Optional["DynamicBatcher"] = None,
+        **kwargs,
+    ) -> Iterator[Dict]:
+        """
+        Transcribes an audio stream received piece by piece, e.g. from a microphone or a socket, and yields the
+        transcript as it goes, for live captioning.
+
+        The audio is split in chunks of `chunk_length_s` seconds overlapping by their strides, as with `chunk_length_s`
+        in `__call__`, but each chunk is transcribed as soon as its audio is received. Only the audio of the chunk
+        being filled and the last tokens of the transcript are kept in memory, so that streams of any length can be
+        transcribed. For CTC models, the transcript is the one of `__call__` with the same `chunk_length_s`. Seq2seq
+        models (including Whisper) merge the transcripts of the chunks where their tokens overlap, as the non-Whisper
+        seq2seq models do in `__call__`.
+
+        Args:
+            audio_stream (iterable of `np.ndarray`):
+                The successive pieces of the audio, of any length, as single channel arrays of shape (n, ) at the
+                sampling rate of the feature extractor (e.g. a generator reading them from a socket).
+            chunk_length_s (`float`):
+                The length of the chunks, in seconds: a transcript is yielded every `chunk_length_s` minus the length
+                of the strides. Whisper models take chunks of up to 30 seconds.
+            stride_length_s (`float` or `Tuple[float, float]`, *optional*, defaults to `chunk_length_s / 6`):
+                The length of the strides on the left and right of each chunk, as in `__call__`.
+            batcher ([`~pipelines.DynamicBatcher`], *optional*):
+                A batcher of this pipeline transcribing the chunks: the chunks of the streams transcribed at the same
+                time with the same batcher (e.g. by the threads serving several clients) share the forward passes of
+                the model. The parameters of the forward passes are then the ones of the batcher.
+            generate_kwargs (`dict`, *optional*):
+                The dictionary of ad-hoc parametrization of `generate_config` to be used for the generation call of
+                seq2seq models.
+            max_new_tokens (`int`, *optional*):
+                The maximum numbers of tokens to generate for each chunk, for seq2seq models.
+
+        Return:
+            A generator of `dict`, with one dictionary per chunk transcribed and a last one once the stream ends, with
+            the following keys:
+                - **text** (`str`) -- The new text of the transcript, which is final. The transcript of the stream is
+                  the concatenation of these texts.
+                - **partial_text** (`str`) -- For CTC models, the text of the rest of the audio received so far, which
+                  is transcribed again with more context by the next chunk and may still change.
+                - **is_last** (`bool`) -- Whether the stream ended.
+        """
+        if self.type not in {"ctc", "seq2seq", "seq2seq_whisper"}:
+            raise ValueError(f"Streaming transcription is not supported by `{self.type}` models.")
+        if kwargs.get("return_timestamps") or kwargs.get("return_language"):
+            raise ValueError("Streaming transcription cannot return timestamps or languages.")
+        if batcher is not None and batcher.pipeline is not self:
+            raise ValueError("`batcher` has to batch the calls to this pipeline.")
+        _, forward_params, _ = self._sanitize_parameters(**kwargs)
+        forward_params = {**self._forward_params, **forward_params}
+
+        chunk_len, stride_left, stride_right = self._get_chunk_lengths(chunk_length_s, stride_length_s)
+        chunker = _AudioStreamChunker(
+            self.feature_extractor,
+            chunk_len,
+            stride_left,
+            stride_right,
+            rescale=self.type != "seq2seq_whisper",
+            dtype=self.torch_dtype,
+        )
+        transcript = _StreamTranscript(self.tokenizer, self.type)
+
+        def transcribe(chunks):
+            if len(chunks) == 0:
+                return []
+            if batcher is not None:
+                return batcher.submit_model_inputs(chunks).result()
+            return [self.forward(chunk, **forward_params) for chunk in chunks]
+
+        for audio in audio_stream:
+            for model_outputs in transcribe(chunker.add_audio(audio)):
+                yield transcript.update(model_outputs)
+        for model_outputs in transcribe(chunker.end()):
+            yield transcript.update(model_outputs)
+        yield transcript.end()
+
     def _forward(self, model_inputs, return_timestamps=False, generate_kwargs=None):
         if generate_kwargs is None:
             generate_kwargs = {}
@@ -12,8 +12,10 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
 import collections
 import csv
+import functools
 import importlib
 import json
 import os
@@ -23,6 +25,7 @@ import types
 import warnings
 from abc import ABC, abstractmethod
 from collections import UserDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import contextmanager
 from os.path import abspath, exists
 from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
@@ -687,6 +690,27 @@ class _ScikitCompat(ABC):
         raise NotImplementedError()
 
 
+# The pipeline of a stage worker process, see `Pipeline._get_stage_executor`
+_stage_worker_pipeline = None
+
+
+def _init_pipeline_stage_worker(pipeline):
+    global _stage_worker_pipeline
+    _stage_worker_pipeline = pipeline
+
+
+def _run_pipeline_stage(pipeline, stage, item, **params):
+    """
+    Runs the `"preprocess"` or `"postprocess"` stage of `pipeline` on `item` in a stage worker, or splits it in chunks
+    for `"preprocess_chunks"`. In worker processes, `pipeline` is `None` and the copy of the process is used.
+    """
+    if pipeline is None:
+        pipeline = _stage_worker_pipeline
+    if stage == "preprocess_chunks":
+        return list(pipeline.preprocess(item, **params))
+    return getattr(pipeline, stage)(item, **params)
+
+
 PIPELINE_INIT_ARGS = r"""
     Arguments:
         model ([`PreTrainedModel`] or [`TFPreTrainedModel`]):
@@ -713,6 +737,21 @@ PIPELINE_INIT_ARGS = r"""
             When the pipeline will use *DataLoader* (when passing a dataset, on GPU for a Pytorch model), the size of
             the batch to use, for inference this is not always beneficial, please read [Batching with
             pipelines](https://huggingface.co/transformers/main_classes/pipelines.html#pipeline-batching) .
+        bucket_window (`int`, *optional*):
+            When the pipeline uses a `batch_size` larger than 1 with a PyTorch model, the number of consecutive inputs
+            that are sorted by length (their number of tokens or of audio samples) before being split in batches, so
+            that inputs of similar lengths are padded together. The outputs are still returned in the order of the
+            inputs. Not supported by pipelines that split their inputs in chunks.
+        stage_workers (`int`, *optional*):
+            When the pipeline iterates over its inputs with a PyTorch model, the number of workers running the
+            preprocessing and the postprocessing of the inputs, so that they overlap with the forward passes of the
+            model (which stay in the main thread) instead of running in turn. The number of inputs submitted to the
+            workers ahead of the model is bounded by twice the largest of `stage_workers` and `batch_size`. This
+            replaces the *DataLoader* workers.
+        stage_executor (`str`, *optional*, defaults to `"thread"`):
+            The pool of the `stage_workers`: `"thread"` for threads, which suits preprocessing that releases the GIL
+            (tokenizers, image decoding, `ffmpeg`), or `"process"` for processes, which suits pure Python processing.
+            The pipeline is sent to each worker process once, when it starts.
         args_parser ([`~pipelines.ArgumentHandler`], *optional*):
             Reference to the object in charge of parsing supplied pipeline parameters.
         device (`int`, *optional*, defaults to -1):
@@ -724,10 +763,13 @@ PIPELINE_INIT_ARGS = r"""
 
 if is_torch_available():
     from transformers.pipelines.pt_utils import (
+        PipelineBucketIterator,
         PipelineChunkIterator,
         PipelineDataset,
         PipelineIterator,
         PipelinePackIterator,
+        PipelineReorderIterator,
+        PipelineStagedIterator,
     )
 
 
@@ -813,6 +855,9 @@ class Pipeline(_ScikitCompat):
         self.call_count = 0
         self._batch_size = kwargs.pop("batch_size", None)
         self._num_workers = kwargs.pop("num_workers", None)
+        self._bucket_window = kwargs.pop("bucket_window", None)
+        self._stage_workers = kwargs.pop("stage_workers", None)
+        self._stage_executor = kwargs.pop("stage_executor", None)
         self._preprocess_params, self._forward_params, self._postprocess_params = self._sanitize_parameters(**kwargs)
 
         if self.image_processor is None and self.feature_extractor is not None:
@@ -1037,10 +1082,35 @@ class Pipeline(_ScikitCompat):
                 raise ValueError(f"Framework {self.framework} is not supported")
         return model_outputs
 
+    def _get_collate_fn(self, batch_size: int):
+        """
+        Returns the function collating `batch_size` preprocessed items into the inputs of a single forward pass.
+        """
+        # TODO hack by collating feature_extractor and image_processor
+        feature_extractor = self.feature_extractor if self.feature_extractor is not None else self.image_processor
+        return no_collate_fn if batch_size == 1 else pad_collate_fn(self.tokenizer, feature_extractor)
+
     def get_iterator(
-        self, inputs, num_workers: int, batch_size: int, preprocess_params, forward_params, postprocess_params
+        self,
+        inputs,
+        num_workers: int,
+        batch_size: int,
+        preprocess_params,
+        forward_params,
+        postprocess_params,
+        bucket_window: Optional[int] = None,
+        stage_workers: Optional[int] = None,
+        stage_executor: Optional[str] = None,
     ):
-        if isinstance(inputs, collections.abc.Sized):
+        executor = None
+        if stage_workers:
+            executor, stage_pipeline = self._get_stage_executor(stage_workers, stage_executor)
+            max_pending = 2 * max(stage_workers, batch_size)
+            # the inputs are preprocessed by the stage workers, ahead of the forward passes
+            preprocess = functools.partial(_run_pipeline_stage, stage_pipeline, "preprocess")
+            dataset = PipelineStagedIterator(inputs, preprocess, preprocess_params, executor, max_pending)
+            num_workers = 0
+        elif isinstance(inputs, collections.abc.Sized):
             dataset = PipelineDataset(inputs, self.preprocess, preprocess_params)
         else:
             if num_workers > 1:
@@ -1054,15 +1124,56 @@ class Pipeline(_ScikitCompat):
         if "TOKENIZERS_PARALLELISM" not in os.environ:
             logger.info("Disabling tokenizer parallelism, we're using DataLoader multithreading already")
             os.environ["TOKENIZERS_PARALLELISM"] = "false"
-        # TODO hack by collating feature_extractor and image_processor
-        feature_extractor = self.feature_extractor if self.feature_extractor is not None else self.image_processor
-        collate_fn = no_collate_fn if batch_size == 1 else pad_collate_fn(self.tokenizer, feature_extractor)
-        dataloader = DataLoader(dataset, num_workers=num_workers, batch_size=batch_size, collate_fn=collate_fn)
-        model_iterator = PipelineIterator(dataloader, self.forward, forward_params, loader_batch_size=batch_size)
-        final_iterator = PipelineIterator(model_iterator, self.postprocess, postprocess_params)
+        collate_fn = self._get_collate_fn(batch_size)
+        bucket_iterator = None
+        if bucket_window is not None and batch_size > 1:
+            # preprocess the items one at a time, and batch them by length in the main process
+            dataloader = DataLoader(dataset, num_workers=num_workers, batch_size=1, collate_fn=no_collate_fn)
+            bucket_iterator = PipelineBucketIterator(dataloader, collate_fn, batch_size, bucket_window)
+            model_iterator = PipelineIterator(
+                bucket_iterator, self.forward, forward_params, loader_batch_size=batch_size
+            )
+        else:
+            dataloader = DataLoader(dataset, num_workers=num_workers, batch_size=batch_size, collate_fn=collate_fn)
+            model_iterator = PipelineIterator(dataloader, self.forward, forward_params, loader_batch_size=batch_size)
+        if executor is not None:
+            postprocess = functools.partial(_run_pipeline_stage, stage_pipeline, "postprocess")
+            final_iterator = PipelineStagedIterator(
+                model_iterator, postprocess, postprocess_params, executor, max_pending, shutdown_executor=True
+            )
+        else:
+            final_iterator = PipelineIterator(model_iterator, self.postprocess, postprocess_params)
+        if bucket_iterator is not None:
+            final_iterator = PipelineReorderIterator(final_iterator, bucket_iterator)
         return final_iterator
 
-    def __call__(self, inputs, *args, num_workers=None, batch_size=None, **kwargs):
+    def _get_stage_executor(self, stage_workers: int, stage_executor: Optional[str]):
+        """
+        Creates the pool of the `stage_workers` running the preprocessing and the postprocessing in `get_iterator`.
+        Returns it with the pipeline to pass to `_run_pipeline_stage` (`None` in worker processes, which hold their
+        own copy of the pipeline).
+        """
+        stage_executor = "thread" if stage_executor is None else stage_executor
+        if stage_executor == "thread":
+            return ThreadPoolExecutor(max_workers=stage_workers, thread_name_prefix="pipeline-stage"), self
+        elif stage_executor == "process":
+            executor = ProcessPoolExecutor(
+                max_workers=stage_workers, initializer=_init_pipeline_stage_worker, initargs=(self,)
+            )
+            return executor, None
+        raise ValueError(f"`stage_executor` should be `'thread'` or `'process'`, but is {stage_executor}.")
+
+    def __call__(
+        self,
+        inputs,
+        *args,
+        num_workers=None,
+        batch_size=None,
+        bucket_window=None,
+        stage_workers=None,
+        stage_executor=None,
+        **kwargs,
+    ):
         if args:
             logger.warning(f"Ignoring args : {args}")
 
@@ -1076,6 +1187,12 @@ class Pipeline(_ScikitCompat):
                 batch_size = 1
             else:
                 batch_size = self._batch_size
+        if bucket_window is None:
+            bucket_window = self._bucket_window
+        if stage_workers is None:
+            stage_workers = self._stage_workers
+        if stage_executor is None:
+            stage_executor = self._stage_executor
 
         preprocess_params, forward_params, postprocess_params = self._sanitize_parameters(**kwargs)
 
@@ -1104,7 +1221,15 @@ class Pipeline(_ScikitCompat):
         if is_list:
             if can_use_iterator:
                 final_iterator = self.get_iterator(
-                    inputs, num_workers, batch_size, preprocess_params, forward_params, postprocess_params
+                    inputs,
+                    num_workers,
+                    batch_size,
+                    preprocess_params,
+                    forward_params,
+                    postprocess_params,
+                    bucket_window=bucket_window,
+                    stage_workers=stage_workers,
+                    stage_executor=stage_executor,
                 )
                 outputs = list(final_iterator)
                 return outputs
@@ -1112,7 +1237,15 @@ class Pipeline(_ScikitCompat):
                 return self.run_multi(inputs, preprocess_params, forward_params, postprocess_params)
         elif can_use_iterator:
             return self.get_iterator(
-                inputs, num_workers, batch_size, preprocess_params, forward_params, postprocess_params
+                inputs,
+                num_workers,
+                batch_size,
+                preprocess_params,
+                forward_params,
+                postprocess_params,
+                bucket_window=bucket_window,
+                stage_workers=stage_workers,
+                stage_executor=stage_executor,
             )
         elif is_iterable:
             return self.iterate(inputs, preprocess_params, forward_params, postprocess_params)
@@ -1127,6 +1260,58 @@ class Pipeline(_ScikitCompat):
         else:
             return self.run_single(inputs, preprocess_params, forward_params, postprocess_params)
 
+    async def acall(self, inputs, *args, **kwargs):
+        """
+        Asynchronous version of `__call__`, for `asyncio` applications: the pipeline runs in the default executor of
+        the event loop, which keeps serving other tasks in the meantime. The arguments are the ones of `__call__`.
+
+        Each call runs on its own. To batch the inputs of concurrent calls together, use the `acall` method of a
+        [`~pipelines.DynamicBatcher`] instead.
+
+        Cancelling the call does not interrupt the pipeline once it started: it runs to completion in the executor,
+        and its output is discarded.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self, inputs, *args, **kwargs))
+
+    async def astream(self, inputs, *args, **kwargs):
+        """
+        Asynchronous iterator over the outputs of the pipeline for an iterable of inputs (e.g. a list, a generator or
+        a dataset), yielded in order as soon as each of them is ready. The iteration of the pipeline, with its
+        batching, runs in the default executor of the event loop. The arguments are the ones of `__call__`.
+
+        The outputs are computed as they are requested: when the iterator is closed or its task is cancelled, the
+        pipeline stops after the output in progress.
+
+        Examples:
+
+        ```python
+        >>> import asyncio
+        >>> from transformers import pipeline
+
+        >>> classifier = pipeline("text-classification", model="distilbert-base-uncased-finetuned-sst-2-english")
+
+
+        >>> async def classify(texts):
+        ...     return [output["label"] async for output in classifier.astream(texts, batch_size=2)]
+
+
+        >>> asyncio.run(classify(["I love this movie!", "I hate this movie."]))
+        ['POSITIVE', 'NEGATIVE']
+        ```
+        """
+        if Dataset is None or not isinstance(inputs, Dataset):
+            # a generator makes `__call__` return an iterator over the outputs, even for a list of inputs
+            inputs = (item for item in inputs)
+        loop = asyncio.get_running_loop()
+        iterator = await loop.run_in_executor(None, lambda: iter(self(inputs, *args, **kwargs)))
+        end = object()
+        while True:
+            output = await loop.run_in_executor(None, next, iterator, end)
+            if output is end:
+                return
+            yield output
+
     def run_multi(self, inputs, preprocess_params, forward_params, postprocess_params):
         return [self.run_single(item, preprocess_params, forward_params, postprocess_params) for item in inputs]
 
@@ -1153,8 +1338,22 @@ class ChunkPipeline(Pipeline):
         return outputs
 
     def get_iterator(
-        self, inputs, num_workers: int, batch_size: int, preprocess_params, forward_params, postprocess_params
+        self,
+        inputs,
+        num_workers: int,
+        batch_size: int,
+        preprocess_params,
+        forward_params,
+        postprocess_params,
+        bucket_window: Optional[int] = None,
+        stage_workers: Optional[int] = None,
+        stage_executor: Optional[str] = None,
     ):
+        if bucket_window is not None and batch_size > 1:
+            raise ValueError(
+                "`bucket_window` is not supported by pipelines that split their inputs in chunks, as the chunks of an "
+                "input have to go through the model in order."
+            )
         if "TOKENIZERS_PARALLELISM" not in os.environ:
             logger.info("Disabling tokenizer parallelism, we're using DataLoader multithreading already")
             os.environ["TOKENIZERS_PARALLELISM"] = "false"
@@ -1164,14 +1363,29 @@ class ChunkPipeline(Pipeline):
                 " setting `num_workers=1` to guarantee correctness."
             )
             num_workers = 1
-        dataset = PipelineChunkIterator(inputs, self.preprocess, preprocess_params)
+        executor = None
+        if stage_workers:
+            executor, stage_pipeline = self._get_stage_executor(stage_workers, stage_executor)
+            max_pending = 2 * max(stage_workers, batch_size)
+            # each input is split in chunks by the stage workers, ahead of the forward passes
+            preprocess = functools.partial(_run_pipeline_stage, stage_pipeline, "preprocess_chunks")
+            dataset = PipelineStagedIterator(
+                inputs, preprocess, preprocess_params, executor, max_pending, flatten=True
+            )
+            num_workers = 0
+        else:
+            dataset = PipelineChunkIterator(inputs, self.preprocess, preprocess_params)
 
-        # TODO hack by collating feature_extractor and image_processor
-        feature_extractor = self.feature_extractor if self.feature_extractor is not None else self.image_processor
-        collate_fn = no_collate_fn if batch_size == 1 else pad_collate_fn(self.tokenizer, feature_extractor)
+        collate_fn = self._get_collate_fn(batch_size)
         dataloader = DataLoader(dataset, num_workers=num_workers, batch_size=batch_size, collate_fn=collate_fn)
         model_iterator = PipelinePackIterator(dataloader, self.forward, forward_params, loader_batch_size=batch_size)
-        final_iterator = PipelineIterator(model_iterator, self.postprocess, postprocess_params)
+        if executor is not None:
+            postprocess = functools.partial(_run_pipeline_stage, stage_pipeline, "postprocess")
+            final_iterator = PipelineStagedIterator(
+                model_iterator, postprocess, postprocess_params, executor, max_pending, shutdown_executor=True
+            )
+        else:
+            final_iterator = PipelineIterator(model_iterator, self.postprocess, postprocess_params)
         return final_iterator
 
 
@@ -0,0 +1,273 @@
+# coding=utf-8
+# Copyright 2023 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, List, Optional
+
+from ..utils import is_torch_available, logging
+from .base import ChunkPipeline, Pipeline
+
+
+if is_torch_available():
+    from .pt_utils import PipelineIterator
+
+
+logger = logging.get_logger(__name__)
+
+
+class _BatcherRequest:
+    """The model inputs of one call to [`DynamicBatcher`], and the model outputs collected for them so far."""
+
+    def __init__(self, model_inputs: List[Any], postprocess: bool = True):
+        self.model_inputs = model_inputs
+        self.model_outputs = [None] * len(model_inputs)
+        self.num_pending = len(model_inputs)
+        self.postprocess = postprocess
+        self.future = Future()
+
+
+class DynamicBatcher:
+    """
+    Batches the inputs of concurrent calls to a [`Pipeline`] on the fly, so that a server answering single requests
+    from many threads runs one forward pass for several of them instead of one each.
+
+    Each call preprocesses its inputs in the calling thread and queues the resulting model inputs. A background thread
+    takes the queued model inputs, waiting up to `max_wait_ms` milliseconds after the first one for up to
+    `max_batch_size` of them, pads them together with the collate function of the pipeline, runs the forward pass,
+    and hands the outputs back to the calls they belong to. The call whose last model inputs went through the model
+    is postprocessed on the background thread, and its result is set on the future returned by `submit`.
+
+    In `asyncio` applications, `await batcher.acall(inputs)` batches the inputs of concurrent coroutines the same way.
+
+    [`ChunkPipeline`] tasks are supported: the chunks produced by the preprocessing of a call are queued separately,
+    so the chunks of several calls can share a forward pass, and are gathered back before the postprocessing.
+
+    The parameters of the pipeline (e.g. `max_new_tokens` for text generation) are fixed when the batcher is created,
+    as only calls with the same parameters can share a forward pass. Batching requires the pipeline to be able to pad
+    its inputs, just like calling it with a `batch_size`.
+
+    Args:
+        pipeline ([`Pipeline`]):
+            The PyTorch pipeline whose calls are batched.
+        max_batch_size (`int`, *optional*, defaults to 8):
+            The maximum number of model inputs in a forward pass.
+        max_wait_ms (`float`, *optional*, defaults to 5.0):
+            How long to wait for more model inputs once the first one of a batch is queued, in milliseconds.
+        kwargs:
+            The parameters of the calls to the pipeline.
+
+    Examples:
+
+    ```python
+    >>> from concurrent.futures import ThreadPoolExecutor
+    >>> from transformers import pipeline
+    >>> from transformers.pipelines import DynamicBatcher
+
+    >>> classifier = pipeline("text-classification", model="distilbert-base-uncased-finetuned-sst-2-english")
+    >>> with DynamicBatcher(classifier, max_batch_size=16, max_wait_ms=10) as batcher:
+    ...     with ThreadPoolExecutor(max_workers=4) as executor:
+    ...         outputs = list(executor.map(batcher, ["I love this movie!", "I hate this movie."]))
+    >>> [output["label"] for output in outputs]
+    ['POSITIVE', 'NEGATIVE']
+    ```
+    """
+
+    def __init__(self, pipeline: Pipeline, max_batch_size: int = 8, max_wait_ms: float = 5.0, **kwargs):
+        if pipeline.framework != "pt":
+            raise ValueError("`DynamicBatcher` only supports PyTorch pipelines.")
+        if max_batch_size < 1:
+            raise ValueError(f"`max_batch_size` has to be a strictly positive integer, but is {max_batch_size}.")
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+
+        preprocess_params, forward_params, postprocess_params = pipeline._sanitize_parameters(**kwargs)
+        self.preprocess_params = {**pipeline._preprocess_params, **preprocess_params}
+        self.forward_params = {**pipeline._forward_params, **forward_params}
+        self.postprocess_params = {**pipeline._postprocess_params, **postprocess_params}
+
+        self.collate_fn = pipeline._get_collate_fn(max_batch_size)
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self._closed = False
+
+    def submit(self, inputs: Any) -> Future:
+        """
+        Preprocesses `inputs` in the calling thread and queues them for the next forward passes.
+
+        Return:
+            `concurrent.futures.Future`: A future holding the output of the pipeline for `inputs`.
+        """
+        if self._closed:
+            raise ValueError("This `DynamicBatcher` is closed.")
+        if isinstance(self.pipeline, ChunkPipeline):
+            model_inputs = list(self.pipeline.preprocess(inputs, **self.preprocess_params))
+        else:
+            model_inputs = [self.pipeline.preprocess(inputs, **self.preprocess_params)]
+        return self._submit(_BatcherRequest(model_inputs))
+
+    def submit_model_inputs(self, model_inputs: List[Any]) -> Future:
+        """
+        Queues inputs already preprocessed by the pipeline for the next forward passes, such as the chunks of the
+        audio streams of [`AutomaticSpeechRecognitionPipeline.transcribe_stream`].
+
+        Return:
+            `concurrent.futures.Future`: A future holding the list of the model outputs for `model_inputs`, which are
+            not postprocessed.
+        """
+        if self._closed:
+            raise ValueError("This `DynamicBatcher` is closed.")
+        return self._submit(_BatcherRequest(model_inputs, postprocess=False))
+
+    def _submit(self, request: _BatcherRequest) -> Future:
+        if len(request.model_inputs) == 0:
+            self._postprocess(request)
+            return request.future
+        self._start_worker()
+        for index in range(len(request.model_inputs)):
+            self._queue.put((request, index))
+        return request.future
+
+    def __call__(self, inputs: Any) -> Any:
+        """Runs the pipeline on `inputs`, batched with the concurrent calls, and returns its output."""
+        return self.submit(inputs).result()
+
+    async def acall(self, inputs: Any) -> Any:
+        """
+        Asynchronous version of `__call__`: `inputs` are preprocessed in the default executor of the event loop, and
+        batched with the inputs of the concurrent calls and coroutines.
+
+        Cancelling the call drops its inputs from the queue if they are not part of a forward pass yet, and skips their
+        postprocessing otherwise.
+        """
+        loop = asyncio.get_running_loop()
+        submission = loop.run_in_executor(None, self.submit, inputs)
+        try:
+            # shielded, so that the future of the request can still be cancelled if the call is cancelled while
+            # `submit` runs in the executor
+            future = await asyncio.shield(submission)
+        except asyncio.CancelledError:
+            submission.add_done_callback(_cancel_submitted_request)
+            raise
+        return await asyncio.wrap_future(future)
+
+    def close(self):
+        """Stops the background thread once the queued inputs are processed."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._worker is not None:
+                self._queue.put(None)
+                self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _start_worker(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="DynamicBatcher", daemon=True)
+                self._worker.start()
+
+    def _next_batch(self) -> Optional[List[Any]]:
+        """Waits for the queued model inputs of the next forward pass, or returns `None` once the batcher is closed."""
+        batch = []
+        deadline = None
+        while len(batch) < self.max_batch_size:
+            if deadline is None:
+                item = self._queue.get()
+            else:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if item is None:
+                if len(batch) == 0:
+                    return None
+                # let the loop stop after this batch
+                self._queue.put(None)
+                break
+            request, _ = item
+            if request.future.done():
+                # the request was cancelled, or another of its inputs failed
+                continue
+            batch.append(item)
+            if deadline is None:
+                deadline = time.monotonic() + self.max_wait_ms / 1000
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                model_inputs = self.collate_fn([request.model_inputs[index] for request, index in batch])
+                # unbatch the outputs as `Pipeline.get_iterator` does
+                model_outputs = list(
+                    PipelineIterator(
+                        [model_inputs], self.pipeline.forward, self.forward_params, loader_batch_size=len(batch)
+                    )
+                )
+            except Exception as error:
+                logger.error(f"The forward pass of a batch of {len(batch)} inputs failed: {error}")
+                for request, _ in batch:
+                    if not request.future.done() and request.future.set_running_or_notify_cancel():
+                        request.future.set_exception(error)
+                continue
+
+            for (request, index), outputs in zip(batch, model_outputs):
+                if request.future.done():
+                    # another input of the request failed
+                    continue
+                request.model_outputs[index] = outputs
+                request.num_pending -= 1
+                if request.num_pending == 0:
+                    self._postprocess(request)
+
+    def _postprocess(self, request: _BatcherRequest):
+        if not request.future.set_running_or_notify_cancel():
+            # the request was cancelled
+            return
+        if not request.postprocess:
+            request.future.set_result(request.model_outputs)
+            return
+        try:
+            if isinstance(self.pipeline, ChunkPipeline):
+                for outputs in request.model_outputs:
+                    outputs.pop("is_last", None)
+                result = self.pipeline.postprocess(request.model_outputs, **self.postprocess_params)
+            else:
+                result = self.pipeline.postprocess(request.model_outputs[0], **self.postprocess_params)
+        except Exception as error:
+            request.future.set_exception(error)
+        else:
+            request.future.set_result(result)
+
+
+def _cancel_submitted_request(submission: asyncio.Future):
+    # cancels the request queued by the `submit` call of a cancelled `DynamicBatcher.acall`
+    if not submission.cancelled() and submission.exception() is None:
+        submission.result().cancel()
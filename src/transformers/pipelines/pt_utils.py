@@ -1,3 +1,5 @@
+import collections
+
 import numpy as np
 import torch
 from torch.utils.data import Dataset, IterableDataset
@@ -293,6 +295,201 @@ class PipelinePackIterator(PipelineIterator):
         return accumulator
 
 
+class PipelineStagedIterator(IterableDataset):
+    def __init__(self, loader, infer, params, executor, max_pending, flatten=False, shutdown_executor=False):
+        """
+        Roughly equivalent to
+
+        ```
+        for item in loader:
+            yield infer(item, **params)
+        ```
+
+        but `infer` runs on `executor` (a `concurrent.futures.Executor`), up to `max_pending` items ahead of the
+        consumer, so that it overlaps with the work done in the main thread to produce the next items of `loader` or
+        to consume the outputs. The outputs are returned in the order of the items.
+
+                Arguments:
+                    loader (`torch.utils.data.DataLoader` or any iterator):
+                        The iterator that will be used to apply `infer` on.
+                    infer (any function):
+                        The function to apply of each element of `loader`. It has to be picklable for process pools.
+                    params (`dict`):
+                        The parameters passed to `infer` along with every item
+                    executor (`concurrent.futures.Executor`):
+                        The pool running `infer`.
+                    max_pending (`int`):
+                        The maximum number of items submitted to `executor` whose output wasn't returned yet.
+                    flatten (`bool`, *optional*, defaults to `False`):
+                        Whether `infer` returns a list of outputs to yield one by one, like the `preprocess` of a
+                        `ChunkPipeline` as iterated by [`PipelineChunkIterator`].
+                    shutdown_executor (`bool`, *optional*, defaults to `False`):
+                        Whether to shut `executor` down once `loader` is exhausted, when `infer` or `loader` raises,
+                        and when the iterator is closed or deleted before the end.
+        """
+        self.loader = loader
+        self.infer = infer
+        self.params = params
+        self.executor = executor
+        self.max_pending = max_pending
+        self.flatten = flatten
+        self.shutdown_executor = shutdown_executor
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self._pending = collections.deque()
+        self._outputs = collections.deque()
+        return self
+
+    def __next__(self):
+        try:
+            while not self._outputs:
+                while len(self._pending) < self.max_pending:
+                    try:
+                        item = next(self.iterator)
+                    except StopIteration:
+                        break
+                    self._pending.append(self.executor.submit(self.infer, item, **self.params))
+                if not self._pending:
+                    raise StopIteration
+                output = self._pending.popleft().result()
+                if not self.flatten:
+                    return output
+                self._outputs.extend(output)
+            return self._outputs.popleft()
+        except BaseException:
+            # the end of the stream, or an error in a stage
+            self.close()
+            raise
+
+    def close(self):
+        """
+        Cancels the items submitted to `executor` whose processing hasn't started, and shuts `executor` down if
+        `shutdown_executor` is set.
+        """
+        for future in getattr(self, "_pending", ()):
+            future.cancel()
+        self._pending = collections.deque()
+        if self.shutdown_executor:
+            self.executor.shutdown(wait=False)
+
+    def __del__(self):
+        self.close()
+
+
+def _get_item_length(item) -> int:
+    """The length used to bucket a preprocessed item: its number of tokens, audio samples or feature frames."""
+    if not hasattr(item, "get"):
+        return 0
+    for key in ("input_ids", "input_values", "input_features"):
+        value = item.get(key)
+        if isinstance(value, (torch.Tensor, np.ndarray)):
+            return value.shape[-1]
+    return 0
+
+
+class PipelineBucketIterator(IterableDataset):
+    def __init__(self, loader, collate_fn, batch_size, bucket_window):
+        """
+        Roughly equivalent to
+
+        ```
+        for window in chunks(loader, bucket_window):
+            window = sorted(window, key=length)
+            for items in chunks(window, batch_size):
+                yield collate_fn(items)
+        ```
+
+        so that the items batched together have similar lengths and need little padding. The original index of the
+        items in the order they are yielded is kept in `order`, for [`PipelineReorderIterator`] to restore the order
+        of the outputs.
+
+                Arguments:
+                    loader (`torch.utils.data.DataLoader` or any iterator):
+                        The iterator of the preprocessed items, one at a time.
+                    collate_fn (any function):
+                        The function batching a list of items.
+                    batch_size (`int`):
+                        The size of the batches.
+                    bucket_window (`int`):
+                        The number of consecutive items sorted by length, rounded up to a multiple of `batch_size` so
+                        that only the last batch can be smaller than `batch_size`.
+        """
+        self.loader = loader
+        self.collate_fn = collate_fn
+        self.batch_size = batch_size
+        self.bucket_window = -(-bucket_window // batch_size) * batch_size
+        self.order = collections.deque()
+
+    def __len__(self):
+        return -(-len(self.loader) // self.batch_size)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.order.clear()
+        self._num_items = 0
+        self._batches = collections.deque()
+        return self
+
+    def _fill_window(self):
+        window = []
+        for item in self.iterator:
+            window.append((self._num_items, item))
+            self._num_items += 1
+            if len(window) == self.bucket_window:
+                break
+        window.sort(key=lambda indexed_item: _get_item_length(indexed_item[1]))
+        for start in range(0, len(window), self.batch_size):
+            batch = window[start : start + self.batch_size]
+            self.order.extend(index for index, _ in batch)
+            self._batches.append(self.collate_fn([item for _, item in batch]))
+
+    def __next__(self):
+        if not self._batches:
+            self._fill_window()
+        if not self._batches:
+            raise StopIteration
+        return self._batches.popleft()
+
+
+class PipelineReorderIterator(IterableDataset):
+    def __init__(self, loader, bucket_iterator):
+        """
+        Yields the outputs of `loader`, which come in the order of the items yielded by `bucket_iterator` (a
+        [`PipelineBucketIterator`]), in the original order of the items instead. Only the outputs of the current bucket
+        window are held at once.
+
+                Arguments:
+                    loader (any iterator):
+                        The iterator of the outputs, one at a time.
+                    bucket_iterator ([`PipelineBucketIterator`]):
+                        The iterator that reordered the items.
+        """
+        self.loader = loader
+        self.bucket_iterator = bucket_iterator
+
+    def __len__(self):
+        return len(self.bucket_iterator.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self._pending = {}
+        self._next_index = 0
+        return self
+
+    def __next__(self):
+        while self._next_index not in self._pending:
+            # raises `StopIteration` once all the outputs are returned
+            output = next(self.iterator)
+            self._pending[self.bucket_iterator.order.popleft()] = output
+        output = self._pending.pop(self._next_index)
+        self._next_index += 1
+        return output
+
+
 class KeyDataset(Dataset):
     def __init__(self, dataset: Dataset, key: str):
         self.dataset = dataset
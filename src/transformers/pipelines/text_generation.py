@@ -1,11 +1,15 @@
+import asyncio
 import enum
+import functools
 import warnings
 
+from ..generation import AsyncTextIteratorStreamer
 from ..utils import add_end_docstrings, is_tf_available, is_torch_available
 from .base import PIPELINE_INIT_ARGS, Pipeline
 
 
 if is_torch_available():
+    from ..generation import StoppingCriteriaList
     from ..models.auto.modeling_auto import MODEL_FOR_CAUSAL_LM_MAPPING_NAMES
 
 if is_tf_available():
@@ -100,6 +104,7 @@ class TextGenerationPipeline(Pipeline):
         prefix=None,
         handle_long_generation=None,
         stop_sequence=None,
+        result_cache=None,
         **generate_kwargs,
     ):
         preprocess_params = {}
@@ -121,6 +126,10 @@ class TextGenerationPipeline(Pipeline):
 
         preprocess_params.update(generate_kwargs)
         forward_params = generate_kwargs
+        if result_cache is not None:
+            if self.framework != "pt":
+                raise ValueError("`result_cache` is only supported by PyTorch models.")
+            forward_params["result_cache"] = result_cache
 
         postprocess_params = {}
         if return_full_text is not None and return_type is None:
@@ -188,6 +197,10 @@ class TextGenerationPipeline(Pipeline):
                 - `None` : default strategy where nothing in particular happens
                 - `"hole"`: Truncates left of input, and leaves a gap wide enough to let generation happen (might
                   truncate a lot of the prompt and not suitable when generation exceed the model capacity)
+            result_cache (`GenerationResultCache`, *optional*):
+                A [`~generation.GenerationResultCache`] storing the generated sequences, so that repeated prompts are
+                answered without running the model. Only deterministic generation (e.g. greedy decoding or beam search)
+                is cached.
 
             generate_kwargs:
                 Additional keyword arguments to pass along to the generate method of the model (see the generate method
@@ -203,6 +216,64 @@ class TextGenerationPipeline(Pipeline):
         """
         return super().__call__(text_inputs, **kwargs)
 
+    async def astream(self, text_inputs, **kwargs):
+        """
+        Asynchronous iterator over the text generated for a prompt, yielded piece by piece as the tokens are generated
+        (with an [`AsyncTextIteratorStreamer`]). The generation runs in the default executor of the event loop, and
+        stops at the next step when the iterator is closed or its task is cancelled. The arguments are the ones of
+        `__call__`, and only the new text is yielded.
+
+        With an iterable of prompts (e.g. a list, a generator or a dataset), iterates over the complete outputs of the
+        prompts instead, as [`Pipeline.astream`] does.
+
+        Examples:
+
+        ```python
+        >>> import asyncio
+        >>> from transformers import pipeline
+
+        >>> generator = pipeline("text-generation", model="gpt2")
+
+
+        >>> async def complete(prompt):
+        ...     generated_text = ""
+        ...     async for new_text in generator.astream(prompt, max_new_tokens=20, do_sample=False):
+        ...         generated_text += new_text
+        ...     return generated_text
+
+
+        >>> asyncio.run(complete("An increasing sequence: one,"))
+        ' two, three, four, five, six, seven, eight, nine, ten, eleven,'
+        ```
+        """
+        if not isinstance(text_inputs, str):
+            async for outputs in super().astream(text_inputs, **kwargs):
+                yield outputs
+            return
+        if self.framework != "pt":
+            raise ValueError("Streaming the generated text is only supported by PyTorch models.")
+
+        streamer = AsyncTextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        # `streamer.stopping_criteria` stops the generation once the iterator is cancelled
+        stopping_criteria = kwargs.pop("stopping_criteria", None) or []
+        stopping_criteria = StoppingCriteriaList([*stopping_criteria, *streamer.stopping_criteria])
+        loop = asyncio.get_running_loop()
+        generation = loop.run_in_executor(
+            None,
+            functools.partial(self, text_inputs, streamer=streamer, stopping_criteria=stopping_criteria, **kwargs),
+        )
+        # the streamer is not ended if the generation fails
+        generation.add_done_callback(
+            lambda generation: generation.cancelled() or generation.exception() is None or streamer.cancel()
+        )
+        try:
+            async for new_text in streamer:
+                yield new_text
+            await generation
+        finally:
+            if not generation.done():
+                streamer.cancel()
+
     def preprocess(self, prompt_text, prefix="", handle_long_generation=None, **generate_kwargs):
         inputs = self.tokenizer(
             prefix + prompt_text, padding=False, add_special_tokens=False, return_tensors=self.framework
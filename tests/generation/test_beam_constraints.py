@@ -23,7 +23,8 @@ from transformers.testing_utils import require_torch
 if is_torch_available():
     import torch
 
-    from transformers.generation import DisjunctiveConstraint
+    from transformers.generation import ConstraintListState, DisjunctiveConstraint, PhrasalConstraint
+    from transformers.generation.beam_constraints import ConstraintAutomaton
 
 
 @require_torch
@@ -113,3 +114,40 @@ class ConstraintTest(unittest.TestCase):
         self.assertTrue(dc.completed)  # Completed!
         self.assertTrue(dc.remaining() == 0)
         self.assertTrue(dc.current_seq == [1, 2, 5])
+
+    def test_automaton_matches_constraint_list_state(self):
+        constraints = [
+            PhrasalConstraint([1, 2, 1, 3]),
+            DisjunctiveConstraint([[4, 5, 6], [4, 7], [8, 5]]),
+            PhrasalConstraint([9]),
+        ]
+        automaton = ConstraintAutomaton(constraints)
+        self.assertListEqual(automaton.alphabet.tolist(), [1, 2, 3, 4, 5, 6, 7, 8, 9])
+
+        sequences = torch.randint(0, 11, (64, 12))
+        # some sequences fulfilling all the constraints, with resets in between
+        sequences[:4, :10] = torch.tensor([1, 2, 1, 3, 9, 4, 7, 0, 0, 0])
+        sequences[4:8, :11] = torch.tensor([4, 5, 1, 2, 1, 2, 1, 3, 8, 5, 9])
+        states = automaton.run(sequences)
+        completed = automaton.is_completed(states)
+        banks = automaton.bank(states)
+        is_advance, next_states = automaton.advance(states)
+
+        for idx, sequence in enumerate(sequences.tolist()):
+            state = ConstraintListState(constraints)
+            state.reset(sequence)
+            self.assertEqual(completed[idx].item(), state.completed)
+            self.assertEqual(banks[idx].item(), state.get_bank())
+            advance = sorted(set(state.advance() or []))
+            self.assertListEqual(automaton.alphabet[is_advance[idx]].tolist(), advance)
+
+            for token in advance:
+                state.reset(sequence + [token])
+                next_state = next_states[idx, automaton.alphabet.tolist().index(token)]
+                self.assertEqual(automaton.bank(next_state).item(), state.get_bank())
+        self.assertTrue(completed[:8].all())
+
+        # stepping the states is the same as running the extended sequences
+        next_tokens = torch.randint(0, 11, (64,))
+        extended_states = automaton.run(torch.cat([sequences, next_tokens.unsqueeze(-1)], dim=-1))
+        self.assertListEqual(automaton.step(states, next_tokens).tolist(), extended_states.tolist())
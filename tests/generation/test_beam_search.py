@@ -250,6 +250,71 @@ class BeamSearchTester:
         self.parent.assertListEqual(list(sequences.shape), [self.num_beams * self.batch_size, max_length])
         self.parent.assertListEqual(list(sequence_scores.shape), [self.num_beams * self.batch_size])
 
+    def check_beam_scorer_matches_beam_hypotheses(self, input_ids, *args):
+        # the tensorized scorer keeps the same hypotheses as one `BeamHypotheses` per batch item
+        eos_token_id = 1
+        beam_scorer = self.prepare_beam_scorer(do_early_stopping=False, num_beam_hyps_to_keep=2)
+        reference_hyps = [
+            BeamHypotheses(self.num_beams, self.length_penalty, early_stopping=False) for _ in range(self.batch_size)
+        ]
+        reference_done = [False] * self.batch_size
+
+        for _ in range(5):
+            # a small vocabulary makes ends of sentence frequent, the last `num_beams` candidates never are
+            next_tokens = ids_tensor((self.batch_size, 2 * self.num_beams), 4).to(torch_device)
+            next_tokens[:, self.num_beams :] += 2
+            next_indices = ids_tensor((self.batch_size, 2 * self.num_beams), self.num_beams).to(torch_device)
+            next_scores, _ = (-floats_tensor((self.batch_size, 2 * self.num_beams)).to(torch_device) * 10).sort(
+                descending=True
+            )
+            beam_outputs = beam_scorer.process(
+                input_ids, next_scores, next_tokens, next_indices, pad_token_id=0, eos_token_id=eos_token_id
+            )
+
+            for batch_idx, beam_hyp in enumerate(reference_hyps):
+                if reference_done[batch_idx]:
+                    continue
+                for rank in range(self.num_beams):
+                    if next_tokens[batch_idx, rank].item() == eos_token_id:
+                        batch_beam_idx = batch_idx * self.num_beams + next_indices[batch_idx, rank]
+                        beam_hyp.add(input_ids[batch_beam_idx].clone(), next_scores[batch_idx, rank].item())
+                best_sum_logprobs = next_scores[batch_idx].max().item()
+                reference_done[batch_idx] = beam_hyp.is_done(best_sum_logprobs, input_ids.shape[-1] + 1)
+
+            self.parent.assertListEqual(beam_scorer._done.tolist(), reference_done)
+            for beam_hyp, reference_hyp in zip(beam_scorer._beam_hyps, reference_hyps):
+                self.parent.assertListEqual(
+                    sorted((score, hyp.tolist()) for score, hyp, _ in beam_hyp.beams),
+                    sorted((score, hyp.tolist()) for score, hyp, _ in reference_hyp.beams),
+                )
+
+            input_ids = torch.cat(
+                [input_ids[beam_outputs["next_beam_indices"], :], beam_outputs["next_beam_tokens"].unsqueeze(-1)],
+                dim=-1,
+            )
+
+        sequence_output = beam_scorer.finalize(
+            input_ids,
+            beam_outputs["next_beam_scores"],
+            beam_outputs["next_beam_tokens"],
+            beam_outputs["next_beam_indices"],
+            pad_token_id=0,
+            eos_token_id=eos_token_id,
+            max_length=self.max_length,
+        )
+        for batch_idx, beam_hyp in enumerate(reference_hyps):
+            if not reference_done[batch_idx]:
+                for beam_idx in range(self.num_beams):
+                    batch_beam_idx = batch_idx * self.num_beams + beam_idx
+                    beam_hyp.add(input_ids[batch_beam_idx], beam_outputs["next_beam_scores"][batch_beam_idx].item())
+            best_hyps = sorted(beam_hyp.beams, key=lambda x: x[0])[-2:][::-1]
+            for hyp_idx, (score, hyp, _) in enumerate(best_hyps):
+                output_idx = batch_idx * 2 + hyp_idx
+                self.parent.assertAlmostEqual(sequence_output["sequence_scores"][output_idx].item(), score, places=5)
+                self.parent.assertListEqual(
+                    sequence_output["sequences"][output_idx, : len(hyp)].tolist(), hyp.tolist()
+                )
+
 
 class ConstrainedBeamSearchTester:
     def __init__(
@@ -517,6 +582,32 @@ class ConstrainedBeamSearchTester:
         self.parent.assertListEqual(list(sequences.shape), [self.num_beams * self.batch_size, max_length])
         self.parent.assertListEqual(list(sequence_scores.shape), [self.num_beams * self.batch_size])
 
+    def check_constrained_beam_scorer_tracks_states(
+        self, input_ids, next_tokens, next_indices, next_scores, scores_for_all_vocab
+    ):
+        constraint_tokens = set()
+        for constraint in self.constraints:
+            token_ids = constraint.token_ids
+            constraint_tokens.update(sum(token_ids, []) if isinstance(token_ids[0], list) else token_ids)
+
+        # the constraint states the scorer carries over from one step to the next lead to the same beams as the states
+        # computed from the sequences by a new scorer
+        constrained_beam_scorer = self.prepare_constrained_beam_scorer()
+        for _ in range(3):
+            expected_outputs = self.prepare_constrained_beam_scorer().process(
+                input_ids, next_scores, next_tokens, next_indices, scores_for_all_vocab, eos_token_id=self.eos_token_id
+            )
+            beam_outputs = constrained_beam_scorer.process(
+                input_ids, next_scores, next_tokens, next_indices, scores_for_all_vocab, eos_token_id=self.eos_token_id
+            )
+            for key in ["next_beam_scores", "next_beam_tokens", "next_beam_indices"]:
+                self.parent.assertListEqual(beam_outputs[key].tolist(), expected_outputs[key].tolist())
+
+            # the tokens advancing the constraints are proposed
+            output_tokens = beam_outputs["next_beam_tokens"]
+            self.parent.assertTrue(any(token in constraint_tokens for token in output_tokens.tolist()))
+            input_ids = torch.cat([input_ids[beam_outputs["next_beam_indices"]], output_tokens.unsqueeze(-1)], dim=-1)
+
     def _check_sequence_inside_sequence(self, tensor_1, tensor_2):
         # check if tensor_1 inside tensor_2 or tensor_2 inside tensor_1.
         # set to same device. we don't care what device.
@@ -558,6 +649,10 @@ class BeamSearchTest(unittest.TestCase):
         inputs = self.beam_search_tester.prepare_inputs()
         self.beam_search_tester.check_beam_scores_finalize(*inputs)
 
+    def test_beam_scorer_matches_beam_hypotheses(self):
+        inputs = self.beam_search_tester.prepare_inputs()
+        self.beam_search_tester.check_beam_scorer_matches_beam_hypotheses(*inputs)
+
 
 @require_torch
 class ConstrainedBeamSearchTest(unittest.TestCase):
@@ -575,3 +670,7 @@ class ConstrainedBeamSearchTest(unittest.TestCase):
     def test_constrained_beam_scorer_finalize(self):
         inputs = self.constrained_beam_search_tester.prepare_inputs()
         self.constrained_beam_search_tester.check_constrained_beam_scorer_finalize(*inputs)
+
+    def test_constrained_beam_scorer_tracks_states(self):
+        inputs = self.constrained_beam_search_tester.prepare_inputs()
+        self.constrained_beam_search_tester.check_constrained_beam_scorer_tracks_states(*inputs)
@@ -0,0 +1,83 @@
+# coding=utf-8
+# Copyright 2023 The HuggingFace Team Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a clone of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from transformers import AutoTokenizer, TextStreamer, is_torch_available
+from transformers.testing_utils import CaptureStdout, require_torch, torch_device
+
+
+if is_torch_available():
+    import torch
+
+    from transformers import AutoModelForCausalLM, ContinuousBatchingEngine
+
+
+@require_torch
+class ContinuousBatchingEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2").to(torch_device)
+        self.model.generation_config.eos_token_id = -1
+        self.model.generation_config.pad_token_id = 0
+        self.prompts = [[3, 14, 15, 92, 6], [5, 35], [89, 79, 3, 23, 84, 62, 64], [33, 8, 32]]
+        self.max_new_tokens = [6, 3, 9, 4]
+
+    def test_outputs_match_generate(self):
+        engine = ContinuousBatchingEngine(self.model, max_batch_size=2)
+        request_ids = [
+            engine.add_request(prompt, max_new_tokens=max_new_tokens)
+            for prompt, max_new_tokens in zip(self.prompts, self.max_new_tokens)
+        ]
+        outputs = engine.run()
+        self.assertFalse(engine.has_unfinished_requests())
+
+        for request_id, prompt, max_new_tokens in zip(request_ids, self.prompts, self.max_new_tokens):
+            input_ids = torch.tensor([prompt], device=torch_device)
+            expected = self.model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=False)
+            self.assertListEqual(outputs[request_id].tolist(), expected.tolist())
+
+    def test_finished_sequences_free_their_slot(self):
+        engine = ContinuousBatchingEngine(self.model, max_batch_size=2)
+        short_id = engine.add_request(self.prompts[0], max_new_tokens=1)
+        long_id = engine.add_request(self.prompts[1], max_new_tokens=4)
+        waiting_id = engine.add_request(self.prompts[2], max_new_tokens=2)
+
+        # the first step prefills the first two requests, the shortest one is done right away
+        self.assertListEqual(engine.step(), [short_id])
+        self.assertIsNotNone(engine.get_output(short_id))
+        # its slot is then used by the waiting request while the long one keeps decoding
+        engine.step()
+        self.assertEqual(len(engine._running), 2)
+        outputs = engine.run()
+        self.assertListEqual(sorted(outputs.keys()), [long_id, waiting_id])
+
+    def test_streamer(self):
+        tokenizer = AutoTokenizer.from_pretrained("hf-internal-testing/tiny-random-gpt2")
+        input_ids = torch.tensor([self.prompts[0]], device=torch_device)
+        greedy_ids = self.model.generate(input_ids, max_new_tokens=6, do_sample=False)
+        greedy_text = tokenizer.decode(greedy_ids[0])
+
+        engine = ContinuousBatchingEngine(self.model, max_batch_size=2)
+        with CaptureStdout() as cs:
+            engine.add_request(self.prompts[0], max_new_tokens=6, streamer=TextStreamer(tokenizer))
+            engine.add_request(self.prompts[1], max_new_tokens=3)
+            engine.run()
+        # The greedy text should be printed to stdout, except for the final "\n" in the streamer
+        self.assertEqual(cs.out[:-1], greedy_text)
+
+    def test_rejects_beam_search(self):
+        engine = ContinuousBatchingEngine(self.model)
+        with self.assertRaises(ValueError):
+            engine.add_request(self.prompts[0], num_beams=2)
@@ -13,12 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+import re
+import tempfile
 import unittest
 from typing import List, Union
 
 from parameterized import parameterized
 
-from transformers import is_torch_available
+from transformers import AutoTokenizer, is_torch_available
 from transformers.testing_utils import require_torch, torch_device
 
 from ..test_modeling_common import ids_tensor
@@ -45,6 +49,7 @@ if is_torch_available():
         NoBadWordsLogitsProcessor,
         NoRepeatNGramLogitsProcessor,
         PrefixConstrainedLogitsProcessor,
+        RegexLogitsProcessor,
         RepetitionPenaltyLogitsProcessor,
         SequenceBiasLogitsProcessor,
         TemperatureLogitsWarper,
@@ -52,6 +57,7 @@ if is_torch_available():
         TopPLogitsWarper,
         TypicalLogitsWarper,
     )
+    from transformers.generation.token_automaton import json_schema_to_regex
 
 
 @require_torch
@@ -488,6 +494,35 @@ class LogitsProcessorTest(unittest.TestCase):
             [[False, True, False], [False, False, False], [False, False, True], [False, False, False]],
         )
 
+    def test_no_repeat_ngram_processors_match_reference(self):
+        vocab_size = 4
+        encoder_input_ids = ids_tensor((2, 12), vocab_size)
+        input_ids = ids_tensor((6, 15), vocab_size)
+        scores = self._get_uniform_logits(6, vocab_size)
+
+        def banned_tokens(ngram_size, source_ids, hypothesis_ids):
+            prefix = hypothesis_ids[len(hypothesis_ids) - ngram_size + 1 :]
+            return {
+                source_ids[i + ngram_size - 1]
+                for i in range(len(source_ids) - ngram_size + 1)
+                if source_ids[i : i + ngram_size - 1] == prefix
+            }
+
+        for ngram_size in range(1, 5):
+            filtered_scores = NoRepeatNGramLogitsProcessor(ngram_size)(input_ids, scores.clone())
+            encoder_filtered_scores = EncoderNoRepeatNGramLogitsProcessor(ngram_size, encoder_input_ids)(
+                input_ids, scores.clone()
+            )
+            for hypo_idx, hypothesis_ids in enumerate(input_ids.tolist()):
+                expected = banned_tokens(ngram_size, hypothesis_ids, hypothesis_ids)
+                banned = set(torch.isinf(filtered_scores[hypo_idx]).nonzero().flatten().tolist())
+                self.assertSetEqual(banned, expected)
+
+                # 3 beams per encoder input
+                expected = banned_tokens(ngram_size, encoder_input_ids[hypo_idx // 3].tolist(), hypothesis_ids)
+                banned = set(torch.isinf(encoder_filtered_scores[hypo_idx]).nonzero().flatten().tolist())
+                self.assertSetEqual(banned, expected)
+
     def test_no_bad_words_dist_processor(self):
         vocab_size = 5
         batch_size = 2
@@ -588,6 +623,44 @@ class LogitsProcessorTest(unittest.TestCase):
         # input_ids should never be changed
         self.assertListEqual(input_ids.tolist(), input_ids_comp.tolist())
 
+    def test_processor_list_fused_warpers(self):
+        batch_size = 4
+        vocab_size = 50
+        input_ids = ids_tensor((batch_size, 5), vocab_size)
+        scores = torch.randn((batch_size, vocab_size), device=torch_device) * 3
+
+        warper_chains = [
+            [TemperatureLogitsWarper(0.7), TopKLogitsWarper(20), TopPLogitsWarper(0.8)],
+            [TopPLogitsWarper(0.9, min_tokens_to_keep=2), EtaLogitsWarper(0.01)],
+            [TopKLogitsWarper(30), TypicalLogitsWarper(0.8), EpsilonLogitsWarper(0.02)],
+            [TypicalLogitsWarper(0.6, min_tokens_to_keep=3), TopKLogitsWarper(2), TemperatureLogitsWarper(1.5)],
+        ]
+        for warpers in warper_chains:
+            processor = LogitsProcessorList([MinLengthLogitsProcessor(10, eos_token_id=0)] + warpers)
+            fused_scores = processor(input_ids, scores.clone())
+            # the min length processor, then a single fused step for all the warpers
+            self.assertEqual(len(processor._get_execution_plan()), 2)
+
+            # same filtered tokens, and the kept tokens keep their warped scores
+            expected_scores = MinLengthLogitsProcessor(10, eos_token_id=0)(input_ids, scores.clone())
+            for warper in warpers:
+                expected_scores = warper(input_ids, expected_scores)
+            self.assertListEqual(torch.isinf(fused_scores).tolist(), torch.isinf(expected_scores).tolist())
+            self.assertTrue(torch.allclose(fused_scores, expected_scores))
+
+    def test_processor_list_does_not_fuse_custom_warpers(self):
+        class CustomTopPLogitsWarper(TopPLogitsWarper):
+            pass
+
+        processor = LogitsProcessorList([TopKLogitsWarper(3), CustomTopPLogitsWarper(0.8)])
+        self.assertEqual(len(processor._get_execution_plan()), 2)
+        processor = LogitsProcessorList([TopKLogitsWarper(3, filter_value=0.0), TopPLogitsWarper(0.8)])
+        self.assertEqual(len(processor._get_execution_plan()), 2)
+
+        # the plan follows changes to the list
+        processor[0] = TopKLogitsWarper(3)
+        self.assertEqual(len(processor._get_execution_plan()), 1)
+
     def test_prefix_constrained_logits_processor(self):
         vocab_size = 5
         batch_size = 2
@@ -608,6 +681,81 @@ class LogitsProcessorTest(unittest.TestCase):
             torch.isinf(filtered_scores).tolist(), [[False, False, True, True, True], [True, True, False, False, True]]
         )
 
+    def test_regex_logits_processor(self):
+        tokenizer = AutoTokenizer.from_pretrained("hf-internal-testing/tiny-random-gpt2")
+        pattern = r" [0-9]{3}-[0-9]{4}"
+        batch_size = 3
+        prompt_length = 4
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            regex_processor = RegexLogitsProcessor(tokenizer, regex=pattern, cache_dir=tmp_dir)
+            self.assertEqual(len(os.listdir(tmp_dir)), 1)
+
+            # the automaton is loaded back from the cache
+            cached_regex_processor = RegexLogitsProcessor(tokenizer, regex=pattern, cache_dir=tmp_dir)
+            self.assertListEqual(
+                cached_regex_processor.automaton.transition_keys.tolist(),
+                regex_processor.automaton.transition_keys.tolist(),
+            )
+
+        # greedy decoding over random scores only produces matching texts
+        torch.manual_seed(0)
+        input_ids = ids_tensor((batch_size, prompt_length), vocab_size=len(tokenizer))
+        for _ in range(12):
+            scores = torch.randn((batch_size, len(tokenizer)), device=torch_device)
+            scores = regex_processor(input_ids, scores)
+            next_tokens = scores.argmax(-1)
+            input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+        for sequence in input_ids[:, prompt_length:].tolist():
+            self.assertIn(tokenizer.eos_token_id, sequence)
+            text = tokenizer.decode(sequence[: sequence.index(tokenizer.eos_token_id)])
+            self.assertIsNotNone(re.fullmatch(pattern, text))
+
+        # reordered sequences, as in beam search, are tracked as well
+        scores = torch.zeros((batch_size, len(tokenizer)), device=torch_device)
+        regex_processor(input_ids[:, : prompt_length + 1], scores)
+        reordered_input_ids = input_ids[[2, 0, 0], : prompt_length + 2]
+        filtered_scores = regex_processor(reordered_input_ids, scores)
+        expected_processor = RegexLogitsProcessor(
+            tokenizer, regex=pattern, prompt_length=prompt_length, use_cache=False
+        )
+        expected_scores = expected_processor(reordered_input_ids, scores)
+        self.assertListEqual(torch.isinf(filtered_scores).tolist(), torch.isinf(expected_scores).tolist())
+
+        with self.assertRaises(ValueError):
+            RegexLogitsProcessor(tokenizer)
+
+    def test_json_schema_to_regex(self):
+        schema = {
+            "type": "object",
+            "properties": {
+                "name": {"type": "string", "maxLength": 5},
+                "age": {"type": "integer"},
+                "tags": {"type": "array", "items": {"enum": ["a", "b"]}, "maxItems": 2},
+                "valid": {"type": ["boolean", "null"]},
+            },
+            "required": ["name"],
+        }
+        pattern = re.compile(json_schema_to_regex(json.dumps(schema)))
+
+        for document in [
+            '{"name": "bob"}',
+            '{"name": "bob", "age": -3}',
+            '{"name":"bob","tags":["a","b"],"valid":null}',
+            '{ "name" : "x" , "valid" : true }',
+        ]:
+            self.assertIsNotNone(pattern.fullmatch(document), document)
+        for document in [
+            '{"age": 3}',
+            '{"name": "too long"}',
+            '{"name": "x", "tags": ["a", "b", "a"]}',
+            '{"name": "x", "age": 1.5}',
+        ]:
+            self.assertIsNone(pattern.fullmatch(document), document)
+
+        with self.assertRaises(ValueError):
+            json_schema_to_regex({"type": "object", "patternProperties": {"a": {"type": "string"}}})
+
     def test_hamming_diversity(self):
         vocab_size = 4
         num_beams = 2
@@ -0,0 +1,152 @@
+# coding=utf-8
+# Copyright 2023 The HuggingFace Team Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a clone of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from transformers import is_torch_available
+from transformers.testing_utils import require_torch, torch_device
+
+
+if is_torch_available():
+    import torch
+
+    from transformers import AutoModelForCausalLM, PrefixCache
+
+
+def _random_past(length, num_layers=2):
+    return tuple((torch.randn(1, 2, length, 4), torch.randn(1, 2, length, 4)) for _ in range(num_layers))
+
+
+@require_torch
+class PrefixCacheTest(unittest.TestCase):
+    def test_lookup_longest_prefix(self):
+        prefix_cache = PrefixCache(block_size=2)
+        past = _random_past(5)
+        prefix_cache.store([1, 2, 3, 4, 5], past)
+
+        # the match is found block by block, then extended token by token
+        length, cached_past = prefix_cache.lookup([1, 2, 3, 4, 9, 9])
+        self.assertEqual(length, 4)
+        self.assertTrue(torch.equal(cached_past[1][0], past[1][0][:, :, :4]))
+        length, _ = prefix_cache.lookup([1, 2, 3, 9])
+        self.assertEqual(length, 3)
+        length, _ = prefix_cache.lookup([1, 2, 3, 4, 5, 6], max_length=2)
+        self.assertEqual(length, 2)
+
+        # prompts need to share at least a block with a cached one
+        self.assertEqual(prefix_cache.lookup([1, 9, 3, 4]), (0, None))
+        self.assertEqual(prefix_cache.lookup([1]), (0, None))
+        self.assertEqual(prefix_cache.num_hits, 3)
+        self.assertEqual(prefix_cache.num_misses, 2)
+        self.assertEqual(prefix_cache.num_reused_tokens, 9)
+
+    def test_extended_prompt_replaces_cached_one(self):
+        prefix_cache = PrefixCache(block_size=2)
+        prefix_cache.store([1, 2, 3], _random_past(3))
+        prefix_cache.store([1, 2], _random_past(2))
+        self.assertEqual(len(prefix_cache), 1)
+
+        prefix_cache.store([1, 2, 3, 4, 5], _random_past(5))
+        self.assertEqual(len(prefix_cache), 1)
+        self.assertEqual(prefix_cache.lookup([1, 2, 3, 4, 5, 6])[0], 5)
+
+    def test_lru_eviction(self):
+        entry_bytes = sum(t.numel() * t.element_size() for layer in _random_past(4) for t in layer)
+        prefix_cache = PrefixCache(block_size=2, max_memory_bytes=2 * entry_bytes)
+        prefix_cache.store([1, 2, 3, 4], _random_past(4))
+        prefix_cache.store([5, 6, 7, 8], _random_past(4))
+        # refreshes the first prompt, so that the second one is evicted next
+        prefix_cache.lookup([1, 2, 3, 4])
+        prefix_cache.store([9, 10, 11, 12], _random_past(4))
+
+        self.assertEqual(len(prefix_cache), 2)
+        self.assertEqual(prefix_cache.num_bytes, 2 * entry_bytes)
+        self.assertEqual(prefix_cache.lookup([1, 2, 3, 4])[0], 4)
+        self.assertEqual(prefix_cache.lookup([5, 6, 7, 8])[0], 0)
+        self.assertEqual(prefix_cache.lookup([9, 10, 11, 12])[0], 4)
+
+        prefix_cache.clear()
+        self.assertEqual(len(prefix_cache), 0)
+        self.assertEqual(prefix_cache.num_bytes, 0)
+
+    def test_eviction_keeps_shared_blocks(self):
+        entry_bytes = sum(t.numel() * t.element_size() for layer in _random_past(5) for t in layer)
+        prefix_cache = PrefixCache(block_size=2, max_memory_bytes=2 * entry_bytes)
+        prefix_cache.store([1, 2, 3, 4, 5], _random_past(5))
+        prefix_cache.store([1, 2, 3, 4, 6], _random_past(5))
+        # refreshes the first prompt, so that the second one is evicted next
+        prefix_cache.lookup([1, 2, 3, 4, 5])
+        prefix_cache.store([7, 8, 9, 10, 11], _random_past(5))
+
+        # the blocks shared by the evicted prompt are still indexed for the remaining one
+        self.assertEqual(len(prefix_cache), 2)
+        self.assertEqual(prefix_cache.lookup([1, 2, 3, 4, 6, 6])[0], 4)
+        self.assertEqual(prefix_cache.lookup([1, 2, 3, 4, 5, 6])[0], 5)
+
+    def test_generate_matches_default(self):
+        model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2").to(torch_device)
+        model.generation_config.eos_token_id = -1
+        system_prompt = [3, 14, 15, 92, 6, 5, 35, 89, 79, 3, 23, 84]
+        prompts = [system_prompt + [62, 64], system_prompt + [33, 8, 32], system_prompt + [33, 8, 32, 2]]
+        prefix_cache = PrefixCache(block_size=4)
+
+        for generation_kwargs in ({"do_sample": False}, {"do_sample": False, "num_beams": 2}):
+            for prompt in prompts:
+                input_ids = torch.tensor([prompt], device=torch_device)
+                expected = model.generate(input_ids, max_new_tokens=5, **generation_kwargs)
+                output = model.generate(input_ids, max_new_tokens=5, prefix_cache=prefix_cache, **generation_kwargs)
+                self.assertListEqual(output.tolist(), expected.tolist())
+        # only the very first prompt was encoded from scratch
+        self.assertEqual(prefix_cache.num_misses, 1)
+        self.assertEqual(prefix_cache.num_hits, 5)
+
+    def test_generate_batched(self):
+        model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2").to(torch_device)
+        model.generation_config.eos_token_id = -1
+        model.generation_config.pad_token_id = 0
+        prefix_cache = PrefixCache(block_size=2)
+        model.generate(torch.tensor([[3, 14, 15, 92, 6, 5]], device=torch_device), prefix_cache=prefix_cache)
+
+        input_ids = torch.tensor([[3, 14, 15, 92, 7, 7], [3, 14, 15, 92, 6, 5]], device=torch_device)
+        expected = model.generate(input_ids, max_new_tokens=5)
+        output = model.generate(input_ids, max_new_tokens=5, prefix_cache=prefix_cache)
+        self.assertListEqual(output.tolist(), expected.tolist())
+        # both rows reuse the 4 tokens they have in common with the cache
+        self.assertEqual(prefix_cache.num_hits, 2)
+        self.assertEqual(prefix_cache.num_reused_tokens, 4 + 4)
+
+    def test_generate_batched_with_uncached_row(self):
+        model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2").to(torch_device)
+        model.generation_config.eos_token_id = -1
+        model.generation_config.pad_token_id = 0
+        prefix_cache = PrefixCache(block_size=2)
+        model.generate(torch.tensor([[3, 14, 15, 92, 6, 5]], device=torch_device), prefix_cache=prefix_cache)
+
+        # the second row shares no block with the cache, so nothing is reused for the batch
+        input_ids = torch.tensor([[3, 14, 15, 92, 6, 5], [33, 8, 32, 2, 7, 7]], device=torch_device)
+        expected = model.generate(input_ids, max_new_tokens=5)
+        output = model.generate(input_ids, max_new_tokens=5, prefix_cache=prefix_cache)
+        self.assertListEqual(output.tolist(), expected.tolist())
+        self.assertEqual(prefix_cache.num_hits, 0)
+        self.assertEqual(prefix_cache.num_misses, 1 + 2)
+        self.assertEqual(prefix_cache.num_reused_tokens, 0)
+
+    def test_unsupported_generation_modes(self):
+        model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2").to(torch_device)
+        input_ids = torch.tensor([[3, 14, 15, 92, 6]], device=torch_device)
+        with self.assertRaises(ValueError):
+            model.generate(input_ids, penalty_alpha=0.6, top_k=4, prefix_cache=PrefixCache())
+        with self.assertRaises(ValueError):
+            model.generate(input_ids, cache_implementation="static", prefix_cache=PrefixCache())
@@ -0,0 +1,73 @@
+# coding=utf-8
+# Copyright 2023 The HuggingFace Team Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a clone of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from transformers import is_torch_available
+from transformers.testing_utils import require_torch, torch_device
+
+
+if is_torch_available():
+    import torch
+
+    from transformers import AutoModelForCausalLM, GenerationProfiler
+
+
+@require_torch
+class GenerationProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2").to(torch_device)
+        self.input_ids = torch.randint(1, self.model.config.vocab_size, (2, 6), device=torch_device)
+
+    def test_greedy_search_profile(self):
+        steps, summaries = [], []
+        profiler = GenerationProfiler(on_step=steps.append, on_end=summaries.append)
+        output = self.model.generate(
+            self.input_ids, max_new_tokens=5, min_new_tokens=5, do_sample=False, profiler=profiler
+        )
+        self.assertEqual(output.shape[-1], 11)
+
+        self.assertEqual(len(steps), 5)
+        self.assertEqual([step.step for step in steps], list(range(5)))
+        self.assertTrue(all(step.num_new_tokens == 1 for step in steps))
+        # the cache grows by one position per step
+        self.assertTrue(all(step.past_key_values_bytes > 0 for step in steps))
+        self.assertTrue(all(a.past_key_values_bytes < b.past_key_values_bytes for a, b in zip(steps, steps[1:])))
+
+        self.assertEqual(len(summaries), 1)
+        summary = profiler.summary()
+        self.assertEqual(summary["num_steps"], 5)
+        self.assertEqual(summary["num_new_tokens"], 5)
+        self.assertEqual(summary["max_past_key_values_bytes"], steps[-1].past_key_values_bytes)
+        self.assertGreater(summary["time_to_first_token"], 0)
+        self.assertIsNotNone(summary["inter_token_latency"])
+        self.assertLessEqual(summary["inter_token_latency_p50"], summary["inter_token_latency_max"])
+        self.assertIn("forward", summary["phase_times"])
+        self.assertIn("sampling", summary["phase_times"])
+        self.assertIn("stopping_criteria", summary["phase_times"])
+        self.assertLessEqual(sum(summary["phase_times"].values()), summary["total_time"])
+
+    def test_beam_search_profile(self):
+        profiler = GenerationProfiler()
+        self.model.generate(
+            self.input_ids, max_new_tokens=4, min_new_tokens=4, num_beams=2, do_sample=False, profiler=profiler
+        )
+        summary = profiler.summary()
+        self.assertEqual(summary["num_steps"], 4)
+        self.assertIn("cache_update", summary["phase_times"])
+
+        # the profiler is reset by each call to `generate`
+        self.model.generate(self.input_ids, max_new_tokens=2, min_new_tokens=2, profiler=profiler)
+        self.assertEqual(profiler.summary()["num_steps"], 2)
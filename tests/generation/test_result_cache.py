@@ -0,0 +1,119 @@
+# coding=utf-8
+# Copyright 2023 The HuggingFace Team Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a clone of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import tempfile
+import unittest
+
+from transformers import is_torch_available
+from transformers.testing_utils import require_torch, torch_device
+
+
+if is_torch_available():
+    import torch
+
+    from transformers import AutoModelForCausalLM, LRUGenerationResultCache, SQLiteGenerationResultCache
+
+
+@require_torch
+class GenerationResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2").to(torch_device)
+        self.model.generation_config.pad_token_id = self.model.generation_config.eos_token_id
+        self.input_ids = torch.randint(1, self.model.config.vocab_size, (2, 6), device=torch_device)
+
+    def test_lru_cache(self):
+        result_cache = LRUGenerationResultCache(max_entries=2)
+        expected = self.model.generate(self.input_ids, max_new_tokens=5, do_sample=False)
+
+        for _ in range(2):
+            output = self.model.generate(self.input_ids, max_new_tokens=5, do_sample=False, result_cache=result_cache)
+            self.assertListEqual(output.tolist(), expected.tolist())
+        self.assertEqual(result_cache.metrics["hits"], 1)
+        self.assertEqual(result_cache.metrics["misses"], 1)
+        self.assertEqual(result_cache.metrics["num_bytes"], expected.numel() * expected.element_size())
+
+        # a different generation config or different inputs are different entries, and the oldest one is evicted
+        self.model.generate(self.input_ids, max_new_tokens=3, do_sample=False, result_cache=result_cache)
+        self.model.generate(self.input_ids[:1], max_new_tokens=5, do_sample=False, result_cache=result_cache)
+        self.assertEqual(result_cache.metrics["misses"], 3)
+        self.assertEqual(result_cache.metrics["evictions"], 1)
+        self.assertEqual(len(result_cache), 2)
+
+        # sampling without `sequence_seeds` is not cached
+        self.model.generate(self.input_ids, max_new_tokens=5, do_sample=True, result_cache=result_cache)
+        self.assertEqual(result_cache.metrics["bypasses"], 1)
+        seeded = self.model.generate(
+            self.input_ids, max_new_tokens=5, do_sample=True, sequence_seeds=[1, 2], result_cache=result_cache
+        )
+        cached = self.model.generate(
+            self.input_ids, max_new_tokens=5, do_sample=True, sequence_seeds=[1, 2], result_cache=result_cache
+        )
+        self.assertListEqual(cached.tolist(), seeded.tolist())
+        self.assertEqual(result_cache.metrics["hits"], 2)
+
+    def test_sqlite_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "results.sqlite")
+            result_cache = SQLiteGenerationResultCache(path)
+            expected = self.model.generate(self.input_ids, max_new_tokens=5, result_cache=result_cache)
+            result_cache.close()
+
+            # the results outlive the cache instance
+            result_cache = SQLiteGenerationResultCache(path, max_num_bytes=expected.numel() * expected.element_size())
+            output = self.model.generate(self.input_ids, max_new_tokens=5, result_cache=result_cache)
+            self.assertListEqual(output.tolist(), expected.tolist())
+            self.assertEqual(result_cache.metrics["hits"], 1)
+
+            self.model.generate(self.input_ids, max_new_tokens=4, result_cache=result_cache)
+            self.assertEqual(result_cache.metrics["evictions"], 1)
+            self.assertEqual(len(result_cache), 1)
+            result_cache.close()
+
+    def test_sqlite_cache_bypasses_unnamed_models(self):
+        # a model that wasn't loaded from a checkpoint is only identified by its `id`, which a later model can reuse
+        self.model.config._name_or_path = ""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result_cache = SQLiteGenerationResultCache(os.path.join(tmp_dir, "results.sqlite"))
+            self.model.generate(self.input_ids, max_new_tokens=5, result_cache=result_cache)
+            self.assertEqual(result_cache.metrics["bypasses"], 1)
+            self.assertEqual(len(result_cache), 0)
+            result_cache.close()
+
+        result_cache = LRUGenerationResultCache()
+        self.model.generate(self.input_ids, max_new_tokens=5, result_cache=result_cache)
+        self.assertEqual(result_cache.metrics["misses"], 1)
+        self.assertEqual(len(result_cache), 1)
+
+    def test_sqlite_cache_rejects_pickles(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "results.sqlite")
+            result_cache = SQLiteGenerationResultCache(path)
+            expected = self.model.generate(self.input_ids, max_new_tokens=5, result_cache=result_cache)
+
+            # a result written with `torch.save` is not loaded, as unpickling it could run arbitrary code
+            buffer = io.BytesIO()
+            torch.save(expected, buffer)
+            result_cache._connection.execute("UPDATE generation_results SET sequences = ?", (buffer.getvalue(),))
+            output = self.model.generate(self.input_ids, max_new_tokens=5, result_cache=result_cache)
+            self.assertListEqual(output.tolist(), expected.tolist())
+            self.assertEqual(result_cache.metrics["hits"], 0)
+            self.assertEqual(result_cache.metrics["misses"], 2)
+
+            # the unreadable row is replaced by the new result
+            self.model.generate(self.input_ids, max_new_tokens=5, result_cache=result_cache)
+            self.assertEqual(result_cache.metrics["hits"], 1)
+            result_cache.close()
@@ -13,11 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import unittest
 from queue import Empty
 from threading import Thread
 
-from transformers import AutoTokenizer, TextIteratorStreamer, TextStreamer, is_torch_available
+from transformers import (
+    AsyncTextIteratorStreamer,
+    AutoTokenizer,
+    TextIteratorStreamer,
+    TextStreamer,
+    is_torch_available,
+)
 from transformers.testing_utils import CaptureStdout, require_torch, torch_device
 
 from ..test_modeling_common import ids_tensor
@@ -120,3 +127,55 @@ class StreamerTester(unittest.TestCase):
             streamer_text = ""
             for new_text in streamer:
                 streamer_text += new_text
+
+    def test_async_streamer_batched_matches_non_streaming(self):
+        tokenizer = AutoTokenizer.from_pretrained("hf-internal-testing/tiny-random-gpt2")
+        model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2").to(torch_device)
+        model.config.eos_token_id = -1
+
+        input_ids = ids_tensor((3, 5), vocab_size=model.config.vocab_size).to(torch_device)
+        greedy_ids = model.generate(input_ids, max_new_tokens=10, do_sample=False)
+        greedy_texts = [tokenizer.decode(sequence_ids) for sequence_ids in greedy_ids]
+
+        async def stream():
+            streamer = AsyncTextIteratorStreamer(tokenizer, max_queue_size=2, eos_token_id=-1)
+            generation_kwargs = {"input_ids": input_ids, "max_new_tokens": 10, "do_sample": False}
+            generation = asyncio.get_running_loop().run_in_executor(
+                None, lambda: model.generate(**generation_kwargs, streamer=streamer)
+            )
+
+            async def consume(sequence_idx):
+                return "".join([new_text async for new_text in streamer[sequence_idx]])
+
+            streamer_texts = await asyncio.gather(*[consume(sequence_idx) for sequence_idx in range(3)])
+            await generation
+            return streamer_texts
+
+        self.assertListEqual(asyncio.run(stream()), greedy_texts)
+
+    def test_async_streamer_cancellation_stops_generation(self):
+        tokenizer = AutoTokenizer.from_pretrained("hf-internal-testing/tiny-random-gpt2")
+        model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2").to(torch_device)
+        model.config.eos_token_id = -1
+
+        input_ids = ids_tensor((1, 5), vocab_size=model.config.vocab_size).to(torch_device)
+
+        async def stream():
+            streamer = AsyncTextIteratorStreamer(tokenizer, max_queue_size=1, eos_token_id=-1)
+            generation_kwargs = {
+                "input_ids": input_ids,
+                "max_new_tokens": 100,
+                "do_sample": False,
+                "streamer": streamer,
+                "stopping_criteria": streamer.stopping_criteria,
+            }
+            generation = asyncio.get_running_loop().run_in_executor(None, lambda: model.generate(**generation_kwargs))
+
+            # the stream is cancelled after the first piece of text: as the queue only holds a single piece of text,
+            # generation can't get far ahead of the consumer, and stops once it notices the cancellation
+            async for _ in streamer:
+                streamer.cancel()
+            return await generation
+
+        output_ids = asyncio.run(stream())
+        self.assertLess(output_ids.shape[1], input_ids.shape[1] + 100)
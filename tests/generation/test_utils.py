@@ -72,6 +72,8 @@ if is_torch_available():
         TopKLogitsWarper,
         TopPLogitsWarper,
     )
+    from transformers.generation.candidate_generator import PromptLookupCandidateGenerator
+    from transformers.generation.utils import _speculative_sampling
 
 
 class GenerationTesterMixin:
@@ -1467,7 +1469,7 @@ class GenerationTesterMixin:
             ):
                 return
 
-            config, input_ids, attention_mask, max_length = self._get_input_ids_and_config(batch_size=1)
+            config, input_ids, attention_mask, max_length = self._get_input_ids_and_config()
 
             # NOTE: contrastive search only works with cache on at the moment.
             if not hasattr(config, "use_cache"):
@@ -1476,7 +1478,7 @@ class GenerationTesterMixin:
             config.use_cache = True
             config.is_decoder = True
 
-            # test output equality of low versus high memory
+            # test output equality of low versus high memory, on a batch: the selected candidates are gathered per row
             model = model_class(config).to(torch_device).eval()
 
             low_output = model.generate(
@@ -1488,6 +1490,21 @@ class GenerationTesterMixin:
                 attention_mask=attention_mask,
             )
 
+            low_output_dict = model.generate(
+                input_ids,
+                top_k=4,
+                penalty_alpha=0.6,
+                low_memory=True,
+                max_length=max_length,
+                attention_mask=attention_mask,
+                output_scores=True,
+                output_hidden_states=True,
+                output_attentions=True,
+                return_dict_in_generate=True,
+            )
+            self.assertListEqual(low_output_dict.sequences.tolist(), low_output.tolist())
+            self._check_outputs(low_output_dict, input_ids, model.config, use_cache=True)
+
             high_output = model.generate(
                 input_ids,
                 top_k=4,
@@ -1507,7 +1524,6 @@ class GenerationTesterMixin:
         # - assisted_decoding, contrarily to the other methods, can't be called on its own (e.g. needs to
         # prepare the assistant encoder outputs in the main generate body);
         # - assisted_decoding does not support `use_cache = False`
-        # - assisted_decoding does not support `batch_size > 1`
 
         for model_class in self.all_generative_model_classes:
             # won't fix: FSMT and Reformer have a different cache variable type (and format).
@@ -2050,6 +2066,56 @@ class UtilsFunctionsTest(unittest.TestCase):
 
         self.assertTrue(torch.allclose(expected_output, output, atol=1e-12))
 
+    def test_speculative_sampling_keeps_model_distribution(self):
+        # whatever the distribution the candidates are drawn from, the first new token follows the model distribution
+        torch.manual_seed(0)
+        num_sequences = 20000
+        model_probs = torch.tensor([0.5, 0.3, 0.15, 0.05], device=torch_device)
+        candidate_probs = torch.tensor([0.1, 0.2, 0.3, 0.4], device=torch_device)
+
+        for num_branches in (1, 3):
+            num_rows = num_sequences * num_branches
+            candidate_new_tokens = torch.multinomial(candidate_probs, num_rows, replacement=True).view(num_rows, 1)
+            selected_tokens, num_accepted, _ = _speculative_sampling(
+                candidate_new_tokens,
+                candidate_probs.expand(num_rows, 1, 4),
+                model_probs.expand(num_rows, 2, 4),
+                num_branches,
+            )
+            self.assertEqual(selected_tokens.shape, (num_sequences, 2))
+            frequencies = torch.bincount(selected_tokens[:, 0], minlength=4).float() / num_sequences
+            self.assertTrue(torch.allclose(frequencies, model_probs, atol=0.02))
+
+        # deterministic candidates, e.g. drafted greedily, are accepted with the probability the model gives them
+        candidate_new_tokens = torch.full((num_sequences, 1), 3, device=torch_device)
+        selected_tokens, num_accepted, _ = _speculative_sampling(
+            candidate_new_tokens, None, model_probs.expand(num_sequences, 2, 4), 1
+        )
+        frequencies = torch.bincount(selected_tokens[:, 0], minlength=4).float() / num_sequences
+        self.assertTrue(torch.allclose(frequencies, model_probs, atol=0.02))
+        self.assertAlmostEqual(num_accepted.float().mean().item(), 0.05, delta=0.02)
+
+    def test_prompt_lookup_candidate_generator(self):
+        candidate_generator = PromptLookupCandidateGenerator(num_output_tokens=3, max_matching_ngram_size=2)
+        input_ids = torch.tensor([[5, 6, 7, 8, 9, 5, 6], [1, 2, 3, 1, 2, 4, 2]], device=torch_device)
+
+        # the longest n-gram is looked up first, then shorter ones, the most recent occurrences first. Sequences with
+        # fewer candidates are completed with their last token
+        candidate_input_ids, candidate_probs = candidate_generator.get_candidates(input_ids, num_branches=2)
+        self.assertIsNone(candidate_probs)
+        self.assertListEqual(candidate_input_ids[:, 7:].tolist(), [[7, 8, 9], [7, 8, 9], [4, 2, 2], [3, 1, 2]])
+
+        # the index is extended with the new tokens only
+        input_ids = torch.cat([input_ids, torch.tensor([[7, 8], [3, 1]], device=torch_device)], dim=-1)
+        candidate_input_ids, _ = candidate_generator.get_candidates(input_ids)
+        self.assertListEqual(candidate_input_ids[:, 9:].tolist(), [[9, 5, 6], [2, 4, 2]])
+
+        # no earlier occurrence: no candidate
+        candidate_generator = PromptLookupCandidateGenerator()
+        input_ids = torch.tensor([[1, 2, 3]], device=torch_device)
+        candidate_input_ids, _ = candidate_generator.get_candidates(input_ids)
+        self.assertListEqual(candidate_input_ids.tolist(), input_ids.tolist())
+
 
 @require_torch
 class GenerationIntegrationTests(unittest.TestCase, GenerationIntegrationTestsMixin):
@@ -2822,3 +2888,152 @@ class GenerationIntegrationTests(unittest.TestCase, GenerationIntegrationTestsMi
         with self.assertRaises(TypeError):
             # FakeEncoder.forward() accepts **kwargs -> no filtering -> type error due to unexpected input "foo"
             bart_model.generate(input_ids, foo="bar")
+
+    def test_assisted_decoding_batched(self):
+        tokenizer = AutoTokenizer.from_pretrained("hf-internal-testing/tiny-random-gpt2", padding_side="left")
+        tokenizer.pad_token = tokenizer.eos_token
+        model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2").to(torch_device)
+        model.generation_config.pad_token_id = tokenizer.eos_token_id
+        inputs = tokenizer(["Hello world", "Today is a nice day and"], return_tensors="pt", padding=True).to(
+            torch_device
+        )
+        expected = model.generate(**inputs, max_new_tokens=10, do_sample=False)
+
+        # with the model as its own assistant, all the candidates are accepted
+        for generation_kwargs in (
+            {},
+            {"num_draft_branches": 3},
+            {"num_draft_branches": 3, "cache_implementation": "paged"},
+        ):
+            output = model.generate(
+                **inputs, max_new_tokens=10, do_sample=False, assistant_model=model, **generation_kwargs
+            )
+            self.assertListEqual(output.tolist(), expected.tolist())
+
+        output = model.generate(
+            **inputs, max_new_tokens=10, min_new_tokens=10, do_sample=True, assistant_model=model, num_draft_branches=2
+        )
+        self.assertEqual(output.shape, expected.shape)
+
+    def test_prompt_lookup_decoding_matches_greedy_search(self):
+        tokenizer = AutoTokenizer.from_pretrained("hf-internal-testing/tiny-random-gpt2", padding_side="left")
+        tokenizer.pad_token = tokenizer.eos_token
+        model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2").to(torch_device)
+        model.generation_config.pad_token_id = tokenizer.eos_token_id
+        inputs = tokenizer(
+            ["The cat sat on the mat. The cat sat on the", "def f(x): return x\ndef g(x): return"],
+            return_tensors="pt",
+            padding=True,
+        ).to(torch_device)
+        expected = model.generate(**inputs, max_new_tokens=10, do_sample=False)
+
+        for generation_kwargs in ({}, {"num_draft_branches": 2}):
+            output = model.generate(
+                **inputs, max_new_tokens=10, do_sample=False, prompt_lookup_num_tokens=4, **generation_kwargs
+            )
+            self.assertListEqual(output.tolist(), expected.tolist())
+
+        output = model.generate(
+            **inputs, max_new_tokens=10, min_new_tokens=10, do_sample=True, prompt_lookup_num_tokens=4
+        )
+        self.assertEqual(output.shape, expected.shape)
+
+        with self.assertRaises(ValueError):
+            model.generate(**inputs, assistant_model=model, prompt_lookup_num_tokens=4)
+
+    def test_chunked_prefill_matches_generate(self):
+        tokenizer = AutoTokenizer.from_pretrained("hf-internal-testing/tiny-random-gpt2", padding_side="left")
+        tokenizer.pad_token = tokenizer.eos_token
+        model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2").to(torch_device)
+        model.generation_config.pad_token_id = tokenizer.eos_token_id
+        inputs = tokenizer(
+            ["Hello world", "Today is a nice day and the sun is shining over the hills"],
+            return_tensors="pt",
+            padding=True,
+        ).to(torch_device)
+
+        for generation_kwargs in ({}, {"num_beams": 2}, {"cache_implementation": "static"}):
+            expected = model.generate(**inputs, max_new_tokens=10, do_sample=False, **generation_kwargs)
+            for prefill_chunk_size in (1, 3, 100):
+                output = model.generate(
+                    **inputs,
+                    max_new_tokens=10,
+                    do_sample=False,
+                    prefill_chunk_size=prefill_chunk_size,
+                    **generation_kwargs,
+                )
+                self.assertListEqual(output.tolist(), expected.tolist())
+
+        with self.assertRaises(ValueError):
+            model.generate(**inputs, penalty_alpha=0.6, top_k=4, prefill_chunk_size=3)
+        with self.assertRaises(ValueError):
+            model.generate(**inputs, prefill_chunk_size=0)
+
+    def test_compact_finished_sequences_matches_generate(self):
+        tokenizer = AutoTokenizer.from_pretrained("hf-internal-testing/tiny-random-gpt2", padding_side="left")
+        tokenizer.pad_token = tokenizer.eos_token
+        model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2").to(torch_device)
+        model.generation_config.pad_token_id = tokenizer.eos_token_id
+        inputs = tokenizer(
+            ["Hello world", "Today is a nice day", "The sun is shining over the hills"],
+            return_tensors="pt",
+            padding=True,
+        ).to(torch_device)
+        prompt_length = inputs["input_ids"].shape[-1]
+
+        # pick end-of-sequence tokens so that the sequences finish at different steps
+        reference = model.generate(**inputs, max_new_tokens=10, do_sample=False, eos_token_id=None)
+        eos_token_id = [reference[0, prompt_length + 1].item(), reference[1, prompt_length + 4].item()]
+
+        for generation_kwargs in ({}, {"cache_implementation": "static"}):
+            expected = model.generate(
+                **inputs, max_new_tokens=10, do_sample=False, eos_token_id=eos_token_id, **generation_kwargs
+            )
+            output = model.generate(
+                **inputs,
+                max_new_tokens=10,
+                do_sample=False,
+                eos_token_id=eos_token_id,
+                compact_finished_sequences=True,
+                **generation_kwargs,
+            )
+            self.assertListEqual(output.tolist(), expected.tolist())
+
+        with self.assertRaises(ValueError):
+            model.generate(**inputs, compact_finished_sequences=True, guidance_scale=1.5)
+        with self.assertRaises(ValueError):
+            model.generate(
+                **inputs,
+                compact_finished_sequences=True,
+                return_dict_in_generate=True,
+                output_scores=True,
+            )
+
+    def test_sequence_seeds_batch_invariance(self):
+        model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2").to(torch_device)
+        model.generation_config.pad_token_id = model.generation_config.eos_token_id
+        input_ids = torch.tensor([[11, 24, 35, 7, 90], [3, 54, 12, 86, 29]], device=torch_device)
+        generation_kwargs = {"do_sample": True, "top_k": 0, "max_new_tokens": 10, "min_new_tokens": 10}
+
+        torch.manual_seed(0)
+        batched = model.generate(input_ids, sequence_seeds=[5, 7], **generation_kwargs)
+        torch.manual_seed(1)
+        single = model.generate(input_ids[1:], sequence_seeds=7, **generation_kwargs)
+        swapped = model.generate(input_ids.flip(0), sequence_seeds=[7, 5], **generation_kwargs)
+        self.assertListEqual(single[0].tolist(), batched[1].tolist())
+        self.assertListEqual(swapped.flip(0).tolist(), batched.tolist())
+
+        # the first of the `num_return_sequences` sequences of a prompt keeps the seed of the prompt
+        returned = model.generate(input_ids, sequence_seeds=[5, 7], num_return_sequences=2, **generation_kwargs)
+        self.assertListEqual(returned[::2].tolist(), batched.tolist())
+
+        torch.manual_seed(0)
+        expected = model.generate(input_ids, sequence_seeds=[5, 7], num_beams=2, **generation_kwargs)
+        torch.manual_seed(1)
+        output = model.generate(input_ids, sequence_seeds=[5, 7], num_beams=2, **generation_kwargs)
+        self.assertListEqual(output.tolist(), expected.tolist())
+
+        with self.assertRaises(ValueError):
+            model.generate(input_ids, sequence_seeds=[5, 7], max_new_tokens=3)
+        with self.assertRaises(ValueError):
+            model.generate(input_ids, sequence_seeds=[5, 7, 9], do_sample=True, max_new_tokens=3)
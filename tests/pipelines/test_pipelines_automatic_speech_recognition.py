@@ -31,7 +31,11 @@ from transformers import (
 )
 from transformers.pipelines import AutomaticSpeechRecognitionPipeline, pipeline
 from transformers.pipelines.audio_utils import chunk_bytes_iter
-from transformers.pipelines.automatic_speech_recognition import _find_timestamp_sequence, chunk_iter
+from transformers.pipelines.automatic_speech_recognition import (
+    _AudioStreamChunker,
+    _find_timestamp_sequence,
+    chunk_iter,
+)
 from transformers.testing_utils import (
     is_pipeline_test,
     is_torch_available,
@@ -1187,6 +1191,81 @@ class AutomaticSpeechRecognitionPipelineTests(unittest.TestCase):
         # (85, 100)
         self.assertEqual(nested_simplify(input_values[:, 80:100]), nested_simplify(outs[4]["input_values"]))
 
+    @require_torch
+    def test_audio_stream_chunker(self):
+        feature_extractor = AutoFeatureExtractor.from_pretrained("facebook/wav2vec2-base-960h")
+        inputs = np.arange(100, dtype=np.float32)
+        for chunk_len, stride_left, stride_right in [(100, 0, 0), (80, 0, 0), (105, 5, 5), (36, 6, 6), (90, 20, 0)]:
+            expected = list(chunk_iter(inputs, feature_extractor, chunk_len, stride_left, stride_right))
+            chunker = _AudioStreamChunker(feature_extractor, chunk_len, stride_left, stride_right)
+            outs = []
+            # the audio is received in pieces of 7 samples
+            for start in range(0, inputs.shape[0], 7):
+                outs.extend(chunker.add_audio(inputs[start : start + 7]))
+            outs.extend(chunker.end())
+            self.assertEqual([o["stride"] for o in outs], [o["stride"] for o in expected])
+            self.assertEqual(
+                nested_simplify([o["input_values"] for o in outs]),
+                nested_simplify([o["input_values"] for o in expected]),
+            )
+            if stride_right > 0:
+                # without right stride, a full chunk can only be known to be the last one once the stream ends
+                self.assertEqual([o["is_last"] for o in outs], [o["is_last"] for o in expected])
+
+    @require_torch
+    def test_transcribe_stream_ctc_fast(self):
+        speech_recognizer = pipeline(
+            task="automatic-speech-recognition",
+            model="hf-internal-testing/tiny-random-wav2vec2",
+        )
+        ds = load_dataset("hf-internal-testing/librispeech_asr_dummy", "clean", split="validation").sort("id")
+        audio = np.tile(ds[40]["audio"]["array"], 2)
+        expected = speech_recognizer(audio, chunk_length_s=2.0, stride_length_s=0.5)
+
+        # the audio is received in pieces of 0.1s, as from a microphone
+        audio_stream = (audio[start : start + 1600] for start in range(0, audio.shape[0], 1600))
+        outputs = list(speech_recognizer.transcribe_stream(audio_stream, chunk_length_s=2.0, stride_length_s=0.5))
+        self.assertEqual([output["is_last"] for output in outputs], [False] * (len(outputs) - 1) + [True])
+        self.assertEqual(outputs[-1]["partial_text"], "")
+        self.assertEqual("".join(output["text"] for output in outputs), expected["text"])
+
+    @require_torch
+    def test_transcribe_stream_batcher(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        from transformers.pipelines import DynamicBatcher
+
+        speech_recognizer = pipeline(
+            task="automatic-speech-recognition",
+            model="hf-internal-testing/tiny-random-wav2vec2",
+        )
+        ds = load_dataset("hf-internal-testing/librispeech_asr_dummy", "clean", split="validation").sort("id")
+        audio = ds[40]["audio"]["array"]
+
+        def transcribe(batcher=None):
+            audio_stream = (audio[start : start + 1600] for start in range(0, audio.shape[0], 1600))
+            outputs = speech_recognizer.transcribe_stream(audio_stream, chunk_length_s=1.0, batcher=batcher)
+            return [output["text"] for output in outputs]
+
+        expected = transcribe()
+
+        num_forward_calls = []
+        forward = speech_recognizer.model.forward
+
+        def counting_forward(*args, **kwargs):
+            num_forward_calls.append(1)
+            return forward(*args, **kwargs)
+
+        speech_recognizer.model.forward = counting_forward
+        # the two streams wait for each other, so that the same chunks of both are transcribed together
+        with DynamicBatcher(speech_recognizer, max_batch_size=2, max_wait_ms=1000) as batcher:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                futures = [executor.submit(transcribe, batcher) for _ in range(2)]
+                outputs = [future.result() for future in futures]
+        self.assertEqual(outputs, [expected, expected])
+        # one forward pass per chunk of a stream, without the update of the end of the stream
+        self.assertEqual(len(num_forward_calls), len(expected) - 1)
+
     @require_torch
     def test_stride(self):
         speech_recognizer = pipeline(
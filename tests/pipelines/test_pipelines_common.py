@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import gc
 import logging
 import os
@@ -486,6 +487,93 @@ class PipelineUtilsTest(unittest.TestCase):
         outputs = list(dataset)
         self.assertEqual(outputs, [[{"id": 2}, {"id": 3}, {"id": 4}, {"id": 5}]])
 
+    @require_torch
+    def test_pipeline_bucket_reorder_iterator(self):
+        import torch
+
+        from transformers.pipelines.pt_utils import PipelineBucketIterator, PipelineIterator, PipelineReorderIterator
+
+        lengths = [5, 1, 4, 2, 3, 6, 1]
+        dummy_dataset = [{"input_ids": torch.zeros((1, length), dtype=torch.long)} for length in lengths]
+
+        def collate(items):
+            return {"length": torch.tensor([item["input_ids"].shape[-1] for item in items])}
+
+        # the window is rounded up to 4 items
+        bucket_iterator = PipelineBucketIterator(dummy_dataset, collate, batch_size=2, bucket_window=3)
+        self.assertEqual(len(bucket_iterator), 4)
+        batches = [batch["length"].tolist() for batch in bucket_iterator]
+        self.assertEqual(batches, [[1, 2], [4, 5], [1, 3], [6]])
+
+        model_iterator = PipelineIterator(bucket_iterator, lambda batch: batch, {}, loader_batch_size=2)
+        outputs = list(PipelineReorderIterator(model_iterator, bucket_iterator))
+        self.assertEqual([output["length"].item() for output in outputs], lengths)
+
+    @require_torch
+    def test_pipeline_bucket_window(self):
+        classifier = pipeline("text-classification", model="hf-internal-testing/tiny-random-distilbert")
+        inputs = ["A much longer test input, padded by the others", "Short", "Another test", "This is a test", "Hi"]
+        expected = classifier(inputs, batch_size=1)
+        outputs = classifier(inputs, batch_size=2, bucket_window=4)
+        self.assertEqual(nested_simplify(outputs, decimals=3), nested_simplify(expected, decimals=3))
+
+    @require_torch
+    def test_pipeline_staged_iterator(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        from transformers.pipelines.pt_utils import PipelineStagedIterator
+
+        dummy_dataset = [0, 1, 2, 3, 4, 5]
+
+        def add(number, extra=0):
+            return number + extra
+
+        executor = ThreadPoolExecutor(max_workers=2)
+        dataset = PipelineStagedIterator(dummy_dataset, add, {"extra": 2}, executor, max_pending=3)
+        self.assertEqual(len(dataset), 6)
+        self.assertEqual(list(dataset), [2, 3, 4, 5, 6, 7])
+
+        def repeat(number):
+            return [number] * number
+
+        dataset = PipelineStagedIterator(
+            [0, 1, 2, 3], repeat, {}, executor, max_pending=2, flatten=True, shutdown_executor=True
+        )
+        self.assertEqual(list(dataset), [1, 2, 2, 3, 3, 3])
+        with self.assertRaises(RuntimeError):
+            executor.submit(repeat, 1)
+
+        def invert(number):
+            return 1 / number
+
+        # the executor is shut down when a stage raises, or when the outputs are not consumed to the end
+        executor = ThreadPoolExecutor(max_workers=2)
+        dataset = PipelineStagedIterator([1, 0, 2], invert, {}, executor, max_pending=2, shutdown_executor=True)
+        with self.assertRaises(ZeroDivisionError):
+            list(dataset)
+        with self.assertRaises(RuntimeError):
+            executor.submit(invert, 1)
+
+        executor = ThreadPoolExecutor(max_workers=2)
+        dataset = iter(PipelineStagedIterator(dummy_dataset, add, {}, executor, max_pending=3, shutdown_executor=True))
+        self.assertEqual(next(dataset), 0)
+        dataset.close()
+        with self.assertRaises(RuntimeError):
+            executor.submit(add, 1)
+
+    @require_torch
+    def test_pipeline_stage_workers(self):
+        classifier = pipeline("text-classification", model="hf-internal-testing/tiny-random-distilbert")
+        inputs = ["This is a test", "Another test", "A much longer test input to pad the others", "Short", "Hi"]
+        expected = classifier(inputs, batch_size=1)
+        outputs = classifier(inputs, batch_size=2, stage_workers=2)
+        self.assertEqual(nested_simplify(outputs, decimals=3), nested_simplify(expected, decimals=3))
+        outputs = classifier(inputs, batch_size=2, stage_workers=2, bucket_window=4)
+        self.assertEqual(nested_simplify(outputs, decimals=3), nested_simplify(expected, decimals=3))
+
+        with self.assertRaises(ValueError):
+            classifier(inputs, stage_workers=2, stage_executor="gpu")
+
     def test_pipeline_negative_device(self):
         # To avoid regressing, pipeline used to accept device=-1
         classifier = pipeline("text-generation", "hf-internal-testing/tiny-random-bert", device=-1)
@@ -494,6 +582,108 @@ class PipelineUtilsTest(unittest.TestCase):
         actual_output = classifier("Test input.")
         self.assertEqual(expected_output, actual_output)
 
+    @require_torch
+    def test_dynamic_batcher(self):
+        from transformers.pipelines import DynamicBatcher
+
+        classifier = pipeline("text-classification", model="hf-internal-testing/tiny-random-distilbert")
+        inputs = ["This is a test", "Another test", "A much longer test input to pad the others", "Short"]
+        # the batcher returns the outputs of `postprocess`, not wrapped in a list as for a single text
+        expected = classifier(inputs)
+
+        num_forward_calls = []
+        forward = classifier.model.forward
+
+        def counting_forward(*args, **kwargs):
+            num_forward_calls.append(1)
+            return forward(*args, **kwargs)
+
+        classifier.model.forward = counting_forward
+        with DynamicBatcher(classifier, max_batch_size=4, max_wait_ms=1000) as batcher:
+            futures = [batcher.submit(text) for text in inputs]
+            outputs = [future.result() for future in futures]
+        self.assertEqual(nested_simplify(outputs, decimals=3), nested_simplify(expected, decimals=3))
+        self.assertEqual(len(num_forward_calls), 1)
+
+        with self.assertRaises(ValueError):
+            batcher.submit("This is a test")
+
+    @require_torch
+    def test_dynamic_batcher_acall(self):
+        from transformers.pipelines import DynamicBatcher
+
+        classifier = pipeline("text-classification", model="hf-internal-testing/tiny-random-distilbert")
+        inputs = ["This is a test", "Another test", "A much longer test input to pad the others", "Short"]
+        expected = classifier(inputs)
+
+        num_forward_calls = []
+        forward = classifier.model.forward
+
+        def counting_forward(*args, **kwargs):
+            num_forward_calls.append(1)
+            return forward(*args, **kwargs)
+
+        classifier.model.forward = counting_forward
+
+        async def run(batcher):
+            outputs = await asyncio.gather(*(batcher.acall(text) for text in inputs))
+
+            # the batcher waits for more inputs while the call is cancelled
+            cancelled_call = asyncio.ensure_future(batcher.acall("This call is cancelled"))
+            await asyncio.sleep(0.1)
+            cancelled_call.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await cancelled_call
+            output = await batcher.acall(inputs[0])
+            return outputs, output
+
+        with DynamicBatcher(classifier, max_batch_size=4, max_wait_ms=1000) as batcher:
+            outputs, output = asyncio.run(run(batcher))
+        self.assertEqual(nested_simplify(outputs, decimals=3), nested_simplify(expected, decimals=3))
+        self.assertEqual(nested_simplify(output, decimals=3), nested_simplify(expected[0], decimals=3))
+        self.assertEqual(len(num_forward_calls), 2)
+
+    @require_torch
+    def test_pipeline_acall_astream(self):
+        classifier = pipeline("text-classification", model="hf-internal-testing/tiny-random-distilbert")
+        inputs = ["This is a test", "Another test", "Short"]
+        expected = classifier(inputs)
+
+        async def run():
+            outputs = await asyncio.gather(*(classifier.acall(text) for text in inputs))
+            streamed_outputs = [output async for output in classifier.astream(inputs, batch_size=2)]
+            return outputs, streamed_outputs
+
+        outputs, streamed_outputs = asyncio.run(run())
+        # a single text gets a list of outputs, as with `__call__`
+        self.assertEqual(nested_simplify(outputs, decimals=3), nested_simplify([[x] for x in expected], decimals=3))
+        self.assertEqual(nested_simplify(streamed_outputs, decimals=3), nested_simplify(expected, decimals=3))
+
+    @require_torch
+    def test_dynamic_batcher_chunk_pipeline(self):
+        from transformers.pipelines import DynamicBatcher
+
+        zero_shot_classifier = pipeline(
+            "zero-shot-classification", model="sshleifer/tiny-distilbert-base-cased-distilled-squad"
+        )
+        candidate_labels = ["politics", "public health", "science"]
+        inputs = ["Who are you voting for in 2020?", "The vaccine trial starts next week"]
+
+        with DynamicBatcher(
+            zero_shot_classifier, max_batch_size=8, max_wait_ms=1000, candidate_labels=candidate_labels
+        ) as batcher:
+            futures = [batcher.submit(text) for text in inputs]
+            outputs = [future.result() for future in futures]
+
+        for text, output in zip(inputs, outputs):
+            expected = zero_shot_classifier(text, candidate_labels=candidate_labels)
+            self.assertEqual(output["sequence"], text)
+            self.assertEqual(sorted(output["labels"]), candidate_labels)
+            self.assertEqual(
+                nested_simplify(sorted(output["scores"]), decimals=3),
+                nested_simplify(sorted(expected["scores"]), decimals=3),
+            )
+
     @slow
     @require_torch
     def test_load_default_pipelines_pt(self):
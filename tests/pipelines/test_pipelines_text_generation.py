@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import unittest
 
 from transformers import (
@@ -357,3 +358,33 @@ class TextGenerationPipelineTests(unittest.TestCase):
         with CaptureLogger(logger) as cl:
             _ = text_generator(prompt, max_length=10)
         self.assertNotIn(logger_msg, cl.out)
+
+    @require_torch
+    def test_result_cache(self):
+        from transformers import LRUGenerationResultCache
+
+        result_cache = LRUGenerationResultCache()
+        text_generator = pipeline(
+            "text-generation", model="hf-internal-testing/tiny-random-gpt2", result_cache=result_cache
+        )
+        expected = text_generator("Hello world", do_sample=False, max_new_tokens=5)
+        outputs = text_generator("Hello world", do_sample=False, max_new_tokens=5)
+        self.assertEqual(outputs, expected)
+        self.assertEqual(result_cache.metrics["hits"], 1)
+
+    @require_torch
+    def test_astream(self):
+        text_generator = pipeline("text-generation", model="hf-internal-testing/tiny-random-gpt2")
+        outputs = text_generator("Hello world", do_sample=False, max_new_tokens=5, return_tensors=True)
+        prompt_length = len(text_generator.tokenizer("Hello world")["input_ids"])
+        expected = text_generator.tokenizer.decode(
+            outputs[0]["generated_token_ids"][prompt_length:], skip_special_tokens=True
+        )
+
+        async def stream():
+            new_texts = []
+            async for new_text in text_generator.astream("Hello world", do_sample=False, max_new_tokens=5):
+                new_texts.append(new_text)
+            return new_texts
+
+        self.assertEqual("".join(asyncio.run(stream())), expected)
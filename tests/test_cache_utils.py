@@ -0,0 +1,431 @@
+# coding=utf-8
+# Copyright 2023 The HuggingFace Team Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a clone of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from parameterized import parameterized
+
+from transformers import is_torch_available
+from transformers.testing_utils import require_torch, torch_device
+
+
+if is_torch_available():
+    import torch
+
+    from transformers import (
+        AutoModelForCausalLM,
+        FalconConfig,
+        GPT2Config,
+        GPTNeoXConfig,
+        LlamaConfig,
+        MptConfig,
+        OPTConfig,
+        PagedCache,
+        QuantizedCache,
+        SinkCache,
+        StaticCache,
+    )
+
+
+@require_torch
+class StaticCacheTest(unittest.TestCase):
+    def test_update_matches_concatenation(self):
+        cache = StaticCache(max_cache_len=10)
+        self.assertFalse(cache)
+
+        past_key = torch.randn(2, 4, 3, 8)
+        past_value = torch.randn(2, 4, 3, 8)
+        key, value = cache.update(past_key, past_value, layer_idx=0)
+        self.assertTrue(torch.equal(key, past_key))
+        self.assertTrue(torch.equal(value, past_value))
+
+        new_key = torch.randn(2, 4, 1, 8)
+        new_value = torch.randn(2, 4, 1, 8)
+        key, value = cache.update(new_key, new_value, layer_idx=0)
+        self.assertTrue(torch.equal(key, torch.cat([past_key, new_key], dim=2)))
+        self.assertTrue(torch.equal(value, torch.cat([past_value, new_value], dim=2)))
+        self.assertEqual(cache.get_seq_length(), 4)
+        self.assertEqual(cache.get_max_length(), 10)
+        self.assertTrue(cache)
+
+    def test_buffers_are_allocated_once(self):
+        cache = StaticCache(max_cache_len=5)
+        cache.update(torch.randn(1, 2, 2, 4), torch.randn(1, 2, 2, 4), layer_idx=0)
+        key_buffer = cache.key_cache[0]
+        for _ in range(3):
+            cache.update(torch.randn(1, 2, 1, 4), torch.randn(1, 2, 1, 4), layer_idx=0)
+        self.assertIs(cache.key_cache[0], key_buffer)
+        self.assertEqual(key_buffer.data_ptr(), cache.key_cache[0].data_ptr())
+
+        with self.assertRaises(ValueError):
+            cache.update(torch.randn(1, 2, 1, 4), torch.randn(1, 2, 1, 4), layer_idx=0)
+
+    def test_reorder_and_crop(self):
+        cache = StaticCache(max_cache_len=6)
+        key = torch.randn(3, 2, 4, 4)
+        value = torch.randn(3, 2, 4, 4)
+        cache.update(key, value, layer_idx=0)
+
+        beam_idx = torch.tensor([2, 2, 0])
+        cache.reorder_cache(beam_idx)
+        legacy_key, legacy_value = cache.to_legacy_cache()[0]
+        self.assertTrue(torch.equal(legacy_key, key[beam_idx]))
+        self.assertTrue(torch.equal(legacy_value, value[beam_idx]))
+
+        cache.crop(2)
+        self.assertEqual(cache.get_seq_length(), 2)
+        new_key = torch.randn(3, 2, 1, 4)
+        key, _ = cache.update(new_key, torch.randn(3, 2, 1, 4), layer_idx=0)
+        self.assertTrue(torch.equal(key, torch.cat([legacy_key[:, :, :2], new_key], dim=2)))
+
+    @parameterized.expand(
+        [
+            ("hf-internal-testing/tiny-random-gpt2",),
+            ("hf-internal-testing/tiny-random-LlamaForCausalLM",),
+            ("hf-internal-testing/tiny-random-OPTForCausalLM",),
+        ]
+    )
+    def test_static_cache_generate_matches_default(self, model_name):
+        model = AutoModelForCausalLM.from_pretrained(model_name).to(torch_device)
+        model.config.eos_token_id = -1
+        model.generation_config.eos_token_id = -1
+        input_ids = torch.tensor([[3, 14, 15, 92, 6], [5, 35, 89, 79, 3]], device=torch_device)
+        attention_mask = torch.tensor([[0, 1, 1, 1, 1], [1, 1, 1, 1, 1]], device=torch_device)
+
+        for generation_kwargs in ({"do_sample": False}, {"do_sample": False, "num_beams": 2}):
+            expected = model.generate(input_ids, attention_mask=attention_mask, max_new_tokens=10, **generation_kwargs)
+            output = model.generate(
+                input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=10,
+                cache_implementation="static",
+                **generation_kwargs,
+            )
+            self.assertListEqual(output.tolist(), expected.tolist())
+
+    def test_static_cache_assisted_generate_matches_default(self):
+        model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2").to(torch_device)
+        assistant = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2").to(torch_device)
+        model.generation_config.eos_token_id = -1
+        input_ids = torch.tensor([[3, 14, 15, 92, 6]], device=torch_device)
+
+        expected = model.generate(input_ids, max_new_tokens=10, do_sample=False)
+        output = model.generate(
+            input_ids, max_new_tokens=10, do_sample=False, assistant_model=assistant, cache_implementation="static"
+        )
+        self.assertListEqual(output.tolist(), expected.tolist())
+
+    def test_unsupported_model_raises(self):
+        model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-BloomForCausalLM")
+        input_ids = torch.tensor([[3, 14, 15, 92, 6]])
+        with self.assertRaises(ValueError):
+            model.generate(input_ids, max_new_tokens=2, cache_implementation="static")
+
+
+@require_torch
+class PagedCacheTest(unittest.TestCase):
+    def test_update_matches_concatenation(self):
+        cache = PagedCache(block_size=2)
+        self.assertFalse(cache)
+
+        past_key = torch.randn(2, 4, 3, 8)
+        past_value = torch.randn(2, 4, 3, 8)
+        key, value = cache.update(past_key, past_value, layer_idx=0)
+        self.assertTrue(torch.equal(key, past_key))
+        self.assertTrue(torch.equal(value, past_value))
+
+        for _ in range(4):
+            new_key = torch.randn(2, 4, 1, 8)
+            new_value = torch.randn(2, 4, 1, 8)
+            key, value = cache.update(new_key, new_value, layer_idx=0)
+            past_key = torch.cat([past_key, new_key], dim=2)
+            past_value = torch.cat([past_value, new_value], dim=2)
+            self.assertTrue(torch.equal(key, past_key))
+            self.assertTrue(torch.equal(value, past_value))
+        self.assertEqual(cache.get_seq_length(), 7)
+        self.assertEqual(cache.num_used_blocks, 8)
+
+    def test_expanded_prompt_is_stored_once(self):
+        cache = PagedCache(block_size=2)
+        cache.expand_batch(3)
+
+        prompt_key = torch.randn(1, 2, 4, 4).repeat_interleave(3, dim=0)
+        prompt_value = torch.randn(1, 2, 4, 4).repeat_interleave(3, dim=0)
+        for layer_idx in range(2):
+            cache.update(prompt_key, prompt_value, layer_idx=layer_idx)
+        self.assertEqual(cache.num_used_blocks, 2)
+
+        new_key = torch.randn(3, 2, 1, 4)
+        for layer_idx in range(2):
+            key, _ = cache.update(new_key, torch.randn(3, 2, 1, 4), layer_idx=layer_idx)
+            self.assertTrue(torch.equal(key, torch.cat([prompt_key, new_key], dim=2)))
+        # each row only owns the block holding its new token
+        self.assertEqual(cache.num_used_blocks, 5)
+
+    def test_reorder_shares_blocks_and_copies_on_write(self):
+        cache = PagedCache(block_size=2)
+        key = torch.randn(3, 2, 3, 4)
+        value = torch.randn(3, 2, 3, 4)
+        cache.update(key, value, layer_idx=0)
+        self.assertEqual(cache.num_used_blocks, 6)
+
+        beam_idx = torch.tensor([2, 2, 0])
+        cache.reorder_cache(beam_idx)
+        # the blocks of the dropped row are freed, the ones of the duplicated row are shared
+        self.assertEqual(cache.num_used_blocks, 4)
+        legacy_key, legacy_value = cache.to_legacy_cache()[0]
+        self.assertTrue(torch.equal(legacy_key, key[beam_idx]))
+        self.assertTrue(torch.equal(legacy_value, value[beam_idx]))
+
+        # writing in the shared, partially filled, last block copies it
+        new_key = torch.randn(3, 2, 1, 4)
+        updated_key, _ = cache.update(new_key, torch.randn(3, 2, 1, 4), layer_idx=0)
+        self.assertTrue(torch.equal(updated_key, torch.cat([key[beam_idx], new_key], dim=2)))
+        self.assertEqual(cache.num_used_blocks, 5)
+
+    def test_crop_frees_blocks(self):
+        cache = PagedCache(block_size=2)
+        key = torch.randn(2, 2, 5, 4)
+        cache.update(key, torch.randn(2, 2, 5, 4), layer_idx=0)
+        self.assertEqual(cache.num_used_blocks, 6)
+
+        cache.crop(2)
+        self.assertEqual(cache.get_seq_length(), 2)
+        self.assertEqual(cache.num_used_blocks, 2)
+        new_key = torch.randn(2, 2, 1, 4)
+        updated_key, _ = cache.update(new_key, torch.randn(2, 2, 1, 4), layer_idx=0)
+        self.assertTrue(torch.equal(updated_key, torch.cat([key[:, :, :2], new_key], dim=2)))
+
+    def test_pool_grows(self):
+        cache = PagedCache(block_size=2, num_blocks=1)
+        key = torch.randn(2, 2, 5, 4)
+        updated_key, _ = cache.update(key, torch.randn(2, 2, 5, 4), layer_idx=0)
+        self.assertTrue(torch.equal(updated_key, key))
+        self.assertGreaterEqual(cache.num_blocks, 6)
+
+    @parameterized.expand(
+        [
+            ("gpt2",),
+            ("llama",),
+            ("gpt_neox",),
+            ("falcon",),
+            ("mpt",),
+        ]
+    )
+    def test_paged_cache_generate_matches_default(self, model_type):
+        configs = {
+            "gpt2": GPT2Config(vocab_size=99, n_embd=32, n_layer=2, n_head=4),
+            "llama": LlamaConfig(
+                vocab_size=99, hidden_size=32, intermediate_size=37, num_hidden_layers=2, num_attention_heads=4
+            ),
+            "gpt_neox": GPTNeoXConfig(
+                vocab_size=99, hidden_size=32, intermediate_size=37, num_hidden_layers=2, num_attention_heads=4
+            ),
+            "falcon": FalconConfig(vocab_size=99, hidden_size=32, num_hidden_layers=2, num_attention_heads=4),
+            "mpt": MptConfig(vocab_size=99, d_model=32, n_layers=2, n_heads=4),
+        }
+        torch.manual_seed(0)
+        model = AutoModelForCausalLM.from_config(configs[model_type]).to(torch_device).eval()
+        model.config.eos_token_id = -1
+        model.generation_config.eos_token_id = -1
+        input_ids = torch.tensor([[3, 14, 15, 92, 6], [5, 35, 89, 79, 3]], device=torch_device)
+        attention_mask = torch.tensor([[0, 1, 1, 1, 1], [1, 1, 1, 1, 1]], device=torch_device)
+
+        for generation_kwargs in (
+            {"do_sample": False},
+            {"do_sample": False, "num_beams": 3, "num_return_sequences": 2},
+            {"do_sample": True, "num_return_sequences": 3},
+        ):
+            torch.manual_seed(0)
+            expected = model.generate(input_ids, attention_mask=attention_mask, max_new_tokens=10, **generation_kwargs)
+            torch.manual_seed(0)
+            output = model.generate(
+                input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=10,
+                cache_implementation="paged",
+                **generation_kwargs,
+            )
+            self.assertListEqual(output.tolist(), expected.tolist())
+
+
+@require_torch
+class SinkCacheTest(unittest.TestCase):
+    def test_update_evicts_between_sinks_and_window(self):
+        cache = SinkCache(window_length=5, num_sink_tokens=2)
+        keys = torch.randn(1, 2, 8, 4)
+        values = torch.randn(1, 2, 8, 4)
+
+        key, _ = cache.update(keys[:, :, :4], values[:, :, :4], layer_idx=0)
+        self.assertTrue(torch.equal(key, keys[:, :, :4]))
+        self.assertEqual(cache.get_seq_length(), 4)
+
+        # the new tokens attend to all the cached ones, the eviction happens once they are cached
+        key, value = cache.update(keys[:, :, 4:7], values[:, :, 4:7], layer_idx=0)
+        self.assertTrue(torch.equal(key, keys[:, :, :7]))
+        self.assertTrue(torch.equal(value, values[:, :, :7]))
+        self.assertEqual(cache.get_seq_length(), 5)
+        self.assertEqual(cache.seen_tokens, 7)
+        self.assertEqual(cache.get_max_length(), 5)
+
+        # the mask over the whole sequence is mapped to the sinks, the window and the new tokens
+        attention_mask = torch.arange(8)[None, :]
+        self.assertListEqual(cache.select_attention_mask(attention_mask, 1).tolist(), [[0, 1, 4, 5, 6, 7]])
+        self.assertListEqual(cache.select_attention_mask(attention_mask[:, :6], 1).tolist(), [[0, 1, 2, 3, 4, 5]])
+
+        key, _ = cache.update(keys[:, :, 7:], values[:, :, 7:], layer_idx=0)
+        expected_key = torch.cat([keys[:, :, :2], keys[:, :, 4:8]], dim=2)
+        self.assertTrue(torch.equal(key, expected_key))
+        self.assertEqual(cache.get_seq_length(), 5)
+
+        with self.assertRaises(ValueError):
+            cache.crop(3)
+        with self.assertRaises(ValueError):
+            SinkCache(window_length=4, num_sink_tokens=4)
+
+    @parameterized.expand([("llama",), ("gpt_neox",), ("falcon",)])
+    def test_sink_cache_generate(self, model_type):
+        configs = {
+            "llama": LlamaConfig(
+                vocab_size=99, hidden_size=32, intermediate_size=37, num_hidden_layers=2, num_attention_heads=4
+            ),
+            "gpt_neox": GPTNeoXConfig(
+                vocab_size=99, hidden_size=32, intermediate_size=37, num_hidden_layers=2, num_attention_heads=4
+            ),
+            "falcon": FalconConfig(vocab_size=99, hidden_size=32, num_hidden_layers=2, num_attention_heads=4),
+        }
+        torch.manual_seed(0)
+        model = AutoModelForCausalLM.from_config(configs[model_type]).to(torch_device).eval()
+        model.config.eos_token_id = -1
+        model.generation_config.eos_token_id = -1
+        input_ids = torch.tensor([[3, 14, 15, 92, 6], [5, 35, 89, 79, 3]], device=torch_device)
+        attention_mask = torch.tensor([[0, 1, 1, 1, 1], [1, 1, 1, 1, 1]], device=torch_device)
+
+        # nothing is evicted while the sequences fit in the window
+        for generation_kwargs in ({"do_sample": False}, {"do_sample": False, "num_beams": 2}):
+            expected = model.generate(input_ids, attention_mask=attention_mask, max_new_tokens=10, **generation_kwargs)
+            output = model.generate(
+                input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=10,
+                cache_implementation="sink",
+                cache_window_length=16,
+                **generation_kwargs,
+            )
+            self.assertListEqual(output.tolist(), expected.tolist())
+
+        # past the window, the cache stays bounded
+        cache = SinkCache(window_length=8, num_sink_tokens=2)
+        output = model.generate(
+            input_ids, attention_mask=attention_mask, max_new_tokens=20, do_sample=False, past_key_values=cache
+        )
+        self.assertEqual(output.shape, (2, 25))
+        self.assertEqual(cache.get_seq_length(), 8)
+        self.assertEqual(cache.seen_tokens, 24)
+
+    def test_unsupported_model_raises(self):
+        model = AutoModelForCausalLM.from_pretrained("hf-internal-testing/tiny-random-gpt2")
+        input_ids = torch.tensor([[3, 14, 15, 92, 6]])
+        with self.assertRaises(ValueError):
+            model.generate(input_ids, max_new_tokens=2, cache_implementation="sink", cache_window_length=8)
+        with self.assertRaises(ValueError):
+            model.generate(input_ids, max_new_tokens=2, cache_implementation="sink")
+
+
+@require_torch
+class QuantizedCacheTest(unittest.TestCase):
+    @parameterized.expand([(8,), (4,)])
+    def test_update_quantizes_full_blocks(self, nbits):
+        cache = QuantizedCache(nbits=nbits, residual_length=4)
+        keys = torch.randn(2, 3, 10, 8)
+        values = torch.randn(2, 3, 10, 8)
+
+        # the states are returned in full precision on the update that adds them
+        key, value = cache.update(keys[:, :, :9], values[:, :, :9], layer_idx=0)
+        self.assertTrue(torch.equal(key, keys[:, :, :9]))
+        self.assertTrue(torch.equal(value, values[:, :, :9]))
+        self.assertEqual(cache.get_seq_length(), 9)
+        self.assertEqual(cache.quantized_key_cache[0][0].dtype, torch.uint8)
+        self.assertEqual(cache.quantized_key_cache[0][0].shape[-1], 8 * nbits // 8)
+        self.assertEqual(cache.key_cache[0].shape[-2], 1)
+
+        # the quantization error is bounded by half a quantization step
+        key, value = cache.update(keys[:, :, 9:], values[:, :, 9:], layer_idx=0)
+        max_key_error = (keys.amax(dim=-2) - keys.amin(dim=-2)).max() / (2**nbits - 1) / 2
+        max_value_error = (values.amax(dim=-1) - values.amin(dim=-1)).max() / (2**nbits - 1) / 2
+        self.assertLessEqual((key - keys).abs().max().item(), max_key_error.item() + 1e-6)
+        self.assertLessEqual((value - values).abs().max().item(), max_value_error.item() + 1e-6)
+        self.assertTrue(torch.equal(key[:, :, 8:], keys[:, :, 8:]))
+
+        # legacy conversion, cropping within a quantized block and reordering
+        self.assertTrue(torch.allclose(cache.to_legacy_cache()[0][0], key))
+        cache.crop(6)
+        self.assertEqual(cache.get_seq_length(), 6)
+        self.assertEqual(cache.quantized_key_cache[0][0].shape[2], 1)
+        self.assertTrue(torch.allclose(cache.to_legacy_cache()[0][0], key[:, :, :6]))
+        cache.reorder_cache(torch.tensor([1, 1, 0]))
+        self.assertTrue(torch.allclose(cache.to_legacy_cache()[0][1][2], value[0, :, :6]))
+
+    @parameterized.expand([("gpt2",), ("llama",), ("opt",), ("falcon",)])
+    def test_quantized_cache_matches_full_precision(self, model_type):
+        configs = {
+            "gpt2": GPT2Config(vocab_size=99, n_embd=32, n_layer=2, n_head=4),
+            "llama": LlamaConfig(
+                vocab_size=99, hidden_size=32, intermediate_size=37, num_hidden_layers=2, num_attention_heads=4
+            ),
+            "opt": OPTConfig(
+                vocab_size=99,
+                hidden_size=32,
+                ffn_dim=37,
+                num_hidden_layers=2,
+                num_attention_heads=4,
+                word_embed_proj_dim=32,
+            ),
+            "falcon": FalconConfig(vocab_size=99, hidden_size=32, num_hidden_layers=2, num_attention_heads=4),
+        }
+        torch.manual_seed(0)
+        model = AutoModelForCausalLM.from_config(configs[model_type]).to(torch_device).eval()
+        model.config.eos_token_id = -1
+        model.generation_config.eos_token_id = -1
+        input_ids = torch.randint(1, 99, (2, 12), device=torch_device)
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[0, :3] = 0
+
+        # with a residual buffer covering the whole generation, nothing is quantized
+        expected = model.generate(input_ids, attention_mask=attention_mask, max_new_tokens=10, do_sample=False)
+        output = model.generate(
+            input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=10,
+            do_sample=False,
+            cache_implementation="quantized",
+            cache_residual_length=32,
+        )
+        self.assertListEqual(output.tolist(), expected.tolist())
+
+        # accuracy of the next-token logits against the full precision forward pass, with all but the last
+        # token read from the quantized cache
+        sequences = torch.cat([input_ids, expected[:, 12:]], dim=-1)
+        full_attention_mask = torch.cat([attention_mask, torch.ones_like(expected[:, 12:])], dim=-1)
+        with torch.no_grad():
+            expected_logits = model(sequences, attention_mask=full_attention_mask).logits[:, -1]
+            for nbits, tolerance in ((8, 0.02), (4, 0.2)):
+                cache = QuantizedCache(nbits=nbits, residual_length=1)
+                model(sequences[:, :-1], attention_mask=full_attention_mask[:, :-1], past_key_values=cache)
+                self.assertEqual(cache.get_seq_length(), 21)
+                outputs = model(sequences[:, -1:], attention_mask=full_attention_mask, past_key_values=cache)
+                logits = outputs.logits[:, -1]
+                relative_error = (logits - expected_logits).abs().max() / expected_logits.abs().max()
+                self.assertLess(relative_error.item(), tolerance)